@@ -1,12 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request
 
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Literal, Dict, Any
+from typing import List, Optional, Literal, Dict, Any, Tuple, Set
 from datetime import datetime, timezone, timedelta
 
 # Local timezone for Pondok Pesantren (WIB / Asia-Jakarta, UTC+7)
@@ -22,14 +24,26 @@ def get_today_local_iso() -> str:
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import os
+import asyncio
 import logging
 import uuid
+import time
 import qrcode
 import io
 import base64
 import aiohttp
 import pandas as pd
+import csv
+import string
+from openpyxl import Workbook
 from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import hashlib
+import math
+import calendar
 import re
 import json
 
@@ -41,6 +55,7 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 WHATSAPP_BOT_URL = os.environ.get('WHATSAPP_BOT_URL')  # optional: URL service bot WA Web
+WHATSAPP_BOT_QUEUE_URL = os.environ.get('WHATSAPP_BOT_QUEUE_URL')  # optional: default <origin WHATSAPP_BOT_URL>/queue
 
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
@@ -155,7 +170,7 @@ class Santri(BaseModel):
     nama_wali: str
     nomor_hp_wali: str
     email_wali: Optional[str] = None
-    qr_code: str
+    qr_code: Optional[str] = None  # disimpan terpisah di koleksi santri_qr
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -423,8 +438,10 @@ class AbsensiResponse(BaseModel):
 
 class NFCAbsensiRequest(BaseModel):
     nfc_uid: str
-    waktu_sholat: str
+    # Kosong = ditentukan server dari jendela waktu sholat yang sedang berlangsung
+    waktu_sholat: Optional[str] = None
     status: Optional[str] = None
+    # Diabaikan: tanggal ditentukan server dari jendela waktu sholat
     tanggal: Optional[str] = None
 
 
@@ -485,6 +502,7 @@ class WaktuSholatResponse(BaseModel):
     maghrib: str
     isya: str
     lokasi: str
+    sumber: Optional[str] = None
 
 # ==================== MADRASAH DINIYAH MODELS ====================
 
@@ -623,6 +641,9 @@ class DailyWaliReport(BaseModel):
 class DailyWaliReportBatch(BaseModel):
     tanggal: str
     reports: List[DailyWaliReport]
+    # Diisi saat dikirim bertahap oleh job rekap harian
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
 
 
 
@@ -838,62 +859,98 @@ class MonitoringAliyahCreate(BaseModel):
 
 
 
-# Helper auth dependency for Pengabsen & Monitoring Aliyah (must be defined before endpoints)
+# ==================== PRINCIPAL RESOLVER ====================
 
-async def get_current_pengabsen_aliyah(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pengabsen_id: str = payload.get("sub")
-        if pengabsen_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+# Dependency get_current_* memanggil resolve_principal: decode JWT lalu ambil
+# akun dari cache TTL pendek. Cache per-proses dengan key (role, sub); handler
+# yang mengubah/menghapus akun atau meregenerasi kode_akses memanggil
+# invalidate_principal_cache. Invalidasi hanya berlaku di proses tersebut:
+# worker lain tetap memakai akun lama sampai PRINCIPAL_CACHE_TTL_SECONDS habis.
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+PRINCIPAL_CACHE_MAX_ENTRIES = 10000
 
-        pengabsen = await db.pengabsen_aliyah.find_one({"id": pengabsen_id}, {"_id": 0})
-        if pengabsen is None:
-            raise HTTPException(status_code=401, detail="Pengabsen Aliyah not found")
+# role -> (koleksi akun, pesan bila akun tidak ditemukan)
+PRINCIPAL_ROLES: Dict[str, Tuple[str, str]] = {
+    "admin": ("admins", "Admin not found"),
+    "pengabsen": ("pengabsen", "Pengabsen not found"),
+    "pembimbing": ("pembimbing", "Pembimbing tidak ditemukan"),
+    "wali": ("wali_santri", "Wali tidak ditemukan"),
+    "pengabsen_kelas": ("pengabsen_kelas", "Pengabsen kelas not found"),
+    "pembimbing_kelas": ("pembimbing_kelas", "Pembimbing kelas not found"),
+    "pengabsen_aliyah": ("pengabsen_aliyah", "Pengabsen Aliyah not found"),
+    "monitoring_aliyah": ("pembimbing_aliyah", "Monitoring Aliyah not found"),
+    "pengabsen_pmq": ("pengabsen_pmq", "Pengabsen PMQ not found"),
+}
 
-        return pengabsen
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+_principal_cache: Dict[Tuple[str, str], Tuple[float, dict]] = {}
+PRINCIPAL_CACHE_STATS: Dict[str, Dict[str, int]] = {
+    role: {"hits": 0, "misses": 0, "invalidations": 0} for role in PRINCIPAL_ROLES
+}
 
 
-async def get_current_monitoring_aliyah(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        monitoring_id: str = payload.get("sub")
-        if monitoring_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+def _prune_principal_cache(now: float) -> None:
+    expired = [k for k, (ts, _) in _principal_cache.items() if now - ts >= PRINCIPAL_CACHE_TTL_SECONDS]
+    for k in expired:
+        _principal_cache.pop(k, None)
 
-        monitoring = await db.pembimbing_aliyah.find_one({"id": monitoring_id}, {"_id": 0})
-        if monitoring is None:
-            raise HTTPException(status_code=401, detail="Monitoring Aliyah not found")
 
-        return monitoring
+async def resolve_principal(role: str, credentials: HTTPAuthorizationCredentials) -> dict:
+    """Decode JWT dan kembalikan dokumen akun untuk role tersebut."""
+    collection_name, not_found_detail = PRINCIPAL_ROLES[role]
+    try:
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+    sub: Optional[str] = payload.get("sub")
+    if sub is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+    key = (role, sub)
+    now = time.monotonic()
+    entry = _principal_cache.get(key)
+    if entry and now - entry[0] < PRINCIPAL_CACHE_TTL_SECONDS:
+        PRINCIPAL_CACHE_STATS[role]["hits"] += 1
+        return dict(entry[1])
 
-async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        admin_id: str = payload.get("sub")
-        if admin_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    PRINCIPAL_CACHE_STATS[role]["misses"] += 1
+    principal = await db[collection_name].find_one({"id": sub}, {"_id": 0})
+    if principal is None:
+        _principal_cache.pop(key, None)
+        raise HTTPException(status_code=401, detail=not_found_detail)
 
-        admin = await db.admins.find_one({"id": admin_id}, {"_id": 0})
-        if admin is None:
-            raise HTTPException(status_code=401, detail="Admin not found")
+    # Pastikan field role selalu ada di objek admin yang dikembalikan
+    if role == "admin" and "role" not in principal:
+        principal["role"] = payload.get("role", "superadmin")
 
-        # Pastikan field role selalu ada di objek admin yang dikembalikan
-        if "role" not in admin:
-            admin["role"] = payload.get("role", "superadmin")
+    if len(_principal_cache) >= PRINCIPAL_CACHE_MAX_ENTRIES:
+        _prune_principal_cache(now)
+    _principal_cache[key] = (now, principal)
+    return dict(principal)
+
+
+def invalidate_principal_cache(role: str, sub: Optional[str] = None) -> None:
+    """Buang cache akun di proses ini. Tanpa sub: seluruh akun role tersebut."""
+    keys = [k for k in _principal_cache if k[0] == role and (sub is None or k[1] == sub)]
+    for k in keys:
+        _principal_cache.pop(k, None)
+    if keys:
+        PRINCIPAL_CACHE_STATS[role]["invalidations"] += 1
 
-        return admin
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+# Helper auth dependency for Pengabsen & Monitoring Aliyah (must be defined before endpoints)
+
+async def get_current_pengabsen_aliyah(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("pengabsen_aliyah", credentials)
+
+
+async def get_current_monitoring_aliyah(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("monitoring_aliyah", credentials)
+
+
+
+async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("admin", credentials)
 
 # ==================== PMQ MODELS ====================
 
@@ -1092,6 +1149,7 @@ async def create_pmq_kelompok(payload: PMQKelompokCreate, _: dict = Depends(get_
     doc = kelompok.model_dump()
     doc["created_at"] = doc["created_at"].isoformat()
     await db.pmq_kelompok.insert_one(doc)
+    invalidate_reference_cache("pmq_kelompok")
     return PMQKelompokResponse(**kelompok.model_dump())
 
 
@@ -1112,6 +1170,7 @@ async def update_pmq_kelompok(kelompok_id: str, payload: PMQKelompokUpdate, _: d
         raise HTTPException(status_code=400, detail="Tidak ada data untuk diperbarui")
 
     await db.pmq_kelompok.update_one({"id": kelompok_id}, {"$set": update_data})
+    invalidate_reference_cache("pmq_kelompok")
     kelompok.update(update_data)
     created_at_val = kelompok.get("created_at")
     if isinstance(created_at_val, str):
@@ -1123,6 +1182,7 @@ async def update_pmq_kelompok(kelompok_id: str, payload: PMQKelompokUpdate, _: d
 @api_router.delete("/pmq/kelompok/{kelompok_id}")
 async def delete_pmq_kelompok(kelompok_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pmq_kelompok.delete_one({"id": kelompok_id})
+    invalidate_reference_cache("pmq_kelompok")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Kelompok PMQ tidak ditemukan")
     # Optionally, siswa_pmq yang refer ke kelompok ini bisa dibiarkan dengan kelompok_id None
@@ -1155,8 +1215,7 @@ async def get_siswa_pmq(
     docs = await db.siswa_pmq.find(query, {"_id": 0}).to_list(5000)
 
     # Join kelompok & tingkatan label
-    kelompok_docs = await db.pmq_kelompok.find({}, {"_id": 0}).to_list(1000)
-    kelompok_map = {k["id"]: k for k in kelompok_docs}
+    kelompok_map = {k["id"]: k for k in await get_reference_docs("pmq_kelompok")}
     tingkatan_map = {t["key"]: t["label"] for t in PMQ_TINGKATAN}
 
     results: List[SiswaPMQResponse] = []
@@ -1200,7 +1259,7 @@ async def get_santri_available_for_pmq(
     if search:
         santri_query["nama"] = {"$regex": search, "$options": "i"}
 
-    santri_docs = await db.santri.find(santri_query, {"_id": 0}).to_list(5000)
+    santri_docs = await db.santri.find(santri_query, ROSTER_PROJECTIONS["santri_admin"]).to_list(5000)
     available = [s for s in santri_docs if s["id"] not in used_santri_ids]
     return available
 
@@ -1232,9 +1291,8 @@ async def create_siswa_pmq(payload: SiswaPMQCreate, _: dict = Depends(get_curren
         if not santri:
             raise HTTPException(status_code=404, detail="Santri tidak ditemukan")
         data["nama"] = santri["nama"]
-        # Opsional: gunakan QR santri jika ada
-        if santri.get("qr_code"):
-            data["qr_code"] = santri["qr_code"]
+        # Opsional: gunakan QR santri
+        data["qr_code"] = (await get_santri_qr(santri))["qr_code"]
         # Bawa juga gender santri jika ada
         if santri.get("gender"):
             data["gender"] = santri["gender"]
@@ -1252,7 +1310,7 @@ async def create_siswa_pmq(payload: SiswaPMQCreate, _: dict = Depends(get_curren
 
     # Generate QR baru untuk siswa manual (tanpa santri_id) bila belum ada
     if not siswa.santri_id and not siswa.qr_code:
-        siswa.qr_code = generate_qr_code({"type": "siswa_pmq", "id": siswa.id})
+        siswa.qr_code = await generate_qr_code_async({"type": "siswa_pmq", "id": siswa.id})
 
     doc = siswa.model_dump()
     if isinstance(doc.get("created_at"), datetime):
@@ -1402,6 +1460,7 @@ async def update_pengabsen_pmq(pengabsen_id: str, payload: PengabsenPMQUpdate, _
 
     if data:
         await db.pengabsen_pmq.update_one({"id": pengabsen_id}, {"$set": data})
+        invalidate_principal_cache("pengabsen_pmq", pengabsen_id)
         pengabsen.update(data)
 
     created_at_val = pengabsen.get("created_at")
@@ -1428,6 +1487,7 @@ async def regenerate_kode_akses_pmq(pengabsen_id: str, _: dict = Depends(get_cur
 
     new_kode = generate_kode_akses()
     await db.pengabsen_pmq.update_one({"id": pengabsen_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pengabsen_pmq", pengabsen_id)
     pengabsen["kode_akses"] = new_kode
 
     created_at_val = pengabsen.get("created_at")
@@ -1483,12 +1543,10 @@ async def get_pmq_absensi_riwayat(
 
     # Ambil siswa & kelompok untuk enrichment
     siswa_ids = list({a["siswa_id"] for a in raw_list if a.get("siswa_id")})
-    siswa_list = await db.siswa_pmq.find({"id": {"$in": siswa_ids}}, {"_id": 0}).to_list(5000)
+    siswa_list = await db.siswa_pmq.find({"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_pmq_lean"]).to_list(5000)
     siswa_map = {s["id"]: s for s in siswa_list}
 
-    kelompok_ids = list({a.get("kelompok_id") for a in raw_list if a.get("kelompok_id")})
-    kelompok_list = await db.pmq_kelompok.find({"id": {"$in": kelompok_ids}}, {"_id": 0}).to_list(1000)
-    kelompok_map = {k["id"]: k for k in kelompok_list}
+    kelompok_map = {k["id"]: k for k in await get_reference_docs("pmq_kelompok")}
 
     tingkatan_map = {t["key"]: t["label"] for t in PMQ_TINGKATAN}
 
@@ -1531,6 +1589,7 @@ async def get_pmq_absensi_riwayat(
 @api_router.delete("/pmq/pengabsen/{pengabsen_id}")
 async def delete_pengabsen_pmq(pengabsen_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pengabsen_pmq.delete_one({"id": pengabsen_id})
+    invalidate_principal_cache("pengabsen_pmq", pengabsen_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pengabsen PMQ tidak ditemukan")
     return {"message": "Pengabsen PMQ berhasil dihapus"}
@@ -1544,8 +1603,11 @@ async def delete_pengabsen_pmq(pengabsen_id: str, _: dict = Depends(get_current_
 
 @api_router.get("/aliyah/pengabsen/absensi-hari-ini")
 async def get_aliyah_pengabsen_absensi_hari_ini(
+    request: Request,
+    response: Response,
     jenis: Literal["pagi", "dzuhur"],
     tanggal: Optional[str] = None,
+    since: Optional[str] = None,
     current_pengabsen: dict = Depends(get_current_pengabsen_aliyah),
 ):
     if not tanggal:
@@ -1555,7 +1617,15 @@ async def get_aliyah_pengabsen_absensi_hari_ini(
     if not kelas_ids:
         return {"tanggal": tanggal, "jenis": jenis, "data": []}
 
-    siswa_list = await db.siswa_aliyah.find({"kelas_id": {"$in": kelas_ids}}, {"_id": 0}).to_list(5000)
+    delta = await absensi_roster_delta(request, "aliyah", kelas_ids, tanggal, jenis, since)
+    if delta["not_modified"] is not None:
+        return delta["not_modified"]
+    response.headers.update(delta["headers"])
+
+    siswa_query: Dict[str, Any] = {"kelas_id": {"$in": kelas_ids}}
+    if delta["only_ids"] is not None:
+        siswa_query["id"] = {"$in": delta["only_ids"]}
+    siswa_list = await db.siswa_aliyah.find(siswa_query, ROSTER_PROJECTIONS["siswa_aliyah_lean"]).to_list(5000)
     siswa_by_id = {s["id"]: s for s in siswa_list}
 
     absensi_list = await db.absensi_aliyah.find(
@@ -1565,8 +1635,7 @@ async def get_aliyah_pengabsen_absensi_hari_ini(
 
     status_map = {a["siswa_id"]: a["status"] for a in absensi_list}
 
-    kelas_docs = await db.kelas_aliyah.find({"id": {"$in": kelas_ids}}, {"_id": 0}).to_list(1000)
-    kelas_map = {k["id"]: k["nama"] for k in kelas_docs}
+    kelas_map = await get_reference_map("kelas_aliyah")
 
     data = []
     for siswa in siswa_list:
@@ -1584,7 +1653,13 @@ async def get_aliyah_pengabsen_absensi_hari_ini(
 
     data.sort(key=lambda x: (x["kelas_nama"], x["nama"]))
 
-    return {"tanggal": tanggal, "jenis": jenis, "data": data}
+    return {
+        "tanggal": tanggal,
+        "jenis": jenis,
+        "data": data,
+        "delta": delta["only_ids"] is not None,
+        "version": delta["version"],
+    }
 
 
 class AliyahAbsensiUpsertRequest(BaseModel):
@@ -1618,37 +1693,19 @@ async def upsert_aliyah_absensi(
                 "jenis": payload.jenis,
             }
         )
+        emit_absensi_changes("absensi_aliyah", [payload.model_dump()], "delete")
         return {"message": "Absensi dihapus"}
 
-    existing = await db.absensi_aliyah.find_one(
+    await upsert_absensi_atomic(
+        "absensi_aliyah",
+        {"siswa_id": payload.siswa_id, "tanggal": payload.tanggal, "jenis": payload.jenis},
         {
-            "siswa_id": payload.siswa_id,
-            "tanggal": payload.tanggal,
-            "jenis": payload.jenis,
+            "status": payload.status,
+            "kelas_id": payload.kelas_id,
+            "waktu_absen": datetime.now(timezone.utc).isoformat(),
         },
-        {"_id": 0},
     )
 
-    now = datetime.now(timezone.utc)
-
-    if existing:
-        await db.absensi_aliyah.update_one(
-            {"id": existing["id"]},
-            {"$set": {"status": payload.status, "kelas_id": payload.kelas_id, "waktu_absen": now}},
-        )
-    else:
-        absensi = AbsensiAliyah(
-            siswa_id=payload.siswa_id,
-            kelas_id=payload.kelas_id,
-            tanggal=payload.tanggal,
-            jenis=payload.jenis,
-            status=payload.status,
-        )
-        doc = absensi.model_dump()
-        doc["created_at"] = doc["created_at"].isoformat()
-        doc["waktu_absen"] = now.isoformat()
-        await db.absensi_aliyah.insert_one(doc)
-
     return {"message": "Absensi disimpan"}
 
 
@@ -1712,53 +1769,21 @@ async def scan_aliyah_absensi(
 
     tanggal = get_today_local_iso()
 
-    existing = await db.absensi_aliyah.find_one(
+    await upsert_absensi_atomic(
+        "absensi_aliyah",
+        {"siswa_id": siswa["id"], "tanggal": tanggal, "jenis": jenis},
         {
-            "siswa_id": siswa["id"],
-            "tanggal": tanggal,
-            "jenis": jenis,
+            "status": "hadir",
+            "kelas_id": siswa.get("kelas_id"),
+            "waktu_absen": datetime.now(timezone.utc).isoformat(),
         },
-        {"_id": 0},
     )
 
-    now = datetime.now(timezone.utc)
-
-    if existing:
-        await db.absensi_aliyah.update_one(
-            {"id": existing["id"]},
-            {"$set": {"status": "hadir", "kelas_id": siswa.get("kelas_id"), "waktu_absen": now.isoformat()}},
-        )
-    else:
-        absensi = AbsensiAliyah(
-            siswa_id=siswa["id"],
-            kelas_id=siswa.get("kelas_id"),
-            tanggal=tanggal,
-            jenis=jenis,
-            status="hadir",
-        )
-        doc = absensi.model_dump()
-        doc["created_at"] = doc["created_at"].isoformat()
-        doc["waktu_absen"] = now.isoformat()
-        await db.absensi_aliyah.insert_one(doc)
-
 # ==================== AUTH PENGABSEN PMQ (PWA) ====================
 
 
 async def get_current_pengabsen_pmq(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pengabsen_id: str = payload.get("sub")
-        if pengabsen_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-        pengabsen = await db.pengabsen_pmq.find_one({"id": pengabsen_id}, {"_id": 0})
-        if pengabsen is None:
-            raise HTTPException(status_code=401, detail="Pengabsen PMQ not found")
-
-        return pengabsen
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return await resolve_principal("pengabsen_pmq", credentials)
 
 
 
@@ -1794,31 +1819,16 @@ async def pengabsen_pmq_absensi_nfc(
         raise HTTPException(status_code=403, detail="Siswa bukan kelompok yang Anda kelola")
 
     tanggal_final = tanggal or get_today_local_iso()
-    existing = await db.absensi_pmq.find_one({
-        "siswa_id": siswa["id"],
-        "tanggal": tanggal_final,
-        "sesi": sesi,
-    }, {"_id": 0})
-
-    now = datetime.now(timezone.utc)
-    if existing:
-        await db.absensi_pmq.update_one(
-            {"id": existing["id"]},
-            {"$set": {"status": "hadir", "waktu_absen": now.isoformat(), "pengabsen_id": current_pengabsen["id"]}},
-        )
-    else:
-        absensi = PMQAbsensi(
-            siswa_id=siswa["id"],
-            tanggal=tanggal_final,
-            sesi=sesi,
-            status="hadir",
-            kelompok_id=siswa.get("kelompok_id"),
-            pengabsen_id=current_pengabsen["id"],
-            waktu_absen=now.isoformat(),
-        )
-        doc = absensi.model_dump()
-        doc["created_at"] = doc["created_at"].isoformat()
-        await db.absensi_pmq.insert_one(doc)
+    await upsert_absensi_atomic(
+        "absensi_pmq",
+        {"siswa_id": siswa["id"], "tanggal": tanggal_final, "sesi": sesi},
+        {
+            "status": "hadir",
+            "waktu_absen": datetime.now(timezone.utc).isoformat(),
+            "pengabsen_id": current_pengabsen["id"],
+        },
+        {"kelompok_id": siswa.get("kelompok_id")},
+    )
 
     return {"message": "Absensi NFC berhasil dicatat", "siswa_nama": siswa.get("nama")}
 
@@ -1849,30 +1859,16 @@ async def pengabsen_aliyah_absensi_nfc(
     if siswa.get("kelas_id") not in kelas_ids:
         raise HTTPException(status_code=403, detail="Siswa ini bukan dari kelas yang Anda pegang")
 
-    existing = await db.absensi_aliyah.find_one(
+    await upsert_absensi_atomic(
+        "absensi_aliyah",
         {"siswa_id": siswa["id"], "tanggal": tanggal, "jenis": jenis},
-        {"_id": 0},
+        {
+            "status": "hadir",
+            "kelas_id": siswa.get("kelas_id"),
+            "waktu_absen": datetime.now(timezone.utc).isoformat(),
+        },
     )
 
-    now = datetime.now(timezone.utc)
-    if existing:
-        await db.absensi_aliyah.update_one(
-            {"id": existing["id"]},
-            {"$set": {"status": "hadir", "kelas_id": siswa.get("kelas_id"), "waktu_absen": now.isoformat()}},
-        )
-    else:
-        absensi = AbsensiAliyah(
-            siswa_id=siswa["id"],
-            kelas_id=siswa.get("kelas_id"),
-            tanggal=tanggal,
-            jenis=jenis,
-            status="hadir",
-        )
-        doc = absensi.model_dump()
-        doc["created_at"] = doc["created_at"].isoformat()
-        doc["waktu_absen"] = now.isoformat()
-        await db.absensi_aliyah.insert_one(doc)
-
     return {"message": "Absensi NFC berhasil dicatat", "siswa_nama": siswa.get("nama")}
 
 
@@ -1960,342 +1956,2533 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def send_wali_push_notification(wali: dict, title: str, body: str):
-    """Send FCM push notification to all tokens of a wali (if configured)."""
-    try:
-        tokens: list[str] = wali.get("fcm_tokens", []) or []
-        if not tokens:
-            return
+# ==================== HTTP CLIENT ====================
+
+# Satu aiohttp.ClientSession per proses untuk semua HTTP keluar (Aladhan, WA bot),
+# supaya koneksi (DNS/TCP/TLS) dipakai ulang. Batas pool, timeout default dan
+# kebijakan retry diatur di sini. Latensi per host dicatat sebagai histogram dan
+# ditampilkan di GET /admin/metrics.
+HTTP_CLIENT_POOL_LIMIT = int(os.environ.get("HTTP_CLIENT_POOL_LIMIT", "100"))
+HTTP_CLIENT_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_CLIENT_POOL_LIMIT_PER_HOST", "20"))
+HTTP_CLIENT_TIMEOUT_SECONDS = float(os.environ.get("HTTP_CLIENT_TIMEOUT_SECONDS", "30"))
+HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS = 10.0
+HTTP_CLIENT_MAX_RETRIES = int(os.environ.get("HTTP_CLIENT_MAX_RETRIES", "2"))
+HTTP_CLIENT_RETRY_BACKOFF_SECONDS = 0.5
+HTTP_CLIENT_RETRY_STATUSES = {502, 503, 504}
+HTTP_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_host_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CLIENT_POOL_LIMIT,
+            limit_per_host=HTTP_CLIENT_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=HTTP_CLIENT_TIMEOUT_SECONDS, connect=HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS
+            ),
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _record_http_call(host: str, started: float, status_code: Optional[int], retried: bool = False) -> None:
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = _http_host_stats.get(host)
+    if stats is None:
+        stats = _http_host_stats[host] = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "status": {},
+            "sum_ms": 0.0,
+            "buckets": [0] * (len(HTTP_LATENCY_BUCKETS_MS) + 1),
+        }
+    stats["requests"] += 1
+    stats["sum_ms"] += elapsed_ms
+    if retried:
+        stats["retries"] += 1
+    if status_code is None:
+        stats["errors"] += 1
+    else:
+        key = str(status_code)
+        stats["status"][key] = stats["status"].get(key, 0) + 1
+    for i, bound in enumerate(HTTP_LATENCY_BUCKETS_MS):
+        if elapsed_ms <= bound:
+            stats["buckets"][i] += 1
+            break
+    else:
+        stats["buckets"][-1] += 1
 
-        # Build individual messages for each token (firebase-admin 7.x uses send_each)
-        messages = [
-            messaging.Message(
-                notification=messaging.Notification(title=title, body=body),
-                token=token,
-            )
-            for token in tokens
-        ]
-        
-        # Send each message
-        response = messaging.send_each(messages)
-        logging.info(f"Sent FCM to wali {wali.get('id')} count={len(tokens)} success={response.success_count}")
-    except Exception as e:
-        logging.error(f"Failed to send FCM notification: {e}")
 
+@asynccontextmanager
+async def http_request(method: str, url: str, *, retry: Optional[bool] = None,
+                       timeout: Optional[float] = None, **kwargs):
+    """Request lewat session bersama; `async with http_request(...) as resp`.
 
-async def get_current_pengabsen(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pengabsen_id: str = payload.get("sub")
-        if pengabsen_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    Error koneksi/timeout dan status 502/503/504 dicoba ulang (backoff eksponensial)
+    untuk method idempoten, atau bila `retry=True`. Latensi dihitung sampai header diterima.
+    """
+    session = get_http_session()
+    if timeout is not None:
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout, connect=HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS)
+    if retry is None:
+        retry = method.upper() in ("GET", "HEAD", "OPTIONS")
+    attempts = HTTP_CLIENT_MAX_RETRIES + 1 if retry else 1
+    host = urlsplit(url).netloc
+
+    for attempt in range(1, attempts + 1):
+        started = time.perf_counter()
+        try:
+            resp = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            _record_http_call(host, started, None, retried=attempt > 1)
+            if attempt >= attempts:
+                raise
+            await asyncio.sleep(HTTP_CLIENT_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            continue
 
-        pengabsen = await db.pengabsen.find_one({"id": pengabsen_id}, {"_id": 0})
-        if pengabsen is None:
-            raise HTTPException(status_code=401, detail="Pengabsen not found")
+        _record_http_call(host, started, resp.status, retried=attempt > 1)
+        if resp.status in HTTP_CLIENT_RETRY_STATUSES and attempt < attempts:
+            resp.release()
+            await asyncio.sleep(HTTP_CLIENT_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            continue
+        try:
+            yield resp
+        finally:
+            resp.release()
+        return
 
-        return pengabsen
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+def http_client_stats() -> Dict[str, Any]:
+    labels = [f"le_{b}ms" for b in HTTP_LATENCY_BUCKETS_MS] + ["gt_10000ms"]
+    hosts = {}
+    for host, stats in _http_host_stats.items():
+        hosts[host] = {
+            "requests": stats["requests"],
+            "errors": stats["errors"],
+            "retries": stats["retries"],
+            "status": stats["status"],
+            "mean_ms": round(stats["sum_ms"] / stats["requests"], 1) if stats["requests"] else None,
+            "latency_histogram": dict(zip(labels, stats["buckets"])),
+        }
+    connector = _http_session.connector if _http_session is not None and not _http_session.closed else None
+    return {
+        "pool_limit": HTTP_CLIENT_POOL_LIMIT,
+        "pool_limit_per_host": HTTP_CLIENT_POOL_LIMIT_PER_HOST,
+        "timeout_seconds": HTTP_CLIENT_TIMEOUT_SECONDS,
+        "max_retries": HTTP_CLIENT_MAX_RETRIES,
+        "session_open": connector is not None,
+        "hosts": hosts,
+    }
 
 
+# ==================== FCM SENDER ====================
 
+# Pengiriman FCM terkumpul: pesan dari banyak wali digabung ke panggilan
+# send_each berisi maksimal 500 pesan, konten yang sama untuk banyak token
+# memakai send_each_for_multicast. SDK Firebase bersifat blocking sehingga
+# dijalankan di thread pool khusus agar event loop tidak tertahan.
+# Transport bisa diganti lewat `_fcm_transport` (tes/benchmark offline).
+FCM_BATCH_LIMIT = 500
+FCM_MULTICAST_MIN_TOKENS = 100
+FCM_SENDER_WORKERS = int(os.environ.get("FCM_SENDER_WORKERS", 4))
 
-async def get_current_pengabsen_kelas(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pengabsen_kelas_id: str = payload.get("sub")
-        if pengabsen_kelas_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+_fcm_thread_pool: Optional[ThreadPoolExecutor] = None
+_fcm_transport: Any = None
+_fcm_latencies_ms: deque = deque(maxlen=1000)
+FCM_SENDER_STATS: Dict[str, Any] = {
+    "calls": 0,
+    "multicast_calls": 0,
+    "messages": 0,
+    "success": 0,
+    "failure": 0,
+    "send_seconds": 0.0,
+}
 
-        pengabsen = await db.pengabsen_kelas.find_one({"id": pengabsen_kelas_id}, {"_id": 0})
-        if pengabsen is None:
-            raise HTTPException(status_code=401, detail="Pengabsen kelas not found")
 
-        return pengabsen
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+def get_fcm_transport() -> Any:
+    return _fcm_transport if _fcm_transport is not None else messaging
 
 
-async def get_current_pembimbing_kelas(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+def fcm_is_configured() -> bool:
+    return firebase_app is not None or _fcm_transport is not None
+
+
+def get_fcm_thread_pool() -> ThreadPoolExecutor:
+    global _fcm_thread_pool
+    if _fcm_thread_pool is None:
+        _fcm_thread_pool = ThreadPoolExecutor(max_workers=FCM_SENDER_WORKERS, thread_name_prefix="fcm-send")
+    return _fcm_thread_pool
+
+
+def _fcm_call(method: str, payload: Any, size: int) -> Tuple[List[Tuple[bool, Optional[str]]], float]:
+    """Satu panggilan SDK (blocking). Hasil per token (success, nama error) dan durasinya."""
+    started = time.perf_counter()
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pembimbing_kelas_id: str = payload.get("sub")
-        if pembimbing_kelas_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        response = getattr(get_fcm_transport(), method)(payload)
+        results = [(r.success, type(r.exception).__name__ if r.exception else None) for r in response.responses]
+    except Exception as e:
+        results = [(False, f"{type(e).__name__}: {e}")] * size
+    return results, time.perf_counter() - started
+
+
+def _record_fcm_call(method: str, results: List[Tuple[bool, Optional[str]]], elapsed: float) -> None:
+    _fcm_latencies_ms.append(elapsed * 1000)
+    success = sum(1 for ok, _ in results if ok)
+    FCM_SENDER_STATS["calls"] += 1
+    if method == "send_each_for_multicast":
+        FCM_SENDER_STATS["multicast_calls"] += 1
+    FCM_SENDER_STATS["messages"] += len(results)
+    FCM_SENDER_STATS["success"] += success
+    FCM_SENDER_STATS["failure"] += len(results) - success
+    FCM_SENDER_STATS["send_seconds"] += elapsed
+
+
+async def send_fcm_pushes(pushes: List[Tuple[List[str], str, str]]) -> List[List[Dict[str, Any]]]:
+    """Kirim banyak (tokens, title, body) sekaligus. Hasil per push, per token."""
+    loop = asyncio.get_running_loop()
+    pool = get_fcm_thread_pool()
+    results: List[List[Dict[str, Any]]] = [[] for _ in pushes]
+
+    by_content: Dict[Tuple[str, str], List[Tuple[int, str]]] = {}
+    for idx, (tokens, title, body) in enumerate(pushes):
+        for token in tokens:
+            by_content.setdefault((title, body), []).append((idx, token))
+
+    calls = []  # (method, future, [(push_idx, token), ...])
+    single: List[Tuple[int, str, Tuple[str, str]]] = []
+    for (title, body), targets in by_content.items():
+        if len(targets) < FCM_MULTICAST_MIN_TOKENS:
+            single.extend((idx, token, (title, body)) for idx, token in targets)
+            continue
+        notification = messaging.Notification(title=title, body=body)
+        for i in range(0, len(targets), FCM_BATCH_LIMIT):
+            chunk = targets[i:i + FCM_BATCH_LIMIT]
+            multicast = messaging.MulticastMessage(notification=notification, tokens=[t for _, t in chunk])
+            calls.append((
+                "send_each_for_multicast",
+                loop.run_in_executor(pool, _fcm_call, "send_each_for_multicast", multicast, len(chunk)),
+                chunk,
+            ))
+
+    for i in range(0, len(single), FCM_BATCH_LIMIT):
+        chunk = single[i:i + FCM_BATCH_LIMIT]
+        messages = [
+            messaging.Message(notification=messaging.Notification(title=title, body=body), token=token)
+            for _, token, (title, body) in chunk
+        ]
+        calls.append((
+            "send_each",
+            loop.run_in_executor(pool, _fcm_call, "send_each", messages, len(chunk)),
+            [(idx, token) for idx, token, _ in chunk],
+        ))
 
-        pembimbing = await db.pembimbing_kelas.find_one({"id": pembimbing_kelas_id}, {"_id": 0})
-        if pembimbing is None:
-            raise HTTPException(status_code=401, detail="Pembimbing kelas not found")
+    outcomes = await asyncio.gather(*(fut for _, fut, _ in calls))
+    for (method, _, targets), (outcome, elapsed) in zip(calls, outcomes):
+        _record_fcm_call(method, outcome, elapsed)
+        for (idx, token), (success, error) in zip(targets, outcome):
+            results[idx].append({"token": token, "success": success, "error": error})
+    return results
 
-        return pembimbing
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+def fcm_sender_stats() -> Dict[str, Any]:
+    latencies = sorted(_fcm_latencies_ms)
 
-def generate_kode_akses() -> str:
-    """Generate random 9-digit access code for Pembimbing"""
-    import random
-    return ''.join([str(random.randint(0, 9)) for _ in range(9)])
+    def pct(p: float) -> Optional[float]:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1) if latencies else None
 
+    send_seconds = FCM_SENDER_STATS["send_seconds"]
+    return {
+        **FCM_SENDER_STATS,
+        "send_seconds": round(send_seconds, 3),
+        "transport": "firebase" if _fcm_transport is None else type(_fcm_transport).__name__,
+        "workers": FCM_SENDER_WORKERS,
+        "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": round(latencies[-1], 1) if latencies else None},
+        "messages_per_second": round(FCM_SENDER_STATS["messages"] / send_seconds, 1) if send_seconds else None,
+    }
 
-def generate_qr_code(data: dict) -> str:
-    import json
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(json.dumps(data))
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    
-    return img_str
 
-def generate_username(nama: str, nomor_hp: str) -> str:
-    """Generate username dari nama dan nomor HP"""
-    # Ambil nama depan dan bersihkan
-    nama_clean = re.sub(r'[^a-zA-Z]', '', nama.split()[0].lower())
-    # Ambil 4 digit terakhir HP
-    hp_suffix = nomor_hp[-4:] if len(nomor_hp) >= 4 else nomor_hp
-    return f"{nama_clean}{hp_suffix}"
+# ==================== NOTIFICATION OUTBOX ====================
 
-async def sync_wali_santri():
-    """Sinkronisasi data wali dari santri - termasuk menghapus wali tanpa anak"""
-    # Aggregate santri by wali
-    pipeline = [
+# Endpoint absensi hanya menulis satu entri ke notification_outbox; dispatcher
+# di background yang memilih wali, merender template, mengirim FCM, mencatat
+# hasil per token, dan membuang token yang sudah tidak terdaftar. Event untuk
+# wali yang sama di dalam jendela coalesce_seconds digabung jadi satu pesan.
+NOTIFICATION_DISPATCH_INTERVAL_SECONDS = float(os.environ.get("NOTIFICATION_DISPATCH_INTERVAL_SECONDS", "2"))
+NOTIFICATION_BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", "100"))
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_BACKOFF_BASE_SECONDS = 5
+NOTIFICATION_BACKOFF_MAX_SECONDS = 300
+NOTIFICATION_LOCK_TIMEOUT_SECONDS = 300
+NOTIFICATION_RETENTION_DAYS = 7
+
+# Error FCM yang berarti token tidak akan pernah valid lagi
+FCM_DEAD_TOKEN_ERRORS = ("UnregisteredError", "SenderIdMismatchError")
+
+NOTIFICATION_STATS: Dict[str, int] = {
+    "enqueued": 0,
+    "sent": 0,
+    "skipped": 0,
+    "superseded": 0,
+    "digests": 0,
+    "retried": 0,
+    "failed": 0,
+    "tokens_success": 0,
+    "tokens_failed": 0,
+    "tokens_pruned": 0,
+}
+
+_notification_dispatcher_task: Optional[asyncio.Task] = None
+
+
+async def enqueue_absensi_notification(santri: dict, tanggal: str, waktu_sholat: str, status_absen: str) -> None:
+    """Catat notifikasi absensi sholat untuk wali; pengiriman dilakukan dispatcher."""
+    await enqueue_absensi_notifications([(santri, tanggal, waktu_sholat, status_absen)])
+
+
+async def enqueue_absensi_notifications(events: List[Tuple[dict, str, str, str]]) -> None:
+    """Versi batch: satu insert_many untuk banyak (santri, tanggal, waktu_sholat, status)."""
+    if not events:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    docs = [
         {
-            "$group": {
-                "_id": {
-                    "nama_wali": "$nama_wali",
-                    "nomor_hp_wali": "$nomor_hp_wali"
-                },
-                "email_wali": {"$first": "$email_wali"},
-                "nama_anak": {"$push": "$nama"},
-                "anak_ids": {"$push": "$id"},
-                "jumlah_anak": {"$sum": 1},
-                "first_created": {"$min": "$created_at"}
-            }
+            "id": str(uuid.uuid4()),
+            "kind": "absensi_sholat",
+            "santri_id": santri["id"],
+            "santri_nama": santri.get("nama", ""),
+            "tanggal": tanggal,
+            "waktu_sholat": waktu_sholat,
+            "status_absen": status_absen,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now,
         }
+        for santri, tanggal, waktu_sholat, status_absen in events
     ]
-    
-    wali_groups = await db.santri.aggregate(pipeline).to_list(1000)
-    
-    # Collect valid wali IDs from current santri
-    valid_wali_ids = set()
-    
-    for group in wali_groups:
-        nama_wali = group["_id"]["nama_wali"]
-        nomor_hp = group["_id"]["nomor_hp_wali"]
-        email = group.get("email_wali")
-        anak_ids = group.get("anak_ids", [])
-        
-        # Generate wali_id
-        wali_id = f"wali_{nomor_hp}"
-        valid_wali_ids.add(wali_id)
-        
-        # Check if wali exists
-        existing_wali = await db.wali_santri.find_one({"id": wali_id}, {"_id": 0})
-        
-        if existing_wali:
-            # Update existing
-            await db.wali_santri.update_one(
-                {"id": wali_id},
-                {
-                    "$set": {
-                        "nama": nama_wali,
-                        "nomor_hp": nomor_hp,
-                        "email": email,
-                        "jumlah_anak": group["jumlah_anak"],
-                        "nama_anak": group["nama_anak"],
-                        "anak_ids": anak_ids,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }
-                }
-            )
-        else:
-            # Create new
-            username = generate_username(nama_wali, nomor_hp)
-            # Check username uniqueness
-            counter = 1
-            original_username = username
-            while await db.wali_santri.find_one({"username": username}):
-                username = f"{original_username}{counter}"
-                counter += 1
-            
-            wali_doc = {
-                "id": wali_id,
-                "nama": nama_wali,
-                "username": username,
-                "password_hash": hash_password("12345"),  # default password
-                "nomor_hp": nomor_hp,
-                "email": email,
-                "jumlah_anak": group["jumlah_anak"],
-                "nama_anak": group["nama_anak"],
-                "anak_ids": anak_ids,
-                "created_at": group["first_created"],
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.wali_santri.insert_one(wali_doc)
-    
-    # Delete wali yang tidak punya santri lagi
-    if valid_wali_ids:
-        # Delete all wali whose ID is NOT in the valid set
-        delete_result = await db.wali_santri.delete_many({"id": {"$nin": list(valid_wali_ids)}})
-        if delete_result.deleted_count > 0:
-            logging.info(f"Deleted {delete_result.deleted_count} wali without santri")
-    else:
-        # No santri at all, delete all wali
-        delete_result = await db.wali_santri.delete_many({})
-        if delete_result.deleted_count > 0:
-            logging.info(f"Deleted all {delete_result.deleted_count} wali (no santri left)")
-
-async def fetch_prayer_times(date: str) -> Optional[dict]:
     try:
-        url = "http://api.aladhan.com/v1/timingsByAddress"
-        params = {
-            "address": "Desa Cintamulya, Candipuro, Lampung Selatan, Lampung, Indonesia",
-            "method": 2,
-            "date": date
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    timings = data['data']['timings']
-                    return {
-                        'subuh': timings['Fajr'],
-                        'dzuhur': timings['Dhuhr'],
-                        'ashar': timings['Asr'],
-                        'maghrib': timings['Maghrib'],
-                        'isya': timings['Isha']
-                    }
-        return None
+        await db.notification_outbox.insert_many(docs, ordered=False)
+        NOTIFICATION_STATS["enqueued"] += len(docs)
     except Exception as e:
-        logging.error(f"Error fetching prayer times: {e}")
-        return None
+        logging.error(f"Failed to enqueue wali notification: {e}")
 
-# ==================== DAILY WHATSAPP REPORT ENDPOINT ====================
 
-@api_router.post("/notifications/whatsapp/daily-report", dependencies=[Depends(get_current_admin)])
-async def trigger_daily_whatsapp_report(tanggal: Optional[str] = None):
-    """Bangun rekap absensi sholat per wali untuk 1 hari dan kirim ke WA Bot service.
+def _notification_backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(NOTIFICATION_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), NOTIFICATION_BACKOFF_MAX_SECONDS))
 
-    Endpoint ini TIDAK mengirim WhatsApp langsung, hanya memanggil service bot eksternal
-    melalui WHATSAPP_BOT_URL (kalau diset). Kalau tidak diset, hanya mengembalikan
-    payload yang akan dikirim, supaya mudah dites.
-    """
-    if not tanggal:
-        tanggal = get_today_local_iso()
 
-    # Ambil semua absensi sholat (koleksi 'absensi') pada tanggal tsb
-    absensi_list = await db.absensi.find({"tanggal": tanggal}, {"_id": 0}).to_list(100000)
-    if not absensi_list:
-        return {"tanggal": tanggal, "reports": [], "message": "Tidak ada data absensi untuk tanggal ini"}
+async def _claim_notifications(query: dict, limit: int) -> List[dict]:
+    """Klaim entri outbox satu per satu secara atomik (aman untuk beberapa worker)."""
+    now = datetime.now(timezone.utc).isoformat()
+    claimed: List[dict] = []
+    for _ in range(limit):
+        doc = await db.notification_outbox.find_one_and_update(
+            query,
+            {"$set": {"status": "sending", "locked_at": now}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            break
+        doc.pop("_id", None)
+        claimed.append(doc)
+    return claimed
 
-    # Ambil semua santri yang muncul di absensi
-    santri_ids = list({a["santri_id"] for a in absensi_list if a.get("santri_id")})
-    santri_docs = await db.santri.find({"id": {"$in": santri_ids}}, {"_id": 0}).to_list(len(santri_ids))
-    santri_map = {s["id"]: s for s in santri_docs}
 
-    # Ambil kelas untuk info nama kelas
-    asrama_ids = list({s["asrama_id"] for s in santri_docs if s.get("asrama_id")})
-    asrama_docs = await db.asrama.find({"id": {"$in": asrama_ids}}, {"_id": 0}).to_list(len(asrama_ids))
-    asrama_map = {a["id"]: a["nama"] for a in asrama_docs}
+async def _claim_notification_batch(limit: int, coalesce_seconds: int) -> List[dict]:
+    """Entri jatuh tempo: event yang sudah melewati jendela coalescing, retry, atau lock basi."""
+    now = datetime.now(timezone.utc)
+    stale_lock = (now - timedelta(seconds=NOTIFICATION_LOCK_TIMEOUT_SECONDS)).isoformat()
+    coalesce_cutoff = (now - timedelta(seconds=coalesce_seconds)).isoformat()
+    return await _claim_notifications(
+        {
+            "$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": coalesce_cutoff}},
+                {"status": "retry", "next_attempt_at": {"$lte": now.isoformat()}},
+                {"status": "sending", "locked_at": {"$lt": stale_lock}},
+            ]
+        },
+        limit,
+    )
 
-    # Group per wali -> per anak -> per waktu sholat
-    per_wali: Dict[str, Dict[str, Any]] = {}
 
-    for rec in absensi_list:
-        santri = santri_map.get(rec["santri_id"])
-        if not santri:
-            continue
+async def _load_wali_notification_settings() -> Tuple[Dict[str, str], int]:
+    """Template per status dan jendela coalescing (detik) dari settings wali_notifikasi."""
+    settings_doc = await db.settings.find_one({"id": "wali_notifikasi"}, {"_id": 0}) or {}
+    defaults = WaliNotifikasiSettings().model_dump()
+    coalesce_seconds = int(settings_doc.get("coalesce_seconds", defaults.pop("coalesce_seconds")))
+    templates = {status: settings_doc.get(status, template) for status, template in defaults.items()}
+    return templates, max(coalesce_seconds, 0)
 
-        wali_nomor = santri.get("nomor_hp_wali")
-        wali_nama = santri.get("nama_wali")
-        if not wali_nomor:
-            continue
 
-        wali_key = wali_nomor
-        if wali_key not in per_wali:
-            per_wali[wali_key] = {
-                "wali_nama": wali_nama or "Wali Santri",
-                "wali_nomor": wali_nomor,
-                "anak": {},
-            }
+async def _prune_dead_fcm_tokens(tokens: List[str]) -> None:
+    if not tokens:
+        return
+    result = await db.wali_santri.update_many(
+        {"fcm_tokens": {"$in": tokens}}, {"$pull": {"fcm_tokens": {"$in": tokens}}}
+    )
+    NOTIFICATION_STATS["tokens_pruned"] += len(tokens)
+    invalidate_principal_cache("wali")
+    logging.info(f"Pruned {len(tokens)} dead FCM tokens from {result.modified_count} wali")
+
+
+async def _deliver_pushes(pushes: List[Tuple[List[str], str, str]]) -> List[Tuple[List[Dict[str, Any]], List[str]]]:
+    """Kirim banyak pesan sekaligus. Per push: (hasil per token, token gagal sementara)."""
+    all_results = await send_fcm_pushes(pushes)
+    delivered = []
+    dead: List[str] = []
+    for results in all_results:
+        dead.extend(r["token"] for r in results if r["error"] in FCM_DEAD_TOKEN_ERRORS)
+        transient = [r["token"] for r in results if not r["success"] and r["error"] not in FCM_DEAD_TOKEN_ERRORS]
+        success_count = sum(1 for r in results if r["success"])
+        NOTIFICATION_STATS["tokens_success"] += success_count
+        NOTIFICATION_STATS["tokens_failed"] += len(results) - success_count
+        delivered.append((results, transient))
+    try:
+        await _prune_dead_fcm_tokens(list(dict.fromkeys(dead)))
+    except Exception as e:
+        # Push sudah terkirim; gagal membuang token tidak boleh memicu kirim ulang
+        logging.error(f"Failed to prune dead FCM tokens: {e}")
+    return delivered
 
-        anak_key = santri["id"]
-        if anak_key not in per_wali[wali_key]["anak"]:
-            per_wali[wali_key]["anak"][anak_key] = {
-                "nama": santri["nama"],
-                "kelas": asrama_map.get(santri.get("asrama_id"), "-"),
-                "subuh": "-",
-                "dzuhur": "-",
-                "ashar": "-",
-                "maghrib": "-",
-                "isya": "-",
-            }
 
-        waktu = rec.get("waktu_sholat")
-        status = rec.get("status")
-        if waktu in ["subuh", "dzuhur", "ashar", "maghrib", "isya"] and status:
-            per_wali[wali_key]["anak"][anak_key][waktu] = status
+def _result_log(results: List[Dict[str, Any]], attempt: int, **extra: Any) -> List[Dict[str, Any]]:
+    # Simpan hanya akhiran token agar log outbox tidak membocorkan token utuh
+    return [
+        {"attempt": attempt, "token": r["token"][-12:], "success": r["success"], "error": r["error"], **extra}
+        for r in results
+    ]
 
-    reports: List[DailyWaliReport] = []
-    for wali in per_wali.values():
-        anak_items = [
-            DailyWaliReportAnak(**anak) for anak in wali["anak"].values()
-        ]
 
-        reports.append(
-            DailyWaliReport(
-                wali_nama=wali["wali_nama"],
-                wali_nomor=wali["wali_nomor"],
-                tanggal=tanggal,
-                anak=anak_items,
-            )
-        )
+async def _schedule_digest_retry(wali_id: str, title: str, body: str, tokens: List[str],
+                                 attempts: int, event_ids: List[str]) -> None:
+    now = datetime.now(timezone.utc)
+    await db.notification_outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "kind": "wali_digest",
+        "wali_id": wali_id,
+        "title": title,
+        "body": body,
+        "tokens": tokens,
+        "event_ids": event_ids,
+        "status": "retry",
+        "attempts": attempts,
+        "next_attempt_at": (now + _notification_backoff(attempts)).isoformat(),
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+    })
+    NOTIFICATION_STATS["retried"] += 1
+
+
+async def _dispatch_digest_retries(entries: List[dict], settled: Set[str]) -> None:
+    """Kirim ulang digest yang sebelumnya gagal sementara, hanya ke token yang gagal."""
+    delivered = await _deliver_pushes([(e.get("tokens", []), e["title"], e["body"]) for e in entries])
+    settled.update(e["id"] for e in entries)
+    for entry, (results, transient) in zip(entries, delivered):
+        attempts = entry.get("attempts", 0) + 1
+        update: Dict[str, Any] = {
+            "attempts": attempts,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "results": entry.get("results", []) + _result_log(results, attempts),
+        }
+        if transient and attempts < NOTIFICATION_MAX_ATTEMPTS:
+            update.update({
+                "status": "retry",
+                "tokens": transient,
+                "next_attempt_at": (datetime.now(timezone.utc) + _notification_backoff(attempts)).isoformat(),
+            })
+            NOTIFICATION_STATS["retried"] += 1
+        elif transient:
+            update.update({"status": "failed", "last_error": f"{len(transient)} token gagal setelah {attempts} percobaan"})
+            NOTIFICATION_STATS["failed"] += 1
+        else:
+            update.update({"status": "sent", "sent_at": update["updated_at"]})
+            NOTIFICATION_STATS["sent"] += 1
+        await db.notification_outbox.update_one({"id": entry["id"]}, {"$set": update, "$unset": {"locked_at": ""}})
 
-    batch = DailyWaliReportBatch(tanggal=tanggal, reports=reports)
 
-    # Kalau env WA bot tidak diset, hanya kembalikan payload (untuk debugging)
-    if not WHATSAPP_BOT_URL:
-        return {"whatsapp_bot_url": None, "payload": batch.model_dump()}
+# Error dari str.format untuk template admin yang rusak ({nama2}, {0}, kurung kurawal tak berpasangan)
+TEMPLATE_RENDER_ERRORS = (KeyError, IndexError, ValueError, AttributeError)
 
-    # Kirim ke WA Bot service via HTTP POST
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(WHATSAPP_BOT_URL, json=batch.model_dump()) as resp:
-                text = await resp.text()
-                return {
-                    "whatsapp_bot_url": WHATSAPP_BOT_URL,
-                    "status_code": resp.status,
-                    "response_text": text,
-                    "payload_count": len(reports),
-                }
-    except Exception as e:
-        logging.error(f"Gagal mengirim ke WhatsApp Bot: {e}")
-        return {
-            "whatsapp_bot_url": WHATSAPP_BOT_URL,
-            "error": str(e),
-            "payload": batch.model_dump(),
-        }
 
+def _render_wali_digest(events: List[dict], templates: Dict[str, str]) -> Optional[Tuple[str, str]]:
+    """Gabungkan event absensi beberapa anak/waktu menjadi satu (title, body)."""
+    lines = []
+    for e in events:
+        template = templates.get(e.get("status_absen"))
+        if template:
+            lines.append(template.format(nama=e.get("santri_nama", ""), waktu=e.get("waktu_sholat", "")))
+    if not lines:
+        return None
+    waktu_set = {e.get("waktu_sholat", "") for e in events}
+    title = f"Absensi Sholat {waktu_set.pop().capitalize()}" if len(waktu_set) == 1 else "Absensi Sholat"
+    return title, "\n".join(lines)
 
 
-# ==================== AUTHENTIKASI PENGABSEN (PWA - Kode Akses) ====================
+async def _dispatch_absensi_events(events: List[dict], templates: Dict[str, str], settled: Set[str]) -> None:
+    """Kirim digest per wali. Event saudara yang ikut diklaim ditambahkan ke `events`;
+    id event yang push-nya sudah terkirim dicatat di `settled`."""
+    now_iso = datetime.now(timezone.utc).isoformat()
 
-@api_router.post("/pengabsen/login", response_model=PengabsenTokenResponse)
-async def login_pengabsen(request: PengabsenLoginRequest):
-    pengabsen = await db.pengabsen.find_one({"username": request.username}, {"_id": 0})
+    # Wali dari event yang jatuh tempo; event saudara (anak lain dari wali yang sama)
+    # yang masih di dalam jendela coalescing ikut diklaim agar terkirim dalam satu pesan.
+    wali_list = await db.wali_santri.find(
+        {"anak_ids": {"$in": list({e["santri_id"] for e in events})}},
+        {"_id": 0, "id": 1, "anak_ids": 1, "fcm_tokens": 1},
+    ).to_list(1000)
+    sibling_ids = list({sid for w in wali_list for sid in w.get("anak_ids", [])})
+    if sibling_ids:
+        events.extend(await _claim_notifications(
+            {"status": "pending", "kind": "absensi_sholat", "santri_id": {"$in": sibling_ids}},
+            NOTIFICATION_BATCH_SIZE,
+        ))
 
-    if not pengabsen:
-        raise HTTPException(
+    # Status yang sudah digantikan (mis. hadir -> masbuq) tidak perlu dikirim
+    latest: Dict[Tuple[str, str, str], dict] = {}
+    superseded: List[str] = []
+    for e in sorted(events, key=lambda x: x.get("created_at", "")):
+        key = (e["santri_id"], e.get("tanggal", ""), e.get("waktu_sholat", ""))
+        if key in latest:
+            superseded.append(latest[key]["id"])
+        latest[key] = e
+    if superseded:
+        await db.notification_outbox.update_many(
+            {"id": {"$in": superseded}},
+            {"$set": {"status": "superseded", "updated_at": now_iso}, "$unset": {"locked_at": ""}},
+        )
+        NOTIFICATION_STATS["superseded"] += len(superseded)
+    live = list(latest.values())
+    live_by_santri: Dict[str, List[dict]] = {}
+    for e in live:
+        live_by_santri.setdefault(e["santri_id"], []).append(e)
+
+    # Satu digest per wali; semua digest dikirim bersama dalam batch FCM
+    digests: List[Tuple[dict, List[dict], str, str, List[str]]] = []
+    render_errors: Dict[str, str] = {}
+    configured = fcm_is_configured()
+    for wali in wali_list:
+        wali_events = [e for sid in wali.get("anak_ids", []) for e in live_by_santri.get(sid, [])]
+        tokens = list(dict.fromkeys(wali.get("fcm_tokens", []) or []))
+        if not wali_events or not tokens or not configured:
+            continue
+        try:
+            rendered = _render_wali_digest(wali_events, templates)
+        except TEMPLATE_RENDER_ERRORS as e:
+            logging.error(f"Invalid wali notification template for wali {wali['id']}: {e!r}")
+            render_errors.update((ev["id"], f"Template notifikasi tidak valid: {e!r}") for ev in wali_events)
+            continue
+        if rendered is None:
+            continue
+        digests.append((wali, wali_events, rendered[0], rendered[1], tokens))
+
+    outcome: Dict[str, Dict[str, Any]] = {e["id"]: {"results": [], "delivered": False} for e in live}
+    delivered = await _deliver_pushes([(tokens, title, body) for _, _, title, body, tokens in digests])
+    settled.update(e["id"] for _, wali_events, *_ in digests for e in wali_events)
+    for (wali, wali_events, title, body, _), (results, transient) in zip(digests, delivered):
+        NOTIFICATION_STATS["digests"] += 1
+        event_ids = [e["id"] for e in wali_events]
+        if transient:
+            await _schedule_digest_retry(wali["id"], title, body, transient, 1, event_ids)
+        for eid in event_ids:
+            outcome[eid]["results"].extend(_result_log(results, 1, wali_id=wali["id"]))
+            outcome[eid]["delivered"] = True
+
+    for e in live:
+        update: Dict[str, Any] = {"attempts": e.get("attempts", 0) + 1, "updated_at": now_iso}
+        if outcome[e["id"]]["delivered"]:
+            update.update({"status": "sent", "sent_at": now_iso, "results": outcome[e["id"]]["results"]})
+            NOTIFICATION_STATS["sent"] += 1
+        else:
+            update.update({
+                "status": "skipped",
+                "last_error": "FCM belum dikonfigurasi" if not configured
+                else render_errors.get(e["id"], "Tidak ada wali bertoken FCM atau template untuk status ini"),
+            })
+            NOTIFICATION_STATS["skipped"] += 1
+        await db.notification_outbox.update_one({"id": e["id"]}, {"$set": update, "$unset": {"locked_at": ""}})
+
+
+async def dispatch_notification_batch() -> int:
+    """Proses satu batch outbox. Mengembalikan jumlah entri yang diklaim dari antrean jatuh tempo."""
+    templates, coalesce_seconds = await _load_wali_notification_settings()
+    entries = await _claim_notification_batch(NOTIFICATION_BATCH_SIZE, coalesce_seconds)
+    if not entries:
+        return 0
+
+    events = [e for e in entries if e.get("kind") == "absensi_sholat"]
+    digests = [e for e in entries if e.get("kind") == "wali_digest"]
+    settled: Set[str] = set()
+    if events:
+        try:
+            await _dispatch_absensi_events(events, templates, settled)
+        except Exception as e:
+            logging.error(f"Failed to dispatch absensi notifications: {e}")
+            await _settle_failed_notifications(events, settled, str(e))
+    if digests:
+        try:
+            await _dispatch_digest_retries(digests, settled)
+        except Exception as e:
+            logging.error(f"Failed to dispatch notification digests: {e}")
+            await _settle_failed_notifications(digests, settled, str(e))
+    return len(entries)
+
+
+async def _settle_failed_notifications(entries: List[dict], settled: Set[str], error: str) -> None:
+    """Pembukuan entri yang masih `sending` setelah dispatch gagal.
+
+    Entri yang push-nya sudah terkirim ditandai sent agar tidak dikirim dua kali;
+    sisanya dijadwalkan retry dengan backoff, atau failed setelah NOTIFICATION_MAX_ATTEMPTS.
+    Jika pembukuan ini pun gagal, entri diklaim ulang setelah NOTIFICATION_LOCK_TIMEOUT_SECONDS.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        sent_ids = [e["id"] for e in entries if e["id"] in settled]
+        if sent_ids:
+            await db.notification_outbox.update_many(
+                {"id": {"$in": sent_ids}, "status": "sending"},
+                {"$set": {"status": "sent", "sent_at": now.isoformat(), "updated_at": now.isoformat()},
+                 "$unset": {"locked_at": ""}},
+            )
+        for entry in entries:
+            if entry["id"] in settled:
+                continue
+            attempts = entry.get("attempts", 0) + 1
+            update: Dict[str, Any] = {"attempts": attempts, "updated_at": now.isoformat(), "last_error": error[:500]}
+            if attempts < NOTIFICATION_MAX_ATTEMPTS:
+                update.update({"status": "retry", "next_attempt_at": (now + _notification_backoff(attempts)).isoformat()})
+                NOTIFICATION_STATS["retried"] += 1
+            else:
+                update["status"] = "failed"
+                NOTIFICATION_STATS["failed"] += 1
+            await db.notification_outbox.update_one(
+                {"id": entry["id"], "status": "sending"}, {"$set": update, "$unset": {"locked_at": ""}}
+            )
+    except Exception as e:
+        logging.error(f"Failed to record notification dispatch failure: {e}")
+
+
+async def prune_notification_outbox() -> int:
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=NOTIFICATION_RETENTION_DAYS)).isoformat()
+    result = await db.notification_outbox.delete_many(
+        {"status": {"$in": ["sent", "skipped", "failed"]}, "updated_at": {"$lt": cutoff}}
+    )
+    return result.deleted_count
+
+
+async def notification_dispatcher_loop() -> None:
+    last_prune = 0.0
+    last_job_sweep = time.monotonic()
+    while True:
+        try:
+            processed = await dispatch_notification_batch()
+            if time.monotonic() - last_job_sweep > WHATSAPP_REPORT_HEARTBEAT_SECONDS:
+                # Job rekap WA: heartbeat job milik worker ini, klaim ulang job yatim
+                last_job_sweep = time.monotonic()
+                await heartbeat_whatsapp_report_jobs()
+                resumed = await resume_stale_whatsapp_report_jobs()
+                if resumed:
+                    logging.info(f"Melanjutkan {resumed} job rekap WhatsApp yang terhenti")
+                # Job export: sama, tetapi job yatim ditandai failed (file parsial tidak dilanjutkan)
+                await heartbeat_export_jobs()
+                orphaned = await fail_orphaned_export_jobs()
+                if orphaned:
+                    logging.info(f"Menandai {orphaned} job export yatim sebagai failed")
+            if time.monotonic() - last_prune > 3600:
+                pruned = await prune_notification_outbox()
+                if pruned:
+                    logging.info(f"Pruned {pruned} old notification_outbox entries")
+                last_prune = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Notification dispatcher error: {e}")
+            processed = 0
+        # Batch penuh: langsung lanjut tanpa menunggu interval
+        if processed < NOTIFICATION_BATCH_SIZE:
+            await asyncio.sleep(NOTIFICATION_DISPATCH_INTERVAL_SECONDS)
+
+
+async def get_current_pengabsen(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("pengabsen", credentials)
+
+
+
+
+
+async def get_current_pengabsen_kelas(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("pengabsen_kelas", credentials)
+
+
+async def get_current_pembimbing_kelas(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("pembimbing_kelas", credentials)
+
+
+def generate_kode_akses() -> str:
+    """Generate random 9-digit access code for Pembimbing"""
+    import random
+    return ''.join([str(random.randint(0, 9)) for _ in range(9)])
+
+
+def generate_qr_code(data: dict) -> str:
+    import json
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(json.dumps(data))
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    img_str = base64.b64encode(buffer.getvalue()).decode()
+    
+    return img_str
+
+# ==================== REFERENCE DATA CACHE ====================
+
+# Data referensi (asrama, kelas, pengabsen, kelompok PMQ) jarang berubah tetapi
+# dibaca di hampir setiap endpoint untuk membangun map id -> nama. Cache ini
+# per-proses: handler create/update/delete memanggil invalidate_reference_cache,
+# dan TTL membatasi umur data bila ada worker lain yang menulis.
+REFERENCE_CACHE_TTL_SECONDS = int(os.environ.get("REFERENCE_CACHE_TTL_SECONDS", "300"))
+
+REFERENCE_PROJECTIONS: Dict[str, dict] = {
+    "asrama": {"_id": 0},
+    "kelas": {"_id": 0},
+    "kelas_aliyah": {"_id": 0},
+    "pengabsen": {"_id": 0, "kode_akses": 0},
+    "pmq_kelompok": {"_id": 0},
+}
+
+_reference_cache: Dict[str, Tuple[float, List[dict]]] = {}
+_reference_locks: Dict[str, asyncio.Lock] = {}
+REFERENCE_CACHE_STATS: Dict[str, Dict[str, int]] = {
+    name: {"hits": 0, "misses": 0, "invalidations": 0} for name in REFERENCE_PROJECTIONS
+}
+
+
+async def _load_reference_docs(name: str) -> List[dict]:
+    entry = _reference_cache.get(name)
+    if entry and time.monotonic() - entry[0] < REFERENCE_CACHE_TTL_SECONDS:
+        REFERENCE_CACHE_STATS[name]["hits"] += 1
+        return entry[1]
+
+    lock = _reference_locks.setdefault(name, asyncio.Lock())
+    async with lock:
+        # Request lain mungkin sudah mengisi ulang selagi menunggu lock
+        entry = _reference_cache.get(name)
+        if entry and time.monotonic() - entry[0] < REFERENCE_CACHE_TTL_SECONDS:
+            REFERENCE_CACHE_STATS[name]["hits"] += 1
+            return entry[1]
+
+        REFERENCE_CACHE_STATS[name]["misses"] += 1
+        docs = await db[name].find({}, REFERENCE_PROJECTIONS[name]).to_list(10000)
+        _reference_cache[name] = (time.monotonic(), docs)
+        return docs
+
+
+async def get_reference_docs(name: str) -> List[dict]:
+    """Semua dokumen referensi (salinan, aman dimodifikasi pemanggil)."""
+    return [dict(doc) for doc in await _load_reference_docs(name)]
+
+
+async def get_reference_map(name: str, field: str = "nama") -> Dict[str, Any]:
+    """Map id -> field untuk koleksi referensi, dilayani dari cache."""
+    return {doc["id"]: doc.get(field) for doc in await _load_reference_docs(name) if "id" in doc}
+
+
+def invalidate_reference_cache(*names: str) -> None:
+    for name in names:
+        if _reference_cache.pop(name, None) is not None:
+            REFERENCE_CACHE_STATS[name]["invalidations"] += 1
+
+
+# ==================== ROSTER PROJECTIONS ====================
+
+# Proyeksi bernama untuk dokumen roster (santri & siswa). Query laporan/riwayat
+# cukup memakai varian *_lean supaya qr_code base64 dan data wali tidak ikut
+# terbaca untuk setiap baris. Lihat tests/test_roster_projections.py.
+_SANTRI_LEAN_FIELDS = {"_id": 0, "id": 1, "nama": 1, "nis": 1, "gender": 1, "asrama_id": 1}
+
+ROSTER_PROJECTIONS = {
+    "santri_lean": _SANTRI_LEAN_FIELDS,
+    "santri_with_wali": {**_SANTRI_LEAN_FIELDS, "nama_wali": 1, "nomor_hp_wali": 1, "email_wali": 1},
+    "santri_admin": {"_id": 0, "qr_code": 0},
+    "siswa_madrasah_lean": {
+        "_id": 0, "id": 1, "nama": 1, "nis": 1, "gender": 1, "jenis_kelamin": 1,
+        "kelas_id": 1, "santri_id": 1,
+    },
+    "siswa_aliyah_lean": {"_id": 0, "id": 1, "nama": 1, "nis": 1, "gender": 1, "kelas_id": 1, "santri_id": 1},
+    "siswa_pmq_lean": {
+        "_id": 0, "id": 1, "nama": 1, "gender": 1, "tingkatan_key": 1, "kelompok_id": 1, "santri_id": 1,
+    },
+}
+
+# ==================== QR RENDER POOL & CACHE ====================
+
+# Render QR (qrcode + PIL) CPU-bound, jadi tidak boleh jalan langsung di event loop.
+# - QR satuan (create santri/siswa): thread pool kecil dengan jumlah worker terbatas.
+# - QR massal (import): process pool, dipecah per chunk.
+# Hasil disimpan di cache LRU berbasis hash isi payload, sehingga payload yang sama
+# (id/nama/nis sama) tidak pernah dirender ulang.
+QR_THREAD_WORKERS = int(os.environ.get("QR_THREAD_WORKERS", 2))
+QR_PROCESS_WORKERS = int(os.environ.get("QR_PROCESS_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+QR_RENDER_CHUNK_SIZE = 100
+QR_CACHE_MAX_ENTRIES = int(os.environ.get("QR_CACHE_MAX_ENTRIES", 4096))
+
+_qr_thread_pool: Optional[ThreadPoolExecutor] = None
+_qr_process_pool: Optional[ProcessPoolExecutor] = None
+_qr_cache: "OrderedDict[str, str]" = OrderedDict()
+QR_CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def get_qr_thread_pool() -> ThreadPoolExecutor:
+    global _qr_thread_pool
+    if _qr_thread_pool is None:
+        _qr_thread_pool = ThreadPoolExecutor(max_workers=QR_THREAD_WORKERS, thread_name_prefix="qr-render")
+    return _qr_thread_pool
+
+
+def get_qr_process_pool() -> ProcessPoolExecutor:
+    global _qr_process_pool
+    if _qr_process_pool is None:
+        _qr_process_pool = ProcessPoolExecutor(max_workers=QR_PROCESS_WORKERS)
+    return _qr_process_pool
+
+
+def qr_cache_key(data: dict) -> str:
+    """Kunci cache = sha256 dari isi QR persis seperti yang di-encode."""
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def _qr_cache_get(key: str) -> Optional[str]:
+    qr = _qr_cache.get(key)
+    if qr is None:
+        QR_CACHE_STATS["misses"] += 1
+        return None
+    _qr_cache.move_to_end(key)
+    QR_CACHE_STATS["hits"] += 1
+    return qr
+
+
+def _qr_cache_put(key: str, qr: str):
+    _qr_cache[key] = qr
+    _qr_cache.move_to_end(key)
+    while len(_qr_cache) > QR_CACHE_MAX_ENTRIES:
+        _qr_cache.popitem(last=False)
+
+
+def generate_qr_codes_batch(payloads: List[dict]) -> List[str]:
+    """Render beberapa QR sekaligus (dijalankan di worker process)."""
+    return [generate_qr_code(p) for p in payloads]
+
+
+async def generate_qr_code_async(data: dict) -> str:
+    """Versi async generate_qr_code: cek cache, lalu render di thread pool."""
+    key = qr_cache_key(data)
+    cached = _qr_cache_get(key)
+    if cached is not None:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    qr = await loop.run_in_executor(get_qr_thread_pool(), generate_qr_code, data)
+    _qr_cache_put(key, qr)
+    return qr
+
+
+async def render_qr_codes_bulk(payloads: List[dict]) -> List[str]:
+    """Render QR untuk banyak payload di process pool, urutan hasil = urutan input."""
+    if not payloads:
+        return []
+
+    keys = [qr_cache_key(p) for p in payloads]
+    results: List[Optional[str]] = [_qr_cache_get(k) for k in keys]
+    missing = [i for i, qr in enumerate(results) if qr is None]
+
+    if missing:
+        loop = asyncio.get_running_loop()
+        pool = get_qr_process_pool()
+        chunks = [missing[i:i + QR_RENDER_CHUNK_SIZE] for i in range(0, len(missing), QR_RENDER_CHUNK_SIZE)]
+        rendered = await asyncio.gather(
+            *[
+                loop.run_in_executor(pool, generate_qr_codes_batch, [payloads[i] for i in chunk])
+                for chunk in chunks
+            ]
+        )
+        for chunk, chunk_result in zip(chunks, rendered):
+            for i, qr in zip(chunk, chunk_result):
+                results[i] = qr
+                _qr_cache_put(keys[i], qr)
+
+    return results  # type: ignore[return-value]
+
+# QR santri disimpan di koleksi terpisah `santri_qr` (bukan di dokumen roster),
+# supaya query daftar/laporan santri tidak ikut membawa PNG base64 berukuran KB.
+def santri_qr_payload(santri: dict) -> dict:
+    return {"santri_id": santri["id"], "nama": santri.get("nama"), "nis": santri.get("nis")}
+
+
+def santri_qr_doc(santri_id: str, qr_code: str) -> dict:
+    return {
+        "santri_id": santri_id,
+        "qr_code": qr_code,
+        "etag": hashlib.sha256(qr_code.encode()).hexdigest()[:32],
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+async def get_santri_qr(santri: dict) -> dict:
+    """Ambil QR santri dari santri_qr; render dan simpan bila belum ada."""
+    stored = await db.santri_qr.find_one({"santri_id": santri["id"]}, {"_id": 0})
+    if stored:
+        return stored
+
+    qr_code = santri.get("qr_code") or await generate_qr_code_async(santri_qr_payload(santri))
+    doc = santri_qr_doc(santri["id"], qr_code)
+    await db.santri_qr.update_one({"santri_id": santri["id"]}, {"$setOnInsert": doc}, upsert=True)
+    return doc
+
+def generate_username(nama: str, nomor_hp: str) -> str:
+    """Generate username dari nama dan nomor HP"""
+    # Ambil nama depan dan bersihkan
+    nama_clean = re.sub(r'[^a-zA-Z]', '', nama.split()[0].lower())
+    # Ambil 4 digit terakhir HP
+    hp_suffix = nomor_hp[-4:] if len(nomor_hp) >= 4 else nomor_hp
+    return f"{nama_clean}{hp_suffix}"
+
+# ==================== ABSENSI WRITE HELPERS ====================
+
+# Natural key tiap koleksi absensi (dijaga unique index di INDEX_PLAN)
+ABSENSI_NATURAL_KEYS: Dict[str, List[str]] = {
+    "absensi": ["santri_id", "waktu_sholat", "tanggal"],
+    "absensi_kelas": ["siswa_id", "tanggal"],
+    "absensi_aliyah": ["siswa_id", "tanggal", "jenis"],
+    "absensi_pmq": ["siswa_id", "tanggal", "sesi"],
+}
+
+
+def _absensi_upsert_update(
+    key: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    insert_fields: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    now_iso = datetime.now(timezone.utc).isoformat()
+    # updated_at menandai perubahan baris untuk delta sync PWA (lihat /pengabsen/sync);
+    # upsert "insert saja" tidak menyentuh baris yang sudah ada.
+    set_fields = {**set_fields, "updated_at": now_iso} if set_fields else {}
+    on_insert: Dict[str, Any] = {
+        "id": str(uuid.uuid4()),
+        "created_at": now_iso,
+        "updated_at": now_iso,
+        **(insert_fields or {}),
+    }
+    for field in list(set_fields.keys()) + list(key.keys()):
+        on_insert.pop(field, None)
+
+    update: Dict[str, Any] = {"$setOnInsert": on_insert}
+    if set_fields:
+        update["$set"] = set_fields
+    return update
+
+
+async def upsert_absensi_atomic(
+    collection_name: str,
+    key: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    insert_fields: Optional[Dict[str, Any]] = None,
+) -> Optional[dict]:
+    """Upsert satu baris absensi secara atomik berdasarkan natural key.
+
+    Hanya satu round trip ke Mongo (find_one_and_update + upsert), sehingga dua
+    pengabsen yang scan santri yang sama bersamaan tidak menghasilkan baris ganda.
+    `set_fields` selalu ditulis; `insert_fields` hanya saat baris baru dibuat.
+    Mengembalikan dokumen sebelum perubahan, atau None jika baris baru dibuat.
+    """
+    update = _absensi_upsert_update(key, set_fields, insert_fields)
+
+    collection = db[collection_name]
+    try:
+        existing = await collection.find_one_and_update(
+            key, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Upsert bersamaan pada key yang sama: insert kalah di unique index,
+        # ulangi sekali - sekarang dokumen sudah ada sehingga menjadi update biasa.
+        existing = await collection.find_one_and_update(
+            key, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    if collection_name in ABSENSI_EVENT_SCOPES:
+        emit_absensi_changes(collection_name, [{**(existing or {}), **(insert_fields or {}), **(set_fields or {}), **key}])
+    return existing
+
+
+def absensi_key_tuple(collection_name: str, doc: Dict[str, Any]) -> tuple:
+    return tuple(doc.get(f) for f in ABSENSI_NATURAL_KEYS[collection_name])
+
+
+async def bulk_upsert_absensi(
+    collection_name: str,
+    items: List[Tuple[Dict[str, Any], Dict[str, Any], Optional[Dict[str, Any]]]],
+) -> Dict[tuple, Optional[dict]]:
+    """Upsert banyak baris absensi dengan satu find + satu bulk_write.
+
+    `items` berisi (key, set_fields, insert_fields) dengan key = natural key koleksi.
+    Mengembalikan {key tuple: dokumen lama (status & natural key) atau None bila baru}.
+    Update baris yang sudah ada disyaratkan status yang dibaca masih sama, dan baris
+    baru harus benar-benar ter-insert, sehingga tanpa penulis lain dokumen lama
+    persis sama dengan yang ditimpa. Bila ada tulis bersamaan (scan tunggal/NFC/batch
+    lain), semua item diterapkan ulang tanpa syarat dan rollup tanggalnya ditandai
+    untuk dibangun ulang karena selisih counter tidak lagi bisa dipastikan.
+    """
+    if not items:
+        return {}
+    key_fields = ABSENSI_NATURAL_KEYS[collection_name]
+    collection = db[collection_name]
+    projection = {"_id": 0, "status": 1, **{f: 1 for f in key_fields}}
+    existing_docs = await collection.find(
+        {"$or": [key for key, _, _ in items]}, projection
+    ).to_list(len(items))
+    existing = {absensi_key_tuple(collection_name, d): d for d in existing_docs}
+
+    updates = [_absensi_upsert_update(key, set_fields, insert_fields) for key, set_fields, insert_fields in items]
+    ops = []
+    expected_inserts = set()
+    for index, ((key, _, _), update) in enumerate(zip(items, updates)):
+        current = existing.get(absensi_key_tuple(collection_name, key))
+        if current:
+            ops.append(UpdateOne({**key, "status": current.get("status")}, update))
+        else:
+            expected_inserts.add(index)
+            ops.append(UpdateOne(key, update, upsert=True))
+    try:
+        result = await collection.bulk_write(ops, ordered=False)
+        matched, upserted = result.matched_count, set(result.upserted_ids or {})
+    except BulkWriteError as e:
+        # Insert yang kalah balapan di unique index: ditangani sebagai tulis bersamaan
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        matched, upserted = e.details.get("nMatched", 0), {u["index"] for u in e.details.get("upserted", [])}
+
+    if upserted != expected_inserts or matched != len(items) - len(expected_inserts):
+        unguarded = [UpdateOne(key, update, upsert=True) for (key, _, _), update in zip(items, updates)]
+        try:
+            await collection.bulk_write(unguarded, ordered=False)
+        except BulkWriteError as e:
+            retry = [unguarded[err["index"]] for err in e.details.get("writeErrors", []) if err.get("code") == 11000]
+            if len(retry) != len(e.details.get("writeErrors", [])):
+                raise
+            await collection.bulk_write(retry, ordered=False)
+        if collection_name == "absensi":
+            await mark_absensi_rollup_stale([key["tanggal"] for key, _, _ in items])
+
+    if collection_name in ABSENSI_EVENT_SCOPES:
+        emit_absensi_changes(
+            collection_name, [{**(insert_fields or {}), **set_fields, **key} for key, set_fields, insert_fields in items]
+        )
+    return {absensi_key_tuple(collection_name, key): existing.get(absensi_key_tuple(collection_name, key)) for key, _, _ in items}
+
+
+# ==================== ABSENSI ROLLUP HARIAN ====================
+
+# Counter per (tanggal, asrama_id, waktu_sholat) untuk laporan ringkasan, supaya
+# tidak perlu menghitung ulang puluhan ribu baris absensi di setiap request.
+ROLLUP_STATUS_LIST = ["hadir", "alfa", "sakit", "izin", "haid", "istihadhoh", "masbuq"]
+
+
+async def apply_absensi_rollup(
+    tanggal: str,
+    asrama_id: Optional[str],
+    waktu_sholat: str,
+    old_status: Optional[str],
+    new_status: Optional[str],
+):
+    """Geser counter rollup dari old_status ke new_status ($inc, upsert).
+
+    old_status None = baris baru, new_status None = baris dihapus.
+    Kegagalan hanya dicatat di log; data bisa dipulihkan via rebuild.
+    """
+    if old_status == new_status:
+        return
+
+    inc: Dict[str, int] = {}
+    if old_status in ROLLUP_STATUS_LIST:
+        inc[old_status] = inc.get(old_status, 0) - 1
+        inc["total"] = inc.get("total", 0) - 1
+    if new_status in ROLLUP_STATUS_LIST:
+        inc[new_status] = inc.get(new_status, 0) + 1
+        inc["total"] = inc.get("total", 0) + 1
+    inc = {k: v for k, v in inc.items() if v != 0}
+    if not inc:
+        return
+
+    try:
+        await db.absensi_rollup_harian.update_one(
+            {"tanggal": tanggal, "asrama_id": asrama_id, "waktu_sholat": waktu_sholat},
+            {"$inc": inc, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+        )
+    except Exception as e:
+        logging.error(f"Gagal update rollup absensi {tanggal}/{asrama_id}/{waktu_sholat}: {e}")
+    emit_absensi_changes(
+        "absensi_rollup_harian", [{"tanggal": tanggal, "asrama_id": asrama_id, "waktu_sholat": waktu_sholat}]
+    )
+
+
+async def apply_absensi_rollup_bulk(
+    changes: List[Tuple[str, Optional[str], str, Optional[str], Optional[str]]],
+):
+    """Versi batch apply_absensi_rollup: (tanggal, asrama_id, waktu_sholat, old, new) digabung per key."""
+    incs: Dict[tuple, Dict[str, int]] = {}
+    for tanggal, asrama_id, waktu_sholat, old_status, new_status in changes:
+        if old_status == new_status:
+            continue
+        inc = incs.setdefault((tanggal, asrama_id, waktu_sholat), {})
+        if old_status in ROLLUP_STATUS_LIST:
+            inc[old_status] = inc.get(old_status, 0) - 1
+            inc["total"] = inc.get("total", 0) - 1
+        if new_status in ROLLUP_STATUS_LIST:
+            inc[new_status] = inc.get(new_status, 0) + 1
+            inc["total"] = inc.get("total", 0) + 1
+
+    now_iso = datetime.now(timezone.utc).isoformat()
+    ops = []
+    keys = []
+    for (tanggal, asrama_id, waktu_sholat), inc in incs.items():
+        inc = {k: v for k, v in inc.items() if v != 0}
+        if inc:
+            key = {"tanggal": tanggal, "asrama_id": asrama_id, "waktu_sholat": waktu_sholat}
+            ops.append(UpdateOne(key, {"$inc": inc, "$set": {"updated_at": now_iso}}, upsert=True))
+            keys.append(key)
+    if not ops:
+        return
+    try:
+        await db.absensi_rollup_harian.bulk_write(ops, ordered=False)
+    except Exception as e:
+        logging.error(f"Gagal update rollup absensi (batch {len(ops)}): {e}")
+    emit_absensi_changes("absensi_rollup_harian", keys)
+
+
+def _rollup_dates(tanggal_start: str, tanggal_end: str) -> List[str]:
+    start, end = datetime.fromisoformat(tanggal_start), datetime.fromisoformat(tanggal_end)
+    return [(start + timedelta(days=i)).date().isoformat() for i in range((end - start).days + 1)]
+
+
+async def _aggregate_absensi_rollup(tanggal_start: str, tanggal_end: str, now_iso: str) -> Dict[tuple, Dict[str, Any]]:
+    """Rollup dihitung dari baris absensi mentah: {(tanggal, asrama_id, waktu_sholat): dokumen}."""
+    pipeline = [
+        {"$match": {"tanggal": {"$gte": tanggal_start, "$lte": tanggal_end}}},
+        {
+            "$lookup": {
+                "from": "santri",
+                "localField": "santri_id",
+                "foreignField": "id",
+                "as": "santri",
+            }
+        },
+        {"$unwind": {"path": "$santri", "preserveNullAndEmptyArrays": True}},
+        {
+            "$group": {
+                "_id": {
+                    "tanggal": "$tanggal",
+                    "asrama_id": "$santri.asrama_id",
+                    "waktu_sholat": "$waktu_sholat",
+                    "status": "$status",
+                },
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+
+    rollups: Dict[tuple, Dict[str, Any]] = {}
+    async for row in db.absensi.aggregate(pipeline, allowDiskUse=True):
+        key_doc = row["_id"]
+        status = key_doc.get("status")
+        if status not in ROLLUP_STATUS_LIST:
+            continue
+        key = (key_doc.get("tanggal"), key_doc.get("asrama_id"), key_doc.get("waktu_sholat"))
+        doc = rollups.setdefault(
+            key,
+            {
+                "tanggal": key[0],
+                "asrama_id": key[1],
+                "waktu_sholat": key[2],
+                "total": 0,
+                **{st: 0 for st in ROLLUP_STATUS_LIST},
+                "updated_at": now_iso,
+            },
+        )
+        doc[status] += row["count"]
+        doc["total"] += row["count"]
+    return rollups
+
+
+async def rebuild_absensi_rollup(tanggal_start: str, tanggal_end: Optional[str] = None) -> Dict[str, Any]:
+    """Hitung ulang rollup dari koleksi absensi untuk rentang tanggal (inklusif).
+
+    Hook scan tetap boleh $inc selama rebuild: tiap key ditulis dengan ReplaceOne
+    yang hanya berlaku bila counter belum disentuh sejak rebuild dimulai, dan key
+    yang tidak lagi muncul dihapus dengan syarat yang sama. Tanggal yang tersentuh
+    hook di tengah rebuild tidak ditandai tercakup, sehingga dibangun ulang lagi
+    saat dibaca berikutnya.
+    """
+    if not tanggal_end:
+        tanggal_end = tanggal_start
+
+    started = datetime.now(timezone.utc).isoformat()
+    rollups = await _aggregate_absensi_rollup(tanggal_start, tanggal_end, started)
+    untouched = {"$or": [{"updated_at": {"$lte": started}}, {"updated_at": {"$exists": False}}]}
+
+    contended: set = set()
+    ops = [
+        ReplaceOne(
+            {"tanggal": doc["tanggal"], "asrama_id": doc["asrama_id"], "waktu_sholat": doc["waktu_sholat"], **untouched},
+            doc,
+            upsert=True,
+        )
+        for doc in rollups.values()
+    ]
+    for i in range(0, len(ops), 500):
+        chunk = ops[i:i + 500]
+        try:
+            await db.absensi_rollup_harian.bulk_write(chunk, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            # Key sudah di-$inc hook setelah rebuild dimulai: biarkan, ulangi nanti
+            contended.update(chunk[err["index"]]._filter["tanggal"] for err in errors)
+
+    stale_docs = await db.absensi_rollup_harian.find(
+        {"tanggal": {"$gte": tanggal_start, "$lte": tanggal_end}},
+        {"_id": 0, "tanggal": 1, "asrama_id": 1, "waktu_sholat": 1, "updated_at": 1},
+    ).to_list(None)
+    stale_keys = [
+        {"tanggal": d["tanggal"], "asrama_id": d.get("asrama_id"), "waktu_sholat": d.get("waktu_sholat")}
+        for d in stale_docs
+        if (d["tanggal"], d.get("asrama_id"), d.get("waktu_sholat")) not in rollups
+    ]
+    for key in stale_keys:
+        result = await db.absensi_rollup_harian.delete_one({**key, **untouched})
+        if result.deleted_count == 0:
+            contended.add(key["tanggal"])
+
+    covered = [t for t in _rollup_dates(tanggal_start, tanggal_end) if t not in contended]
+    if covered:
+        await db.absensi_rollup_status.bulk_write(
+            [UpdateOne({"tanggal": t}, {"$set": {"tanggal": t, "rebuilt_at": started}}, upsert=True) for t in covered],
+            ordered=False,
+        )
+    if rollups or stale_keys:
+        emit_absensi_changes("absensi_rollup_harian", list(rollups.values()) + stale_keys, "rebuild")
+
+    return {
+        "tanggal_start": tanggal_start,
+        "tanggal_end": tanggal_end,
+        "rollup_docs": len(rollups),
+        "removed_docs": len(stale_keys),
+        "contended": sorted(contended),
+    }
+
+
+async def mark_absensi_rollup_stale(dates: List[str]) -> None:
+    """Cabut tanda tercakup: counter tanggal ini dibangun ulang saat dibaca berikutnya."""
+    if dates:
+        await db.absensi_rollup_status.delete_many({"tanggal": {"$in": sorted(set(dates))}})
+
+
+# Tanggal hanya dipercaya rollup-nya bila punya penanda di absensi_rollup_status,
+# yang ditulis semata-mata oleh rebuild_absensi_rollup. Dokumen rollup hasil $inc
+# hook (mis. scan pertama setelah deploy di tengah hari) tidak menandai tanggal;
+# tanggal tanpa penanda dibangun dari baris absensi mentah saat pertama dibaca.
+_rollup_backfill_lock = asyncio.Lock()
+
+
+async def ensure_absensi_rollup(tanggal_start: str, tanggal_end: Optional[str] = None) -> List[str]:
+    """Bangun rollup untuk tanggal dalam rentang yang belum ditandai tercakup."""
+    tanggal_end = tanggal_end or tanggal_start
+    try:
+        days = _rollup_dates(tanggal_start, tanggal_end)
+    except ValueError:
+        return []
+    tanggal_query = {"tanggal": {"$gte": tanggal_start, "$lte": tanggal_end}}
+    marked = set(await db.absensi_rollup_status.distinct("tanggal", tanggal_query))
+    if marked.issuperset(days):
+        return []
+
+    async with _rollup_backfill_lock:
+        # Worker/permintaan lain mungkin baru saja membangunnya
+        marked = set(await db.absensi_rollup_status.distinct("tanggal", tanggal_query))
+        missing = [t for t in days if t not in marked]
+        if missing:
+            try:
+                await rebuild_absensi_rollup(missing[0], missing[-1])
+            except Exception as e:
+                logging.error(f"Gagal backfill rollup absensi {missing[0]}..{missing[-1]}: {e}")
+    if missing:
+        logging.info(f"Backfill rollup absensi untuk {len(missing)} tanggal: {missing[0]}..{missing[-1]}")
+    return missing
+
+
+async def get_absensi_rollup(
+    tanggal_start: str,
+    tanggal_end: Optional[str] = None,
+    asrama_ids: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    await ensure_absensi_rollup(tanggal_start, tanggal_end)
+    query: Dict[str, Any] = {"tanggal": {"$gte": tanggal_start, "$lte": tanggal_end or tanggal_start}}
+    if asrama_ids is not None:
+        query["asrama_id"] = {"$in": asrama_ids}
+    return await db.absensi_rollup_harian.find(query, {"_id": 0}).to_list(10000)
+
+
+async def dedupe_absensi_collection(collection_name: str, dry_run: bool = False) -> Dict[str, Any]:
+    """Hapus baris absensi ganda (natural key sama), simpan yang paling baru.
+
+    "Paling baru" mengikuti aturan riwayat: waktu_absen, lalu created_at.
+    Baris lama yang belum punya field `id` sekalian diberi uuid.
+    """
+    key_fields = ABSENSI_NATURAL_KEYS[collection_name]
+    collection = db[collection_name]
+
+    pipeline = [
+        {
+            "$group": {
+                "_id": {f: f"${f}" for f in key_fields},
+                "count": {"$sum": 1},
+                "docs": {
+                    "$push": {
+                        "_id": "$_id",
+                        "ts": {"$ifNull": ["$waktu_absen", "$created_at"]},
+                    }
+                },
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+
+    ops: List[Any] = []
+    duplicate_groups = 0
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        duplicate_groups += 1
+        docs = sorted(group["docs"], key=lambda d: str(d.get("ts") or ""), reverse=True)
+        ops.extend(DeleteOne({"_id": d["_id"]}) for d in docs[1:])
+
+    removed = len(ops)
+    if ops and not dry_run:
+        for i in range(0, len(ops), 1000):
+            await collection.bulk_write(ops[i:i + 1000], ordered=False)
+
+    id_ops: List[Any] = []
+    async for doc in collection.find({"id": {"$exists": False}}, {"_id": 1}):
+        id_ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"id": str(uuid.uuid4())}}))
+    if id_ops and not dry_run:
+        for i in range(0, len(id_ops), 1000):
+            await collection.bulk_write(id_ops[i:i + 1000], ordered=False)
+
+    return {
+        "collection": collection_name,
+        "duplicate_groups": duplicate_groups,
+        "removed": removed,
+        "ids_assigned": len(id_ops),
+    }
+
+
+# Hash bcrypt password default wali dihitung sekali saja (bcrypt sengaja lambat)
+_default_wali_password_hash: Optional[str] = None
+
+
+def get_default_wali_password_hash() -> str:
+    global _default_wali_password_hash
+    if _default_wali_password_hash is None:
+        _default_wali_password_hash = hash_password("12345")
+    return _default_wali_password_hash
+
+
+async def _next_wali_username(nama_wali: str, nomor_hp: str, taken: set) -> str:
+    """Username unik untuk wali baru: nama+4digit HP, ditambah angka jika bentrok."""
+    original_username = generate_username(nama_wali or "wali", nomor_hp)
+    existing = await db.wali_santri.find(
+        {"username": {"$regex": f"^{re.escape(original_username)}\\d*$"}},
+        {"_id": 0, "username": 1},
+    ).to_list(1000)
+    taken.update(w["username"] for w in existing)
+
+    username = original_username
+    counter = 1
+    while username in taken:
+        username = f"{original_username}{counter}"
+        counter += 1
+    taken.add(username)
+    return username
+
+
+async def sync_wali_santri(nomor_hp_list: Optional[List[Optional[str]]] = None):
+    """Sinkronisasi data wali dari santri - termasuk menghapus wali tanpa anak.
+
+    - `nomor_hp_list` diisi: hanya wali dengan nomor tersebut yang disentuh
+      (dipakai create/update/delete santri: nomor lama + nomor baru).
+    - `nomor_hp_list` None: full resync semua wali dengan bulk write.
+    """
+    match: Dict[str, Any] = {}
+    if nomor_hp_list is not None:
+        nomor_set = sorted({n for n in nomor_hp_list if n})
+        if not nomor_set:
+            return
+        match = {"nomor_hp_wali": {"$in": nomor_set}}
+
+    # Aggregate santri by wali (wali_id = wali_{nomor_hp})
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": 1}},
+        {
+            "$group": {
+                "_id": "$nomor_hp_wali",
+                "nama_wali": {"$last": "$nama_wali"},
+                "email_wali": {"$first": "$email_wali"},
+                "nama_anak": {"$push": "$nama"},
+                "anak_ids": {"$push": "$id"},
+                "jumlah_anak": {"$sum": 1},
+                "first_created": {"$min": "$created_at"}
+            }
+        }
+    ]
+    
+    wali_groups = [g async for g in db.santri.aggregate(pipeline) if g["_id"]]
+    valid_wali_ids = [f"wali_{g['_id']}" for g in wali_groups]
+
+    existing_ids = {
+        w["id"]
+        for w in await db.wali_santri.find(
+            {"id": {"$in": valid_wali_ids}}, {"_id": 0, "id": 1}
+        ).to_list(len(valid_wali_ids) or 1)
+    }
+
+    now_iso = datetime.now(timezone.utc).isoformat()
+    taken_usernames: set = set()
+    ops: List[Any] = []
+
+    for group in wali_groups:
+        nomor_hp = group["_id"]
+        nama_wali = group.get("nama_wali")
+        wali_id = f"wali_{nomor_hp}"
+
+        update: Dict[str, Any] = {
+            "$set": {
+                "nama": nama_wali,
+                "nomor_hp": nomor_hp,
+                "email": group.get("email_wali"),
+                "jumlah_anak": group["jumlah_anak"],
+                "nama_anak": group["nama_anak"],
+                "anak_ids": group.get("anak_ids", []),
+                "updated_at": now_iso,
+            }
+        }
+        if wali_id not in existing_ids:
+            update["$setOnInsert"] = {
+                "username": await _next_wali_username(nama_wali, nomor_hp, taken_usernames),
+                "password_hash": get_default_wali_password_hash(),  # default password
+                "created_at": group["first_created"],
+            }
+        ops.append(UpdateOne({"id": wali_id}, update, upsert=True))
+
+    # Delete wali yang tidak punya santri lagi
+    if nomor_hp_list is not None:
+        target_ids = [f"wali_{n}" for n in nomor_set]
+        stale_filter: Dict[str, Any] = {"id": {"$in": [i for i in target_ids if i not in valid_wali_ids]}}
+    else:
+        stale_filter = {"id": {"$nin": valid_wali_ids}}
+    ops.append(DeleteMany(stale_filter))
+
+    for i in range(0, len(ops), 1000):
+        result = await db.wali_santri.bulk_write(ops[i:i + 1000], ordered=False)
+        if result.deleted_count > 0:
+            logging.info(f"Deleted {result.deleted_count} wali without santri")
+
+    # anak_ids wali bisa berubah; buang cache principal wali
+    invalidate_principal_cache("wali")
+
+# ==================== ROSTER HARI INI: ETAG & DELTA ====================
+
+# Layar "absensi hari ini" di PWA di-poll tiap beberapa detik. Sebelum membangun
+# roster, handler menghitung state murah per (scope, tanggal, waktu):
+# - sholat: dokumen rollup harian per asrama (berubah setiap status absensi berubah)
+# - aliyah/PMQ: jumlah baris + updated_at terbaru lewat index kelas/kelompok
+# - roster: jumlah anggota scope + epoch waktu, sehingga perubahan data santri/siswa
+#   (nama, pindah kelas) paling lambat terlihat setelah satu epoch
+# ETag = hash state. If-None-Match yang cocok -> 304 tanpa query roster.
+# `since=<version>` -> hanya baris anggota yang berubah sejak versi tsb; bila
+# perubahan tidak bisa dipastikan (roster berubah, ada baris terhapus, terlalu
+# banyak perubahan) respons kembali penuh dengan `delta: false`.
+ROSTER_ETAG_EPOCH_SECONDS = int(os.environ.get("ROSTER_ETAG_EPOCH_SECONDS", 300))
+ROSTER_DELTA_SAFETY_SECONDS = 5
+ROSTER_DELTA_MAX_IDS = 1000
+
+ROSTER_DELTA_SPECS: Dict[str, Dict[str, Any]] = {
+    "sholat": {"collection": "absensi", "member": "santri_id", "slot": "waktu_sholat",
+               "roster": "santri", "roster_scope": "asrama_id"},
+    "aliyah": {"collection": "absensi_aliyah", "member": "siswa_id", "slot": "jenis",
+               "roster": "siswa_aliyah", "roster_scope": "kelas_id"},
+    "pmq": {"collection": "absensi_pmq", "member": "siswa_id", "slot": "sesi",
+            "roster": "siswa_pmq", "roster_scope": "kelompok_id"},
+}
+
+
+async def absensi_roster_state(kind: str, scope_ids: List[str], tanggal: str, slot: Optional[str]) -> Dict[str, Any]:
+    """State ringkas roster hari ini untuk ETag dan versi delta."""
+    spec = ROSTER_DELTA_SPECS[kind]
+    scope_ids = sorted(scope_ids)
+    started = datetime.now(timezone.utc)
+    roster_count = await db[spec["roster"]].count_documents({spec["roster_scope"]: {"$in": scope_ids}})
+
+    if kind == "sholat":
+        query: Dict[str, Any] = {"tanggal": tanggal, "asrama_id": {"$in": scope_ids}}
+        if slot:
+            query["waktu_sholat"] = slot
+        rollups = await db.absensi_rollup_harian.find(
+            query, {"_id": 0, "asrama_id": 1, "waktu_sholat": 1, "total": 1, "updated_at": 1}
+        ).to_list(None)
+        data = sorted([r.get("asrama_id") or "", r.get("waktu_sholat") or "", r.get("total", 0), r.get("updated_at") or ""]
+                      for r in rollups)
+        count = sum(r.get("total", 0) for r in rollups)
+    else:
+        match = {"tanggal": tanggal, spec["slot"]: slot, spec["roster_scope"]: {"$in": scope_ids}}
+        rows = await db[spec["collection"]].aggregate([
+            {"$match": match},
+            {"$group": {"_id": None, "n": {"$sum": 1}, "u": {"$max": "$updated_at"}}},
+        ]).to_list(1)
+        count = rows[0]["n"] if rows else 0
+        data = [count, (rows[0].get("u") if rows else None) or ""]
+
+    scope = hashlib.sha1(json.dumps([kind, scope_ids, tanggal, slot]).encode()).hexdigest()[:16]
+    roster = [roster_count, int(started.timestamp()) // ROSTER_ETAG_EPOCH_SECONDS]
+    return {"scope": scope, "roster": roster, "data": data, "count": count, "at": started.isoformat()}
+
+
+def roster_etag(state: Dict[str, Any]) -> str:
+    digest = hashlib.sha1(json.dumps([state["scope"], state["roster"], state["data"]]).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def encode_roster_version(state: Dict[str, Any]) -> str:
+    cutoff = (datetime.fromisoformat(state["at"]) - timedelta(seconds=ROSTER_DELTA_SAFETY_SECONDS)).isoformat()
+    raw = json.dumps({"k": state["scope"], "r": state["roster"], "t": cutoff, "c": state["at"], "n": state["count"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_roster_version(version: str) -> Dict[str, Any]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(version + "=" * (-len(version) % 4)))
+        if not isinstance(decoded, dict) or "t" not in decoded:
+            raise ValueError(version)
+        return decoded
+    except Exception:
+        raise HTTPException(status_code=400, detail="Versi delta tidak valid")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Pembanding lemah: W/"x" dan "x" dianggap sama
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in header.split(","))
+
+
+async def absensi_roster_changed_ids(
+    kind: str, state: Dict[str, Any], since: str, scope_ids: List[str], tanggal: str, slot: Optional[str]
+) -> Optional[List[str]]:
+    """Id anggota yang barisnya berubah sejak versi `since`; None = perlu respons penuh."""
+    spec = ROSTER_DELTA_SPECS[kind]
+    version = decode_roster_version(since)
+    if version.get("k") != state["scope"] or version.get("r") != state["roster"]:
+        return None
+
+    query: Dict[str, Any] = {"tanggal": tanggal, "updated_at": {"$gt": version["t"]}}
+    if slot or kind != "sholat":
+        query[spec["slot"]] = slot
+    if kind != "sholat":
+        query[spec["roster_scope"]] = {"$in": scope_ids}
+    rows = await db[spec["collection"]].find(
+        query, {"_id": 0, spec["member"]: 1, "created_at": 1}
+    ).to_list(ROSTER_DELTA_MAX_IDS + 1)
+    changed = {r[spec["member"]] for r in rows}
+
+    inserted = [r[spec["member"]] for r in rows if str(r.get("created_at") or "") > version.get("c", "")]
+    removed: List[str] = []
+    if kind == "sholat":
+        tombstone_query: Dict[str, Any] = {"tanggal": tanggal, "deleted_at": {"$gt": version["t"]}}
+        if slot:
+            tombstone_query["waktu_sholat"] = slot
+        deleted = await db.absensi_tombstones.find(
+            tombstone_query, {"_id": 0, "santri_id": 1, "deleted_at": 1}
+        ).to_list(ROSTER_DELTA_MAX_IDS + 1)
+        changed.update(d["santri_id"] for d in deleted)
+        removed = [d["santri_id"] for d in deleted if str(d.get("deleted_at") or "") > version.get("c", "")]
+        if inserted or removed:
+            # Baris absensi sholat tidak menyimpan asrama: hitung hanya santri dalam scope
+            in_scope = set(await db.santri.distinct(
+                "id", {"id": {"$in": list({*inserted, *removed})}, "asrama_id": {"$in": scope_ids}}
+            ))
+            inserted = [m for m in inserted if m in in_scope]
+            removed = [m for m in removed if m in in_scope]
+
+    # Baris terhapus tanpa tombstone (aliyah/PMQ, atau tombstone sholat yang gagal
+    # dicatat) terdeteksi dari selisih jumlah baris (sholat: total rollup)
+    if version.get("n") is None or version["n"] + len(inserted) - len(removed) != state["count"]:
+        return None
+
+    if len(rows) > ROSTER_DELTA_MAX_IDS or len(changed) > ROSTER_DELTA_MAX_IDS:
+        return None
+    return sorted(changed)
+
+
+async def absensi_roster_delta(
+    request: Request, kind: str, scope_ids: List[str], tanggal: str, slot: Optional[str], since: Optional[str]
+) -> Dict[str, Any]:
+    """ETag/304 dan filter delta untuk endpoint roster hari ini.
+
+    Mengembalikan dict berisi `not_modified` (Response 304 atau None), `etag`,
+    `version` dan `only_ids` (None = bangun roster penuh).
+    """
+    state = await absensi_roster_state(kind, scope_ids, tanggal, slot)
+    etag = roster_etag(state)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return {"not_modified": Response(status_code=304, headers=headers), "etag": etag}
+
+    only_ids = await absensi_roster_changed_ids(kind, state, since, scope_ids, tanggal, slot) if since else None
+    return {
+        "not_modified": None,
+        "etag": etag,
+        "headers": headers,
+        "version": encode_roster_version(state),
+        "only_ids": only_ids,
+    }
+
+
+# ==================== LIVE ABSENSI EVENTS (SSE) ====================
+
+# Dashboard pembimbing / monitoring berlangganan event perubahan absensi lewat
+# Server-Sent Events alih-alih polling roster. Event hanya berisi scope yang
+# berubah (asrama / kelas / kelas aliyah / kelompok + tanggal + waktu); dashboard
+# lalu mengambil baris yang berubah lewat endpoint ETag/delta roster hari ini.
+#
+# Sumber event:
+# - change_stream: watch Mongo (replica set / sharded) pada koleksi di bawah, sehingga
+#   perubahan dari worker mana pun sampai ke semua subscriber.
+# - local: fallback untuk Mongo standalone; jalur tulis absensi mem-publish langsung
+#   ke pub/sub in-process (hanya subscriber di worker yang sama).
+ABSENSI_EVENTS_SOURCE = os.environ.get("ABSENSI_EVENTS_SOURCE", "auto")  # auto | change_stream | local
+ABSENSI_EVENT_QUEUE_SIZE = 256
+ABSENSI_EVENT_HEARTBEAT_SECONDS = 15
+ABSENSI_EVENT_COALESCE_SECONDS = 1.0
+
+# koleksi -> (kind, scope, field scope, field waktu/jenis/sesi)
+ABSENSI_EVENT_SCOPES: Dict[str, Tuple[str, str, str, Optional[str]]] = {
+    "absensi_rollup_harian": ("sholat", "asrama", "asrama_id", "waktu_sholat"),
+    "absensi_kelas": ("kelas", "kelas", "kelas_id", None),
+    "absensi_aliyah": ("aliyah", "kelas_aliyah", "kelas_id", "jenis"),
+    "absensi_pmq": ("pmq", "kelompok", "kelompok_id", "sesi"),
+}
+
+_absensi_subscribers: Dict[str, Dict[str, Any]] = {}
+_absensi_event_tasks: List[asyncio.Task] = []
+ABSENSI_EVENT_STATS: Dict[str, Any] = {"source": "local", "seq": 0, "published": 0, "delivered": 0, "dropped": 0}
+
+
+def absensi_event(collection_name: str, doc: Dict[str, Any], op: str = "update") -> Optional[Dict[str, Any]]:
+    """Bentuk event dari dokumen absensi/rollup; None bila scope tidak diketahui."""
+    kind, scope, scope_field, slot_field = ABSENSI_EVENT_SCOPES[collection_name]
+    if not doc.get(scope_field):
+        return None
+    event = {
+        "kind": kind,
+        "scope": scope,
+        "scope_id": doc[scope_field],
+        "tanggal": doc.get("tanggal"),
+        "slot": doc.get(slot_field) if slot_field else None,
+        "op": op,
+    }
+    if doc.get("siswa_id"):
+        event["siswa_id"] = doc["siswa_id"]
+        event["status"] = doc.get("status") if op != "delete" else None
+    return event
+
+
+def publish_absensi_events(events: List[Dict[str, Any]]) -> None:
+    """Kirim event ke semua subscriber yang scope-nya cocok (non-blocking)."""
+    for event in events:
+        ABSENSI_EVENT_STATS["seq"] += 1
+        ABSENSI_EVENT_STATS["published"] += 1
+        event = {**event, "seq": ABSENSI_EVENT_STATS["seq"]}
+        for subscriber in _absensi_subscribers.values():
+            if event["scope_id"] not in subscriber["scopes"].get(event["scope"], ()):
+                continue
+            try:
+                subscriber["queue"].put_nowait(event)
+                ABSENSI_EVENT_STATS["delivered"] += 1
+            except asyncio.QueueFull:
+                # Klien lambat: buang event, minta klien resync penuh
+                subscriber["overflow"] = True
+                ABSENSI_EVENT_STATS["dropped"] += 1
+
+
+def emit_absensi_changes(collection_name: str, docs: List[Dict[str, Any]], op: str = "update") -> None:
+    """Hook jalur tulis absensi. Tidak melakukan apa-apa bila change stream aktif."""
+    if ABSENSI_EVENT_STATS["source"] == "change_stream" or not _absensi_subscribers:
+        return
+    publish_absensi_events([e for e in (absensi_event(collection_name, d, op) for d in docs) if e])
+
+
+ABSENSI_CHANGE_STREAM_PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+
+
+async def watch_absensi_collection(collection_name: str, options: Dict[str, Any]):
+    """Teruskan change stream satu koleksi ke pub/sub; resume otomatis setelah error."""
+    resume_token = None
+    while True:
+        try:
+            async with db[collection_name].watch(
+                ABSENSI_CHANGE_STREAM_PIPELINE, resume_after=resume_token, **options
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    op = "delete" if change["operationType"] == "delete" else "update"
+                    # Delete hanya membawa dokumen bila pre-image koleksi diaktifkan
+                    doc = change.get("fullDocument") or change.get("fullDocumentBeforeChange")
+                    event = absensi_event(collection_name, doc, op) if doc else None
+                    if event:
+                        publish_absensi_events([event])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Change stream {collection_name} terputus: {e}")
+            await asyncio.sleep(5)
+
+
+async def change_stream_options() -> Optional[Dict[str, Any]]:
+    """Opsi watch() yang didukung server, atau None bila change stream tidak tersedia."""
+    try:
+        hello = await db.command("hello")
+        build_info = await db.command("buildInfo")
+    except Exception as e:
+        logging.error(f"Gagal memeriksa topologi MongoDB: {e}")
+        return None
+    if not (hello.get("setName") or hello.get("msg") == "isdbgrid"):
+        return None
+    options: Dict[str, Any] = {"full_document": "updateLookup"}
+    # Pre-image (fullDocumentBeforeChange) baru didukung MongoDB 6.0
+    if (build_info.get("versionArray") or [0])[0] >= 6:
+        options["full_document_before_change"] = "whenAvailable"
+    return options
+
+
+async def probe_change_stream(options: Dict[str, Any]) -> bool:
+    """Buka satu change stream untuk memastikan server benar-benar menerimanya."""
+    try:
+        async with db[next(iter(ABSENSI_EVENT_SCOPES))].watch(ABSENSI_CHANGE_STREAM_PIPELINE, **options):
+            pass
+    except Exception as e:
+        logging.error(f"Change stream tidak dapat dibuka, memakai pub/sub lokal: {e}")
+        return False
+    return True
+
+
+async def start_absensi_event_source() -> str:
+    source = "local"
+    options: Optional[Dict[str, Any]] = None
+    if ABSENSI_EVENTS_SOURCE != "local":
+        options = await change_stream_options()
+        if options is not None and await probe_change_stream(options):
+            source = "change_stream"
+        elif ABSENSI_EVENTS_SOURCE == "change_stream":
+            logging.error("ABSENSI_EVENTS_SOURCE=change_stream tapi change stream tidak tersedia; memakai pub/sub lokal")
+
+    ABSENSI_EVENT_STATS["source"] = source
+    if source == "change_stream":
+        for collection_name in ABSENSI_EVENT_SCOPES:
+            if "full_document_before_change" in options:
+                try:
+                    # Pre-image agar event delete tetap membawa scope
+                    await db.command("collMod", collection_name, changeStreamPreAndPostImages={"enabled": True})
+                except Exception as e:
+                    logging.error(f"Gagal mengaktifkan pre-image {collection_name}: {e}")
+            _absensi_event_tasks.append(asyncio.create_task(watch_absensi_collection(collection_name, options)))
+    return source
+
+
+async def stop_absensi_event_source():
+    for task in _absensi_event_tasks:
+        task.cancel()
+    await asyncio.gather(*_absensi_event_tasks, return_exceptions=True)
+    _absensi_event_tasks.clear()
+
+
+def _sse(event: str, data: Any, event_id: Optional[int] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data, default=str)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def absensi_event_stream(request: Request, scopes: Dict[str, set]):
+    """Generator SSE untuk satu subscriber; event dalam jendela coalesce digabung."""
+    subscriber_id = uuid.uuid4().hex
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ABSENSI_EVENT_QUEUE_SIZE)
+    subscriber = {"queue": queue, "scopes": scopes, "overflow": False}
+    _absensi_subscribers[subscriber_id] = subscriber
+    try:
+        yield "retry: 5000\n\n"
+        yield _sse("ready", {"source": ABSENSI_EVENT_STATS["source"], "scopes": {k: sorted(v) for k, v in scopes.items()}})
+        while not await request.is_disconnected():
+            if subscriber["overflow"]:
+                while not queue.empty():
+                    queue.get_nowait()
+                subscriber["overflow"] = False
+                yield _sse("resync", {})
+                continue
+            try:
+                first = await asyncio.wait_for(queue.get(), timeout=ABSENSI_EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+
+            # Gabungkan burst (mis. batch/sync) menjadi satu pesan per jendela coalesce
+            changes = {}
+            deadline = time.monotonic() + ABSENSI_EVENT_COALESCE_SECONDS
+            event = first
+            while True:
+                key = (event["kind"], event["scope_id"], event["tanggal"], event["slot"], event.get("siswa_id"))
+                changes.pop(key, None)
+                changes[key] = {k: v for k, v in event.items() if k != "seq"}
+                last_seq = event["seq"]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            yield _sse("absensi", {"changes": list(changes.values())}, last_seq)
+    finally:
+        _absensi_subscribers.pop(subscriber_id, None)
+
+
+async def resolve_stream_principal(role: str, request: Request, token: Optional[str]) -> dict:
+    """EventSource tidak bisa mengirim header Authorization: token boleh lewat query."""
+    if not token:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await resolve_principal(role, HTTPAuthorizationCredentials(scheme="Bearer", credentials=token))
+
+
+def absensi_event_response(request: Request, scopes: Dict[str, set]) -> StreamingResponse:
+    return StreamingResponse(
+        absensi_event_stream(request, scopes),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api_router.get("/pembimbing/events")
+async def stream_pembimbing_events(request: Request, token: Optional[str] = None):
+    """SSE perubahan absensi sholat untuk asrama pembimbing."""
+    pembimbing = await resolve_stream_principal("pembimbing", request, token)
+    return absensi_event_response(request, {"asrama": set(pembimbing.get("asrama_ids", []) or [])})
+
+
+@api_router.get("/pembimbing-kelas/events")
+async def stream_pembimbing_kelas_events(request: Request, token: Optional[str] = None):
+    """SSE perubahan absensi kelas madrasah untuk kelas pembimbing kelas."""
+    pembimbing = await resolve_stream_principal("pembimbing_kelas", request, token)
+    return absensi_event_response(request, {"kelas": set(pembimbing.get("kelas_ids", []) or [])})
+
+
+@api_router.get("/aliyah/monitoring/events")
+async def stream_monitoring_aliyah_events(request: Request, token: Optional[str] = None):
+    """SSE perubahan absensi Aliyah untuk kelas monitoring."""
+    monitoring = await resolve_stream_principal("monitoring_aliyah", request, token)
+    return absensi_event_response(request, {"kelas_aliyah": set(monitoring.get("kelas_ids", []) or [])})
+
+
+# ==================== WAKTU SHOLAT PREFETCH ====================
+
+# Jadwal sholat diambil per bulan/tahun sekaligus lewat endpoint calendar Aladhan
+# (satu request), di-upsert massal ke waktu_sholat (unique per tanggal) dan dibaca
+# lewat cache in-process. Kalau API tidak bisa dihubungi, jadwal dihitung lokal
+# dengan pendekatan astronomis (metode ISNA, sama dengan method=2 Aladhan) dan
+# ditandai sumber="perkiraan" sampai prefetch berikutnya berhasil.
+ALADHAN_API_URL = os.environ.get("ALADHAN_API_URL", "http://api.aladhan.com/v1").rstrip("/")
+PRAYER_ADDRESS = "Desa Cintamulya, Candipuro, Lampung Selatan, Lampung, Indonesia"
+PRAYER_METHOD = 2
+PRAYER_LATITUDE = float(os.environ.get("PRAYER_LATITUDE", "-5.5667"))
+PRAYER_LONGITUDE = float(os.environ.get("PRAYER_LONGITUDE", "105.5833"))
+PRAYER_FAJR_ANGLE = 15.0
+PRAYER_ISHA_ANGLE = 15.0
+WAKTU_SHOLAT_LOKASI = "Lampung Selatan"
+WAKTU_SHOLAT_CACHE_TTL_SECONDS = 3600
+WAKTU_SHOLAT_CACHE_MAX_ENTRIES = 800
+WAKTU_SHOLAT_PREFETCH_INTERVAL_SECONDS = 24 * 3600
+
+_waktu_sholat_cache: Dict[str, Tuple[float, dict]] = {}
+_waktu_sholat_prefetch_task: Optional[asyncio.Task] = None
+WAKTU_SHOLAT_STATS: Dict[str, int] = {
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "api_calls": 0,
+    "api_failures": 0,
+    "fallback_days": 0,
+}
+ALADHAN_TIMING_KEYS = {"subuh": "Fajr", "dzuhur": "Dhuhr", "ashar": "Asr", "maghrib": "Maghrib", "isya": "Isha"}
+
+
+def _parse_aladhan_timings(timings: dict) -> Dict[str, str]:
+    # Endpoint calendar menambahkan zona waktu, mis. "04:21 (WIB)"
+    return {key: timings[src].split(" ")[0] for key, src in ALADHAN_TIMING_KEYS.items()}
+
+
+def _parse_aladhan_calendar(days: List[dict]) -> Dict[str, Dict[str, str]]:
+    result = {}
+    for day in days:
+        dd, mm, yyyy = day["date"]["gregorian"]["date"].split("-")
+        result[f"{yyyy}-{mm}-{dd}"] = _parse_aladhan_timings(day["timings"])
+    return result
+
+
+async def fetch_prayer_calendar(year: int, month: Optional[int] = None) -> Optional[Dict[str, Dict[str, str]]]:
+    """Jadwal satu bulan (atau satu tahun bila month=None) dalam satu request: {tanggal: waktu}."""
+    path = f"{year}/{month}" if month else f"{year}"
+    try:
+        WAKTU_SHOLAT_STATS["api_calls"] += 1
+        async with http_request(
+            "GET", f"{ALADHAN_API_URL}/calendarByAddress/{path}",
+            params={"address": PRAYER_ADDRESS, "method": PRAYER_METHOD}, timeout=30,
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(f"status {response.status}")
+            data = (await response.json())["data"]
+        # Kalender tahunan dikelompokkan per bulan: {"1": [...], "2": [...], ...}
+        days = data if isinstance(data, list) else [d for m in sorted(data, key=int) for d in data[m]]
+        return _parse_aladhan_calendar(days)
+    except Exception as e:
+        WAKTU_SHOLAT_STATS["api_failures"] += 1
+        logging.error(f"Error fetching prayer calendar {path}: {e}")
+        return None
+
+
+def compute_prayer_times(tanggal: str, latitude: float = PRAYER_LATITUDE, longitude: float = PRAYER_LONGITUDE,
+                         tz_hours: float = 7.0) -> Dict[str, str]:
+    """Perkiraan waktu sholat secara astronomis (tanpa jaringan), akurat sekitar +/- 2 menit."""
+    y, m, d = (int(p) for p in tanggal.split("-"))
+    if m <= 2:
+        y, m = y - 1, m + 12
+    a = y // 100
+    jd = math.floor(365.25 * (y + 4716)) + math.floor(30.6001 * (m + 1)) + d + (2 - a + a // 4) - 1524.5
+    jd -= longitude / (15 * 24)
+
+    def sun_position(day_fraction: float) -> Tuple[float, float]:
+        n = jd + day_fraction - 2451545.0
+        g = math.radians((357.529 + 0.98560028 * n) % 360)
+        q = (280.459 + 0.98564736 * n) % 360
+        lam = math.radians((q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g)) % 360)
+        e = math.radians(23.439 - 0.00000036 * n)
+        ra = (math.degrees(math.atan2(math.cos(e) * math.sin(lam), math.cos(lam))) / 15) % 24
+        eqt = q / 15 - ra
+        decl = math.asin(math.sin(e) * math.sin(lam))
+        return decl, eqt
+
+    lat = math.radians(latitude)
+
+    def mid_day(day_fraction: float) -> float:
+        return (12 - sun_position(day_fraction)[1]) % 24
+
+    def angle_time(angle: float, day_fraction: float, before_noon: bool) -> float:
+        decl = sun_position(day_fraction)[0]
+        cos_h = (-math.sin(math.radians(angle)) - math.sin(decl) * math.sin(lat)) / (math.cos(decl) * math.cos(lat))
+        t = math.degrees(math.acos(max(-1.0, min(1.0, cos_h)))) / 15
+        return mid_day(day_fraction) + (-t if before_noon else t)
+
+    def asr_time(day_fraction: float) -> float:
+        decl = sun_position(day_fraction)[0]
+        angle = -math.degrees(math.atan(1 / (1 + math.tan(abs(lat - decl)))))
+        return angle_time(angle, day_fraction, before_noon=False)
+
+    hours = {
+        "subuh": angle_time(PRAYER_FAJR_ANGLE, 5 / 24, before_noon=True),
+        "dzuhur": mid_day(12 / 24),
+        "ashar": asr_time(13 / 24),
+        "maghrib": angle_time(0.833, 18 / 24, before_noon=False),
+        "isya": angle_time(PRAYER_ISHA_ANGLE, 18 / 24, before_noon=False),
+    }
+    result = {}
+    for key, value in hours.items():
+        minutes = round(((value + tz_hours - longitude / 15) % 24) * 60) % (24 * 60)
+        result[key] = f"{minutes // 60:02d}:{minutes % 60:02d}"
+    return result
+
+
+async def upsert_waktu_sholat(times_by_date: Dict[str, Dict[str, str]], sumber: str) -> int:
+    """Bulk upsert jadwal per tanggal; id & created_at dokumen lama dipertahankan.
+
+    Jadwal perkiraan hanya mengisi tanggal yang belum ada, tidak pernah menimpa
+    jadwal yang sudah tersimpan (mis. dari Aladhan).
+    """
+    if not times_by_date:
+        return 0
+    now_iso = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for tanggal, times in times_by_date.items():
+        fields = {**times, "lokasi": WAKTU_SHOLAT_LOKASI, "sumber": sumber, "updated_at": now_iso}
+        insert_fields = {"id": str(uuid.uuid4()), "tanggal": tanggal, "created_at": now_iso}
+        if sumber == "perkiraan":
+            update = {"$setOnInsert": {**insert_fields, **fields}}
+        else:
+            update = {"$set": fields, "$setOnInsert": insert_fields}
+        ops.append(UpdateOne({"tanggal": tanggal}, update, upsert=True))
+    for i in range(0, len(ops), 500):
+        await db.waktu_sholat.bulk_write(ops[i:i + 500], ordered=False)
+    for tanggal in times_by_date:
+        _waktu_sholat_cache.pop(tanggal, None)
+    invalidate_sholat_windows()
+    return len(ops)
+
+
+async def prefetch_waktu_sholat(year: int, month: Optional[int] = None) -> Dict[str, Any]:
+    """Ambil jadwal satu bulan/tahun dari Aladhan; kalau gagal isi dengan perkiraan lokal."""
+    times = await fetch_prayer_calendar(year, month)
+    sumber = "aladhan"
+    if not times:
+        sumber = "perkiraan"
+        months = [month] if month else range(1, 13)
+        times = {
+            tanggal: compute_prayer_times(tanggal)
+            for m in months
+            for tanggal in (f"{year}-{m:02d}-{d:02d}" for d in range(1, calendar.monthrange(year, m)[1] + 1))
+        }
+        WAKTU_SHOLAT_STATS["fallback_days"] += len(times)
+    upserted = await upsert_waktu_sholat(times, sumber)
+    logging.info(f"Prefetch waktu sholat {year}{f'-{month:02d}' if month else ''}: {upserted} hari ({sumber})")
+    return {"tahun": year, "bulan": month, "sumber": sumber, "hari": upserted}
+
+
+async def get_waktu_sholat_doc(tanggal: str) -> dict:
+    """Jadwal satu tanggal: cache -> MongoDB -> prefetch bulan tsb (atau perkiraan lokal)."""
+    entry = _waktu_sholat_cache.get(tanggal)
+    if entry and time.monotonic() - entry[0] < WAKTU_SHOLAT_CACHE_TTL_SECONDS:
+        WAKTU_SHOLAT_STATS["cache_hits"] += 1
+        return dict(entry[1])
+    WAKTU_SHOLAT_STATS["cache_misses"] += 1
+
+    doc = await db.waktu_sholat.find_one({"tanggal": tanggal}, {"_id": 0})
+    if not doc:
+        year, month, _ = (int(p) for p in tanggal.split("-"))
+        await prefetch_waktu_sholat(year, month)
+        doc = await db.waktu_sholat.find_one({"tanggal": tanggal}, {"_id": 0})
+    if not doc:
+        raise HTTPException(status_code=500, detail="Gagal mengambil data waktu sholat")
+
+    if len(_waktu_sholat_cache) >= WAKTU_SHOLAT_CACHE_MAX_ENTRIES:
+        _waktu_sholat_cache.clear()
+    _waktu_sholat_cache[tanggal] = (time.monotonic(), doc)
+    return dict(doc)
+
+
+async def _waktu_sholat_year_complete(year: int) -> bool:
+    days = 366 if calendar.isleap(year) else 365
+    count = await db.waktu_sholat.count_documents(
+        {"tanggal": {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}, "sumber": {"$ne": "perkiraan"}}
+    )
+    return count >= days
+
+
+async def waktu_sholat_prefetch_loop():
+    """Pastikan jadwal tahun berjalan (dan tahun depan mulai Desember) sudah tersimpan dari API."""
+    while True:
+        try:
+            today = datetime.now(LOCAL_TZ).date()
+            years = [today.year] + ([today.year + 1] if today.month == 12 else [])
+            for year in years:
+                if not await _waktu_sholat_year_complete(year):
+                    await prefetch_waktu_sholat(year)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Prefetch waktu sholat gagal: {e}")
+        await asyncio.sleep(WAKTU_SHOLAT_PREFETCH_INTERVAL_SECONDS)
+
+
+async def dedupe_waktu_sholat() -> int:
+    """Hapus dokumen waktu_sholat ganda per tanggal (sisa insert lama) agar unique index bisa dibuat."""
+    removed = 0
+    async for group in db.waktu_sholat.aggregate([
+        {"$group": {"_id": "$tanggal", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]):
+        result = await db.waktu_sholat.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
+
+# ==================== JENDELA WAKTU SHOLAT ====================
+
+# Jadwal jendela absensi per hari dihitung sekali dari waktu_sholat lalu di-cache,
+# sehingga scan cukup mencocokkan jam sekarang ke 10 jendela (kemarin & hari ini)
+# tanpa membaca settings/waktu_sholat. Jendela sebuah waktu dibuka
+# `buka_sebelum_menit` sebelum adzan dan berakhir saat jendela berikutnya dibuka;
+# isya berakhir saat jendela subuh besok dibuka, jadi scan isya lewat tengah malam
+# tetap bertanggal kemarin.
+WAKTU_SHOLAT_URUTAN = ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
+SHOLAT_WINDOW_SETTINGS_ID = "absensi_sholat_window"
+
+_sholat_window_cache: Dict[str, Tuple[float, Dict[str, Tuple[datetime, datetime]]]] = {}
+_sholat_window_settings: Optional[Tuple[float, dict]] = None
+
+
+async def get_sholat_window_settings() -> dict:
+    global _sholat_window_settings
+    if _sholat_window_settings and time.monotonic() - _sholat_window_settings[0] < WAKTU_SHOLAT_CACHE_TTL_SECONDS:
+        return _sholat_window_settings[1]
+    doc = await db.settings.find_one({"id": SHOLAT_WINDOW_SETTINGS_ID}, {"_id": 0}) or {}
+    settings = AbsensiSholatWindowSettings(**doc).model_dump()
+    _sholat_window_settings = (time.monotonic(), settings)
+    return settings
+
+
+def invalidate_sholat_windows(settings: bool = False) -> None:
+    global _sholat_window_settings
+    _sholat_window_cache.clear()
+    if settings:
+        _sholat_window_settings = None
+
+
+def _local_datetime(tanggal: str, jam: str) -> datetime:
+    y, m, d = (int(p) for p in tanggal.split("-"))
+    hh, mm = (int(p) for p in jam.split(":")[:2])
+    return datetime(y, m, d, hh, mm, tzinfo=LOCAL_TZ)
+
+
+async def get_sholat_window_schedule(tanggal: str) -> Dict[str, Tuple[datetime, datetime]]:
+    """{waktu: (buka, tutup)} untuk satu tanggal, dalam WIB."""
+    entry = _sholat_window_cache.get(tanggal)
+    if entry and time.monotonic() - entry[0] < WAKTU_SHOLAT_CACHE_TTL_SECONDS:
+        return entry[1]
+
+    settings = await get_sholat_window_settings()
+    lead = timedelta(minutes=settings["buka_sebelum_menit"])
+    besok = (datetime.fromisoformat(tanggal) + timedelta(days=1)).date().isoformat()
+    hari_ini = await get_waktu_sholat_doc(tanggal)
+    subuh_besok = await get_waktu_sholat_doc(besok)
+
+    opens = [_local_datetime(tanggal, hari_ini[w]) - lead for w in WAKTU_SHOLAT_URUTAN]
+    opens.append(_local_datetime(besok, subuh_besok["subuh"]) - lead)
+    schedule = {w: (opens[i], opens[i + 1]) for i, w in enumerate(WAKTU_SHOLAT_URUTAN)}
+
+    if len(_sholat_window_cache) >= WAKTU_SHOLAT_CACHE_MAX_ENTRIES:
+        _sholat_window_cache.clear()
+    _sholat_window_cache[tanggal] = (time.monotonic(), schedule)
+    return schedule
+
+
+async def resolve_sholat_scan(
+    waktu_sholat: Optional[str] = None,
+    now: Optional[datetime] = None,
+    enforce: Optional[bool] = None,
+) -> Tuple[str, str]:
+    """Tentukan (waktu_sholat, tanggal) sebuah scan dari jendela waktu sholat.
+
+    - Tanpa waktu_sholat: pakai jendela yang sedang berlangsung.
+    - Dengan waktu_sholat: tanggal diambil dari jendela waktu tsb (boleh terlambat
+      `toleransi_menit`); di luar jendela ditolak bila pengaturan `enforce` aktif.
+    """
+    now = (now or datetime.now(timezone.utc)).astimezone(LOCAL_TZ)
+    today = now.date().isoformat()
+    yesterday = (now.date() - timedelta(days=1)).isoformat()
+    settings = await get_sholat_window_settings()
+    if enforce is None:
+        enforce = settings["enforce"]
+
+    try:
+        schedules = [(today, await get_sholat_window_schedule(today)),
+                     (yesterday, await get_sholat_window_schedule(yesterday))]
+    except HTTPException:
+        # Jadwal tidak tersedia sama sekali: jangan blokir absensi
+        if waktu_sholat:
+            return waktu_sholat, today
+        raise HTTPException(status_code=400, detail="Waktu sholat wajib dipilih (jadwal sholat tidak tersedia)")
+
+    if waktu_sholat is None:
+        for tanggal, schedule in schedules:
+            for waktu, (start, end) in schedule.items():
+                if start <= now < end:
+                    return waktu, tanggal
+        raise HTTPException(status_code=400, detail="Tidak ada waktu sholat yang sedang berlangsung")
+
+    grace = timedelta(minutes=settings["toleransi_menit"])
+    for tanggal, schedule in schedules:
+        start, end = schedule[waktu_sholat]
+        if start <= now < end + grace:
+            return waktu_sholat, tanggal
+
+    if enforce:
+        start, end = schedules[0][1][waktu_sholat]
+        raise HTTPException(
+            status_code=400,
+            detail=f"Absensi {waktu_sholat} hanya dapat dicatat pukul {start:%H:%M} - {end + grace:%H:%M} WIB",
+        )
+    return waktu_sholat, today
+
+
+# ==================== DAILY WHATSAPP REPORT ENDPOINT ====================
+
+# Rekap dibangun dari cursor agregasi yang sudah dikelompokkan & diurutkan per
+# nomor wali, lalu dikirim ke bot per chunk. Setiap chunk di-ack bot dengan hasil
+# per wali; job menyimpan nomor wali terakhir yang di-ack sehingga bila proses
+# mati di tengah jalan, job dilanjutkan dari wali berikutnya.
+WHATSAPP_REPORT_CHUNK_SIZE = int(os.environ.get("WHATSAPP_REPORT_CHUNK_SIZE", "25"))
+WHATSAPP_REPORT_CHUNK_TIMEOUT_SECONDS = 300
+# Job yang sedang dijalankan worker ini diperbarui heartbeat-nya tiap
+# WHATSAPP_REPORT_HEARTBEAT_SECONDS (juga saat menunggu ack chunk yang lama);
+# job 'running' tanpa heartbeat selama WHATSAPP_REPORT_STALE_SECONDS dianggap
+# ditinggal proses yang mati dan diklaim ulang oleh sweep di dispatcher.
+WHATSAPP_REPORT_HEARTBEAT_SECONDS = 60
+WHATSAPP_REPORT_STALE_SECONDS = 3 * WHATSAPP_REPORT_HEARTBEAT_SECONDS
+
+_whatsapp_report_tasks: Dict[str, asyncio.Task] = {}
+
+
+def _daily_report_pipeline(tanggal: str, after_nomor: Optional[str] = None) -> List[dict]:
+    return [
+        {"$match": {"tanggal": tanggal}},
+        {"$group": {"_id": "$santri_id", "statuses": {"$push": {"waktu": "$waktu_sholat", "status": "$status"}}}},
+        {"$lookup": {"from": "santri", "localField": "_id", "foreignField": "id", "as": "santri"}},
+        {"$unwind": "$santri"},
+        {"$match": {"santri.nomor_hp_wali": {"$gt": after_nomor or ""}}},
+        {"$group": {
+            "_id": "$santri.nomor_hp_wali",
+            "wali_nama": {"$first": "$santri.nama_wali"},
+            "anak": {"$push": {
+                "nama": "$santri.nama",
+                "asrama_id": "$santri.asrama_id",
+                "statuses": "$statuses",
+            }},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+async def iter_daily_wali_reports(tanggal: str, after_nomor: Optional[str] = None):
+    """Rekap per wali (urut nomor HP), dimulai setelah `after_nomor`."""
+    asrama_map = await get_reference_map("asrama")
+    waktu_list = ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
+    cursor = db.absensi.aggregate(_daily_report_pipeline(tanggal, after_nomor), allowDiskUse=True)
+    async for group in cursor:
+        anak_items = []
+        for anak in sorted(group["anak"], key=lambda a: a.get("nama", "")):
+            row = {w: "-" for w in waktu_list}
+            for s in anak.get("statuses", []):
+                if s.get("waktu") in row and s.get("status"):
+                    row[s["waktu"]] = s["status"]
+            anak_items.append(DailyWaliReportAnak(
+                nama=anak.get("nama", ""), kelas=asrama_map.get(anak.get("asrama_id"), "-"), **row
+            ))
+        yield DailyWaliReport(
+            wali_nama=group.get("wali_nama") or "Wali Santri",
+            wali_nomor=group["_id"],
+            tanggal=tanggal,
+            anak=anak_items,
+        )
+
+
+async def count_daily_wali_reports(tanggal: str) -> int:
+    rows = await db.absensi.aggregate(
+        _daily_report_pipeline(tanggal) + [{"$count": "total"}], allowDiskUse=True
+    ).to_list(1)
+    return rows[0]["total"] if rows else 0
+
+
+def _whatsapp_job_view(job: dict) -> dict:
+    total = job.get("total_wali", 0)
+    sent = job.get("sent", 0)
+    failed = job.get("failed", 0)
+    return {
+        "job_id": job["id"],
+        "tanggal": job["tanggal"],
+        "status": job["status"],
+        "total_wali": total,
+        "sent": sent,
+        "failed": failed,
+        "pending": max(total - sent - failed, 0),
+        "chunks_acked": job.get("chunks_acked", 0),
+        "last_acked_wali": job.get("last_acked_wali"),
+        "last_error": job.get("last_error"),
+        "failures": job.get("failures", []),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+        "finished_at": job.get("finished_at"),
+    }
+
+
+async def _send_report_chunk(job: dict, chunk_index: int, reports: List[DailyWaliReport]) -> None:
+    batch = DailyWaliReportBatch(tanggal=job["tanggal"], reports=reports, job_id=job["id"], chunk_index=chunk_index)
+    # Aman dicoba ulang: bot membuang job_id:wali_nomor yang sudah ada di antriannya
+    async with http_request("POST", WHATSAPP_BOT_URL, json=batch.model_dump(), retry=True,
+                            timeout=WHATSAPP_REPORT_CHUNK_TIMEOUT_SECONDS) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Bot membalas {resp.status}: {(await resp.text())[:200]}")
+        ack = await resp.json()
+    if not ack.get("ok"):
+        raise RuntimeError(f"Bot menolak chunk {chunk_index}: {ack.get('error')}")
+
+    # Bot lama tidak mengirim hasil per wali: anggap seluruh chunk terkirim
+    results = ack.get("results") or [{"wali_nomor": r.wali_nomor, "ok": True} for r in reports]
+    failures = [
+        {"wali_nomor": r.get("wali_nomor"), "error": r.get("error")} for r in results if not r.get("ok")
+    ]
+    now_iso = datetime.now(timezone.utc).isoformat()
+    await db.whatsapp_report_jobs.update_one(
+        {"id": job["id"]},
+        {
+            "$inc": {"sent": len(results) - len(failures), "failed": len(failures)},
+            "$set": {
+                "last_acked_wali": reports[-1].wali_nomor,
+                "chunks_acked": chunk_index + 1,
+                "heartbeat_at": now_iso,
+                "updated_at": now_iso,
+            },
+            "$push": {"failures": {"$each": failures, "$slice": -200}},
+        },
+    )
+
+
+async def run_whatsapp_report_job(job_id: str) -> None:
+    job = await db.whatsapp_report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        return
+    chunk_index = job.get("chunks_acked", 0)
+    chunk: List[DailyWaliReport] = []
+    try:
+        async for report in iter_daily_wali_reports(job["tanggal"], job.get("last_acked_wali")):
+            chunk.append(report)
+            if len(chunk) >= WHATSAPP_REPORT_CHUNK_SIZE:
+                await _send_report_chunk(job, chunk_index, chunk)
+                chunk_index += 1
+                chunk = []
+        if chunk:
+            await _send_report_chunk(job, chunk_index, chunk)
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        await db.whatsapp_report_jobs.update_one(
+            {"id": job_id},
+            {"$set": {"status": "completed", "finished_at": now_iso, "updated_at": now_iso, "last_error": None}},
+        )
+        logging.info(f"Rekap WhatsApp {job['tanggal']} selesai (job {job_id})")
+    except Exception as e:
+        logging.error(f"Rekap WhatsApp job {job_id} berhenti: {e}")
+        await db.whatsapp_report_jobs.update_one(
+            {"id": job_id},
+            {"$set": {"status": "failed", "last_error": str(e), "updated_at": datetime.now(timezone.utc).isoformat()}},
+        )
+    finally:
+        _whatsapp_report_tasks.pop(job_id, None)
+
+
+def _start_whatsapp_report_job(job_id: str) -> None:
+    if job_id not in _whatsapp_report_tasks:
+        _whatsapp_report_tasks[job_id] = asyncio.create_task(run_whatsapp_report_job(job_id))
+
+
+async def _claim_whatsapp_report_job(query: dict) -> Optional[dict]:
+    now_iso = datetime.now(timezone.utc).isoformat()
+    job = await db.whatsapp_report_jobs.find_one_and_update(
+        query,
+        {"$set": {"status": "running", "heartbeat_at": now_iso, "updated_at": now_iso}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if job:
+        job.pop("_id", None)
+    return job
+
+
+async def heartbeat_whatsapp_report_jobs() -> None:
+    """Perbarui heartbeat job yang task-nya masih hidup di worker ini."""
+    if not _whatsapp_report_tasks:
+        return
+    now_iso = datetime.now(timezone.utc).isoformat()
+    await db.whatsapp_report_jobs.update_many(
+        {"id": {"$in": list(_whatsapp_report_tasks)}, "status": "running"},
+        {"$set": {"heartbeat_at": now_iso}},
+    )
+
+
+async def resume_stale_whatsapp_report_jobs() -> int:
+    """Lanjutkan job 'running' yang ditinggal proses sebelumnya (mis. crash/restart)."""
+    if not WHATSAPP_BOT_URL:
+        return 0
+    stale = (datetime.now(timezone.utc) - timedelta(seconds=WHATSAPP_REPORT_STALE_SECONDS)).isoformat()
+    resumed = 0
+    while True:
+        job = await _claim_whatsapp_report_job({
+            "status": "running",
+            "heartbeat_at": {"$lt": stale},
+            "id": {"$nin": list(_whatsapp_report_tasks)},
+        })
+        if not job:
+            break
+        _start_whatsapp_report_job(job["id"])
+        resumed += 1
+    return resumed
+
+
+@api_router.post("/notifications/whatsapp/daily-report", dependencies=[Depends(get_current_admin)])
+async def trigger_daily_whatsapp_report(tanggal: Optional[str] = None, force: bool = False):
+    """Bangun rekap absensi sholat per wali untuk 1 hari dan kirim ke WA Bot service.
+
+    Endpoint ini TIDAK mengirim WhatsApp langsung, hanya memanggil service bot eksternal
+    melalui WHATSAPP_BOT_URL (kalau diset). Pengiriman berjalan di background sebagai job;
+    pantau lewat GET /notifications/whatsapp/daily-report/{job_id}. Kalau WHATSAPP_BOT_URL
+    tidak diset, hanya mengembalikan payload yang akan dikirim, supaya mudah dites.
+    """
+    if not tanggal:
+        tanggal = get_today_local_iso()
+
+    # Kalau env WA bot tidak diset, hanya kembalikan payload (untuk debugging)
+    if not WHATSAPP_BOT_URL:
+        reports = [r async for r in iter_daily_wali_reports(tanggal)]
+        if not reports:
+            return {"tanggal": tanggal, "reports": [], "message": "Tidak ada data absensi untuk tanggal ini"}
+        batch = DailyWaliReportBatch(tanggal=tanggal, reports=reports)
+        return {"whatsapp_bot_url": None, "payload": batch.model_dump(exclude_none=True)}
+
+    existing = await db.whatsapp_report_jobs.find_one(
+        {"tanggal": tanggal}, {"_id": 0}, sort=[("created_at", -1)]
+    )
+    if existing and existing["status"] == "running":
+        return {"message": "Rekap tanggal ini sedang dikirim", **_whatsapp_job_view(existing)}
+    if existing and existing["status"] == "failed" and not force:
+        job = await _claim_whatsapp_report_job({"id": existing["id"], "status": "failed"})
+        if job:
+            _start_whatsapp_report_job(job["id"])
+            return {"message": "Melanjutkan rekap dari wali terakhir yang terkirim", **_whatsapp_job_view(job)}
+    if existing and existing["status"] == "completed" and not force:
+        return {"message": "Rekap tanggal ini sudah terkirim (gunakan force=true untuk kirim ulang)",
+                **_whatsapp_job_view(existing)}
+
+    total = await count_daily_wali_reports(tanggal)
+    if total == 0:
+        return {"tanggal": tanggal, "reports": [], "message": "Tidak ada data absensi untuk tanggal ini"}
+
+    now_iso = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "tanggal": tanggal,
+        "status": "running",
+        "total_wali": total,
+        "sent": 0,
+        "failed": 0,
+        "chunks_acked": 0,
+        "last_acked_wali": None,
+        "failures": [],
+        "heartbeat_at": now_iso,
+        "created_at": now_iso,
+        "updated_at": now_iso,
+    }
+    await db.whatsapp_report_jobs.insert_one(dict(job))
+    _start_whatsapp_report_job(job["id"])
+    return {"message": "Rekap sedang dikirim ke WhatsApp Bot", "whatsapp_bot_url": WHATSAPP_BOT_URL,
+            **_whatsapp_job_view(job)}
+
+
+def _whatsapp_bot_queue_url() -> Optional[str]:
+    if WHATSAPP_BOT_QUEUE_URL:
+        return WHATSAPP_BOT_QUEUE_URL
+    if not WHATSAPP_BOT_URL:
+        return None
+    parsed = urlsplit(WHATSAPP_BOT_URL)
+    return f"{parsed.scheme}://{parsed.netloc}/queue"
+
+
+async def fetch_whatsapp_bot_queue(job_id: str) -> Optional[dict]:
+    """Status antrian kirim di bot untuk satu job (None kalau bot tidak bisa dihubungi)."""
+    url = _whatsapp_bot_queue_url()
+    if not url:
+        return None
+    try:
+        async with http_request("GET", url, params={"job_id": job_id, "status": "failed"}, timeout=5) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json()
+    except Exception as e:
+        logging.error(f"Gagal membaca antrian WhatsApp Bot: {e}")
+        return None
+    return {
+        "connected": data.get("connected"),
+        "counts": data.get("counts", {}),
+        "failed_items": [
+            {"wali_nomor": m.get("wali_nomor"), "attempts": m.get("attempts"), "error": m.get("last_error")}
+            for m in data.get("items", [])
+        ],
+    }
+
+
+@api_router.get("/notifications/whatsapp/daily-report/{job_id}", dependencies=[Depends(get_current_admin)])
+async def get_daily_whatsapp_report_job(job_id: str):
+    """Status job rekap harian.
+
+    sent/failed/pending di level job = wali yang sudah diterima antrian bot; status
+    pengiriman WhatsApp sebenarnya per wali ada di `bot_queue` (dibaca dari GET /queue bot).
+    """
+    job = await db.whatsapp_report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job rekap tidak ditemukan")
+    return {
+        **_whatsapp_job_view(job),
+        "active_in_this_worker": job_id in _whatsapp_report_tasks,
+        "bot_queue": await fetch_whatsapp_bot_queue(job_id),
+    }
+
+
+@api_router.post("/notifications/whatsapp/daily-report/{job_id}/resume", dependencies=[Depends(get_current_admin)])
+async def resume_daily_whatsapp_report_job(job_id: str):
+    """Lanjutkan job yang gagal/terhenti dari wali terakhir yang di-ack bot."""
+    if not WHATSAPP_BOT_URL:
+        raise HTTPException(status_code=400, detail="WHATSAPP_BOT_URL belum diset")
+    if job_id in _whatsapp_report_tasks:
+        raise HTTPException(status_code=409, detail="Job masih berjalan")
+    stale = (datetime.now(timezone.utc) - timedelta(seconds=WHATSAPP_REPORT_STALE_SECONDS)).isoformat()
+    job = await _claim_whatsapp_report_job({
+        "id": job_id,
+        "$or": [{"status": "failed"}, {"status": "running", "heartbeat_at": {"$lt": stale}}],
+    })
+    if not job:
+        raise HTTPException(status_code=409, detail="Job tidak dapat dilanjutkan (sudah selesai atau masih berjalan)")
+    _start_whatsapp_report_job(job_id)
+    return {"message": "Job dilanjutkan", **_whatsapp_job_view(job)}
+
+
+
+# ==================== AUTHENTIKASI PENGABSEN (PWA - Kode Akses) ====================
+
+@api_router.post("/pengabsen/login", response_model=PengabsenTokenResponse)
+async def login_pengabsen(request: PengabsenLoginRequest):
+    pengabsen = await db.pengabsen.find_one({"username": request.username}, {"_id": 0})
+
+    if not pengabsen:
+        raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Username atau kode akses salah"
         )
@@ -2338,6 +4525,7 @@ async def login(request: LoginRequest):
     role = admin.get("role", "superadmin")
     if "role" not in admin:
         await db.admins.update_one({"id": admin["id"]}, {"$set": {"role": role}})
+        invalidate_principal_cache("admin", admin["id"])
         admin["role"] = role
 
     access_token = create_access_token(data={"sub": admin["id"], "role": role})
@@ -2469,6 +4657,7 @@ async def create_asrama(data: AsramaCreate, _: dict = Depends(get_current_admin)
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.asrama.insert_one(doc)
+    invalidate_reference_cache("asrama")
     return asrama_obj
 
 @api_router.put("/asrama/{asrama_id}", response_model=Asrama)
@@ -2488,6 +4677,7 @@ async def update_asrama(asrama_id: str, data: AsramaUpdate, _: dict = Depends(ge
             update_data["nfc_uid"] = None
     if update_data:
         await db.asrama.update_one({"id": asrama_id}, {"$set": update_data})
+        invalidate_reference_cache("asrama")
         asrama.update(update_data)
     
     if isinstance(asrama['created_at'], str):
@@ -2498,6 +4688,7 @@ async def update_asrama(asrama_id: str, data: AsramaUpdate, _: dict = Depends(ge
 @api_router.delete("/asrama/{asrama_id}")
 async def delete_asrama(asrama_id: str, _: dict = Depends(get_current_admin)):
     result = await db.asrama.delete_one({"id": asrama_id})
+    invalidate_reference_cache("asrama")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Asrama tidak ditemukan")
     return {"message": "Asrama berhasil dihapus"}
@@ -2516,7 +4707,7 @@ async def get_santri(
     if asrama_id:
         query['asrama_id'] = asrama_id
     
-    santri_list = await db.santri.find(query, {"_id": 0, "qr_code": 0}).to_list(1000)
+    santri_list = await db.santri.find(query, ROSTER_PROJECTIONS["santri_admin"]).to_list(1000)
     
     # Get all santri IDs that are linked to madrasah
     santri_ids = [s["id"] for s in santri_list]
@@ -2564,7 +4755,7 @@ async def create_santri(data: SantriCreate, _: dict = Depends(get_current_admin)
         "nama": data.nama,
         "nis": data.nis
     }
-    qr_code = generate_qr_code(qr_data)
+    qr_code = await generate_qr_code_async(qr_data)
     
     santri_dict = data.model_dump()
     if santri_dict.get("nfc_uid"):
@@ -2572,30 +4763,36 @@ async def create_santri(data: SantriCreate, _: dict = Depends(get_current_admin)
     else:
         santri_dict["nfc_uid"] = None
     santri_dict['id'] = santri_id
-    santri_dict['qr_code'] = qr_code
     santri_dict['created_at'] = datetime.now(timezone.utc)
     santri_dict['updated_at'] = datetime.now(timezone.utc)
     
     santri_obj = Santri(**santri_dict)
-    doc = santri_obj.model_dump()
+    doc = santri_obj.model_dump(exclude={'qr_code'})
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.santri.insert_one(doc)
+    await db.santri_qr.insert_one(santri_qr_doc(santri_id, qr_code))
     
-    # Sync wali santri
-    await sync_wali_santri()
+    # Sync wali santri (hanya wali santri ini)
+    await sync_wali_santri([doc.get("nomor_hp_wali")])
     
     return SantriResponse(**{k: v for k, v in santri_obj.model_dump().items() if k != 'qr_code'})
 
 @api_router.get("/santri/{santri_id}/qr-code")
-async def get_santri_qr_code(santri_id: str, _: dict = Depends(get_current_admin)):
-    santri = await db.santri.find_one({"id": santri_id}, {"_id": 0})
+async def get_santri_qr_code(santri_id: str, request: Request, _: dict = Depends(get_current_admin)):
+    santri = await db.santri.find_one({"id": santri_id}, {"_id": 0, "id": 1, "nama": 1, "nis": 1, "qr_code": 1})
     if not santri:
         raise HTTPException(status_code=404, detail="Santri tidak ditemukan")
     
-    img_data = base64.b64decode(santri['qr_code'])
-    return Response(content=img_data, media_type="image/png")
+    qr = await get_santri_qr(santri)
+    etag = f'"{qr["etag"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    img_data = base64.b64decode(qr['qr_code'])
+    return Response(content=img_data, media_type="image/png", headers=headers)
 
 @api_router.put("/santri/{santri_id}", response_model=SantriResponse)
 async def update_santri(santri_id: str, data: SantriUpdate, _: dict = Depends(get_current_admin)):
@@ -2620,14 +4817,16 @@ async def update_santri(santri_id: str, data: SantriUpdate, _: dict = Depends(ge
         if not asrama:
             raise HTTPException(status_code=404, detail="Asrama tidak ditemukan")
     
+    old_nomor_hp_wali = santri.get("nomor_hp_wali")
+
     if update_data:
         update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
         await db.santri.update_one({"id": santri_id}, {"$set": update_data})
         santri.update(update_data)
     
-    # Sync wali if wali data changed
-    if any(k in update_data for k in ['nama_wali', 'nomor_hp_wali', 'email_wali']):
-        await sync_wali_santri()
+    # Sync wali if wali data changed (wali lama + wali baru saja)
+    if any(k in update_data for k in ['nama', 'nama_wali', 'nomor_hp_wali', 'email_wali']):
+        await sync_wali_santri([old_nomor_hp_wali, santri.get("nomor_hp_wali")])
     
     # Sync siswa_madrasah if linked
     if any(k in update_data for k in ['nama', 'nis', 'gender']):
@@ -2701,12 +4900,13 @@ async def get_santri_madrasah_status(santri_id: str, _: dict = Depends(get_curre
 
 @api_router.delete("/santri/{santri_id}")
 async def delete_santri(santri_id: str, _: dict = Depends(get_current_admin)):
-    result = await db.santri.delete_one({"id": santri_id})
-    if result.deleted_count == 0:
+    deleted = await db.santri.find_one_and_delete({"id": santri_id}, projection={"_id": 0, "nomor_hp_wali": 1})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Santri tidak ditemukan")
     
     # Sync wali after deletion
-    await sync_wali_santri()
+    await sync_wali_santri([deleted.get("nomor_hp_wali")])
+    await db.santri_qr.delete_one({"santri_id": santri_id})
     
     # Also delete siswa_madrasah yang linked ke santri ini
     await db.siswa_madrasah.delete_many({"santri_id": santri_id})
@@ -2742,89 +4942,551 @@ async def download_santri_template(_: dict = Depends(get_current_admin)):
         headers={'Content-Disposition': 'attachment; filename=template_santri.xlsx'}
     )
 
+SANTRI_IMPORT_BATCH_SIZE = 500
+
+
+def _clean_santri_import_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Bersihkan kolom import secara vectorised dan tandai error per baris."""
+    df = df.rename(columns=lambda c: str(c).strip())
+    if "email_wali" not in df.columns:
+        df["email_wali"] = ""
+
+    text_columns = ['nama', 'nis', 'gender', 'asrama_id', 'nama_wali', 'nomor_hp_wali', 'email_wali']
+    for col in text_columns:
+        df[col] = df[col].fillna("").astype(str).str.strip()
+    # Angka dari Excel kadang terbaca "123.0"
+    for col in ['nis', 'nomor_hp_wali']:
+        df[col] = df[col].str.replace(r"\.0$", "", regex=True)
+    df["gender"] = df["gender"].str.lower()
+
+    df["baris"] = df.index + 2  # baris 1 = header Excel
+    df["error"] = ""
+    return df
+
+
+def _mark_import_error(df: pd.DataFrame, mask: pd.Series, message: str):
+    target = mask & (df["error"] == "")
+    df.loc[target, "error"] = message
+
+
 @api_router.post("/santri/import")
-async def import_santri(file: UploadFile = File(...), _: dict = Depends(get_current_admin)):
-    """Import santri dari Excel"""
+async def import_santri(
+    file: UploadFile = File(...),
+    dry_run: bool = False,
+    _: dict = Depends(get_current_admin),
+):
+    """Import santri dari Excel (bulk).
+
+    - NIS & asrama divalidasi terhadap set yang diambil sekali dari database.
+    - QR dirender di process pool, data ditulis dengan insert_many (ordered=False).
+    - `dry_run=true` hanya memvalidasi tanpa menulis.
+    - Hasil per baris bisa diunduh lewat /santri/import/{report_id}/hasil.
+    """
     try:
         contents = await file.read()
-        df = pd.read_excel(io.BytesIO(contents))
+        df = pd.read_excel(io.BytesIO(contents), dtype=str)
         
         required_columns = ['nama', 'nis', 'gender', 'asrama_id', 'nama_wali', 'nomor_hp_wali']
-        if not all(col in df.columns for col in required_columns):
+        if not all(col in df.columns.str.strip() for col in required_columns):
             raise HTTPException(status_code=400, detail="Format Excel tidak sesuai template")
         
-        success_count = 0
-        error_list = []
-        
-        for idx, row in df.iterrows():
-            try:
-                # Check if NIS exists
-                existing = await db.santri.find_one({"nis": str(row['nis'])})
-                if existing:
-                    error_list.append(f"Baris {idx+2}: NIS {row['nis']} sudah ada")
-                    continue
-                
-                # Verify asrama
-                asrama = await db.asrama.find_one({"id": str(row['asrama_id'])})
-                if not asrama:
-                    error_list.append(f"Baris {idx+2}: Asrama ID tidak ditemukan")
-                    continue
-                
-                santri_id = str(uuid.uuid4())
-                qr_data = {"santri_id": santri_id, "nama": str(row['nama']), "nis": str(row['nis'])}
-                qr_code = generate_qr_code(qr_data)
-                
-                santri_doc = {
-                    'id': santri_id,
-                    'nama': str(row['nama']),
-                    'nis': str(row['nis']),
-                    'gender': str(row['gender']),
-                    'asrama_id': str(row['asrama_id']),
-                    'nama_wali': str(row['nama_wali']),
-                    'nomor_hp_wali': str(row['nomor_hp_wali']),
-                    'email_wali': str(row.get('email_wali', '')),
-                    'qr_code': qr_code,
-                    'created_at': datetime.now(timezone.utc).isoformat(),
-                    'updated_at': datetime.now(timezone.utc).isoformat()
+        df = _clean_santri_import_frame(df)
+
+        existing_nis = set(await db.santri.distinct("nis"))
+        asrama_ids = {a["id"] for a in await db.asrama.find({}, {"_id": 0, "id": 1}).to_list(1000)}
+
+        for col in required_columns:
+            _mark_import_error(df, df[col] == "", f"Kolom {col} wajib diisi")
+        _mark_import_error(df, ~df["gender"].isin(["putra", "putri"]), "Gender harus putra atau putri")
+        _mark_import_error(df, df["nis"].isin(existing_nis), "NIS sudah ada")
+        _mark_import_error(df, df["nis"].duplicated(keep="first"), "NIS duplikat di dalam file")
+        _mark_import_error(df, ~df["asrama_id"].isin(asrama_ids), "Asrama ID tidak ditemukan")
+
+        valid = df[df["error"] == ""].copy()
+        valid["id"] = [str(uuid.uuid4()) for _ in range(len(valid))]
+        df["status"] = "error"
+        df.loc[valid.index, "status"] = "valid" if dry_run else "berhasil"
+
+        if not dry_run and len(valid):
+            qr_payloads = [
+                {"santri_id": r.id, "nama": r.nama, "nis": r.nis}
+                for r in valid.itertuples(index=False)
+            ]
+            qr_codes = await render_qr_codes_bulk(qr_payloads)
+
+            now_iso = datetime.now(timezone.utc).isoformat()
+            docs = [
+                {
+                    'id': r.id,
+                    'nama': r.nama,
+                    'nis': r.nis,
+                    'gender': r.gender,
+                    'asrama_id': r.asrama_id,
+                    'nfc_uid': None,
+                    'nama_wali': r.nama_wali,
+                    'nomor_hp_wali': r.nomor_hp_wali,
+                    'email_wali': r.email_wali or None,
+                    'created_at': now_iso,
+                    'updated_at': now_iso,
                 }
-                
-                await db.santri.insert_one(santri_doc)
-                success_count += 1
-                
-            except Exception as e:
-                error_list.append(f"Baris {idx+2}: {str(e)}")
-        
+                for r in valid.itertuples(index=False)
+            ]
+            qr_docs = [santri_qr_doc(d['id'], qr) for d, qr in zip(docs, qr_codes)]
+            row_index = list(valid.index)
+
+            for start in range(0, len(docs), SANTRI_IMPORT_BATCH_SIZE):
+                batch = docs[start:start + SANTRI_IMPORT_BATCH_SIZE]
+                failed_positions = set()
+                try:
+                    await db.santri.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    for write_error in e.details.get("writeErrors", []):
+                        failed_positions.add(write_error["index"])
+                        idx = row_index[start + write_error["index"]]
+                        df.loc[idx, "status"] = "error"
+                        df.loc[idx, "error"] = write_error.get("errmsg", "Gagal menyimpan")
+
+                qr_batch = [
+                    q for i, q in enumerate(qr_docs[start:start + SANTRI_IMPORT_BATCH_SIZE])
+                    if i not in failed_positions
+                ]
+                if qr_batch:
+                    await db.santri_qr.insert_many(qr_batch, ordered=False)
+
+        ok_mask = df["status"] != "error"
+        success_count = int(ok_mask.sum())
+        error_rows = df[~ok_mask]
+        error_list = [f"Baris {r.baris}: {r.error}" for r in error_rows.itertuples(index=False)]
+
         # Sync wali after import
-        await sync_wali_santri()
+        if not dry_run and success_count:
+            await sync_wali_santri(df.loc[ok_mask, "nomor_hp_wali"].unique().tolist())
+
+        report_id = str(uuid.uuid4())
+        await db.santri_import_reports.insert_one(
+            {
+                "id": report_id,
+                "filename": file.filename,
+                "dry_run": dry_run,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "rows": df[["baris", "nis", "nama", "asrama_id", "status", "error"]].to_dict("records"),
+            }
+        )
         
         return {
-            "message": "Import selesai",
+            "message": "Validasi selesai" if dry_run else "Import selesai",
+            "dry_run": dry_run,
+            "total": len(df),
             "success": success_count,
-            "errors": error_list
+            "failed": len(error_rows),
+            "errors": error_list,
+            "report_id": report_id,
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing file: {str(e)}")
 
-@api_router.get("/santri/export")
-async def export_santri(_: dict = Depends(get_current_admin)):
-    """Export semua santri ke Excel"""
-    santri_list = await db.santri.find({}, {"_id": 0, "qr_code": 0}).to_list(10000)
-    
-    if not santri_list:
-        raise HTTPException(status_code=404, detail="Tidak ada data santri")
-    
-    df = pd.DataFrame(santri_list)
-    
+
+@api_router.get("/santri/import/{report_id}/hasil")
+async def download_santri_import_report(report_id: str, _: dict = Depends(get_current_admin)):
+    """Unduh hasil import per baris (status + pesan error) dalam Excel"""
+    report = await db.santri_import_reports.find_one({"id": report_id}, {"_id": 0})
+    if not report:
+        raise HTTPException(status_code=404, detail="Hasil import tidak ditemukan")
+
+    df = pd.DataFrame(report.get("rows", []), columns=["baris", "nis", "nama", "asrama_id", "status", "error"])
+
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Data Santri')
+        df.to_excel(writer, index=False, sheet_name='Hasil Import')
     output.seek(0)
-    
+
     return StreamingResponse(
         output,
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename=data_santri.xlsx'}
+        headers={'Content-Disposition': f'attachment; filename=hasil_import_{report_id}.xlsx'}
+    )
+
+@api_router.get("/santri/export")
+async def export_santri(
+    format: Literal["xlsx", "csv"] = "xlsx",
+    background: bool = False,
+    _: dict = Depends(get_current_admin),
+):
+    """Export semua santri ke Excel (atau CSV)"""
+    if not await db.santri.find_one({}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="Tidak ada data santri")
+    if background:
+        return await create_export_job("santri", format, {})
+    return await stream_export("santri", format, {})
+
+# ==================== STREAMING EXPORT ====================
+
+# Export dibaca langsung dari cursor Motor per batch lalu ditulis ke CSV (di-stream
+# per batch) atau workbook openpyxl write-only (baris ditulis ke file sementara,
+# bukan ke memori), sehingga memori tetap konstan berapa pun jumlah datanya.
+# Mode background menyimpan file di EXPORT_DIR untuk diunduh kemudian; job yang
+# task-nya hidup di-heartbeat oleh sweep job di dispatcher notifikasi, job tanpa
+# heartbeat (proses mati/restart) ditandai failed agar tidak menggantung.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_DIR = Path(os.environ.get("EXPORT_DIR", str(ROOT_DIR / "exports")))
+EXPORT_RETENTION_HOURS = 24
+EXPORT_FILE_CHUNK_BYTES = 64 * 1024
+EXPORT_MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+}
+EXPORT_JOB_STALE_SECONDS = WHATSAPP_REPORT_STALE_SECONDS
+
+_export_tasks: Dict[str, asyncio.Task] = {}
+
+
+async def _export_santri_rows(docs: List[dict]) -> List[list]:
+    asrama_map = await get_reference_map("asrama")
+    return [
+        [d.get("id"), d.get("nama"), d.get("nis"), d.get("gender"), d.get("asrama_id"),
+         asrama_map.get(d.get("asrama_id"), "-"), d.get("nfc_uid"), d.get("nama_wali"),
+         d.get("nomor_hp_wali"), d.get("email_wali"), d.get("created_at")]
+        for d in docs
+    ]
+
+
+async def _export_absensi_rows(docs: List[dict]) -> List[list]:
+    ids = list({d["santri_id"] for d in docs})
+    santri_map = {
+        s["id"]: s for s in await db.santri.find({"id": {"$in": ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(len(ids))
+    }
+    asrama_map = await get_reference_map("asrama")
+    pengabsen_map = await get_reference_map("pengabsen")
+    rows = []
+    for d in docs:
+        santri = santri_map.get(d["santri_id"], {})
+        rows.append([
+            d.get("tanggal"), d.get("waktu_sholat"), santri.get("nis"), santri.get("nama"),
+            asrama_map.get(santri.get("asrama_id"), "-"), d.get("status"),
+            pengabsen_map.get(d.get("pengabsen_id"), "-"), d.get("waktu_absen"),
+        ])
+    return rows
+
+
+async def _export_siswa_rows(docs: List[dict], collection: str, group_field: str, group_ref: str,
+                             extra_field: Optional[str], with_nis: bool = True) -> List[list]:
+    ids = list({d["siswa_id"] for d in docs})
+    siswa_map = {
+        s["id"]: s for s in await db[collection].find(
+            {"id": {"$in": ids}}, ROSTER_PROJECTIONS[f"{collection}_lean"]
+        ).to_list(len(ids))
+    }
+    group_map = await get_reference_map(group_ref)
+    rows = []
+    for d in docs:
+        siswa = siswa_map.get(d["siswa_id"], {})
+        row = [d.get("tanggal")]
+        if extra_field:
+            row.append(d.get(extra_field))
+        if with_nis:
+            row.append(siswa.get("nis"))
+        row += [
+            siswa.get("nama"),
+            group_map.get(d.get(group_field) or siswa.get(group_field), "-"),
+            d.get("status"), d.get("waktu_absen"),
+        ]
+        rows.append(row)
+    return rows
+
+
+EXPORT_SPECS: Dict[str, Dict[str, Any]] = {
+    "santri": {
+        "collection": "santri",
+        "projection": ROSTER_PROJECTIONS["santri_admin"],
+        "sort": [("nama", 1)],
+        "dated": False,
+        "sheet": "Data Santri",
+        "columns": ["id", "nama", "nis", "gender", "asrama_id", "nama_asrama", "nfc_uid",
+                    "nama_wali", "nomor_hp_wali", "email_wali", "created_at"],
+        "rows": _export_santri_rows,
+    },
+    "absensi": {
+        "collection": "absensi",
+        "projection": {"_id": 0},
+        "sort": [("tanggal", 1)],
+        "dated": True,
+        "sheet": "Absensi Sholat",
+        "columns": ["tanggal", "waktu_sholat", "nis", "nama", "asrama", "status", "pengabsen", "waktu_absen"],
+        "rows": _export_absensi_rows,
+    },
+    "absensi_kelas": {
+        "collection": "absensi_kelas",
+        "projection": {"_id": 0},
+        "sort": [("tanggal", 1)],
+        "dated": True,
+        "sheet": "Absensi Madrasah",
+        "columns": ["tanggal", "nis", "nama", "kelas", "status", "waktu_absen"],
+        "rows": lambda docs: _export_siswa_rows(docs, "siswa_madrasah", "kelas_id", "kelas", None),
+    },
+    "absensi_aliyah": {
+        "collection": "absensi_aliyah",
+        "projection": {"_id": 0},
+        "sort": [("tanggal", 1)],
+        "dated": True,
+        "sheet": "Absensi Aliyah",
+        "columns": ["tanggal", "jenis", "nis", "nama", "kelas", "status", "waktu_absen"],
+        "rows": lambda docs: _export_siswa_rows(docs, "siswa_aliyah", "kelas_id", "kelas_aliyah", "jenis"),
+    },
+    "absensi_pmq": {
+        "collection": "absensi_pmq",
+        "projection": {"_id": 0},
+        "sort": [("tanggal", 1)],
+        "dated": True,
+        "sheet": "Absensi PMQ",
+        # Siswa PMQ tidak punya NIS
+        "columns": ["tanggal", "sesi", "nama", "kelompok", "status", "waktu_absen"],
+        "rows": lambda docs: _export_siswa_rows(docs, "siswa_pmq", "kelompok_id", "pmq_kelompok", "sesi", with_nis=False),
+    },
+}
+
+
+def _export_query(jenis: str, params: Dict[str, Any]) -> dict:
+    if not EXPORT_SPECS[jenis]["dated"]:
+        return {}
+    return {"tanggal": {"$gte": params["tanggal_start"], "$lte": params["tanggal_end"]}}
+
+
+def _export_filename(jenis: str, fmt: str, params: Dict[str, Any]) -> str:
+    if EXPORT_SPECS[jenis]["dated"]:
+        return f"{jenis}_{params['tanggal_start']}_{params['tanggal_end']}.{fmt}"
+    return f"data_{jenis}.{fmt}"
+
+
+async def iter_export_batches(jenis: str, params: Dict[str, Any]):
+    """Baris export per batch (list of list), dibaca berurutan dari cursor."""
+    spec = EXPORT_SPECS[jenis]
+    cursor = db[spec["collection"]].find(_export_query(jenis, params), spec["projection"]).sort(spec["sort"])
+    batch: List[dict] = []
+    async for doc in cursor.batch_size(EXPORT_BATCH_SIZE):
+        batch.append(doc)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield await spec["rows"](batch)
+            batch = []
+    if batch:
+        yield await spec["rows"](batch)
+
+
+def _csv_chunk(rows: List[list]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def write_export_file(jenis: str, fmt: str, params: Dict[str, Any], path: Path) -> int:
+    """Tulis export ke `path`; mengembalikan jumlah baris data."""
+    spec = EXPORT_SPECS[jenis]
+    count = 0
+    if fmt == "csv":
+        # Tulis ke disk di thread (seperti workbook.save) agar event loop tidak terblokir
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            # BOM supaya Excel membaca UTF-8 dengan benar
+            await asyncio.to_thread(f.write, b"\xef\xbb\xbf" + _csv_chunk([spec["columns"]]))
+            async for rows in iter_export_batches(jenis, params):
+                await asyncio.to_thread(f.write, _csv_chunk(rows))
+                count += len(rows)
+        finally:
+            await asyncio.to_thread(f.close)
+        return count
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(spec["sheet"])
+    sheet.append(spec["columns"])
+    async for rows in iter_export_batches(jenis, params):
+        for row in rows:
+            sheet.append(row)
+        count += len(rows)
+    # Menyusun zip workbook bersifat blocking; jalankan di thread
+    await asyncio.to_thread(workbook.save, str(path))
+    return count
+
+
+def _iter_file(path: Path, remove: bool = False):
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(EXPORT_FILE_CHUNK_BYTES):
+                yield chunk
+    finally:
+        if remove:
+            path.unlink(missing_ok=True)
+
+
+async def stream_export(jenis: str, fmt: str, params: Dict[str, Any]) -> StreamingResponse:
+    filename = _export_filename(jenis, fmt, params)
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+
+    if fmt == "csv":
+        spec = EXPORT_SPECS[jenis]
+
+        async def generate():
+            yield b"\xef\xbb\xbf" + _csv_chunk([spec["columns"]])
+            async for rows in iter_export_batches(jenis, params):
+                yield _csv_chunk(rows)
+
+        return StreamingResponse(generate(), media_type=EXPORT_MEDIA_TYPES["csv"], headers=headers)
+
+    # XLSX baru bisa dikirim setelah zip selesai; baris tetap ditulis ke file, bukan memori
+    (EXPORT_DIR / "tmp").mkdir(parents=True, exist_ok=True)
+    path = EXPORT_DIR / "tmp" / f"{uuid.uuid4()}.xlsx"
+    try:
+        await write_export_file(jenis, fmt, params, path)
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    return StreamingResponse(_iter_file(path, remove=True), media_type=EXPORT_MEDIA_TYPES["xlsx"], headers=headers)
+
+
+async def _prune_export_jobs() -> None:
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=EXPORT_RETENTION_HOURS)).isoformat()
+    expired = await db.export_jobs.find(
+        {"created_at": {"$lt": cutoff}}, {"_id": 0, "id": 1, "path": 1}
+    ).to_list(1000)
+    for job in expired:
+        if job.get("path"):
+            Path(job["path"]).unlink(missing_ok=True)
+    if expired:
+        await db.export_jobs.delete_many({"id": {"$in": [j["id"] for j in expired]}})
+
+
+async def run_export_job(job_id: str) -> None:
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        return
+    path = EXPORT_DIR / f"{job_id}.{job['format']}"
+    try:
+        EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+        await db.export_jobs.update_one(
+            {"id": job_id}, {"$set": {"status": "running", "heartbeat_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        rows = await write_export_file(job["jenis"], job["format"], job["params"], path)
+        await db.export_jobs.update_one(
+            {"id": job_id},
+            {"$set": {
+                "status": "completed",
+                "rows": rows,
+                "path": str(path),
+                "size_bytes": path.stat().st_size,
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+            }},
+        )
+    except Exception as e:
+        logging.error(f"Export job {job_id} gagal: {e}")
+        path.unlink(missing_ok=True)
+        await db.export_jobs.update_one(
+            {"id": job_id},
+            {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()}},
+        )
+    finally:
+        _export_tasks.pop(job_id, None)
+
+
+async def create_export_job(jenis: str, fmt: str, params: Dict[str, Any]) -> dict:
+    await _prune_export_jobs()
+    job = {
+        "id": str(uuid.uuid4()),
+        "jenis": jenis,
+        "format": fmt,
+        "params": params,
+        "filename": _export_filename(jenis, fmt, params),
+        "status": "pending",
+        "rows": None,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    await db.export_jobs.insert_one({**job, "heartbeat_at": job["created_at"]})
+    _export_tasks[job["id"]] = asyncio.create_task(run_export_job(job["id"]))
+    return job
+
+
+async def heartbeat_export_jobs() -> None:
+    """Perbarui heartbeat job export yang task-nya masih hidup di worker ini."""
+    if not _export_tasks:
+        return
+    await db.export_jobs.update_many(
+        {"id": {"$in": list(_export_tasks)}, "status": {"$in": ["pending", "running"]}},
+        {"$set": {"heartbeat_at": datetime.now(timezone.utc).isoformat()}},
+    )
+
+
+async def fail_orphaned_export_jobs() -> int:
+    """Tandai failed job export 'pending'/'running' yang ditinggal proses sebelumnya."""
+    now = datetime.now(timezone.utc)
+    stale = (now - timedelta(seconds=EXPORT_JOB_STALE_SECONDS)).isoformat()
+    query = {
+        "status": {"$in": ["pending", "running"]},
+        "$or": [{"heartbeat_at": {"$lt": stale}}, {"heartbeat_at": {"$exists": False}}],
+    }
+    orphaned = await db.export_jobs.find(
+        {**query, "id": {"$nin": list(_export_tasks)}}, {"_id": 0, "id": 1, "format": 1}
+    ).to_list(1000)
+    failed = 0
+    for job in orphaned:
+        # Filter diulang: job yang baru di-heartbeat worker lain tidak ikut ditandai
+        result = await db.export_jobs.update_one(
+            {**query, "id": job["id"]},
+            {"$set": {
+                "status": "failed",
+                "error": "Proses server berhenti sebelum export selesai, silakan ulangi export",
+                "finished_at": now.isoformat(),
+            }},
+        )
+        if result.matched_count:
+            (EXPORT_DIR / f"{job['id']}.{job.get('format')}").unlink(missing_ok=True)
+            failed += 1
+    return failed
+
+
+@api_router.get("/admin/export/{jenis}")
+async def export_absensi(
+    jenis: Literal["absensi", "absensi_kelas", "absensi_aliyah", "absensi_pmq"],
+    tanggal_start: str,
+    tanggal_end: str,
+    format: Literal["xlsx", "csv"] = "xlsx",
+    background: bool = False,
+    _: dict = Depends(get_current_admin),
+):
+    """Export absensi satu rentang tanggal ke Excel/CSV.
+
+    Dengan `background=true` file dibuat di belakang layar; pantau lewat
+    GET /admin/export-jobs/{job_id} lalu unduh di /admin/export-jobs/{job_id}/download.
+    """
+    if tanggal_start > tanggal_end:
+        raise HTTPException(status_code=400, detail="tanggal_start harus sebelum tanggal_end")
+    params = {"tanggal_start": tanggal_start, "tanggal_end": tanggal_end}
+    if background:
+        return await create_export_job(jenis, format, params)
+    return await stream_export(jenis, format, params)
+
+
+@api_router.get("/admin/export-jobs/{job_id}")
+async def get_export_job(job_id: str, _: dict = Depends(get_current_admin)):
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0, "path": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job export tidak ditemukan")
+    return job
+
+
+@api_router.get("/admin/export-jobs/{job_id}/download")
+async def download_export_job(job_id: str, _: dict = Depends(get_current_admin)):
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job export tidak ditemukan")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Export belum selesai (status: {job['status']})")
+    path = Path(job["path"])
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="File export sudah tidak tersedia")
+    return StreamingResponse(
+        _iter_file(path),
+        media_type=EXPORT_MEDIA_TYPES[job["format"]],
+        headers={"Content-Disposition": f"attachment; filename={job['filename']}"},
     )
 
 # ==================== WALI SANTRI ENDPOINTS (AUTO-GENERATED) ====================
@@ -2852,10 +5514,11 @@ class WaliTokenResponse(BaseModel):
 
 @api_router.get("/wali", response_model=List[WaliSantriResponse])
 async def get_wali(_: dict = Depends(get_current_admin)):
-    """Get all wali santri (auto-generated from santri data)"""
-    # Trigger sync first
-    await sync_wali_santri()
-    
+    """Get all wali santri (auto-generated from santri data).
+
+    Data wali sudah disinkron incremental setiap kali santri berubah;
+    gunakan POST /wali/sync untuk full resync.
+    """
     wali_list = await db.wali_santri.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     
     for wali in wali_list:
@@ -2867,21 +5530,16 @@ async def get_wali(_: dict = Depends(get_current_admin)):
     return wali_list
 
 
-async def get_current_wali(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        wali_id: str = payload.get("sub")
-        if wali_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-        wali = await db.wali_santri.find_one({"id": wali_id}, {"_id": 0})
-        if wali is None:
-            raise HTTPException(status_code=401, detail="Wali tidak ditemukan")
+@api_router.post("/wali/sync")
+async def resync_wali(_: dict = Depends(get_current_admin)):
+    """Full resync wali santri dari seluruh data santri (bulk write)."""
+    await sync_wali_santri()
+    total = await db.wali_santri.count_documents({})
+    return {"message": "Sinkronisasi wali selesai", "total_wali": total}
 
-        return wali
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+async def get_current_wali(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await resolve_principal("wali", credentials)
 
 
 class WaliFcmTokenRequest(BaseModel):
@@ -2903,6 +5561,7 @@ async def register_wali_fcm_token(payload: WaliFcmTokenRequest, current_wali: di
     if token not in tokens:
         tokens.append(token)
         await db.wali_santri.update_one({"id": wali_id}, {"$set": {"fcm_tokens": tokens}})
+        invalidate_principal_cache("wali", wali_id)
 
     return {"status": "ok"}
 
@@ -2928,6 +5587,7 @@ async def update_wali(wali_id: str, data: WaliSantriUpdate, _: dict = Depends(ge
     if update_data:
         update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
         await db.wali_santri.update_one({"id": wali_id}, {"$set": update_data})
+        invalidate_principal_cache("wali", wali_id)
         wali.update(update_data)
     
     if isinstance(wali['created_at'], str):
@@ -2940,9 +5600,6 @@ async def update_wali(wali_id: str, data: WaliSantriUpdate, _: dict = Depends(ge
 
 @api_router.post("/wali/login", response_model=WaliTokenResponse)
 async def login_wali(request: WaliLoginRequest):
-    # Pastikan data wali dan anak_ids sudah tersinkron dari data santri
-    await sync_wali_santri()
-
     # Temukan wali berdasarkan username
     wali = await db.wali_santri.find_one({"username": request.username}, {"_id": 0})
 
@@ -2989,10 +5646,10 @@ async def get_wali_anak_absensi_hari_ini(current_wali: dict = Depends(get_curren
     if not anak_ids:
         return {"tanggal": today, "data": []}
 
-    santri_list = await db.santri.find({"id": {"$in": anak_ids}}, {"_id": 0}).to_list(100)
+    santri_list = await db.santri.find({"id": {"$in": anak_ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(100)
     santri_by_id = {s["id"]: s for s in santri_list}
 
-    asrama_map = {a["id"]: a["nama"] for a in await db.asrama.find({}, {"_id": 0}).to_list(1000)}
+    asrama_map = await get_reference_map("asrama")
 
     absensi_list = await db.absensi.find(
         {"tanggal": today, "santri_id": {"$in": list(santri_by_id.keys())}}, {"_id": 0}
@@ -3007,10 +5664,7 @@ async def get_wali_anak_absensi_hari_ini(current_wali: dict = Depends(get_curren
             status_by_santri[sid][waktu_sholat] = status_val
 
     # Map pengabsen_id -> nama untuk referensi
-    pengabsen_map = {
-        p["id"]: p.get("nama", "-")
-        for p in await db.pengabsen.find({}, {"_id": 0, "id": 1, "nama": 1}).to_list(1000)
-    }
+    pengabsen_map = await get_reference_map("pengabsen")
 
     # Hitung pengabsen "utama" per santri (mis. entry terakhir hari itu)
     pengabsen_by_santri: dict[str, Optional[str]] = {}
@@ -3043,10 +5697,10 @@ async def get_wali_anak_absensi_riwayat(tanggal: str, current_wali: dict = Depen
     if not anak_ids:
         return {"tanggal": tanggal, "data": []}
 
-    santri_list = await db.santri.find({"id": {"$in": anak_ids}}, {"_id": 0}).to_list(100)
+    santri_list = await db.santri.find({"id": {"$in": anak_ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(100)
     santri_by_id = {s["id"]: s for s in santri_list}
 
-    asrama_map = {a["id"]: a["nama"] for a in await db.asrama.find({}, {"_id": 0}).to_list(1000)}
+    asrama_map = await get_reference_map("asrama")
 
     absensi_list = await db.absensi.find(
         {"tanggal": tanggal, "santri_id": {"$in": list(santri_by_id.keys())}}, {"_id": 0}
@@ -3061,10 +5715,7 @@ async def get_wali_anak_absensi_riwayat(tanggal: str, current_wali: dict = Depen
             status_by_santri[sid][waktu_sholat] = status_val
 
     # Map pengabsen_id -> nama untuk referensi
-    pengabsen_map = {
-        p["id"]: p.get("nama", "-")
-        for p in await db.pengabsen.find({}, {"_id": 0, "id": 1, "nama": 1}).to_list(1000)
-    }
+    pengabsen_map = await get_reference_map("pengabsen")
 
     pengabsen_by_santri: dict[str, Optional[str]] = {}
     for a in absensi_list:
@@ -3116,7 +5767,7 @@ async def get_wali_absensi_kelas(
     # Get all siswa_madrasah linked to these santri
     siswa_list = await db.siswa_madrasah.find(
         {"santri_id": {"$in": anak_ids}},
-        {"_id": 0}
+        ROSTER_PROJECTIONS["siswa_madrasah_lean"]
     ).to_list(100)
     
     if not siswa_list:
@@ -3130,12 +5781,7 @@ async def get_wali_absensi_kelas(
     ).to_list(100)
     
     # Get kelas info
-    kelas_ids = list(set([siswa.get("kelas_id") for siswa in siswa_list if siswa.get("kelas_id")]))
-    kelas_map = {}
-    if kelas_ids:
-        kelas_list = await db.kelas.find({"id": {"$in": kelas_ids}}, {"_id": 0}).to_list(100)
-        for kelas in kelas_list:
-            kelas_map[kelas["id"]] = kelas["nama"]
+    kelas_map = await get_reference_map("kelas")
     
     # Build response
     result = []
@@ -3218,6 +5864,7 @@ async def get_pengabsen(_: dict = Depends(get_current_admin)):
         if 'kode_akses' not in pengabsen:
             pengabsen['kode_akses'] = generate_kode_akses()
             await db.pengabsen.update_one({"id": pengabsen['id']}, {"$set": {"kode_akses": pengabsen['kode_akses']}})
+            invalidate_principal_cache("pengabsen", pengabsen['id'])
 
         if isinstance(pengabsen.get('created_at'), str):
             pengabsen['created_at'] = datetime.fromisoformat(pengabsen['created_at'])
@@ -3246,6 +5893,7 @@ async def create_pengabsen(data: PengabsenCreate, _: dict = Depends(get_current_
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.pengabsen.insert_one(doc)
+    invalidate_reference_cache("pengabsen")
     
     return PengabsenResponse(**pengabsen_obj.model_dump())
 
@@ -3265,12 +5913,15 @@ async def update_pengabsen(pengabsen_id: str, data: PengabsenUpdate, _: dict = D
     
     if update_data:
         await db.pengabsen.update_one({"id": pengabsen_id}, {"$set": update_data})
+        invalidate_principal_cache("pengabsen", pengabsen_id)
+        invalidate_reference_cache("pengabsen")
         pengabsen.update(update_data)
     
     # Ensure kode_akses exists
     if 'kode_akses' not in pengabsen:
         pengabsen['kode_akses'] = generate_kode_akses()
         await db.pengabsen.update_one({"id": pengabsen_id}, {"$set": {"kode_akses": pengabsen['kode_akses']}})
+        invalidate_principal_cache("pengabsen", pengabsen_id)
     
     if isinstance(pengabsen.get('created_at'), str):
         pengabsen['created_at'] = datetime.fromisoformat(pengabsen['created_at'])
@@ -3287,6 +5938,7 @@ async def regenerate_pengabsen_kode_akses(pengabsen_id: str, _: dict = Depends(g
     
     new_kode = generate_kode_akses()
     await db.pengabsen.update_one({"id": pengabsen_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pengabsen", pengabsen_id)
     pengabsen['kode_akses'] = new_kode
     
     if isinstance(pengabsen['created_at'], str):
@@ -3298,12 +5950,12 @@ async def regenerate_pengabsen_kode_akses(pengabsen_id: str, _: dict = Depends(g
 @api_router.post("/pengabsen/absensi")
 async def upsert_absensi_pengabsen(
     santri_id: str,
-    waktu_sholat: Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"],
+    waktu_sholat: Optional[Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"]] = None,
     status_absen: Literal["hadir", "alfa", "sakit", "izin", "haid", "istihadhoh", "masbuq"] = "hadir",
     current_pengabsen: dict = Depends(get_current_pengabsen)
 ):
-    # Gunakan tanggal lokal (WIB) agar konsisten dengan persepsi pengguna
-    today = get_today_local_iso()
+    # Waktu sholat & tanggal (WIB) ditentukan dari jendela waktu sholat yang berlaku
+    waktu_sholat, today = await resolve_sholat_scan(waktu_sholat)
 
     santri = await db.santri.find_one({"id": santri_id}, {"_id": 0})
     if not santri:
@@ -3312,80 +5964,25 @@ async def upsert_absensi_pengabsen(
     if santri['asrama_id'] not in current_pengabsen.get('asrama_ids', []):
         raise HTTPException(status_code=403, detail="Santri bukan asrama yang Anda kelola")
 
-    existing = await db.absensi.find_one({
-        "santri_id": santri_id,
-        "waktu_sholat": waktu_sholat,
-        "tanggal": today
-    })
-
-    doc = {
-        "santri_id": santri_id,
-        "waktu_sholat": waktu_sholat,
-        "status": status_absen,
-        "tanggal": today,
-        "pengabsen_id": current_pengabsen['id'],
-        "waktu_absen": datetime.now(timezone.utc).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-
-    if existing:
-        await db.absensi.update_one({"id": existing.get("id")}, {"$set": doc})
-    else:
-        doc["id"] = str(uuid.uuid4())
-        await db.absensi.insert_one(doc)
-
-    # Kirim notifikasi ke wali terkait
-    try:
-        # Cari wali yang memiliki santri ini
-        wali_list = await db.wali_santri.find({"anak_ids": santri_id}, {"_id": 0}).to_list(100)
-        if wali_list:
-            # Ambil template notifikasi dari settings (fallback ke default jika belum di-set)
-            settings_doc = await db.settings.find_one({"id": "wali_notifikasi"}, {"_id": 0}) or {}
-            templates = {
-                "hadir": settings_doc.get(
-                    "hadir",
-                    "{nama} hadir pada waktu sholat {waktu} hari ini, alhamdulillah (hadir)",
-                ),
-                "alfa": settings_doc.get(
-                    "alfa",
-                    "{nama} tidak mengikuti/membolos sholat {waktu} pada hari ini (alfa)",
-                ),
-                "sakit": settings_doc.get(
-                    "sakit",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang sakit (sakit)",
-                ),
-                "izin": settings_doc.get(
-                    "izin",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena izin (izin)",
-                ),
-                "haid": settings_doc.get(
-                    "haid",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang haid (haid)",
-                ),
-                "istihadhoh": settings_doc.get(
-                    "istihadhoh",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang istihadhoh (istihadhoh)",
-                ),
-            }
-
-            waktu_label_map = {
-                "subuh": "subuh",
-                "dzuhur": "dzuhur",
-                "ashar": "ashar",
-                "maghrib": "maghrib",
-                "isya": "isya",
-            }
+    now_iso = datetime.now(timezone.utc).isoformat()
+    existing = await upsert_absensi_atomic(
+        "absensi",
+        {"santri_id": santri_id, "waktu_sholat": waktu_sholat, "tanggal": today},
+        {
+            "status": status_absen,
+            "pengabsen_id": current_pengabsen['id'],
+            "waktu_absen": now_iso,
+            "client_time": now_iso,
+        },
+    )
+    await apply_absensi_rollup(
+        today, santri.get("asrama_id"), waktu_sholat, existing.get("status") if existing else None, status_absen
+    )
 
-            template = templates.get(status_absen)
-            if template:
-                body = template.format(nama=santri["nama"], waktu=waktu_label_map.get(waktu_sholat, waktu_sholat))
-                title = f"Absensi Sholat {waktu_label_map.get(waktu_sholat, waktu_sholat).capitalize()}"
-                for wali in wali_list:
-                    await send_wali_push_notification(wali, title=title, body=body)
-    except Exception as e:
-        logging.error(f"Failed to send wali notification: {e}")
+    # Notifikasi wali dikirim dispatcher outbox di luar request
+    await enqueue_absensi_notification(santri, today, waktu_sholat, status_absen)
 
-    return {"message": "Absensi tersimpan", "tanggal": today}
+    return {"message": "Absensi tersimpan", "tanggal": today, "waktu_sholat": waktu_sholat}
 
 
 @api_router.post("/pengabsen/absensi/nfc")
@@ -3397,9 +5994,8 @@ async def absensi_pengabsen_nfc(
     if not nfc_uid:
         raise HTTPException(status_code=400, detail="NFC UID wajib diisi")
 
-    waktu_sholat = payload.waktu_sholat
-    valid_waktu = ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
-    if waktu_sholat not in valid_waktu:
+    waktu_sholat = payload.waktu_sholat or None
+    if waktu_sholat is not None and waktu_sholat not in WAKTU_SHOLAT_URUTAN:
         raise HTTPException(status_code=400, detail="Waktu sholat tidak valid")
 
     status_absen = payload.status or "hadir"
@@ -3414,93 +6010,41 @@ async def absensi_pengabsen_nfc(
     if santri['asrama_id'] not in current_pengabsen.get('asrama_ids', []):
         raise HTTPException(status_code=403, detail="Santri bukan asrama yang Anda kelola")
 
-    tanggal = payload.tanggal or get_today_local_iso()
-
-    existing = await db.absensi.find_one({
-        "santri_id": santri["id"],
-        "waktu_sholat": waktu_sholat,
-        "tanggal": tanggal,
-    })
+    waktu_sholat, tanggal = await resolve_sholat_scan(waktu_sholat)
 
-    doc = {
-        "santri_id": santri["id"],
-        "waktu_sholat": waktu_sholat,
-        "status": status_absen,
-        "tanggal": tanggal,
-        "pengabsen_id": current_pengabsen['id'],
-        "waktu_absen": datetime.now(timezone.utc).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat(),
-    }
+    now_iso = datetime.now(timezone.utc).isoformat()
+    existing = await upsert_absensi_atomic(
+        "absensi",
+        {"santri_id": santri["id"], "waktu_sholat": waktu_sholat, "tanggal": tanggal},
+        {
+            "status": status_absen,
+            "pengabsen_id": current_pengabsen['id'],
+            "waktu_absen": now_iso,
+            "client_time": now_iso,
+        },
+    )
+    await apply_absensi_rollup(
+        tanggal, santri.get("asrama_id"), waktu_sholat, existing.get("status") if existing else None, status_absen
+    )
+    if not existing or existing.get("status") != status_absen:
+        await enqueue_absensi_notification(santri, tanggal, waktu_sholat, status_absen)
 
     if existing:
-        await db.absensi.update_one({"id": existing.get("id")}, {"$set": doc})
         return {
             "message": "Santri sudah diabsen pada waktu ini",
             "status": existing.get("status"),
             "tanggal": tanggal,
+            "waktu_sholat": waktu_sholat,
             "santri_nama": santri.get("nama"),
         }
     else:
-        doc["id"] = str(uuid.uuid4())
-        await db.absensi.insert_one(doc)
         return {
             "message": "Absensi tersimpan",
             "tanggal": tanggal,
+            "waktu_sholat": waktu_sholat,
             "santri_nama": santri.get("nama"),
         }
 
-    try:
-        wali_list = await db.wali_santri.find({"anak_ids": santri["id"]}, {"_id": 0}).to_list(100)
-        if wali_list:
-            settings_doc = await db.settings.find_one({"id": "wali_notifikasi"}, {"_id": 0}) or {}
-            templates = {
-                "hadir": settings_doc.get(
-                    "hadir",
-                    "{nama} hadir pada waktu sholat {waktu} hari ini, alhamdulillah (hadir)",
-                ),
-                "alfa": settings_doc.get(
-                    "alfa",
-                    "{nama} tidak mengikuti/membolos sholat {waktu} pada hari ini (alfa)",
-                ),
-                "sakit": settings_doc.get(
-                    "sakit",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang sakit (sakit)",
-                ),
-                "izin": settings_doc.get(
-                    "izin",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena izin (izin)",
-                ),
-                "haid": settings_doc.get(
-                    "haid",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang haid (haid)",
-                ),
-                "istihadhoh": settings_doc.get(
-                    "istihadhoh",
-                    "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang istihadhoh (istihadhoh)",
-                ),
-                "masbuq": settings_doc.get(
-                    "masbuq",
-                    "{nama} mengikuti sholat {waktu} hari ini namun datang masbuq (masbuq)",
-                ),
-            }
-            waktu_label_map = {
-                "subuh": "subuh",
-                "dzuhur": "dzuhur",
-                "ashar": "ashar",
-                "maghrib": "maghrib",
-                "isya": "isya",
-            }
-            template = templates.get(status_absen)
-            if template:
-                body = template.format(nama=santri["nama"], waktu=waktu_label_map.get(waktu_sholat, waktu_sholat))
-                title = f"Absensi Sholat {waktu_label_map.get(waktu_sholat, waktu_sholat).capitalize()}"
-                for wali in wali_list:
-                    await send_wali_push_notification(wali, title=title, body=body)
-    except Exception as e:
-        logging.error(f"Failed to send wali notification (NFC): {e}")
-
-    return {"message": "Absensi NFC tersimpan", "tanggal": tanggal}
-
 
 @api_router.delete("/pengabsen/absensi")
 async def delete_absensi_pengabsen(
@@ -3508,7 +6052,7 @@ async def delete_absensi_pengabsen(
     waktu_sholat: Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"],
     current_pengabsen: dict = Depends(get_current_pengabsen)
 ):
-    today = get_today_local_iso()
+    _, today = await resolve_sholat_scan(waktu_sholat, enforce=False)
 
     santri = await db.santri.find_one({"id": santri_id}, {"_id": 0})
     if not santri:
@@ -3517,27 +6061,722 @@ async def delete_absensi_pengabsen(
     if santri['asrama_id'] not in current_pengabsen.get('asrama_ids', []):
         raise HTTPException(status_code=403, detail="Santri bukan asrama yang Anda kelola")
 
-    result = await db.absensi.delete_one({
-        "santri_id": santri_id,
-        "waktu_sholat": waktu_sholat,
-        "tanggal": today
-    })
+    deleted = await db.absensi.find_one_and_delete(
+        {
+            "santri_id": santri_id,
+            "waktu_sholat": waktu_sholat,
+            "tanggal": today
+        },
+        projection={"_id": 0, "id": 1, "santri_id": 1, "waktu_sholat": 1, "tanggal": 1, "status": 1},
+    )
 
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Data absensi tidak ditemukan")
 
-    return {"message": "Absensi dihapus", "tanggal": today}
+    await apply_absensi_rollup(today, santri.get("asrama_id"), waktu_sholat, deleted.get("status"), None)
+    await record_absensi_tombstones([deleted])
+
+    return {"message": "Absensi dihapus", "tanggal": today}
+
+
+# ==================== ABSENSI BATCH ====================
+
+# Pengabsen PWA bisa mengirim satu daftar absensi sekaligus (mis. satu asrama
+# "hadir semua kecuali beberapa") alih-alih satu request per santri. Roster
+# diambil sekali, validasi per item, lalu semua baris ditulis dengan satu
+# bulk_write. Item yang gagal tidak menggagalkan batch; hasilnya dilaporkan per item.
+ABSENSI_BATCH_MAX_ITEMS = int(os.environ.get("ABSENSI_BATCH_MAX_ITEMS", 500))
+
+
+class AbsensiBatchItem(BaseModel):
+    santri_id: str
+    waktu_sholat: Optional[Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"]] = None
+    status: Literal["hadir", "alfa", "sakit", "izin", "haid", "istihadhoh", "masbuq"] = "hadir"
+
+
+class AbsensiBatchRequest(BaseModel):
+    items: List[AbsensiBatchItem] = Field(..., min_length=1, max_length=ABSENSI_BATCH_MAX_ITEMS)
+
+
+class AbsensiKelasBatchItem(BaseModel):
+    siswa_id: str
+    status: Literal["hadir", "alfa", "izin", "sakit", "telat"] = "hadir"
+
+
+class AbsensiKelasBatchRequest(BaseModel):
+    tanggal: Optional[str] = None
+    items: List[AbsensiKelasBatchItem] = Field(..., min_length=1, max_length=ABSENSI_BATCH_MAX_ITEMS)
+
+
+class AliyahAbsensiBatchItem(BaseModel):
+    siswa_id: str
+    jenis: Literal["pagi", "dzuhur"]
+    status: Optional[Literal["hadir", "alfa", "sakit", "izin", "dispensasi", "bolos"]] = None
+
+
+class AliyahAbsensiBatchRequest(BaseModel):
+    tanggal: Optional[str] = None
+    items: List[AliyahAbsensiBatchItem] = Field(..., min_length=1, max_length=ABSENSI_BATCH_MAX_ITEMS)
+
+
+class PMQAbsensiBatchItem(BaseModel):
+    siswa_id: str
+    sesi: Literal["pagi", "malam"]
+    status: Literal["hadir", "alfa", "sakit", "izin", "terlambat"] = "hadir"
+
+
+class PMQAbsensiBatchRequest(BaseModel):
+    tanggal: Optional[str] = None
+    items: List[PMQAbsensiBatchItem] = Field(..., min_length=1, max_length=ABSENSI_BATCH_MAX_ITEMS)
+
+
+def _batch_error(index: int, status_code: int, detail: str, **fields) -> Dict[str, Any]:
+    return {"index": index, **fields, "ok": False, "status_code": status_code, "detail": detail}
+
+
+def _batch_outcome(existing: Optional[dict], new_status: str) -> str:
+    if existing is None:
+        return "created"
+    return "unchanged" if existing.get("status") == new_status else "updated"
+
+
+def _batch_response(results: List[Dict[str, Any]], **extra) -> Dict[str, Any]:
+    results.sort(key=lambda r: r["index"])
+    saved = sum(1 for r in results if r["ok"])
+    return {**extra, "total": len(results), "saved": saved, "failed": len(results) - saved, "results": results}
+
+
+@api_router.post("/pengabsen/absensi/batch")
+async def batch_absensi_pengabsen(
+    payload: AbsensiBatchRequest,
+    current_pengabsen: dict = Depends(get_current_pengabsen),
+):
+    """Simpan banyak absensi sholat sekaligus; hasil dilaporkan per item."""
+    # Jendela waktu sholat cukup diresolve sekali per waktu yang diminta
+    windows: Dict[Optional[str], Any] = {}
+    for waktu in {item.waktu_sholat for item in payload.items}:
+        try:
+            windows[waktu] = await resolve_sholat_scan(waktu)
+        except HTTPException as e:
+            windows[waktu] = e
+
+    santri_ids = list({item.santri_id for item in payload.items})
+    santri_list = await db.santri.find(
+        {"id": {"$in": santri_ids}}, ROSTER_PROJECTIONS["santri_lean"]
+    ).to_list(len(santri_ids))
+    santri_by_id = {s["id"]: s for s in santri_list}
+    asrama_ids = set(current_pengabsen.get("asrama_ids", []))
+
+    results: List[Dict[str, Any]] = []
+    accepted = []
+    seen = set()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    for index, item in enumerate(payload.items):
+        santri = santri_by_id.get(item.santri_id)
+        if not santri:
+            results.append(_batch_error(index, 404, "Santri tidak ditemukan", santri_id=item.santri_id))
+            continue
+        if santri.get("asrama_id") not in asrama_ids:
+            results.append(_batch_error(index, 403, "Santri bukan asrama yang Anda kelola", santri_id=item.santri_id))
+            continue
+        window = windows[item.waktu_sholat]
+        if isinstance(window, HTTPException):
+            results.append(_batch_error(index, window.status_code, window.detail, santri_id=item.santri_id))
+            continue
+        waktu_sholat, tanggal = window
+        key = {"santri_id": item.santri_id, "waktu_sholat": waktu_sholat, "tanggal": tanggal}
+        if absensi_key_tuple("absensi", key) in seen:
+            results.append(_batch_error(index, 409, "Santri muncul lebih dari sekali dalam batch", santri_id=item.santri_id))
+            continue
+        seen.add(absensi_key_tuple("absensi", key))
+        accepted.append((index, item, santri, key))
+
+    previous = await bulk_upsert_absensi(
+        "absensi",
+        [
+            (
+                key,
+                {"status": item.status, "pengabsen_id": current_pengabsen["id"], "waktu_absen": now_iso, "client_time": now_iso},
+                None,
+            )
+            for _, item, _, key in accepted
+        ],
+    )
+
+    rollup_changes = []
+    notifications = []
+    for index, item, santri, key in accepted:
+        existing = previous.get(absensi_key_tuple("absensi", key))
+        old_status = existing.get("status") if existing else None
+        rollup_changes.append((key["tanggal"], santri.get("asrama_id"), key["waktu_sholat"], old_status, item.status))
+        # Notifikasi wali hanya untuk absensi baru / status berubah
+        if old_status != item.status:
+            notifications.append((santri, key["tanggal"], key["waktu_sholat"], item.status))
+        results.append({
+            "index": index,
+            "santri_id": item.santri_id,
+            "ok": True,
+            "result": _batch_outcome(existing, item.status),
+            "tanggal": key["tanggal"],
+            "waktu_sholat": key["waktu_sholat"],
+            "status": item.status,
+        })
+
+    await apply_absensi_rollup_bulk(rollup_changes)
+    await enqueue_absensi_notifications(notifications)
+
+    return _batch_response(results)
+
+
+@api_router.post("/absensi-kelas/batch")
+async def batch_absensi_kelas(
+    payload: AbsensiKelasBatchRequest,
+    current_pengabsen: dict = Depends(get_current_pengabsen_kelas),
+):
+    """Simpan banyak absensi kelas madrasah sekaligus; kelas diambil dari data siswa."""
+    tanggal = payload.tanggal or get_today_local_iso()
+    siswa_ids = list({item.siswa_id for item in payload.items})
+    siswa_list = await db.siswa_madrasah.find(
+        {"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]
+    ).to_list(len(siswa_ids))
+    siswa_by_id = {s["id"]: s for s in siswa_list}
+    kelas_ids = set(current_pengabsen.get("kelas_ids", []))
+
+    results: List[Dict[str, Any]] = []
+    accepted = []
+    seen = set()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    for index, item in enumerate(payload.items):
+        siswa = siswa_by_id.get(item.siswa_id)
+        if not siswa:
+            results.append(_batch_error(index, 404, "Siswa tidak ditemukan", siswa_id=item.siswa_id))
+            continue
+        if not siswa.get("kelas_id"):
+            results.append(_batch_error(index, 400, "Siswa belum memiliki kelas", siswa_id=item.siswa_id))
+            continue
+        if siswa["kelas_id"] not in kelas_ids:
+            results.append(_batch_error(index, 403, "Anda tidak memiliki akses ke kelas ini", siswa_id=item.siswa_id))
+            continue
+        if item.siswa_id in seen:
+            results.append(_batch_error(index, 409, "Siswa muncul lebih dari sekali dalam batch", siswa_id=item.siswa_id))
+            continue
+        seen.add(item.siswa_id)
+        accepted.append((index, item, siswa))
+
+    previous = await bulk_upsert_absensi(
+        "absensi_kelas",
+        [
+            (
+                {"siswa_id": item.siswa_id, "tanggal": tanggal},
+                {"status": item.status, "kelas_id": siswa["kelas_id"]},
+                {"pengabsen_kelas_id": current_pengabsen["id"], "waktu_absen": now_iso},
+            )
+            for _, item, siswa in accepted
+        ],
+    )
+
+    for index, item, siswa in accepted:
+        existing = previous.get((item.siswa_id, tanggal))
+        results.append({
+            "index": index,
+            "siswa_id": item.siswa_id,
+            "ok": True,
+            "result": _batch_outcome(existing, item.status),
+            "status": item.status,
+        })
+
+    return _batch_response(results, tanggal=tanggal)
+
+
+@api_router.post("/aliyah/pengabsen/absensi/batch")
+async def batch_aliyah_absensi(
+    payload: AliyahAbsensiBatchRequest,
+    current_pengabsen: dict = Depends(get_current_pengabsen_aliyah),
+):
+    """Simpan banyak absensi Aliyah sekaligus; status kosong berarti hapus absensi."""
+    tanggal = payload.tanggal or get_today_local_iso()
+    siswa_ids = list({item.siswa_id for item in payload.items})
+    siswa_list = await db.siswa_aliyah.find(
+        {"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_aliyah_lean"]
+    ).to_list(len(siswa_ids))
+    siswa_by_id = {s["id"]: s for s in siswa_list}
+    kelas_ids = set(current_pengabsen.get("kelas_ids", []) or [])
+
+    results: List[Dict[str, Any]] = []
+    upserts = []
+    deletes = []
+    seen = set()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    for index, item in enumerate(payload.items):
+        siswa = siswa_by_id.get(item.siswa_id)
+        if not siswa:
+            results.append(_batch_error(index, 404, "Siswa tidak ditemukan", siswa_id=item.siswa_id))
+            continue
+        if siswa.get("kelas_id") not in kelas_ids:
+            results.append(_batch_error(index, 403, "Tidak boleh mengabsen kelas ini", siswa_id=item.siswa_id))
+            continue
+        if (item.siswa_id, item.jenis) in seen:
+            results.append(_batch_error(index, 409, "Siswa muncul lebih dari sekali dalam batch", siswa_id=item.siswa_id))
+            continue
+        seen.add((item.siswa_id, item.jenis))
+        if item.status is None:
+            deletes.append((index, item))
+        else:
+            upserts.append((index, item, siswa))
+
+    if deletes:
+        await db.absensi_aliyah.bulk_write(
+            [DeleteOne({"siswa_id": item.siswa_id, "tanggal": tanggal, "jenis": item.jenis}) for _, item in deletes],
+            ordered=False,
+        )
+        emit_absensi_changes(
+            "absensi_aliyah",
+            [
+                {"siswa_id": item.siswa_id, "tanggal": tanggal, "jenis": item.jenis,
+                 "kelas_id": siswa_by_id[item.siswa_id].get("kelas_id")}
+                for _, item in deletes
+            ],
+            "delete",
+        )
+    for index, item in deletes:
+        results.append({"index": index, "siswa_id": item.siswa_id, "jenis": item.jenis, "ok": True, "result": "deleted"})
+
+    previous = await bulk_upsert_absensi(
+        "absensi_aliyah",
+        [
+            (
+                {"siswa_id": item.siswa_id, "tanggal": tanggal, "jenis": item.jenis},
+                {"status": item.status, "kelas_id": siswa["kelas_id"], "waktu_absen": now_iso},
+                None,
+            )
+            for _, item, siswa in upserts
+        ],
+    )
+    for index, item, _ in upserts:
+        existing = previous.get((item.siswa_id, tanggal, item.jenis))
+        results.append({
+            "index": index,
+            "siswa_id": item.siswa_id,
+            "jenis": item.jenis,
+            "ok": True,
+            "result": _batch_outcome(existing, item.status),
+            "status": item.status,
+        })
+
+    return _batch_response(results, tanggal=tanggal)
+
+
+@api_router.post("/pmq/pengabsen/absensi/batch")
+async def batch_pmq_pengabsen_absensi(
+    payload: PMQAbsensiBatchRequest,
+    current_pengabsen: dict = Depends(get_current_pengabsen_pmq),
+):
+    """Simpan banyak absensi PMQ sekaligus; kelompok diambil dari data siswa."""
+    tanggal = payload.tanggal or get_today_local_iso()
+    siswa_ids = list({item.siswa_id for item in payload.items})
+    siswa_list = await db.siswa_pmq.find(
+        {"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_pmq_lean"]
+    ).to_list(len(siswa_ids))
+    siswa_by_id = {s["id"]: s for s in siswa_list}
+    kelompok_ids = set(current_pengabsen.get("kelompok_ids") or [])
+
+    results: List[Dict[str, Any]] = []
+    accepted = []
+    seen = set()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    for index, item in enumerate(payload.items):
+        siswa = siswa_by_id.get(item.siswa_id)
+        if not siswa:
+            results.append(_batch_error(index, 404, "Siswa tidak ditemukan", siswa_id=item.siswa_id))
+            continue
+        if siswa.get("kelompok_id") not in kelompok_ids:
+            results.append(_batch_error(index, 403, "Tidak boleh mengakses kelompok ini", siswa_id=item.siswa_id))
+            continue
+        if (item.siswa_id, item.sesi) in seen:
+            results.append(_batch_error(index, 409, "Siswa muncul lebih dari sekali dalam batch", siswa_id=item.siswa_id))
+            continue
+        seen.add((item.siswa_id, item.sesi))
+        accepted.append((index, item, siswa))
+
+    previous = await bulk_upsert_absensi(
+        "absensi_pmq",
+        [
+            (
+                {"siswa_id": item.siswa_id, "tanggal": tanggal, "sesi": item.sesi},
+                {
+                    "status": item.status,
+                    "kelompok_id": siswa.get("kelompok_id"),
+                    "pengabsen_id": current_pengabsen["id"],
+                    "waktu_absen": now_iso,
+                },
+                None,
+            )
+            for _, item, siswa in accepted
+        ],
+    )
+    for index, item, _ in accepted:
+        existing = previous.get((item.siswa_id, tanggal, item.sesi))
+        results.append({
+            "index": index,
+            "siswa_id": item.siswa_id,
+            "sesi": item.sesi,
+            "ok": True,
+            "result": _batch_outcome(existing, item.status),
+            "status": item.status,
+        })
+
+    return _batch_response(results, tanggal=tanggal)
+
+
+# ==================== SYNC OFFLINE PENGABSEN ====================
+
+# PWA pengabsen menyimpan scan di antrean lokal saat offline lalu mengunggahnya
+# lewat /pengabsen/sync begitu jaringan kembali:
+# - setiap scan membawa idempotency_key buatan klien; replay dari key yang sama
+#   mengembalikan hasil tersimpan tanpa menulis ulang (absensi_sync_keys, TTL)
+# - konflik diselesaikan last-writer-wins berdasarkan waktu scan di klien
+#   (client_time), bukan waktu request tiba di server
+# - respons berisi delta otoritatif (baris berubah + tombstone hapus) sejak
+#   sync token klien, beserta token baru untuk sync berikutnya
+ABSENSI_SYNC_MAX_SCANS = int(os.environ.get("ABSENSI_SYNC_MAX_SCANS", 1000))
+ABSENSI_SYNC_DELTA_LIMIT = int(os.environ.get("ABSENSI_SYNC_DELTA_LIMIT", 5000))
+ABSENSI_SYNC_DELTA_DAYS = 1  # hari ini + kemarin (isya lewat tengah malam)
+ABSENSI_SYNC_MAX_CLOCK_SKEW_SECONDS = 300
+ABSENSI_SYNC_TOKEN_SAFETY_SECONDS = 5
+ABSENSI_SYNC_RETENTION_SECONDS = 7 * 24 * 3600  # umur idempotency key (TTL index)
+ABSENSI_SYNC_DELTA_FIELDS = {
+    "_id": 0, "id": 1, "santri_id": 1, "waktu_sholat": 1, "tanggal": 1, "status": 1,
+    "pengabsen_id": 1, "waktu_absen": 1, "client_time": 1, "updated_at": 1,
+}
+
+
+class AbsensiSyncScan(BaseModel):
+    idempotency_key: str = Field(..., min_length=1, max_length=128)
+    santri_id: str
+    client_time: str
+    waktu_sholat: Optional[Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"]] = None
+    status: Literal["hadir", "alfa", "sakit", "izin", "haid", "istihadhoh", "masbuq"] = "hadir"
+
+
+class AbsensiSyncRequest(BaseModel):
+    since: Optional[str] = None
+    scans: List[AbsensiSyncScan] = Field(default_factory=list, max_length=ABSENSI_SYNC_MAX_SCANS)
+
+
+def _parse_client_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=LOCAL_TZ)
+    return parsed.astimezone(timezone.utc)
+
+
+def encode_sync_token(updated_at: str, last_id: str = "") -> str:
+    raw = json.dumps([updated_at, last_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_sync_token(token: str) -> Tuple[str, str]:
+    try:
+        updated_at, last_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(updated_at), str(last_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Sync token tidak valid")
+
+
+def _absensi_effective_time(doc: Optional[dict]) -> str:
+    """Waktu versi baris untuk LWW: yang terbaru dari client_time dan waktu_absen.
+
+    Tulis online mengisi keduanya dengan waktu server; baris lama mungkin hanya
+    punya waktu_absen, dan tulisan versi lama bisa meninggalkan client_time basi.
+    """
+    if not doc:
+        return ""
+    return max(str(doc.get("client_time") or ""), str(doc.get("waktu_absen") or ""))
+
+
+def _absensi_older_than(client_time: str) -> Dict[str, Any]:
+    """Filter Mongo padanan `_absensi_effective_time(doc) < client_time`."""
+    return {
+        "$and": [
+            {"$or": [{"client_time": {"$lt": client_time}}, {"client_time": {"$exists": False}}]},
+            {"$or": [{"waktu_absen": {"$lt": client_time}}, {"waktu_absen": {"$exists": False}}]},
+        ]
+    }
+
+
+async def record_absensi_tombstones(docs: List[dict]) -> None:
+    """Catat baris absensi sholat yang dihapus agar ikut terkirim di delta sync."""
+    if not docs:
+        return
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(days=ABSENSI_SYNC_DELTA_DAYS + 1)
+    try:
+        await db.absensi_tombstones.insert_many(
+            [
+                {
+                    "id": doc.get("id"),
+                    "santri_id": doc.get("santri_id"),
+                    "waktu_sholat": doc.get("waktu_sholat"),
+                    "tanggal": doc.get("tanggal"),
+                    "deleted_at": now.isoformat(),
+                    "expires_at": expires_at,
+                }
+                for doc in docs
+            ],
+            ordered=False,
+        )
+    except Exception as e:
+        logging.error(f"Gagal mencatat tombstone absensi: {e}")
+
+
+async def _apply_sync_scans(scans: List[Tuple[int, AbsensiSyncScan, datetime]], current_pengabsen: dict):
+    """Terapkan scan baru (sudah lolos dedupe key) dengan last-writer-wins; hasil per index."""
+    results: Dict[int, Dict[str, Any]] = {}
+
+    santri_ids = list({scan.santri_id for _, scan, _ in scans})
+    santri_list = await db.santri.find(
+        {"id": {"$in": santri_ids}}, ROSTER_PROJECTIONS["santri_lean"]
+    ).to_list(len(santri_ids))
+    santri_by_id = {s["id"]: s for s in santri_list}
+    asrama_ids = set(current_pengabsen.get("asrama_ids", []))
+
+    # Per natural key hanya scan dengan client_time terbaru yang ditulis
+    latest: Dict[tuple, Tuple[int, AbsensiSyncScan, str, dict]] = {}
+    for index, scan, client_dt in scans:
+        base = {"index": index, "idempotency_key": scan.idempotency_key, "santri_id": scan.santri_id}
+        santri = santri_by_id.get(scan.santri_id)
+        if not santri:
+            results[index] = {**base, "ok": False, "status_code": 404, "detail": "Santri tidak ditemukan"}
+            continue
+        if santri.get("asrama_id") not in asrama_ids:
+            results[index] = {**base, "ok": False, "status_code": 403, "detail": "Santri bukan asrama yang Anda kelola"}
+            continue
+        try:
+            # Jendela waktu sholat dinilai pada saat scan dilakukan, bukan saat upload
+            waktu_sholat, tanggal = await resolve_sholat_scan(scan.waktu_sholat, now=client_dt)
+        except HTTPException as e:
+            results[index] = {**base, "ok": False, "status_code": e.status_code, "detail": e.detail}
+            continue
+        key = {"santri_id": scan.santri_id, "waktu_sholat": waktu_sholat, "tanggal": tanggal}
+        key_tuple = absensi_key_tuple("absensi", key)
+        client_time = client_dt.isoformat()
+        previous = latest.get(key_tuple)
+        if previous and previous[2] >= client_time:
+            results[index] = {**base, "ok": True, "result": "superseded", "tanggal": tanggal, "waktu_sholat": waktu_sholat}
+            continue
+        if previous:
+            prev_index, prev_scan, _, _ = previous
+            results[prev_index] = {
+                "index": prev_index, "idempotency_key": prev_scan.idempotency_key, "santri_id": prev_scan.santri_id,
+                "ok": True, "result": "superseded", "tanggal": tanggal, "waktu_sholat": waktu_sholat,
+            }
+        latest[key_tuple] = (index, scan, client_time, key)
+
+    if not latest:
+        return results
+
+    existing_docs = await db.absensi.find(
+        {"$or": [key for _, _, _, key in latest.values()]},
+        {"_id": 0, "santri_id": 1, "waktu_sholat": 1, "tanggal": 1, "status": 1, "client_time": 1, "waktu_absen": 1},
+    ).to_list(len(latest))
+    existing = {absensi_key_tuple("absensi", d): d for d in existing_docs}
+
+    writes = []
+    for key_tuple, (index, scan, client_time, key) in latest.items():
+        current = existing.get(key_tuple)
+        base = {
+            "index": index, "idempotency_key": scan.idempotency_key, "santri_id": scan.santri_id,
+            "tanggal": key["tanggal"], "waktu_sholat": key["waktu_sholat"],
+        }
+        if current and _absensi_effective_time(current) >= client_time:
+            # Sudah ada versi yang lebih baru (mis. scan online setelah scan offline ini)
+            results[index] = {**base, "ok": True, "result": "stale", "status": current.get("status")}
+            continue
+        # Guard LWW di filter: update hanya bila versi tersimpan lebih lama dari scan ini
+        guarded = {**key, **_absensi_older_than(client_time)}
+        update = _absensi_upsert_update(
+            key,
+            {
+                "status": scan.status,
+                "pengabsen_id": current_pengabsen["id"],
+                "waktu_absen": client_time,
+                "client_time": client_time,
+            },
+        )
+        writes.append((index, scan, key, guarded, update, current, base))
+
+    lost: set = set()
+    if writes:
+        ops = [UpdateOne(guarded, update, upsert=True) for _, _, _, guarded, update, _, _ in writes]
+        try:
+            await db.absensi.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            # Insert ditolak unique index: baris sudah ada (ditulis bersamaan).
+            # Ulangi tanpa upsert - hanya berlaku bila versi tersimpan masih lebih lama.
+            for err in errors:
+                _, _, _, guarded, update, _, _ = writes[err["index"]]
+                retry = await db.absensi.update_one(guarded, update)
+                if retry.matched_count == 0:
+                    lost.add(err["index"])
+
+    rollup_changes = []
+    notifications = []
+    for position, (index, scan, key, _, _, current, base) in enumerate(writes):
+        if position in lost:
+            results[index] = {**base, "ok": True, "result": "stale"}
+            continue
+        old_status = current.get("status") if current else None
+        santri = santri_by_id[scan.santri_id]
+        rollup_changes.append((key["tanggal"], santri.get("asrama_id"), key["waktu_sholat"], old_status, scan.status))
+        if old_status != scan.status:
+            notifications.append((santri, key["tanggal"], key["waktu_sholat"], scan.status))
+        results[index] = {**base, "ok": True, "result": _batch_outcome(current, scan.status), "status": scan.status}
+
+    await apply_absensi_rollup_bulk(rollup_changes)
+    await enqueue_absensi_notifications(notifications)
+    return results
+
+
+async def absensi_sync_delta(current_pengabsen: dict, since: Optional[str]) -> Dict[str, Any]:
+    """Baris absensi & tombstone asrama pengabsen yang berubah sejak `since`."""
+    started = datetime.now(timezone.utc)
+    tanggal_min = (datetime.now(LOCAL_TZ).date() - timedelta(days=ABSENSI_SYNC_DELTA_DAYS)).isoformat()
+    after_updated, after_id = decode_sync_token(since) if since else ("", "")
+
+    santri_list = await db.santri.find(
+        {"asrama_id": {"$in": current_pengabsen.get("asrama_ids", [])}}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    santri_ids = [s["id"] for s in santri_list]
+
+    query: Dict[str, Any] = {"tanggal": {"$gte": tanggal_min}, "santri_id": {"$in": santri_ids}}
+    if after_updated:
+        query["$or"] = [
+            {"updated_at": {"$gt": after_updated}},
+            {"updated_at": after_updated, "id": {"$gt": after_id}},
+        ]
+    rows = await db.absensi.find(query, ABSENSI_SYNC_DELTA_FIELDS).sort(
+        [("updated_at", 1), ("id", 1)]
+    ).limit(ABSENSI_SYNC_DELTA_LIMIT).to_list(ABSENSI_SYNC_DELTA_LIMIT)
+
+    tombstone_query: Dict[str, Any] = {"tanggal": {"$gte": tanggal_min}, "santri_id": {"$in": santri_ids}}
+    if after_updated:
+        tombstone_query["deleted_at"] = {"$gt": after_updated}
+    deleted = await db.absensi_tombstones.find(
+        tombstone_query, {"_id": 0, "id": 1, "santri_id": 1, "waktu_sholat": 1, "tanggal": 1, "deleted_at": 1}
+    ).to_list(ABSENSI_SYNC_DELTA_LIMIT)
+
+    has_more = len(rows) == ABSENSI_SYNC_DELTA_LIMIT
+    if has_more:
+        last = rows[-1]
+        token = encode_sync_token(last.get("updated_at") or "", last["id"])
+    else:
+        # Mundur sedikit dari awal query agar tulisan yang belum terlihat saat query
+        # tetap terambil di sync berikutnya (baris ganda aman karena LWW di klien)
+        safe = (started - timedelta(seconds=ABSENSI_SYNC_TOKEN_SAFETY_SECONDS)).isoformat()
+        token = encode_sync_token(max(safe, after_updated))
+
+    return {"changes": rows, "deleted": deleted, "sync_token": token, "has_more": has_more, "tanggal_min": tanggal_min}
+
+
+@api_router.post("/pengabsen/sync")
+async def sync_absensi_pengabsen(
+    payload: AbsensiSyncRequest,
+    current_pengabsen: dict = Depends(get_current_pengabsen),
+):
+    """Unggah antrean scan offline (idempotent, LWW per client_time) dan ambil delta sejak sync token."""
+    if payload.since:
+        decode_sync_token(payload.since)
+
+    pengabsen_id = current_pengabsen["id"]
+    keys = list({scan.idempotency_key for scan in payload.scans})
+    replayed: Dict[str, Dict[str, Any]] = {}
+    if keys:
+        stored = await db.absensi_sync_keys.find(
+            {"pengabsen_id": pengabsen_id, "idempotency_key": {"$in": keys}},
+            {"_id": 0, "idempotency_key": 1, "result": 1},
+        ).to_list(len(keys))
+        replayed = {doc["idempotency_key"]: doc["result"] for doc in stored}
+
+    results: Dict[int, Dict[str, Any]] = {}
+    fresh: List[Tuple[int, AbsensiSyncScan, datetime]] = []
+    first_index: Dict[str, int] = {}
+    max_client_time = datetime.now(timezone.utc) + timedelta(seconds=ABSENSI_SYNC_MAX_CLOCK_SKEW_SECONDS)
+    for index, scan in enumerate(payload.scans):
+        base = {"index": index, "idempotency_key": scan.idempotency_key, "santri_id": scan.santri_id}
+        if scan.idempotency_key in replayed:
+            results[index] = {**replayed[scan.idempotency_key], "index": index, "replayed": True}
+            continue
+        if scan.idempotency_key in first_index:
+            results[index] = {**base, "ok": True, "result": "duplicate", "duplicate_of": first_index[scan.idempotency_key]}
+            continue
+        first_index[scan.idempotency_key] = index
+        try:
+            client_dt = _parse_client_time(scan.client_time)
+        except ValueError:
+            results[index] = {**base, "ok": False, "status_code": 400, "detail": "client_time tidak valid"}
+            continue
+        if client_dt > max_client_time:
+            results[index] = {**base, "ok": False, "status_code": 400, "detail": "client_time berada di masa depan"}
+            continue
+        fresh.append((index, scan, client_dt))
+
+    if fresh:
+        results.update(await _apply_sync_scans(fresh, current_pengabsen))
+
+    # Simpan hasil per idempotency key agar upload ulang antrean yang sama tidak menulis dua kali
+    new_keys = [
+        {
+            "pengabsen_id": pengabsen_id,
+            "idempotency_key": payload.scans[index].idempotency_key,
+            "result": {k: v for k, v in results[index].items() if k != "index"},
+            "created_at": datetime.now(timezone.utc),
+        }
+        for index in first_index.values()
+        if index in results
+    ]
+    if new_keys:
+        try:
+            await db.absensi_sync_keys.insert_many(new_keys, ordered=False)
+        except BulkWriteError:
+            # Upload paralel dengan key yang sama: hasil pertama yang tersimpan tetap berlaku
+            pass
+
+    delta = await absensi_sync_delta(current_pengabsen, payload.since)
+    ordered = [results[i] for i in sorted(results)]
+    applied = sum(1 for r in ordered if r["ok"] and r.get("result") in ("created", "updated", "unchanged"))
+    return {
+        "accepted": len(ordered),
+        "applied": applied,
+        "failed": sum(1 for r in ordered if not r["ok"]),
+        "results": ordered,
+        **delta,
+    }
 
 
 @api_router.get("/pengabsen/santri-absensi-hari-ini")
 async def get_santri_absensi_hari_ini(
+    request: Request,
+    response: Response,
     waktu_sholat: Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"],
+    since: Optional[str] = None,
     current_pengabsen: dict = Depends(get_current_pengabsen)
 ):
-    today = get_today_local_iso()
+    # Isya lewat tengah malam masih milik tanggal kemarin
+    _, today = await resolve_sholat_scan(waktu_sholat, enforce=False)
 
     asrama_ids = current_pengabsen.get('asrama_ids', [])
-    santri_list = await db.santri.find({"asrama_id": {"$in": asrama_ids}}, {"_id": 0}).to_list(10000)
+    delta = await absensi_roster_delta(request, "sholat", asrama_ids, today, waktu_sholat, since)
+    if delta["not_modified"] is not None:
+        return delta["not_modified"]
+    response.headers.update(delta["headers"])
+
+    santri_query: Dict[str, Any] = {"asrama_id": {"$in": asrama_ids}}
+    if delta["only_ids"] is not None:
+        santri_query["id"] = {"$in": delta["only_ids"]}
+    santri_list = await db.santri.find(santri_query, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_by_id = {s['id']: s for s in santri_list}
 
     absensi_list = await db.absensi.find({
@@ -3548,7 +6787,7 @@ async def get_santri_absensi_hari_ini(
 
     absensi_by_santri = {a['santri_id']: a for a in absensi_list}
 
-    asrama_map = {a['id']: a['nama'] for a in await db.asrama.find({}, {"_id": 0}).to_list(10000)}
+    asrama_map = await get_reference_map("asrama")
 
     result = []
     for sid, santri in santri_by_id.items():
@@ -3563,7 +6802,13 @@ async def get_santri_absensi_hari_ini(
             "status": status_val
         })
 
-    return {"tanggal": today, "waktu_sholat": waktu_sholat, "data": result}
+    return {
+        "tanggal": today,
+        "waktu_sholat": waktu_sholat,
+        "data": result,
+        "delta": delta["only_ids"] is not None,
+        "version": delta["version"],
+    }
 
 
 @api_router.post("/admin/fix-absensi-subuh-kemarin-ke-hari-ini")
@@ -3612,9 +6857,13 @@ async def fix_absensi_subuh_kemarin_ke_hari_ini(_: dict = Depends(get_current_ad
             "waktu_sholat": "subuh",
             "waktu_absen": {"$gte": start_utc, "$lte": end_utc},
         },
-        {"$set": {"tanggal": today_local.isoformat()}},
+        {"$set": {"tanggal": today_local.isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}},
     )
 
+    # Baris berpindah tanggal: hitung ulang rollup kedua tanggal
+    if result.modified_count:
+        await rebuild_absensi_rollup(yesterday_local.isoformat(), today_local.isoformat())
+
     return {
         "from_date": yesterday_local.isoformat(),
         "to_date": today_local.isoformat(),
@@ -3647,7 +6896,7 @@ async def get_pengabsen_riwayat_detail(
         return {"tanggal": tanggal, "waktu_sholat": waktu_sholat, "data": []}
 
     santri_ids = list({a["santri_id"] for a in absensi_list})
-    santri_docs = await db.santri.find({"id": {"$in": santri_ids}}, {"_id": 0}).to_list(10000)
+    santri_docs = await db.santri.find({"id": {"$in": santri_ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_by_id = {s["id"]: s for s in santri_docs}
 
     items = []
@@ -3681,6 +6930,8 @@ async def get_pengabsen_riwayat_detail(
 @api_router.delete("/pengabsen/{pengabsen_id}")
 async def delete_pengabsen(pengabsen_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pengabsen.delete_one({"id": pengabsen_id})
+    invalidate_principal_cache("pengabsen", pengabsen_id)
+    invalidate_reference_cache("pengabsen")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pengabsen tidak ditemukan")
     return {"message": "Pengabsen berhasil dihapus"}
@@ -3708,11 +6959,10 @@ async def get_pengabsen_riwayat(
         return {"items": []}
 
     santri_ids = list({a["santri_id"] for a in absensi_list})
-    santri_docs = await db.santri.find({"id": {"$in": santri_ids}}, {"_id": 0}).to_list(10000)
+    santri_docs = await db.santri.find({"id": {"$in": santri_ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_by_id = {s["id"]: s for s in santri_docs}
 
-    asrama_docs = await db.asrama.find({}, {"_id": 0}).to_list(1000)
-    asrama_map = {a["id"]: a["nama"] for a in asrama_docs}
+    asrama_map = await get_reference_map("asrama")
 
     # Grouping: (tanggal, asrama_id, waktu_sholat) -> counts per status
     groups: dict = {}
@@ -3778,6 +7028,7 @@ async def get_pembimbing(_: dict = Depends(get_current_admin)):
         if 'kode_akses' not in pembimbing:
             pembimbing['kode_akses'] = generate_kode_akses()
             await db.pembimbing.update_one({"id": pembimbing['id']}, {"$set": {"kode_akses": pembimbing['kode_akses']}})
+            invalidate_principal_cache("pembimbing", pembimbing['id'])
 
         if isinstance(pembimbing.get('created_at'), str):
             pembimbing['created_at'] = datetime.fromisoformat(pembimbing['created_at'])
@@ -3815,12 +7066,14 @@ async def update_pembimbing(pembimbing_id: str, data: PembimbingUpdate, _: dict
     
     if update_data:
         await db.pembimbing.update_one({"id": pembimbing_id}, {"$set": update_data})
+        invalidate_principal_cache("pembimbing", pembimbing_id)
         pembimbing.update(update_data)
     
     # Ensure kode_akses exists
     if 'kode_akses' not in pembimbing:
         pembimbing['kode_akses'] = generate_kode_akses()
         await db.pembimbing.update_one({"id": pembimbing_id}, {"$set": {"kode_akses": pembimbing['kode_akses']}})
+        invalidate_principal_cache("pembimbing", pembimbing_id)
     
     if isinstance(pembimbing['created_at'], str):
         pembimbing['created_at'] = datetime.fromisoformat(pembimbing['created_at'])
@@ -3836,6 +7089,7 @@ async def regenerate_kode_akses(pembimbing_id: str, _: dict = Depends(get_curren
     
     new_kode = generate_kode_akses()
     await db.pembimbing.update_one({"id": pembimbing_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pembimbing", pembimbing_id)
     pembimbing['kode_akses'] = new_kode
     
     if isinstance(pembimbing['created_at'], str):
@@ -3846,6 +7100,7 @@ async def regenerate_kode_akses(pembimbing_id: str, _: dict = Depends(get_curren
 @api_router.delete("/pembimbing/{pembimbing_id}")
 async def delete_pembimbing(pembimbing_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pembimbing.delete_one({"id": pembimbing_id})
+    invalidate_principal_cache("pembimbing", pembimbing_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pembimbing tidak ditemukan")
     return {"message": "Pembimbing berhasil dihapus"}
@@ -3854,20 +7109,7 @@ async def delete_pembimbing(pembimbing_id: str, _: dict = Depends(get_current_ad
 # ==================== PEMBIMBING PWA ENDPOINTS ====================
 
 async def get_current_pembimbing(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        pembimbing_id: str = payload.get("sub")
-        if pembimbing_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-        pembimbing = await db.pembimbing.find_one({"id": pembimbing_id}, {"_id": 0})
-        if pembimbing is None:
-            raise HTTPException(status_code=401, detail="Pembimbing tidak ditemukan")
-
-        return pembimbing
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return await resolve_principal("pembimbing", credentials)
 
 
 @api_router.post("/pembimbing/login", response_model=PembimbingTokenResponse)
@@ -3905,7 +7147,10 @@ async def get_pembimbing_me(current_pembimbing: dict = Depends(get_current_pembi
 
 @api_router.get("/pembimbing/santri-absensi-hari-ini")
 async def get_pembimbing_santri_absensi_hari_ini(
+    request: Request,
+    response: Response,
     waktu_sholat: Optional[Literal["subuh", "dzuhur", "ashar", "maghrib", "isya"]] = None,
+    since: Optional[str] = None,
     current_pembimbing: dict = Depends(get_current_pembimbing)
 ):
     """Get today's attendance for santri in pembimbing's asrama"""
@@ -3914,9 +7159,17 @@ async def get_pembimbing_santri_absensi_hari_ini(
     asrama_ids = current_pembimbing.get('asrama_ids', [])
     if not asrama_ids:
         return {"tanggal": today, "waktu_sholat": waktu_sholat, "data": []}
+
+    delta = await absensi_roster_delta(request, "sholat", asrama_ids, today, waktu_sholat, since)
+    if delta["not_modified"] is not None:
+        return delta["not_modified"]
+    response.headers.update(delta["headers"])
     
-    # Get all santri in pembimbing's asrama
-    santri_list = await db.santri.find({"asrama_id": {"$in": asrama_ids}}, {"_id": 0}).to_list(10000)
+    # Get all santri in pembimbing's asrama (atau hanya yang berubah untuk delta)
+    santri_query: Dict[str, Any] = {"asrama_id": {"$in": asrama_ids}}
+    if delta["only_ids"] is not None:
+        santri_query["id"] = {"$in": delta["only_ids"]}
+    santri_list = await db.santri.find(santri_query, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_by_id = {s['id']: s for s in santri_list}
     
     # Get attendance for today
@@ -3935,13 +7188,10 @@ async def get_pembimbing_santri_absensi_hari_ini(
             status_by_santri[sid][ws] = a['status']
     
     # Get asrama names
-    asrama_map = {a['id']: a['nama'] for a in await db.asrama.find({}, {"_id": 0}).to_list(1000)}
+    asrama_map = await get_reference_map("asrama")
     
     # Get pengabsen names
-    pengabsen_map = {
-        p["id"]: p.get("nama", "-")
-        for p in await db.pengabsen.find({}, {"_id": 0, "id": 1, "nama": 1}).to_list(1000)
-    }
+    pengabsen_map = await get_reference_map("pengabsen")
     
     # Build pengabsen per santri (last entry)
     pengabsen_by_santri = {}
@@ -3966,7 +7216,13 @@ async def get_pembimbing_santri_absensi_hari_ini(
     # Sort by asrama then name
     result.sort(key=lambda x: (x['nama_asrama'], x['nama']))
     
-    return {"tanggal": today, "waktu_sholat": waktu_sholat, "data": result}
+    return {
+        "tanggal": today,
+        "waktu_sholat": waktu_sholat,
+        "data": result,
+        "delta": delta["only_ids"] is not None,
+        "version": delta["version"],
+    }
 
 
 @api_router.get("/pembimbing/absensi-riwayat")
@@ -3988,7 +7244,7 @@ async def get_pembimbing_absensi_riwayat(
         filter_asrama_ids = asrama_ids
     
     # Get santri
-    santri_list = await db.santri.find({"asrama_id": {"$in": filter_asrama_ids}}, {"_id": 0}).to_list(10000)
+    santri_list = await db.santri.find({"asrama_id": {"$in": filter_asrama_ids}}, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_by_id = {s['id']: s for s in santri_list}
     
     # Get attendance
@@ -4006,12 +7262,9 @@ async def get_pembimbing_absensi_riwayat(
         if sid in status_by_santri:
             status_by_santri[sid][ws] = a['status']
     
-    asrama_map = {a['id']: a['nama'] for a in await db.asrama.find({}, {"_id": 0}).to_list(1000)}
+    asrama_map = await get_reference_map("asrama")
     
-    pengabsen_map = {
-        p["id"]: p.get("nama", "-")
-        for p in await db.pengabsen.find({}, {"_id": 0, "id": 1, "nama": 1}).to_list(1000)
-    }
+    pengabsen_map = await get_reference_map("pengabsen")
     
     pengabsen_by_santri = {}
     for a in absensi_list:
@@ -4048,91 +7301,142 @@ async def get_pembimbing_statistik(
         return {"tanggal": tanggal, "total_santri": 0, "stats": {}}
     
     # Get santri count
-    santri_list = await db.santri.find({"asrama_id": {"$in": asrama_ids}}, {"_id": 0, "id": 1}).to_list(10000)
-    santri_ids = [s['id'] for s in santri_list]
-    total_santri = len(santri_ids)
+    total_santri = await db.santri.count_documents({"asrama_id": {"$in": asrama_ids}})
     
-    # Get attendance stats
-    absensi_list = await db.absensi.find(
-        {"tanggal": tanggal, "santri_id": {"$in": santri_ids}},
-        {"_id": 0}
-    ).to_list(10000)
+    # Get attendance stats dari rollup harian (bukan baris absensi mentah)
+    rollup_docs = await get_absensi_rollup(tanggal, tanggal, asrama_ids)
     
     # Calculate stats per waktu sholat
     waktu_list = ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
     stats = {}
     for waktu in waktu_list:
-        waktu_absensi = [a for a in absensi_list if a['waktu_sholat'] == waktu]
-        stats[waktu] = {
-            "hadir": len([a for a in waktu_absensi if a['status'] == 'hadir']),
-            "alfa": len([a for a in waktu_absensi if a['status'] == 'alfa']),
-            "sakit": len([a for a in waktu_absensi if a['status'] == 'sakit']),
-            "izin": len([a for a in waktu_absensi if a['status'] == 'izin']),
-            "haid": len([a for a in waktu_absensi if a['status'] == 'haid']),
-            "istihadhoh": len([a for a in waktu_absensi if a['status'] == 'istihadhoh']),
-            "masbuq": len([a for a in waktu_absensi if a['status'] == 'masbuq']),
-            "belum": total_santri - len(waktu_absensi)
-        }
+        stats[waktu] = {st: 0 for st in ROLLUP_STATUS_LIST}
+        sudah = 0
+        for r in rollup_docs:
+            if r.get("waktu_sholat") != waktu:
+                continue
+            for st in ROLLUP_STATUS_LIST:
+                stats[waktu][st] += r.get(st, 0)
+            sudah += r.get("total", 0)
+        stats[waktu]["belum"] = total_santri - sudah
     
     return {"tanggal": tanggal, "total_santri": total_santri, "stats": stats}
 
 
 # ==================== ABSENSI ENDPOINTS (REVISED) ====================
 
-@api_router.get("/absensi", response_model=List[AbsensiResponse])
+ABSENSI_LIST_FIELDS = ["id", "santri_id", "waktu_sholat", "status", "tanggal", "waktu_absen", "pengabsen_id", "created_at"]
+ABSENSI_LIST_DEFAULT_LIMIT = 1000
+ABSENSI_LIST_MAX_LIMIT = 10000
+
+
+def _parse_absensi_cursor(after: str) -> Tuple[str, str]:
+    tanggal, sep, absensi_id = after.partition(",")
+    if not sep or not tanggal or not absensi_id:
+        raise HTTPException(status_code=400, detail="Format after harus <tanggal>,<id>")
+    return tanggal, absensi_id
+
+
+@api_router.get("/absensi", response_model=List[Dict[str, Any]])
 async def get_absensi(
+    response: Response,
     tanggal_start: Optional[str] = None,
     tanggal_end: Optional[str] = None,
     santri_id: Optional[str] = None,
     waktu_sholat: Optional[str] = None,
     asrama_id: Optional[str] = None,
     gender: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = ABSENSI_LIST_DEFAULT_LIMIT,
+    fields: Optional[str] = None,
     _: dict = Depends(get_current_admin)
 ):
-    """Get absensi with advanced filters"""
-    query = {}
+    """Get absensi with advanced filters
+
+    Diurutkan terbaru dulu (tanggal, id menurun) dengan keyset pagination: kalau
+    masih ada data, header X-Next-Cursor berisi nilai `after` untuk halaman berikutnya.
+    `fields` (dipisah koma) membatasi kolom yang dikembalikan; id & tanggal selalu ada.
+    """
+    if not 1 <= limit <= ABSENSI_LIST_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit harus 1-{ABSENSI_LIST_MAX_LIMIT}")
+
+    projection: Dict[str, int] = {"_id": 0}
+    selected = ABSENSI_LIST_FIELDS
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in ABSENSI_LIST_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Field tidak dikenal: {', '.join(unknown)}")
+    for field in {"id", "tanggal", *selected}:
+        projection[field] = 1
+
+    query: Dict[str, Any] = {}
     
     # Date range filter
     if tanggal_start and tanggal_end:
         query['tanggal'] = {"$gte": tanggal_start, "$lte": tanggal_end}
     elif tanggal_start:
         query['tanggal'] = tanggal_start
+    elif tanggal_end:
+        query['tanggal'] = {"$lte": tanggal_end}
     
     if santri_id:
         query['santri_id'] = santri_id
     if waktu_sholat:
         query['waktu_sholat'] = waktu_sholat
     
-    absensi_list = await db.absensi.find(query, {"_id": 0}).to_list(10000)
-    
-    # Filter by asrama or gender if needed
+    # Filter asrama/gender lewat daftar santri_id di query MongoDB
     if asrama_id or gender:
         santri_query = {}
         if asrama_id:
             santri_query['asrama_id'] = asrama_id
         if gender:
             santri_query['gender'] = gender
-        
-        santri_ids = [s['id'] for s in await db.santri.find(santri_query, {"_id": 0, "id": 1}).to_list(10000)]
-        absensi_list = [a for a in absensi_list if a['santri_id'] in santri_ids]
-    
-    for absensi in absensi_list:
-        if isinstance(absensi['waktu_absen'], str):
-            absensi['waktu_absen'] = datetime.fromisoformat(absensi['waktu_absen'])
-        if isinstance(absensi['created_at'], str):
-            absensi['created_at'] = datetime.fromisoformat(absensi['created_at'])
+        if santri_id:
+            santri_query['id'] = santri_id
+        santri_ids = await db.santri.distinct("id", santri_query)
+        query['santri_id'] = {"$in": santri_ids}
+
+    if after:
+        after_tanggal, after_id = _parse_absensi_cursor(after)
+        query = {"$and": [query, {"$or": [
+            {"tanggal": {"$lt": after_tanggal}},
+            {"tanggal": after_tanggal, "id": {"$lt": after_id}},
+        ]}]}
+
+    absensi_list = await db.absensi.find(query, projection).sort(
+        [("tanggal", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    if len(absensi_list) > limit:
+        absensi_list = absensi_list[:limit]
+        last = absensi_list[-1]
+        response.headers["X-Next-Cursor"] = f"{last['tanggal']},{last['id']}"
     
     return absensi_list
 
+ABSENSI_STATUS_LIST = ["hadir", "alfa", "sakit", "izin", "haid", "istihadhoh", "masbuq"]
+
+
+def _empty_absensi_stats() -> Dict[str, int]:
+    return {"total": 0, **{status: 0 for status in ABSENSI_STATUS_LIST}}
+
+
 @api_router.get("/absensi/stats")
 async def get_absensi_stats(
     tanggal_start: Optional[str] = None,
     tanggal_end: Optional[str] = None,
     asrama_id: Optional[str] = None,
     gender: Optional[str] = None,
+    group_by: Optional[Literal["waktu_sholat", "asrama", "tanggal"]] = None,
     _: dict = Depends(get_current_admin)
 ):
-    """Get absensi statistics with filters"""
+    """Get absensi statistics with filters.
+
+    Dihitung dengan satu aggregation pipeline ($group per status). Filter asrama/gender
+    dilakukan lewat $lookup ke santri, bukan daftar $in santri_id. Opsional `group_by`
+    menambahkan `breakdown` per waktu_sholat / asrama / tanggal pada pass yang sama.
+    """
     query = {}
     
     if tanggal_start and tanggal_end:
@@ -4140,36 +7444,66 @@ async def get_absensi_stats(
     elif tanggal_start:
         query['tanggal'] = tanggal_start
     
-    # Filter by asrama or gender
-    if asrama_id or gender:
-        santri_query = {}
+    pipeline: List[Dict[str, Any]] = [{"$match": query}]
+
+    # Join ke santri hanya jika perlu (filter asrama/gender atau breakdown per asrama)
+    if asrama_id or gender or group_by == "asrama":
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": "santri",
+                    "localField": "santri_id",
+                    "foreignField": "id",
+                    "as": "santri",
+                }
+            },
+            {"$unwind": "$santri"},
+        ]
+        santri_match: Dict[str, Any] = {}
         if asrama_id:
-            santri_query['asrama_id'] = asrama_id
+            santri_match["santri.asrama_id"] = asrama_id
         if gender:
-            santri_query['gender'] = gender
-        
-        santri_ids = [s['id'] for s in await db.santri.find(santri_query, {"_id": 0, "id": 1}).to_list(10000)]
-        query['santri_id'] = {"$in": santri_ids}
-    
-    total = await db.absensi.count_documents(query)
-    hadir = await db.absensi.count_documents({**query, "status": "hadir"})
-    alfa = await db.absensi.count_documents({**query, "status": "alfa"})
-    sakit = await db.absensi.count_documents({**query, "status": "sakit"})
-    izin = await db.absensi.count_documents({**query, "status": "izin"})
-    haid = await db.absensi.count_documents({**query, "status": "haid"})
-    istihadhoh = await db.absensi.count_documents({**query, "status": "istihadhoh"})
-    masbuq = await db.absensi.count_documents({**query, "status": "masbuq"})
-    
-    return {
-        "total": total,
-        "hadir": hadir,
-        "alfa": alfa,
-        "sakit": sakit,
-        "izin": izin,
-        "haid": haid,
-        "istihadhoh": istihadhoh,
-        "masbuq": masbuq,
-    }
+            santri_match["santri.gender"] = gender
+        if santri_match:
+            pipeline.append({"$match": santri_match})
+
+    group_field = {
+        "waktu_sholat": "$waktu_sholat",
+        "asrama": "$santri.asrama_id",
+        "tanggal": "$tanggal",
+    }.get(group_by or "")
+
+    pipeline.append(
+        {
+            "$group": {
+                "_id": {"status": "$status", "group": group_field},
+                "count": {"$sum": 1},
+            }
+        }
+    )
+
+    result = _empty_absensi_stats()
+    breakdown: Dict[str, Dict[str, int]] = {}
+
+    async for row in db.absensi.aggregate(pipeline):
+        status = row["_id"].get("status")
+        count = row["count"]
+        result["total"] += count
+        if status in result:
+            result[status] += count
+
+        if group_by:
+            group_key = row["_id"].get("group") or "-"
+            bucket = breakdown.setdefault(group_key, _empty_absensi_stats())
+            bucket["total"] += count
+            if status in bucket:
+                bucket[status] += count
+
+    if group_by:
+        result["group_by"] = group_by
+        result["breakdown"] = dict(sorted(breakdown.items()))
+
+    return result
 
 @api_router.get("/absensi/detail")
 async def get_absensi_detail(
@@ -4194,13 +7528,45 @@ async def get_absensi_riwayat(
     tanggal_end: Optional[str] = None,
     asrama_id: Optional[str] = None,
     gender: Optional[str] = None,
+    summary_only: bool = False,
     _: dict = Depends(get_current_admin),
 ):
-    """Riwayat absensi sholat untuk admin (ringkasan & detail, rentang tanggal)."""
+    """Riwayat absensi sholat untuk admin (ringkasan & detail, rentang tanggal).
+
+    `summary_only=true` hanya menghitung ringkasan dari rollup harian (tanpa detail).
+    """
 
     if not tanggal_end:
         tanggal_end = tanggal_start
 
+    if summary_only:
+        asrama_filter: Optional[List[str]] = None
+        if asrama_id or gender:
+            asrama_query: Dict[str, Any] = {}
+            if asrama_id:
+                asrama_query["id"] = asrama_id
+            if gender:
+                asrama_query["gender"] = gender
+            asrama_filter = [
+                a["id"] for a in await db.asrama.find(asrama_query, {"_id": 0, "id": 1}).to_list(1000)
+            ]
+
+        rollup_docs = await get_absensi_rollup(tanggal_start, tanggal_end, asrama_filter)
+        by_waktu = {
+            w: {st: 0 for st in ROLLUP_STATUS_LIST}
+            for w in ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
+        }
+        total_records = 0
+        for r in rollup_docs:
+            waktu = r.get("waktu_sholat")
+            if waktu not in by_waktu:
+                continue
+            for st in ROLLUP_STATUS_LIST:
+                by_waktu[waktu][st] += r.get(st, 0)
+            total_records += r.get("total", 0)
+
+        return {"summary": {"total_records": total_records, "by_waktu": by_waktu}, "detail": None}
+
     # Get all santri with filters
     santri_query: Dict[str, Any] = {}
     if asrama_id:
@@ -4208,7 +7574,7 @@ async def get_absensi_riwayat(
     if gender:
         santri_query["gender"] = gender
 
-    all_santri = await db.santri.find(santri_query, {"_id": 0}).to_list(10000)
+    all_santri = await db.santri.find(santri_query, ROSTER_PROJECTIONS["santri_lean"]).to_list(10000)
     santri_dict = {s["id"]: s for s in all_santri}
 
     # Get absensi for the date range
@@ -4216,10 +7582,7 @@ async def get_absensi_riwayat(
     absensi_list = await db.absensi.find(absensi_query, {"_id": 0}).to_list(10000)
 
     # Map pengabsen_id -> nama
-    pengabsen_map = {
-        p["id"]: p.get("nama", "-")
-        for p in await db.pengabsen.find({}, {"_id": 0, "id": 1, "nama": 1}).to_list(1000)
-    }
+    pengabsen_map = await get_reference_map("pengabsen")
 
     # Organize by waktu sholat and status
     waktu_sholat_list = ["subuh", "dzuhur", "ashar", "maghrib", "isya"]
@@ -4300,7 +7663,7 @@ async def get_whatsapp_rekap(
             {"nis": {"$regex": q, "$options": "i"}},
         ]
 
-    santri_list = await db.santri.find(santri_query, {"_id": 0}).to_list(10000)
+    santri_list = await db.santri.find(santri_query, ROSTER_PROJECTIONS["santri_with_wali"]).to_list(10000)
     if not santri_list:
         return []
 
@@ -4318,9 +7681,7 @@ async def get_whatsapp_rekap(
 
     absensi_map = {(a["santri_id"], a["waktu_sholat"]): a.get("status", "belum") for a in absensi_list}
 
-    asrama_ids = list({s["asrama_id"] for s in santri_list})
-    asrama_list = await db.asrama.find({"id": {"$in": asrama_ids}}, {"_id": 0, "id": 1, "nama": 1}).to_list(10000)
-    asrama_map = {a["id"]: a.get("nama", "-") for a in asrama_list}
+    asrama_map = await get_reference_map("asrama")
 
     waktu_order = ["dzuhur", "ashar", "maghrib", "isya", "subuh"]
     result: List[WhatsAppRekapItem] = []
@@ -4494,56 +7855,44 @@ async def update_pmq_waktu_settings(data: PMQWaktuSettings, _: dict = Depends(ge
 
 @api_router.delete("/absensi/{absensi_id}")
 async def delete_absensi(absensi_id: str, _: dict = Depends(get_current_admin)):
-    result = await db.absensi.delete_one({"id": absensi_id})
-    if result.deleted_count == 0:
+    deleted = await db.absensi.find_one_and_delete({"id": absensi_id}, projection={"_id": 0})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Data absensi tidak ditemukan")
+
+    santri = await db.santri.find_one({"id": deleted.get("santri_id")}, {"_id": 0, "asrama_id": 1})
+    await apply_absensi_rollup(
+        deleted.get("tanggal"),
+        santri.get("asrama_id") if santri else None,
+        deleted.get("waktu_sholat"),
+        deleted.get("status"),
+        None,
+    )
+    await record_absensi_tombstones([deleted])
     return {"message": "Data absensi berhasil dihapus"}
 
 # ==================== WAKTU SHOLAT ENDPOINTS ====================
 
 @api_router.get("/waktu-sholat", response_model=WaktuSholatResponse)
 async def get_waktu_sholat(tanggal: str, _: dict = Depends(get_current_admin)):
-    waktu = await db.waktu_sholat.find_one({"tanggal": tanggal}, {"_id": 0})
-    
-    if waktu:
-        if isinstance(waktu['created_at'], str):
-            waktu['created_at'] = datetime.fromisoformat(waktu['created_at'])
-        return WaktuSholatResponse(**waktu)
-    
-    # Fetch from API
-    date_parts = tanggal.split('-')
-    api_date = f"{date_parts[2]}-{date_parts[1]}-{date_parts[0]}"
-    
-    prayer_times = await fetch_prayer_times(api_date)
-    if not prayer_times:
-        raise HTTPException(status_code=500, detail="Gagal mengambil data waktu sholat")
-    
-    waktu_obj = WaktuSholat(tanggal=tanggal, **prayer_times)
-    doc = waktu_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    
-    await db.waktu_sholat.insert_one(doc)
-    
-    return WaktuSholatResponse(**waktu_obj.model_dump())
+    return WaktuSholatResponse(**await get_waktu_sholat_doc(tanggal))
 
 @api_router.post("/waktu-sholat/sync")
 async def sync_waktu_sholat(tanggal: str, _: dict = Depends(get_current_admin)):
-    date_parts = tanggal.split('-')
-    api_date = f"{date_parts[2]}-{date_parts[1]}-{date_parts[0]}"
-    
-    prayer_times = await fetch_prayer_times(api_date)
-    if not prayer_times:
+    year, month, _day = (int(p) for p in tanggal.split("-"))
+    times = await fetch_prayer_calendar(year, month)
+    if not times or tanggal not in times:
         raise HTTPException(status_code=500, detail="Gagal mengambil data waktu sholat dari API")
     
-    await db.waktu_sholat.delete_one({"tanggal": tanggal})
-    
-    waktu_obj = WaktuSholat(tanggal=tanggal, **prayer_times)
-    doc = waktu_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    
-    await db.waktu_sholat.insert_one(doc)
+    await upsert_waktu_sholat(times, "aladhan")
     
-    return WaktuSholatResponse(**waktu_obj.model_dump())
+    return WaktuSholatResponse(**await get_waktu_sholat_doc(tanggal))
+
+@api_router.post("/admin/waktu-sholat/prefetch")
+async def prefetch_waktu_sholat_endpoint(tahun: int, bulan: Optional[int] = None, _: dict = Depends(get_current_admin)):
+    """Ambil jadwal sholat satu tahun (atau satu bulan) sekaligus dari Aladhan."""
+    if bulan is not None and not 1 <= bulan <= 12:
+        raise HTTPException(status_code=400, detail="Bulan harus 1-12")
+    return await prefetch_waktu_sholat(tahun, bulan)
 
 
 
@@ -4575,6 +7924,52 @@ async def update_aliyah_absensi_pagi_settings(data: AliyahAbsensiPagiSettings, _
     return {"message": "Pengaturan absensi pagi Aliyah berhasil disimpan"}
 
 
+# ==================== PENGATURAN JENDELA ABSENSI SHOLAT ====================
+
+class AbsensiSholatWindowSettings(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default=SHOLAT_WINDOW_SETTINGS_ID)
+    enforce: bool = False  # tolak absensi di luar jendela waktunya (aktifkan lewat pengaturan)
+    buka_sebelum_menit: int = Field(default=30, ge=0, le=180)
+    toleransi_menit: int = Field(default=60, ge=0, le=720)  # masih boleh dicatat setelah jendela tutup
+    updated_at: Optional[str] = None
+
+
+@api_router.get("/settings/absensi-sholat-window")
+async def get_absensi_sholat_window_settings(_: dict = Depends(get_current_admin)):
+    return await get_sholat_window_settings()
+
+
+@api_router.put("/settings/absensi-sholat-window")
+async def update_absensi_sholat_window_settings(data: AbsensiSholatWindowSettings, _: dict = Depends(get_current_admin)):
+    payload = data.model_dump()
+    payload["id"] = SHOLAT_WINDOW_SETTINGS_ID
+    payload["updated_at"] = datetime.now(timezone.utc).isoformat()
+
+    await db.settings.update_one({"id": SHOLAT_WINDOW_SETTINGS_ID}, {"$set": payload}, upsert=True)
+    invalidate_sholat_windows(settings=True)
+    return {"message": "Pengaturan jendela absensi sholat berhasil disimpan"}
+
+
+@api_router.get("/pengabsen/waktu-sholat-aktif")
+async def get_waktu_sholat_aktif(_: dict = Depends(get_current_pengabsen)):
+    """Waktu sholat yang sedang berlangsung beserta jadwal jendela hari ini (WIB)."""
+    try:
+        waktu, tanggal = await resolve_sholat_scan()
+    except HTTPException:
+        waktu, tanggal = None, get_today_local_iso()
+    try:
+        schedule = await get_sholat_window_schedule(get_today_local_iso())
+    except HTTPException:
+        # Jadwal tidak tersedia: tetap jawab, jendela dikosongkan
+        schedule = {}
+    return {
+        "waktu_sholat": waktu,
+        "tanggal": tanggal,
+        "jendela": {w: {"buka": start.strftime("%H:%M"), "tutup": end.strftime("%H:%M")} for w, (start, end) in schedule.items()},
+    }
+
+
 # ==================== SETTINGS ENDPOINTS ====================
 
 class WaliNotifikasiSettings(BaseModel):
@@ -4584,6 +7979,24 @@ class WaliNotifikasiSettings(BaseModel):
     izin: str = "{nama} tidak mengikuti sholat {waktu} pada hari ini karena izin (izin)"
     haid: str = "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang haid (haid)"
     istihadhoh: str = "{nama} tidak mengikuti sholat {waktu} pada hari ini karena sedang istihadhoh (istihadhoh)"
+    masbuq: str = "{nama} mengikuti sholat {waktu} hari ini namun datang masbuq (masbuq)"
+    # Notifikasi untuk wali yang sama dalam jendela ini digabung menjadi satu pesan
+    coalesce_seconds: int = Field(default=60, ge=0, le=3600)
+
+
+WALI_TEMPLATE_PLACEHOLDERS = ("nama", "waktu")
+
+
+def _wali_template_error(template: str) -> Optional[str]:
+    """Pesan kesalahan jika template memakai placeholder selain {nama} dan {waktu}."""
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(template) if field is not None]
+    except ValueError:
+        return "kurung kurawal tidak berpasangan (gunakan {{ dan }} untuk karakter kurung)"
+    invalid = [f for f in fields if f not in WALI_TEMPLATE_PLACEHOLDERS]
+    if invalid:
+        return f"placeholder {{{invalid[0]}}} tidak dikenal, hanya {{nama}} dan {{waktu}} yang didukung"
+    return None
 
 
 class WhatsAppTemplateSettings(BaseModel):
@@ -4642,6 +8055,8 @@ async def get_wali_notifikasi_settings(_: dict = Depends(get_current_admin)):
         "izin": settings.get("izin", WaliNotifikasiSettings().izin),
         "haid": settings.get("haid", WaliNotifikasiSettings().haid),
         "istihadhoh": settings.get("istihadhoh", WaliNotifikasiSettings().istihadhoh),
+        "masbuq": settings.get("masbuq", WaliNotifikasiSettings().masbuq),
+        "coalesce_seconds": settings.get("coalesce_seconds", WaliNotifikasiSettings().coalesce_seconds),
     }
 
 
@@ -4649,6 +8064,11 @@ async def get_wali_notifikasi_settings(_: dict = Depends(get_current_admin)):
 async def update_wali_notifikasi_settings(data: WaliNotifikasiSettings, _: dict = Depends(get_current_admin)):
     """Update notification template settings for Wali Santri"""
     settings_data = data.model_dump()
+    for status_absen, template in settings_data.items():
+        if isinstance(template, str):
+            error = _wali_template_error(template)
+            if error:
+                raise HTTPException(status_code=400, detail=f"Template {status_absen} tidak valid: {error}")
     settings_data["id"] = "wali_notifikasi"
     settings_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
@@ -4767,6 +8187,7 @@ async def ensure_admin_account(username: str, nama: str, password: str, role: st
 
     if updates:
         await db.admins.update_one({"id": admin["id"]}, {"$set": updates})
+        invalidate_principal_cache("admin", admin["id"])
 
 
 
@@ -4803,6 +8224,7 @@ async def initialize_admin():
                 {"id": existing_default["id"]},
                 {"$set": {"role": "superadmin"}},
             )
+            invalidate_principal_cache("admin", existing_default["id"])
 
     # Akun-akun baru sesuai requirement
     await ensure_admin_account(
@@ -4860,6 +8282,7 @@ async def create_kelas(data: KelasCreate, _: dict = Depends(get_current_admin)):
     doc = kelas.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.kelas.insert_one(doc)
+    invalidate_reference_cache("kelas")
     
     return KelasResponse(**kelas.model_dump(), jumlah_siswa=0)
 
@@ -4881,6 +8304,7 @@ async def update_kelas(kelas_id: str, data: KelasUpdate, _: dict = Depends(get_c
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         await db.kelas.update_one({"id": kelas_id}, {"$set": update_data})
+        invalidate_reference_cache("kelas")
     
     updated_kelas = await db.kelas.find_one({"id": kelas_id}, {"_id": 0})
     jumlah_siswa = await db.siswa_madrasah.count_documents({"kelas_id": kelas_id})
@@ -4895,6 +8319,7 @@ async def delete_kelas(kelas_id: str, _: dict = Depends(get_current_admin)):
     )
     
     result = await db.kelas.delete_one({"id": kelas_id})
+    invalidate_reference_cache("kelas")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Kelas tidak ditemukan")
     
@@ -4947,6 +8372,7 @@ async def create_kelas_aliyah(data: KelasAliyahCreate, _: dict = Depends(get_cur
     doc = kelas.model_dump()
     doc["created_at"] = doc["created_at"].isoformat()
     await db.kelas_aliyah.insert_one(doc)
+    invalidate_reference_cache("kelas_aliyah")
 
     return KelasAliyahResponse(**kelas.model_dump(), jumlah_siswa=0)
 
@@ -4970,6 +8396,7 @@ async def update_kelas_aliyah(kelas_id: str, data: KelasAliyahUpdate, _: dict =
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         await db.kelas_aliyah.update_one({"id": kelas_id}, {"$set": update_data})
+        invalidate_reference_cache("kelas_aliyah")
 
     updated_kelas = await db.kelas_aliyah.find_one({"id": kelas_id}, {"_id": 0})
     jumlah_siswa = await db.siswa_aliyah.count_documents({"kelas_id": kelas_id})
@@ -4985,6 +8412,7 @@ async def delete_kelas_aliyah(kelas_id: str, _: dict = Depends(get_current_admin
     )
 
     result = await db.kelas_aliyah.delete_one({"id": kelas_id})
+    invalidate_reference_cache("kelas_aliyah")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Kelas tidak ditemukan")
 
@@ -5025,10 +8453,7 @@ async def get_siswa_madrasah_list(_: dict = Depends(get_current_admin)):
 
     
     # Get kelas names
-    kelas_map = {}
-    kelas_list = await db.kelas.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas["nama"]
+    kelas_map = await get_reference_map("kelas")
     
     result = []
     for siswa in siswa_list:
@@ -5083,7 +8508,7 @@ async def create_siswa_madrasah(data: SiswaMadrasahCreate, _: dict = Depends(get
         "nama": data.nama,
         "type": "siswa_madrasah",
     }
-    qr_code = generate_qr_code(qr_payload) if not data.santri_id else None
+    qr_code = await generate_qr_code_async(qr_payload) if not data.santri_id else None
 
     siswa_dict = data.model_dump()
     siswa_dict["id"] = qr_payload["id"]
@@ -5127,10 +8552,7 @@ async def get_siswa_aliyah_list(_: dict = Depends(get_current_admin)):
 
 
     # Get kelas aliyah names
-    kelas_map: Dict[str, str] = {}
-    kelas_list = await db.kelas_aliyah.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas["nama"]
+    kelas_map: Dict[str, str] = await get_reference_map("kelas_aliyah")
 
     result: List[SiswaAliyahResponse] = []
     for siswa in siswa_list:
@@ -5193,7 +8615,7 @@ async def create_siswa_aliyah(data: SiswaAliyahCreate, _: dict = Depends(get_cur
             "nama": siswa.nama,
             "type": "siswa_aliyah",
         }
-        siswa.qr_code = generate_qr_code(qr_data)
+        siswa.qr_code = await generate_qr_code_async(qr_data)
 
     doc = siswa.model_dump()
     doc["created_at"] = doc["created_at"].isoformat()
@@ -5218,10 +8640,10 @@ async def get_siswa_aliyah_qr_code(siswa_id: str, _: dict = Depends(get_current_
 
     # If linked to santri, get QR from santri
     if siswa.get("santri_id"):
-        santri = await db.santri.find_one({"id": siswa["santri_id"]}, {"_id": 0})
-        if not santri or not santri.get("qr_code"):
+        santri = await db.santri.find_one({"id": siswa["santri_id"]}, {"_id": 0, "id": 1, "nama": 1, "nis": 1, "qr_code": 1})
+        if not santri:
             raise HTTPException(status_code=404, detail="QR Code tidak ditemukan")
-        img_data = base64.b64decode(santri["qr_code"])
+        img_data = base64.b64decode((await get_santri_qr(santri))["qr_code"])
     elif siswa.get("qr_code"):
         img_data = base64.b64decode(siswa["qr_code"])
     else:
@@ -5290,10 +8712,10 @@ async def get_siswa_madrasah_qr_code(siswa_id: str, _: dict = Depends(get_curren
     
     # If linked to santri, get QR from santri
     if siswa.get("santri_id"):
-        santri = await db.santri.find_one({"id": siswa["santri_id"]}, {"_id": 0})
-        if not santri or not santri.get("qr_code"):
+        santri = await db.santri.find_one({"id": siswa["santri_id"]}, {"_id": 0, "id": 1, "nama": 1, "nis": 1, "qr_code": 1})
+        if not santri:
             raise HTTPException(status_code=404, detail="QR Code tidak ditemukan")
-        img_data = base64.b64decode(santri['qr_code'])
+        img_data = base64.b64decode((await get_santri_qr(santri))["qr_code"])
     elif siswa.get("qr_code"):
         img_data = base64.b64decode(siswa['qr_code'])
     else:
@@ -5359,10 +8781,9 @@ async def get_pengabsen_kelas_siswa_saya(current_pengabsen: dict = Depends(get_c
     if not kelas_ids:
         return []
 
-    siswa_list = await db.siswa_madrasah.find({"kelas_id": {"$in": kelas_ids}}, {"_id": 0}).to_list(1000)
+    siswa_list = await db.siswa_madrasah.find({"kelas_id": {"$in": kelas_ids}}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]).to_list(1000)
     # Ambil nama kelas
-    kelas_docs = await db.kelas.find({"id": {"$in": kelas_ids}}, {"_id": 0}).to_list(1000)
-    kelas_map = {k["id"]: k["nama"] for k in kelas_docs}
+    kelas_map = await get_reference_map("kelas")
 
     result = []
     for siswa in siswa_list:
@@ -5442,16 +8863,7 @@ async def scan_qr_absensi_kelas(
     if siswa["kelas_id"] not in current_pengabsen.get("kelas_ids", []):
         raise HTTPException(status_code=403, detail="Anda tidak memiliki akses ke kelas ini")
     
-    # Check if already marked today
-    existing = await db.absensi_kelas.find_one({
-        "siswa_id": siswa_id,
-        "tanggal": tanggal
-    }, {"_id": 0})
-    
-    if existing:
-        return {"message": "Siswa sudah diabsen hari ini", "status": existing["status"], "siswa_nama": siswa["nama"]}
-    
-    # Create new absensi
+    # Insert hanya jika belum diabsen hari ini (atomik, tanpa find_one terpisah)
     absensi = AbsensiKelas(
         siswa_id=siswa_id,
         kelas_id=siswa["kelas_id"],
@@ -5466,7 +8878,14 @@ async def scan_qr_absensi_kelas(
     if doc.get('waktu_absen'):
         doc['waktu_absen'] = doc['waktu_absen'].isoformat()
     
-    await db.absensi_kelas.insert_one(doc)
+    existing = await upsert_absensi_atomic(
+        "absensi_kelas",
+        {"siswa_id": siswa_id, "tanggal": tanggal},
+        insert_fields=doc,
+    )
+    
+    if existing:
+        return {"message": "Siswa sudah diabsen hari ini", "status": existing["status"], "siswa_nama": siswa["nama"]}
     
     return {"message": "Absensi berhasil dicatat", "siswa_nama": siswa["nama"], "status": "hadir"}
 
@@ -5490,20 +8909,9 @@ async def absensi_kelas_nfc(
     tanggal = payload.tanggal or get_today_local_iso()
     status = payload.status or "hadir"
 
-    existing = await db.absensi_kelas.find_one({
-        "siswa_id": siswa["id"],
-        "tanggal": tanggal,
-    }, {"_id": 0})
-
-    if existing:
-        return {"message": "Siswa sudah diabsen hari ini", "status": existing["status"], "siswa_nama": siswa["nama"]}
-
     now = datetime.now(timezone.utc)
     doc = {
-        "id": str(uuid.uuid4()),
-        "siswa_id": siswa["id"],
         "kelas_id": siswa.get("kelas_id"),
-        "tanggal": tanggal,
         "status": status,
         "waktu_absen": now.isoformat(),
         "pengabsen_kelas_id": current_pengabsen["id"],
@@ -5511,7 +8919,14 @@ async def absensi_kelas_nfc(
         "updated_at": now.isoformat(),
     }
 
-    await db.absensi_kelas.insert_one(doc)
+    existing = await upsert_absensi_atomic(
+        "absensi_kelas",
+        {"siswa_id": siswa["id"], "tanggal": tanggal},
+        insert_fields=doc,
+    )
+
+    if existing:
+        return {"message": "Siswa sudah diabsen hari ini", "status": existing["status"], "siswa_nama": siswa["nama"]}
 
     return {"message": "Absensi NFC berhasil dicatat", "siswa_nama": siswa["nama"], "status": status}
 
@@ -5540,14 +8955,11 @@ async def get_absensi_kelas_riwayat(
     
     # Enrich with siswa and kelas names
     siswa_map = {}
-    siswa_list = await db.siswa_madrasah.find({}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_madrasah.find({}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]).to_list(10000)
     for siswa in siswa_list:
         siswa_map[siswa["id"]] = siswa["nama"]
     
-    kelas_map = {}
-    kelas_list = await db.kelas.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas["nama"]
+    kelas_map = await get_reference_map("kelas")
     
     result = []
     for absensi in absensi_list:
@@ -5571,7 +8983,7 @@ async def get_absensi_kelas_grid(
         raise HTTPException(status_code=403, detail="Anda tidak memiliki akses ke kelas ini")
     
     # Get all siswa in this kelas
-    siswa_list = await db.siswa_madrasah.find({"kelas_id": kelas_id}, {"_id": 0}).to_list(1000)
+    siswa_list = await db.siswa_madrasah.find({"kelas_id": kelas_id}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]).to_list(1000)
     
     # Get all absensi for this month
     tanggal_start = f"{bulan}-01"
@@ -5640,8 +9052,9 @@ async def update_absensi_kelas(
     
     await db.absensi_kelas.update_one(
         {"id": absensi_id},
-        {"$set": {"status": data.status}}
+        {"$set": {"status": data.status, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    emit_absensi_changes("absensi_kelas", [{**absensi, "status": data.status}])
     
     updated_absensi = await db.absensi_kelas.find_one({"id": absensi_id}, {"_id": 0})
     
@@ -5665,22 +9078,7 @@ async def create_absensi_kelas_manual(
     if data.kelas_id not in current_pengabsen.get("kelas_ids", []):
         raise HTTPException(status_code=403, detail="Anda tidak memiliki akses ke kelas ini")
     
-    # Check if already exists
-    existing = await db.absensi_kelas.find_one({
-        "siswa_id": data.siswa_id,
-        "kelas_id": data.kelas_id,
-        "tanggal": data.tanggal
-    }, {"_id": 0})
-    
-    if existing:
-        # Update instead
-        await db.absensi_kelas.update_one(
-            {"id": existing["id"]},
-            {"$set": {"status": data.status}}
-        )
-        return {"message": "Absensi berhasil diupdate", "absensi_id": existing["id"]}
-    
-    # Create new
+    # Upsert atomik per siswa + tanggal (update jika sudah ada)
     absensi = AbsensiKelas(
         siswa_id=data.siswa_id,
         kelas_id=data.kelas_id,
@@ -5694,7 +9092,15 @@ async def create_absensi_kelas_manual(
     if doc.get('waktu_absen'):
         doc['waktu_absen'] = doc['waktu_absen'].isoformat()
     
-    await db.absensi_kelas.insert_one(doc)
+    existing = await upsert_absensi_atomic(
+        "absensi_kelas",
+        {"siswa_id": data.siswa_id, "tanggal": data.tanggal},
+        {"status": data.status, "kelas_id": data.kelas_id},
+        doc,
+    )
+    
+    if existing:
+        return {"message": "Absensi berhasil diupdate", "absensi_id": existing.get("id")}
     
     return {"message": "Absensi berhasil dicatat", "absensi_id": absensi.id}
 
@@ -5735,6 +9141,7 @@ async def delete_absensi_kelas(absensi_id: str, current_pengabsen: dict = Depend
         raise HTTPException(status_code=403, detail="Anda tidak memiliki akses ke kelas ini")
 
     await db.absensi_kelas.delete_one({"id": absensi_id})
+    emit_absensi_changes("absensi_kelas", [absensi], "delete")
     return {"message": "Absensi berhasil dihapus"}
 
 
@@ -5793,6 +9200,7 @@ async def update_pengabsen_aliyah(pengabsen_id: str, data: PengabsenAliyahUpdate
 
     if update_data:
         await db.pengabsen_aliyah.update_one({"id": pengabsen_id}, {"$set": update_data})
+        invalidate_principal_cache("pengabsen_aliyah", pengabsen_id)
 
     updated = await db.pengabsen_aliyah.find_one({"id": pengabsen_id}, {"_id": 0})
     return PengabsenAliyahResponse(**updated)
@@ -5806,6 +9214,7 @@ async def regenerate_pengabsen_aliyah_kode(pengabsen_id: str, _: dict = Depends(
 
     new_kode = generate_kode_akses()
     await db.pengabsen_aliyah.update_one({"id": pengabsen_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pengabsen_aliyah", pengabsen_id)
 
     updated = await db.pengabsen_aliyah.find_one({"id": pengabsen_id}, {"_id": 0})
     return PengabsenAliyahResponse(**updated)
@@ -5814,6 +9223,7 @@ async def regenerate_pengabsen_aliyah_kode(pengabsen_id: str, _: dict = Depends(
 @api_router.delete("/aliyah/pengabsen/{pengabsen_id}")
 async def delete_pengabsen_aliyah(pengabsen_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pengabsen_aliyah.delete_one({"id": pengabsen_id})
+    invalidate_principal_cache("pengabsen_aliyah", pengabsen_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pengabsen Aliyah tidak ditemukan")
     return {"message": "Pengabsen Aliyah berhasil dihapus"}
@@ -5870,6 +9280,7 @@ async def update_monitoring_aliyah(pembimbing_id: str, data: MonitoringAliyahUpd
 
     if update_data:
         await db.pembimbing_aliyah.update_one({"id": pembimbing_id}, {"$set": update_data})
+        invalidate_principal_cache("monitoring_aliyah", pembimbing_id)
 
     updated = await db.pembimbing_aliyah.find_one({"id": pembimbing_id}, {"_id": 0})
     return MonitoringAliyahResponse(**updated)
@@ -5883,6 +9294,7 @@ async def regenerate_monitoring_aliyah_kode(pembimbing_id: str, _: dict = Depend
 
     new_kode = generate_kode_akses()
     await db.pembimbing_aliyah.update_one({"id": pembimbing_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("monitoring_aliyah", pembimbing_id)
 
     updated = await db.pembimbing_aliyah.find_one({"id": pembimbing_id}, {"_id": 0})
     return MonitoringAliyahResponse(**updated)
@@ -5950,14 +9362,11 @@ async def get_aliyah_absensi_riwayat(
 
     # Ambil siswa & kelas untuk enrichment + filter gender
     siswa_map: Dict[str, Dict[str, Any]] = {}
-    siswa_list = await db.siswa_aliyah.find({}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_aliyah.find({}, ROSTER_PROJECTIONS["siswa_aliyah_lean"]).to_list(10000)
     for siswa in siswa_list:
         siswa_map[siswa["id"]] = siswa
 
-    kelas_map: Dict[str, Dict[str, Any]] = {}
-    kelas_list = await db.kelas_aliyah.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas
+    kelas_map: Dict[str, Dict[str, Any]] = {k["id"]: k for k in await get_reference_docs("kelas_aliyah")}
 
     detail: List[Dict[str, Any]] = []
     summary = {"hadir": 0, "alfa": 0, "sakit": 0, "izin": 0, "dispensasi": 0, "bolos": 0}
@@ -5999,9 +9408,12 @@ async def get_aliyah_absensi_riwayat(
 
 @api_router.get("/aliyah/monitoring/absensi-hari-ini")
 async def get_aliyah_monitoring_absensi_hari_ini(
+    request: Request,
+    response: Response,
     jenis: Literal["pagi", "dzuhur"],
     tanggal: Optional[str] = None,
     kelas_id: Optional[str] = None,
+    since: Optional[str] = None,
     current_monitoring: dict = Depends(get_current_monitoring_aliyah),
 ):
     if not tanggal:
@@ -6016,7 +9428,15 @@ async def get_aliyah_monitoring_absensi_hari_ini(
 
     target_kelas_ids = [kelas_id] if kelas_id else kelas_ids
 
-    siswa_list = await db.siswa_aliyah.find({"kelas_id": {"$in": target_kelas_ids}}, {"_id": 0}).to_list(5000)
+    delta = await absensi_roster_delta(request, "aliyah", target_kelas_ids, tanggal, jenis, since)
+    if delta["not_modified"] is not None:
+        return delta["not_modified"]
+    response.headers.update(delta["headers"])
+
+    siswa_query: Dict[str, Any] = {"kelas_id": {"$in": target_kelas_ids}}
+    if delta["only_ids"] is not None:
+        siswa_query["id"] = {"$in": delta["only_ids"]}
+    siswa_list = await db.siswa_aliyah.find(siswa_query, ROSTER_PROJECTIONS["siswa_aliyah_lean"]).to_list(5000)
     siswa_by_id = {s["id"]: s for s in siswa_list}
 
     absensi_list = await db.absensi_aliyah.find(
@@ -6026,8 +9446,7 @@ async def get_aliyah_monitoring_absensi_hari_ini(
 
     status_map: Dict[str, str] = {a["siswa_id"]: a.get("status", "") for a in absensi_list}
 
-    kelas_docs = await db.kelas_aliyah.find({"id": {"$in": target_kelas_ids}}, {"_id": 0}).to_list(1000)
-    kelas_map = {k["id"]: k["nama"] for k in kelas_docs}
+    kelas_map = await get_reference_map("kelas_aliyah")
 
     data = []
     for siswa in siswa_list:
@@ -6045,7 +9464,13 @@ async def get_aliyah_monitoring_absensi_hari_ini(
 
     data.sort(key=lambda x: (x["kelas_nama"], x["nama"]))
 
-    return {"tanggal": tanggal, "jenis": jenis, "data": data}
+    return {
+        "tanggal": tanggal,
+        "jenis": jenis,
+        "data": data,
+        "delta": delta["only_ids"] is not None,
+        "version": delta["version"],
+    }
 
 
 @api_router.get("/aliyah/monitoring/absensi-riwayat")
@@ -6084,11 +9509,10 @@ async def get_aliyah_monitoring_absensi_riwayat(
         }
 
     siswa_ids = list({a["siswa_id"] for a in absensi_list})
-    siswa_list = await db.siswa_aliyah.find({"id": {"$in": siswa_ids}}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_aliyah.find({"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_aliyah_lean"]).to_list(10000)
     siswa_map = {s["id"]: s for s in siswa_list}
 
-    kelas_docs = await db.kelas_aliyah.find({"id": {"$in": target_kelas_ids}}, {"_id": 0}).to_list(1000)
-    kelas_map = {k["id"]: k["nama"] for k in kelas_docs}
+    kelas_map = await get_reference_map("kelas_aliyah")
 
     summary = {"hadir": 0, "alfa": 0, "sakit": 0, "izin": 0, "dispensasi": 0, "bolos": 0}
     detail: List[Dict[str, Any]] = []
@@ -6151,6 +9575,7 @@ async def get_aliyah_monitoring_absensi_riwayat(
 @api_router.delete("/aliyah/monitoring/{pembimbing_id}")
 async def delete_monitoring_aliyah(pembimbing_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pembimbing_aliyah.delete_one({"id": pembimbing_id})
+    invalidate_principal_cache("monitoring_aliyah", pembimbing_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Monitoring Aliyah tidak ditemukan")
     return {"message": "Monitoring Aliyah berhasil dihapus"}
@@ -6240,11 +9665,10 @@ async def get_aliyah_pengabsen_riwayat(
     absensi_list = list(dedup_map.values())
 
     siswa_ids = list({a["siswa_id"] for a in absensi_list})
-    siswa_list = await db.siswa_aliyah.find({"id": {"$in": siswa_ids}}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_aliyah.find({"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_aliyah_lean"]).to_list(10000)
     siswa_map = {s["id"]: s for s in siswa_list}
 
-    kelas_docs = await db.kelas_aliyah.find({"id": {"$in": kelas_ids}}, {"_id": 0}).to_list(1000)
-    kelas_map = {k["id"]: k["nama"] for k in kelas_docs}
+    kelas_map = await get_reference_map("kelas_aliyah")
 
     summary = {"hadir": 0, "alfa": 0, "sakit": 0, "izin": 0, "dispensasi": 0, "bolos": 0}
     detail: List[Dict[str, Any]] = []
@@ -6297,6 +9721,7 @@ async def update_pengabsen_kelas(pengabsen_id: str, data: PengabsenKelasUpdate,
     
     if update_data:
         await db.pengabsen_kelas.update_one({"id": pengabsen_id}, {"$set": update_data})
+        invalidate_principal_cache("pengabsen_kelas", pengabsen_id)
         pengabsen.update(update_data)
 
     return PengabsenKelasResponse(**pengabsen)
@@ -6307,26 +9732,39 @@ async def update_pengabsen_kelas(pengabsen_id: str, data: PengabsenKelasUpdate,
 
 @api_router.get("/pmq/pengabsen/absensi-hari-ini")
 async def get_pmq_pengabsen_absensi_hari_ini(
+    request: Request,
+    response: Response,
     tanggal: str,
     sesi: str,
+    since: Optional[str] = None,
     current_pengabsen: dict = Depends(get_current_pengabsen_pmq),
 ):
     """Data absensi hari ini per siswa untuk pengabsen PMQ.
 
     Hanya mengembalikan siswa di kelompok yang dimiliki pengabsen.
+    Mendukung If-None-Match (304) dan `since=<version>` untuk delta.
     """
     kelompok_ids = current_pengabsen.get("kelompok_ids", []) or []
     if not kelompok_ids:
         return {"data": []}
 
-    # Ambil siswa PMQ di kelompok tersebut
+    delta = await absensi_roster_delta(request, "pmq", kelompok_ids, tanggal, sesi, since)
+    if delta["not_modified"] is not None:
+        return delta["not_modified"]
+    response.headers.update(delta["headers"])
+    delta_fields = {"delta": delta["only_ids"] is not None, "version": delta["version"]}
+
+    # Ambil siswa PMQ di kelompok tersebut (atau hanya yang berubah untuk delta)
+    siswa_query: Dict[str, Any] = {"kelompok_id": {"$in": kelompok_ids}}
+    if delta["only_ids"] is not None:
+        siswa_query["id"] = {"$in": delta["only_ids"]}
     siswa_list = await db.siswa_pmq.find(
-        {"kelompok_id": {"$in": kelompok_ids}},
-        {"_id": 0},
+        siswa_query,
+        ROSTER_PROJECTIONS["siswa_pmq_lean"],
     ).to_list(5000)
 
     if not siswa_list:
-        return {"data": []}
+        return {"data": [], **delta_fields}
 
     siswa_ids = [s["id"] for s in siswa_list]
 
@@ -6338,8 +9776,7 @@ async def get_pmq_pengabsen_absensi_hari_ini(
     abs_map = {(a["siswa_id"], a.get("kelompok_id")): a for a in absensi_list}
 
     # Map kelompok & tingkatan untuk label
-    kelompok_docs = await db.pmq_kelompok.find({"id": {"$in": kelompok_ids}}, {"_id": 0}).to_list(1000)
-    kelompok_map = {k["id"]: k for k in kelompok_docs}
+    kelompok_map = {k["id"]: k for k in await get_reference_docs("pmq_kelompok")}
     tingkatan_map = {t["key"]: t["label"] for t in PMQ_TINGKATAN}
 
     result = []
@@ -6360,7 +9797,7 @@ async def get_pmq_pengabsen_absensi_hari_ini(
             }
         )
 
-    return {"data": result}
+    return {"data": result, **delta_fields}
 
 
 @api_router.post("/pmq/pengabsen/absensi")
@@ -6373,17 +9810,16 @@ async def upsert_pmq_pengabsen_absensi(
         raise HTTPException(status_code=403, detail="Tidak boleh mengakses kelompok ini")
 
     # Upsert by siswa + tanggal + sesi
-    query = {"siswa_id": data.siswa_id, "tanggal": data.tanggal, "sesi": data.sesi}
-    update = {
-        "$set": {
+    await upsert_absensi_atomic(
+        "absensi_pmq",
+        {"siswa_id": data.siswa_id, "tanggal": data.tanggal, "sesi": data.sesi},
+        {
             "status": data.status,
             "kelompok_id": data.kelompok_id,
             "pengabsen_id": current_pengabsen["id"],
             "waktu_absen": datetime.now(timezone.utc).isoformat(),
-        }
-    }
-
-    await db.absensi_pmq.update_one(query, update, upsert=True)
+        },
+    )
 
     return {"message": "Absensi berhasil disimpan"}
 
@@ -6422,17 +9858,16 @@ async def scan_pmq_pengabsen_absensi(
     if kelompok_id and kelompok_id not in (current_pengabsen.get("kelompok_ids") or []):
         raise HTTPException(status_code=403, detail="Siswa bukan bagian dari kelompok Anda")
 
-    query = {"siswa_id": siswa_id, "tanggal": tanggal, "sesi": sesi}
-    update = {
-        "$set": {
+    await upsert_absensi_atomic(
+        "absensi_pmq",
+        {"siswa_id": siswa_id, "tanggal": tanggal, "sesi": sesi},
+        {
             "status": "hadir",
             "kelompok_id": kelompok_id,
             "pengabsen_id": current_pengabsen["id"],
             "waktu_absen": datetime.now(timezone.utc).isoformat(),
-        }
-    }
-
-    await db.absensi_pmq.update_one(query, update, upsert=True)
+        },
+    )
 
     return {"message": "Absensi via scan berhasil disimpan"}
 
@@ -6465,11 +9900,10 @@ async def get_pmq_pengabsen_riwayat(
         return {"detail": []}
 
     siswa_ids = list({a["siswa_id"] for a in absensi_list})
-    siswa_list = await db.siswa_pmq.find({"id": {"$in": siswa_ids}}, {"_id": 0}).to_list(5000)
+    siswa_list = await db.siswa_pmq.find({"id": {"$in": siswa_ids}}, ROSTER_PROJECTIONS["siswa_pmq_lean"]).to_list(5000)
     siswa_map = {s["id"]: s for s in siswa_list}
 
-    kelompok_docs = await db.pmq_kelompok.find({"id": {"$in": kelompok_ids}}, {"_id": 0}).to_list(1000)
-    kelompok_map = {k["id"]: k for k in kelompok_docs}
+    kelompok_map = {k["id"]: k for k in await get_reference_docs("pmq_kelompok")}
 
     tingkatan_map = {t["key"]: t["label"] for t in PMQ_TINGKATAN}
 
@@ -6513,6 +9947,7 @@ async def regenerate_pengabsen_kelas_kode(pengabsen_id: str, _: dict = Depends(g
     
     new_kode = generate_kode_akses()
     await db.pengabsen_kelas.update_one({"id": pengabsen_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pengabsen_kelas", pengabsen_id)
     
     updated = await db.pengabsen_kelas.find_one({"id": pengabsen_id}, {"_id": 0})
     return PengabsenKelasResponse(**updated)
@@ -6520,6 +9955,7 @@ async def regenerate_pengabsen_kelas_kode(pengabsen_id: str, _: dict = Depends(g
 @api_router.delete("/pengabsen-kelas/{pengabsen_id}")
 async def delete_pengabsen_kelas(pengabsen_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pengabsen_kelas.delete_one({"id": pengabsen_id})
+    invalidate_principal_cache("pengabsen_kelas", pengabsen_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pengabsen kelas tidak ditemukan")
     return {"message": "Pengabsen kelas berhasil dihapus"}
@@ -6599,6 +10035,7 @@ async def update_pembimbing_kelas(pembimbing_id: str, data: PembimbingKelasUpdat
     
     if update_data:
         await db.pembimbing_kelas.update_one({"id": pembimbing_id}, {"$set": update_data})
+        invalidate_principal_cache("pembimbing_kelas", pembimbing_id)
     
     updated = await db.pembimbing_kelas.find_one({"id": pembimbing_id}, {"_id": 0})
     return PembimbingKelasResponse(**updated)
@@ -6611,6 +10048,7 @@ async def regenerate_pembimbing_kelas_kode(pembimbing_id: str, _: dict = Depends
     
     new_kode = generate_kode_akses()
     await db.pembimbing_kelas.update_one({"id": pembimbing_id}, {"$set": {"kode_akses": new_kode}})
+    invalidate_principal_cache("pembimbing_kelas", pembimbing_id)
     
     updated = await db.pembimbing_kelas.find_one({"id": pembimbing_id}, {"_id": 0})
     return PembimbingKelasResponse(**updated)
@@ -6618,6 +10056,7 @@ async def regenerate_pembimbing_kelas_kode(pembimbing_id: str, _: dict = Depends
 @api_router.delete("/pembimbing-kelas/{pembimbing_id}")
 async def delete_pembimbing_kelas(pembimbing_id: str, _: dict = Depends(get_current_admin)):
     result = await db.pembimbing_kelas.delete_one({"id": pembimbing_id})
+    invalidate_principal_cache("pembimbing_kelas", pembimbing_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pembimbing kelas tidak ditemukan")
     return {"message": "Pembimbing kelas berhasil dihapus"}
@@ -6721,14 +10160,11 @@ async def get_pembimbing_kelas_riwayat(
     
     # Enrich with siswa and kelas names
     siswa_map = {}
-    siswa_list = await db.siswa_madrasah.find({}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_madrasah.find({}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]).to_list(10000)
     for siswa in siswa_list:
         siswa_map[siswa["id"]] = siswa["nama"]
     
-    kelas_map = {}
-    kelas_list = await db.kelas.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas["nama"]
+    kelas_map = await get_reference_map("kelas")
     
     result = []
     for absensi in absensi_list:
@@ -6770,14 +10206,11 @@ async def get_madin_absensi_riwayat(
 
     # Ambil siswa & kelas untuk enrichment + filter gender
     siswa_map: Dict[str, Dict[str, Any]] = {}
-    siswa_list = await db.siswa_madrasah.find({}, {"_id": 0}).to_list(10000)
+    siswa_list = await db.siswa_madrasah.find({}, ROSTER_PROJECTIONS["siswa_madrasah_lean"]).to_list(10000)
     for siswa in siswa_list:
         siswa_map[siswa["id"]] = siswa
 
-    kelas_map: Dict[str, Dict[str, Any]] = {}
-    kelas_list = await db.kelas.find({}, {"_id": 0}).to_list(1000)
-    for kelas in kelas_list:
-        kelas_map[kelas["id"]] = kelas
+    kelas_map: Dict[str, Dict[str, Any]] = {k["id"]: k for k in await get_reference_docs("kelas")}
 
     detail: List[Dict[str, Any]] = []
     summary = {"hadir": 0, "alfa": 0, "sakit": 0, "izin": 0, "telat": 0}
@@ -6818,6 +10251,353 @@ async def get_madin_absensi_riwayat(
 
     return {"summary": summary, "detail": detail}
 
+# ==================== DATABASE INDEXES ====================
+
+# Rencana index per koleksi. Nama index ditulis eksplisit supaya startup bisa
+# membandingkan dengan index yang sudah ada (idempotent) dan laporan
+# /api/admin/indexes mudah dibaca.
+INDEX_PLAN: List[Dict[str, Any]] = [
+    # Absensi sholat: natural key upsert per santri/waktu/tanggal + laporan per tanggal
+    {"collection": "absensi", "name": "absensi_santri_waktu_tanggal",
+     "keys": [("santri_id", 1), ("waktu_sholat", 1), ("tanggal", 1)], "unique": True},
+    {"collection": "absensi", "name": "absensi_tanggal_waktu",
+     "keys": [("tanggal", 1), ("waktu_sholat", 1)]},
+    {"collection": "absensi", "name": "absensi_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "absensi", "name": "absensi_tanggal_id", "keys": [("tanggal", -1), ("id", -1)]},
+    # Delta sync PWA pengabsen: baris yang berubah sejak sync token
+    {"collection": "absensi", "name": "absensi_tanggal_updated",
+     "keys": [("tanggal", 1), ("updated_at", 1), ("id", 1)]},
+    {"collection": "absensi_sync_keys", "name": "absensi_sync_keys_pengabsen_key",
+     "keys": [("pengabsen_id", 1), ("idempotency_key", 1)], "unique": True},
+    {"collection": "absensi_sync_keys", "name": "absensi_sync_keys_ttl",
+     "keys": [("created_at", 1)], "ttl": ABSENSI_SYNC_RETENTION_SECONDS},
+    {"collection": "absensi_tombstones", "name": "absensi_tombstones_tanggal_deleted",
+     "keys": [("tanggal", 1), ("deleted_at", 1)]},
+    {"collection": "absensi_tombstones", "name": "absensi_tombstones_ttl",
+     "keys": [("expires_at", 1)], "ttl": 0},
+    {"collection": "absensi_rollup_harian", "name": "absensi_rollup_tanggal_asrama_waktu",
+     "keys": [("tanggal", 1), ("asrama_id", 1), ("waktu_sholat", 1)], "unique": True},
+    {"collection": "absensi_rollup_status", "name": "absensi_rollup_status_tanggal",
+     "keys": [("tanggal", 1)], "unique": True},
+
+    # Absensi madrasah diniyah / aliyah / PMQ
+    {"collection": "absensi_kelas", "name": "absensi_kelas_siswa_tanggal",
+     "keys": [("siswa_id", 1), ("tanggal", 1)], "unique": True},
+    {"collection": "absensi_kelas", "name": "absensi_kelas_kelas_tanggal",
+     "keys": [("kelas_id", 1), ("tanggal", 1)]},
+    {"collection": "absensi_aliyah", "name": "absensi_aliyah_siswa_tanggal_jenis",
+     "keys": [("siswa_id", 1), ("tanggal", 1), ("jenis", 1)], "unique": True},
+    {"collection": "absensi_aliyah", "name": "absensi_aliyah_kelas_tanggal_jenis",
+     "keys": [("kelas_id", 1), ("tanggal", 1), ("jenis", 1)]},
+    {"collection": "absensi_pmq", "name": "absensi_pmq_siswa_tanggal_sesi",
+     "keys": [("siswa_id", 1), ("tanggal", 1), ("sesi", 1)], "unique": True},
+    {"collection": "absensi_pmq", "name": "absensi_pmq_kelompok_tanggal",
+     "keys": [("kelompok_id", 1), ("tanggal", 1)]},
+    # Export rentang tanggal (urut tanggal)
+    {"collection": "absensi_kelas", "name": "absensi_kelas_tanggal", "keys": [("tanggal", 1)]},
+    {"collection": "absensi_aliyah", "name": "absensi_aliyah_tanggal", "keys": [("tanggal", 1)]},
+    {"collection": "absensi_pmq", "name": "absensi_pmq_tanggal", "keys": [("tanggal", 1)]},
+    {"collection": "export_jobs", "name": "export_jobs_id", "keys": [("id", 1)], "unique": True},
+
+    # Roster santri & siswa
+    {"collection": "santri", "name": "santri_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "santri", "name": "santri_nfc_uid", "keys": [("nfc_uid", 1)]},
+    {"collection": "santri", "name": "santri_nis", "keys": [("nis", 1)]},
+    {"collection": "santri", "name": "santri_asrama", "keys": [("asrama_id", 1), ("nama", 1)]},
+    {"collection": "santri", "name": "santri_nomor_hp_wali", "keys": [("nomor_hp_wali", 1)]},
+    {"collection": "siswa_madrasah", "name": "siswa_madrasah_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "siswa_madrasah", "name": "siswa_madrasah_kelas", "keys": [("kelas_id", 1)]},
+    {"collection": "siswa_madrasah", "name": "siswa_madrasah_santri", "keys": [("santri_id", 1)]},
+    {"collection": "siswa_madrasah", "name": "siswa_madrasah_nfc_uid", "keys": [("nfc_uid", 1)]},
+    {"collection": "siswa_aliyah", "name": "siswa_aliyah_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "siswa_aliyah", "name": "siswa_aliyah_kelas", "keys": [("kelas_id", 1)]},
+    {"collection": "siswa_aliyah", "name": "siswa_aliyah_santri", "keys": [("santri_id", 1)]},
+    {"collection": "siswa_aliyah", "name": "siswa_aliyah_nfc_uid", "keys": [("nfc_uid", 1)]},
+    {"collection": "siswa_pmq", "name": "siswa_pmq_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "siswa_pmq", "name": "siswa_pmq_kelompok", "keys": [("kelompok_id", 1)]},
+    {"collection": "siswa_pmq", "name": "siswa_pmq_santri", "keys": [("santri_id", 1)]},
+    {"collection": "siswa_pmq", "name": "siswa_pmq_nfc_uid", "keys": [("nfc_uid", 1)]},
+    {"collection": "wali_santri", "name": "wali_santri_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "wali_santri", "name": "wali_santri_username", "keys": [("username", 1)]},
+
+    # Master data & akun (lookup by id / username saat login)
+    *[
+        {"collection": coll, "name": f"{coll}_id", "keys": [("id", 1)], "unique": True}
+        for coll in ("asrama", "kelas", "kelas_aliyah", "pmq_kelompok")
+    ],
+    *[
+        spec
+        for coll in (
+            "admins",
+            "pengabsen",
+            "pembimbing",
+            "pengabsen_kelas",
+            "pembimbing_kelas",
+            "pengabsen_aliyah",
+            "pembimbing_aliyah",
+            "pengabsen_pmq",
+        )
+        for spec in (
+            {"collection": coll, "name": f"{coll}_id", "keys": [("id", 1)]},
+            {"collection": coll, "name": f"{coll}_username", "keys": [("username", 1)]},
+        )
+    ],
+
+    {"collection": "santri_qr", "name": "santri_qr_santri", "keys": [("santri_id", 1)], "unique": True},
+    {"collection": "santri_import_reports", "name": "santri_import_reports_id", "keys": [("id", 1)]},
+    {"collection": "notification_outbox", "name": "notification_outbox_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "whatsapp_report_jobs", "name": "whatsapp_report_jobs_id", "keys": [("id", 1)], "unique": True},
+    {"collection": "whatsapp_report_jobs", "name": "whatsapp_report_jobs_tanggal",
+     "keys": [("tanggal", 1), ("created_at", -1)]},
+    {"collection": "notification_outbox", "name": "notification_outbox_due",
+     "keys": [("status", 1), ("next_attempt_at", 1)]},
+    {"collection": "waktu_sholat", "name": "waktu_sholat_tanggal", "keys": [("tanggal", 1)], "unique": True},
+    {"collection": "whatsapp_history", "name": "whatsapp_history_santri_tanggal",
+     "keys": [("santri_id", 1), ("tanggal", 1)]},
+    {"collection": "whatsapp_history", "name": "whatsapp_history_sent_at", "keys": [("sent_at", -1)]},
+]
+
+# Hasil build terakhir (diisi saat startup, dibaca oleh /api/admin/indexes)
+INDEX_BUILD_REPORT: Dict[str, Any] = {"started_at": None, "finished_at": None, "results": []}
+
+
+def _index_matches(existing: Dict[str, Any], spec: Dict[str, Any]) -> bool:
+    """Cek apakah index yang sudah ada sama dengan spesifikasi di INDEX_PLAN."""
+    existing_keys = [(k, int(v)) for k, v in existing.get("key", [])]
+    return (
+        existing_keys == list(spec["keys"])
+        and bool(existing.get("unique", False)) == bool(spec.get("unique", False))
+        and existing.get("partialFilterExpression") == spec.get("partial")
+        and existing.get("expireAfterSeconds") == spec.get("ttl")
+    )
+
+
+async def ensure_indexes() -> List[Dict[str, Any]]:
+    """Bangun semua index di INDEX_PLAN secara idempotent.
+
+    - Index yang sudah ada dengan spesifikasi sama dilewati ("exists").
+    - Index dengan nama sama tapi spesifikasi berbeda di-drop lalu dibuat ulang ("rebuilt").
+    - Kegagalan (mis. duplikat saat membuat unique index) dicatat tanpa menghentikan startup.
+    """
+    results: List[Dict[str, Any]] = []
+    existing_by_coll: Dict[str, Dict[str, Any]] = {}
+
+    for spec in INDEX_PLAN:
+        coll_name = spec["collection"]
+        collection = db[coll_name]
+        if coll_name not in existing_by_coll:
+            try:
+                existing_by_coll[coll_name] = await collection.index_information()
+            except Exception:
+                existing_by_coll[coll_name] = {}
+
+        entry: Dict[str, Any] = {
+            "collection": coll_name,
+            "name": spec["name"],
+            "keys": [k for k, _ in spec["keys"]],
+            "unique": bool(spec.get("unique", False)),
+        }
+
+        existing = existing_by_coll[coll_name].get(spec["name"])
+        if existing and _index_matches(existing, spec):
+            entry.update({"status": "exists", "duration_ms": 0.0})
+            results.append(entry)
+            continue
+
+        options: Dict[str, Any] = {"name": spec["name"], "background": True}
+        if spec.get("unique"):
+            options["unique"] = True
+        if spec.get("partial"):
+            options["partialFilterExpression"] = spec["partial"]
+        if spec.get("ttl") is not None:
+            options["expireAfterSeconds"] = spec["ttl"]
+
+        started = time.perf_counter()
+        try:
+            if existing:
+                await collection.drop_index(spec["name"])
+            await collection.create_index(spec["keys"], **options)
+            entry["status"] = "rebuilt" if existing else "created"
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            logging.error(f"Gagal membuat index {coll_name}.{spec['name']}: {e}")
+            if spec.get("unique"):
+                # Biasanya karena data ganda lama: tetap pasang index non-unique agar
+                # lookup tidak full scan, lalu jalankan /api/admin/dedupe-absensi.
+                try:
+                    await collection.create_index(spec["keys"], name=spec["name"], background=True)
+                    entry["fallback"] = "non-unique"
+                except Exception as fallback_error:
+                    logging.error(f"Fallback index {coll_name}.{spec['name']} gagal: {fallback_error}")
+        entry["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        if entry["status"] != "failed":
+            logging.info(f"Index {coll_name}.{spec['name']} {entry['status']} ({entry['duration_ms']} ms)")
+        results.append(entry)
+
+    return results
+
+
+async def build_indexes_report() -> Dict[str, Any]:
+    started_at = datetime.now(timezone.utc).isoformat()
+    results = await ensure_indexes()
+    INDEX_BUILD_REPORT.update(
+        {
+            "started_at": started_at,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "results": results,
+        }
+    )
+    return INDEX_BUILD_REPORT
+
+
+@api_router.post("/admin/absensi-rollup/rebuild")
+async def rebuild_absensi_rollup_endpoint(
+    tanggal_start: str,
+    tanggal_end: Optional[str] = None,
+    _: dict = Depends(get_current_admin),
+):
+    """Bangun ulang absensi_rollup_harian untuk data historis (rentang tanggal)."""
+    return await rebuild_absensi_rollup(tanggal_start, tanggal_end)
+
+
+@api_router.post("/admin/migrate-santri-qr")
+async def migrate_santri_qr(batch_size: int = 500, _: dict = Depends(get_current_admin)):
+    """Migrasi sekali jalan: pindahkan santri.qr_code ke koleksi santri_qr lalu hapus field-nya."""
+    moved = 0
+    while True:
+        batch = await db.santri.find(
+            {"qr_code": {"$exists": True}}, {"_id": 0, "id": 1, "qr_code": 1}
+        ).to_list(batch_size)
+        if not batch:
+            break
+
+        qr_ops = [
+            UpdateOne({"santri_id": s["id"]}, {"$setOnInsert": santri_qr_doc(s["id"], s["qr_code"])}, upsert=True)
+            for s in batch
+            if s.get("qr_code")
+        ]
+        if qr_ops:
+            await db.santri_qr.bulk_write(qr_ops, ordered=False)
+        await db.santri.update_many(
+            {"id": {"$in": [s["id"] for s in batch]}}, {"$unset": {"qr_code": ""}}
+        )
+        moved += len(batch)
+
+    return {"message": "Migrasi QR santri selesai", "migrated": moved}
+
+
+@api_router.post("/admin/dedupe-absensi")
+async def dedupe_absensi(dry_run: bool = True, _: dict = Depends(get_current_admin)):
+    """Migrasi sekali jalan: hapus absensi ganda lalu pasang unique index natural key.
+
+    Default `dry_run=true` hanya menghitung; panggil dengan `dry_run=false` untuk eksekusi.
+    """
+    results = []
+    for collection_name in ABSENSI_NATURAL_KEYS:
+        results.append(await dedupe_absensi_collection(collection_name, dry_run=dry_run))
+
+    indexes = None
+    if not dry_run:
+        report = await build_indexes_report()
+        indexes = [
+            r for r in report["results"]
+            if r["collection"] in ABSENSI_NATURAL_KEYS and r["unique"]
+        ]
+
+    return {"dry_run": dry_run, "results": results, "indexes": indexes}
+
+
+@api_router.get("/admin/indexes")
+async def get_index_report(verify: bool = False, _: dict = Depends(get_current_admin)):
+    """Laporan index database: hasil build saat startup + index yang terpasang sekarang.
+
+    `verify=true` menjalankan ulang ensure_indexes (aman, idempotent).
+    """
+    if verify:
+        await build_indexes_report()
+
+    planned_by_coll: Dict[str, List[str]] = {}
+    for spec in INDEX_PLAN:
+        planned_by_coll.setdefault(spec["collection"], []).append(spec["name"])
+
+    installed: Dict[str, Any] = {}
+    missing: List[str] = []
+    for coll_name, names in planned_by_coll.items():
+        info = await db[coll_name].index_information()
+        installed[coll_name] = sorted(info.keys())
+        missing.extend(f"{coll_name}.{n}" for n in names if n not in info)
+
+    summary: Dict[str, int] = {}
+    for r in INDEX_BUILD_REPORT["results"]:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+
+    return {
+        "last_build": {
+            "started_at": INDEX_BUILD_REPORT["started_at"],
+            "finished_at": INDEX_BUILD_REPORT["finished_at"],
+            "summary": summary,
+            "results": INDEX_BUILD_REPORT["results"],
+        },
+        "planned": len(INDEX_PLAN),
+        "missing": missing,
+        "installed": installed,
+    }
+
+
+# ==================== METRICS ====================
+
+@api_router.get("/admin/notification-outbox")
+async def get_notification_outbox_status(_: dict = Depends(get_current_admin)):
+    """Jumlah entri outbox per status dan beberapa kegagalan terakhir."""
+    counts = {
+        row["_id"]: row["count"]
+        async for row in db.notification_outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+    }
+    recent_failures = await db.notification_outbox.find(
+        {"status": {"$in": ["failed", "retry"]}},
+        {"_id": 0, "id": 1, "santri_id": 1, "status": 1, "attempts": 1, "last_error": 1, "updated_at": 1},
+    ).sort("updated_at", -1).to_list(20)
+    return {
+        "counts": counts,
+        "dispatcher_running": _notification_dispatcher_task is not None and not _notification_dispatcher_task.done(),
+        "recent_failures": recent_failures,
+    }
+
+
+@api_router.get("/admin/metrics")
+async def get_metrics(_: dict = Depends(get_current_admin)):
+    """Counter cache in-process (per worker) untuk pemantauan."""
+    reference_cache = {}
+    now = time.monotonic()
+    for name, stats in REFERENCE_CACHE_STATS.items():
+        entry = _reference_cache.get(name)
+        lookups = stats["hits"] + stats["misses"]
+        reference_cache[name] = {
+            **stats,
+            "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else None,
+            "cached_docs": len(entry[1]) if entry else 0,
+            "age_seconds": round(now - entry[0], 1) if entry else None,
+        }
+
+    return {
+        "pid": os.getpid(),
+        "reference_cache": {"ttl_seconds": REFERENCE_CACHE_TTL_SECONDS, "collections": reference_cache},
+        "qr_cache": {**QR_CACHE_STATS, "entries": len(_qr_cache), "max_entries": QR_CACHE_MAX_ENTRIES},
+        "notifications": NOTIFICATION_STATS,
+        "fcm_sender": fcm_sender_stats(),
+        "http_client": http_client_stats(),
+        "waktu_sholat": {**WAKTU_SHOLAT_STATS, "cached_days": len(_waktu_sholat_cache)},
+        "absensi_events": {**ABSENSI_EVENT_STATS, "subscribers": len(_absensi_subscribers)},
+        "principal_cache": {
+            "ttl_seconds": PRINCIPAL_CACHE_TTL_SECONDS,
+            "entries": len(_principal_cache),
+            "roles": PRINCIPAL_CACHE_STATS,
+        },
+    }
+
+
 # Include router
 app.include_router(api_router)
 
@@ -6828,6 +10608,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # Logging
@@ -6837,6 +10618,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_build_indexes():
+    removed = await dedupe_waktu_sholat()
+    if removed:
+        logger.info(f"Menghapus {removed} waktu_sholat ganda sebelum membuat unique index")
+    report = await build_indexes_report()
+    created = [f"{r['collection']}.{r['name']}" for r in report["results"] if r["status"] in ("created", "rebuilt")]
+    failed = [f"{r['collection']}.{r['name']}" for r in report["results"] if r["status"] == "failed"]
+    logger.info(f"Index startup: {len(created)} dibuat, {len(failed)} gagal, {len(report['results'])} direncanakan")
+    if failed:
+        logger.warning(f"Index gagal dibuat: {', '.join(failed)}")
+
+@app.on_event("startup")
+async def startup_http_client():
+    get_http_session()
+
+@app.on_event("startup")
+async def startup_waktu_sholat_prefetch():
+    global _waktu_sholat_prefetch_task
+    _waktu_sholat_prefetch_task = asyncio.create_task(waktu_sholat_prefetch_loop())
+
+@app.on_event("startup")
+async def startup_notification_dispatcher():
+    global _notification_dispatcher_task
+    _notification_dispatcher_task = asyncio.create_task(notification_dispatcher_loop())
+    resumed = await resume_stale_whatsapp_report_jobs()
+    if resumed:
+        logger.info(f"Melanjutkan {resumed} job rekap WhatsApp yang terhenti")
+    orphaned = await fail_orphaned_export_jobs()
+    if orphaned:
+        logger.info(f"Menandai {orphaned} job export yatim sebagai failed")
+
+@app.on_event("startup")
+async def startup_absensi_events():
+    source = await start_absensi_event_source()
+    logger.info(f"Sumber event absensi live: {source}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if _notification_dispatcher_task is not None:
+        _notification_dispatcher_task.cancel()
+    if _waktu_sholat_prefetch_task is not None:
+        _waktu_sholat_prefetch_task.cancel()
+    await stop_absensi_event_source()
     client.close()
+    if _qr_process_pool is not None:
+        _qr_process_pool.shutdown(wait=False)
+    if _qr_thread_pool is not None:
+        _qr_thread_pool.shutdown(wait=False)
+    if _fcm_thread_pool is not None:
+        _fcm_thread_pool.shutdown(wait=False)
+    await close_http_session()
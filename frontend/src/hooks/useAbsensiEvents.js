@@ -0,0 +1,48 @@
+import { useEffect, useRef } from 'react';
+
+// Berlangganan SSE perubahan absensi (helper `events` di lib/api).
+// onChange(changes) dipanggil dengan daftar scope yang berubah; onChange(null)
+// berarti event mungkin terlewat (antrean server penuh / koneksi tersambung
+// ulang) sehingga halaman perlu memuat ulang penuh.
+export function useAbsensiEvents(openStream, onChange, enabled = true) {
+  const onChangeRef = useRef(onChange);
+  onChangeRef.current = onChange;
+
+  useEffect(() => {
+    if (!enabled) return undefined;
+
+    const source = openStream();
+    let connected = false;
+
+    const handleReady = () => {
+      if (connected) onChangeRef.current(null);
+      connected = true;
+    };
+    const handleAbsensi = (event) => {
+      try {
+        onChangeRef.current(JSON.parse(event.data).changes || []);
+      } catch (e) {
+        onChangeRef.current(null);
+      }
+    };
+    const handleResync = () => onChangeRef.current(null);
+
+    source.addEventListener('ready', handleReady);
+    source.addEventListener('absensi', handleAbsensi);
+    source.addEventListener('resync', handleResync);
+    return () => source.close();
+  }, [openStream, enabled]);
+}
+
+// Gabungkan respons delta (`since=`) ke data roster sebelumnya; respons penuh
+// (delta=false) menggantikan seluruh data.
+export function mergeRosterDelta(prevRows, response, key) {
+  if (!response.delta || !prevRows) return response.data || [];
+  const changed = new Map((response.data || []).map((row) => [row[key], row]));
+  const merged = prevRows.map((row) => changed.get(row[key]) || row);
+  const known = new Set(prevRows.map((row) => row[key]));
+  changed.forEach((row, id) => {
+    if (!known.has(id)) merged.push(row);
+  });
+  return merged;
+}
@@ -122,6 +122,14 @@ export const pengabsenAppAPI = {
     axios.post(`${API}/pengabsen/absensi/nfc`, payload, {
       headers: getPengabsenAuthHeader(),
     }),
+  batchAbsensi: (items) =>
+    axios.post(`${API}/pengabsen/absensi/batch`, { items }, {
+      headers: getPengabsenAuthHeader(),
+    }),
+  sync: (payload) =>
+    axios.post(`${API}/pengabsen/sync`, payload, {
+      headers: getPengabsenAuthHeader(),
+    }),
   deleteAbsensi: (params) =>
     axios.delete(`${API}/pengabsen/absensi`, {
       params,
@@ -238,6 +246,10 @@ export const pengabsenPMQAppAPI = {
     axios.post(`${API}/pmq/pengabsen/absensi`, payload, {
       headers: getPengabsenPMQAuthHeader(),
     }),
+  batchAbsensi: (payload) =>
+    axios.post(`${API}/pmq/pengabsen/absensi/batch`, payload, {
+      headers: getPengabsenPMQAuthHeader(),
+    }),
   scanAbsensi: (payload, params) =>
     axios.post(`${API}/pmq/pengabsen/absensi/scan`, payload, {
       params,
@@ -283,6 +295,10 @@ export const pengabsenAliyahAppAPI = {
     axios.post(`${API}/aliyah/pengabsen/absensi`, data, {
       headers: getPengabsenAliyahAuthHeader(),
     }),
+  batchAbsensi: (data) =>
+    axios.post(`${API}/aliyah/pengabsen/absensi/batch`, data, {
+      headers: getPengabsenAliyahAuthHeader(),
+    }),
   scanAbsensi: (data, params) =>
     axios.post(`${API}/aliyah/pengabsen/absensi/scan`, data, {
       params,
@@ -318,6 +334,10 @@ export const monitoringAliyahAppAPI = {
       params,
       headers: getMonitoringAliyahAuthHeader(),
     }),
+  events: () =>
+    new EventSource(
+      `${API}/aliyah/monitoring/events?token=${encodeURIComponent(localStorage.getItem('monitoring_aliyah_token') || '')}`
+    ),
 };
 
 // Pembimbing PWA API
@@ -340,4 +360,17 @@ export const pembimbingAppAPI = {
       params,
       headers: getPembimbingAuthHeader(),
     }),
+  // EventSource tidak bisa mengirim header Authorization, token lewat query
+  events: () =>
+    new EventSource(
+      `${API}/pembimbing/events?token=${encodeURIComponent(localStorage.getItem('pembimbing_token') || '')}`
+    ),
+};
+
+// PWA Pembimbing Kelas (Monitoring Kelas) API
+export const pembimbingKelasAppAPI = {
+  events: () =>
+    new EventSource(
+      `${API}/pembimbing-kelas/events?token=${encodeURIComponent(localStorage.getItem('pembimbing_kelas_token') || '')}`
+    ),
 };
@@ -1,8 +1,9 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useMonitoringAliyahAuth } from '@/contexts/MonitoringAliyahAuthContext';
 import { useAppSettings } from '@/contexts/AppSettingsContext';
 import { monitoringAliyahAppAPI } from '@/lib/api';
+import { useAbsensiEvents, mergeRosterDelta } from '@/hooks/useAbsensiEvents';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
@@ -24,6 +25,7 @@ const MonitoringAliyahApp = () => {
   const [kelasId, setKelasId] = useState('all');
   const [kelasList, setKelasList] = useState([]);
   const [data, setData] = useState([]);
+  const versionRef = useRef(null);
   const [loadingData, setLoadingData] = useState(false);
   const [historyJenis, setHistoryJenis] = useState('pagi');
   const [historyStart, setHistoryStart] = useState(getTodayLocalYMD());
@@ -62,23 +64,36 @@ const MonitoringAliyahApp = () => {
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [user, jenis, tanggal, kelasId]);
 
-  const loadData = async () => {
+  const loadData = async ({ incremental = false } = {}) => {
     try {
-      setLoadingData(true);
+      if (!incremental) setLoadingData(true);
       const params = {
         jenis,
         tanggal,
       };
       if (kelasId !== 'all') params.kelas_id = kelasId;
+      // Refetch dari event SSE: cukup baris yang berubah sejak versi terakhir
+      if (incremental && versionRef.current) params.since = versionRef.current;
       const resp = await monitoringAliyahAppAPI.absensiHariIni(params);
-      setData(resp.data.data || []);
+      versionRef.current = resp.data.version || null;
+      setData((prev) => mergeRosterDelta(prev, resp.data, 'siswa_id'));
     } catch (error) {
       // swallow for now
     } finally {
-      setLoadingData(false);
+      if (!incremental) setLoadingData(false);
     }
   };
 
+  // Perubahan absensi kelas monitoring didorong lewat SSE, tanpa polling
+  useAbsensiEvents(
+    monitoringAliyahAppAPI.events,
+    (changes) => {
+      if (changes && !changes.some((change) => change.tanggal === tanggal && change.slot === jenis)) return;
+      loadData({ incremental: changes !== null });
+    },
+    Boolean(user)
+  );
+
   const loadHistory = async () => {
     try {
       setLoadingHistory(true);
@@ -5,6 +5,8 @@ import { useAppSettings } from '@/contexts/AppSettingsContext';
 import { Button } from '@/components/ui/button';
 import { toast } from 'sonner';
 import axios from 'axios';
+import { pembimbingKelasAppAPI } from '@/lib/api';
+import { useAbsensiEvents } from '@/hooks/useAbsensiEvents';
 import { 
   LogOut, 
   Users,
@@ -111,26 +113,29 @@ const MonitoringKelasApp = () => {
     }
   };
 
+  const fetchKelasDetailRows = async (kelasId) => {
+    const token = localStorage.getItem('pembimbing_kelas_token');
+    const today = new Date().toISOString().slice(0, 10);
+    const params = new URLSearchParams({
+      tanggal_start: today,
+      tanggal_end: today,
+      kelas_id: kelasId,
+    });
+
+    const response = await axios.get(
+      `${API_URL}/api/pembimbing-kelas/absensi-riwayat?${params.toString()}`,
+      { headers: { Authorization: `Bearer ${token}` } }
+    );
+    return response.data || [];
+  };
+
   const loadKelasDetail = async (kelasId, kelasNama) => {
     try {
       setLoadingDetail(true);
       setSelectedKelasDetail({ id: kelasId, nama: kelasNama });
       setKelasDetailSearch('');
       setKelasDetailStatus('all');
-
-      const token = localStorage.getItem('pembimbing_kelas_token');
-      const today = new Date().toISOString().slice(0, 10);
-      const params = new URLSearchParams({
-        tanggal_start: today,
-        tanggal_end: today,
-        kelas_id: kelasId,
-      });
-
-      const response = await axios.get(
-        `${API_URL}/api/pembimbing-kelas/absensi-riwayat?${params.toString()}`,
-        { headers: { Authorization: `Bearer ${token}` } }
-      );
-      setKelasDetailData(response.data || []);
+      setKelasDetailData(await fetchKelasDetailRows(kelasId));
     } catch (error) {
       toast.error('Gagal memuat detail kelas');
     } finally {
@@ -138,6 +143,26 @@ const MonitoringKelasApp = () => {
     }
   };
 
+  // Perubahan absensi kelas hari ini didorong lewat SSE: muat ulang statistik dan
+  // detail kelas yang sedang dibuka (kelas belum punya endpoint roster delta)
+  useAbsensiEvents(
+    pembimbingKelasAppAPI.events,
+    async (changes) => {
+      const today = new Date().toISOString().slice(0, 10);
+      if (changes && !changes.some((change) => change.tanggal === today)) return;
+      loadStatistik();
+      const openKelasId = selectedKelasDetail?.id;
+      if (openKelasId && (!changes || changes.some((change) => change.scope_id === openKelasId))) {
+        try {
+          setKelasDetailData(await fetchKelasDetailRows(openKelasId));
+        } catch (error) {
+          // Abaikan, event berikutnya akan mencoba lagi
+        }
+      }
+    },
+    Boolean(user) && view === 'dashboard'
+  );
+
   const handleLogout = () => {
     logout();
     navigate('/monitoring-kelas-app/login');
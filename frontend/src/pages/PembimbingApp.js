@@ -1,8 +1,9 @@
-import React, { useEffect, useState, useMemo } from 'react';
+import React, { useEffect, useState, useMemo, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { usePembimbingAuth } from '@/contexts/PembimbingAuthContext';
 import { useAppSettings } from '@/contexts/AppSettingsContext';
 import { pembimbingAppAPI } from '@/lib/api';
+import { useAbsensiEvents, mergeRosterDelta } from '@/hooks/useAbsensiEvents';
 import { Button } from '@/components/ui/button';
 import { useToast } from '@/hooks/use-toast';
 
@@ -12,6 +13,7 @@ const PembimbingApp = () => {
   const [activeTab, setActiveTab] = useState('today');
   const [selectedWaktu, setSelectedWaktu] = useState(null);
   const [todayData, setTodayData] = useState(null);
+  const todayVersionRef = useRef(null);
   const [statistik, setStatistik] = useState(null);
   const [todaySearch, setTodaySearch] = useState('');
   const [todayStatus, setTodayStatus] = useState('all');
@@ -45,21 +47,29 @@ const PembimbingApp = () => {
     }
   }, [loading, user, navigate]);
 
-  const loadTodayData = async () => {
+  const loadTodayData = async ({ incremental = false } = {}) => {
     try {
-      setLoadingData(true);
+      if (!incremental) setLoadingData(true);
       const params = selectedWaktu ? { waktu_sholat: selectedWaktu } : {};
+      // Refetch dari event SSE: cukup baris yang berubah sejak versi terakhir
+      if (incremental && todayVersionRef.current) params.since = todayVersionRef.current;
       const todayStr = formatDateYMD(currentYear, now.getMonth(), now.getDate());
       const [absensiRes, statRes] = await Promise.all([
         pembimbingAppAPI.absensiHariIni(params),
         pembimbingAppAPI.statistik({ tanggal: todayStr }),
       ]);
-      setTodayData(absensiRes.data);
+      todayVersionRef.current = absensiRes.data.version || null;
+      setTodayData((prev) => ({
+        ...absensiRes.data,
+        data: mergeRosterDelta(prev?.data, absensiRes.data, 'santri_id'),
+      }));
       setStatistik(statRes.data);
     } catch (error) {
-      toast({ title: 'Error', description: 'Gagal memuat data', variant: 'destructive' });
+      if (!incremental) {
+        toast({ title: 'Error', description: 'Gagal memuat data', variant: 'destructive' });
+      }
     } finally {
-      setLoadingData(false);
+      if (!incremental) setLoadingData(false);
     }
   };
 
@@ -147,6 +157,17 @@ const PembimbingApp = () => {
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [user, activeTab, historyDate, historyWaktu, periodType, dateRange]);
 
+  // Perubahan absensi asrama pembimbing didorong lewat SSE, tanpa polling
+  useAbsensiEvents(
+    pembimbingAppAPI.events,
+    (changes) => {
+      const todayStr = formatDateYMD(currentYear, now.getMonth(), now.getDate());
+      if (changes && !changes.some((change) => change.tanggal === todayStr)) return;
+      loadTodayData({ incremental: changes !== null });
+    },
+    Boolean(user) && activeTab === 'today'
+  );
+
   if (loading || !user) {
     return (
       <div className="min-h-screen flex items-center justify-center">
@@ -18,6 +18,8 @@ const Settings = () => {
     izin: '',
     haid: '',
     istihadhoh: '',
+    masbuq: '',
+    coalesce_seconds: 60,
   });
   const [appSettings, setAppSettings] = useState({
     admin_title: '',
@@ -120,6 +122,7 @@ const Settings = () => {
     izin: { label: 'Izin', color: 'text-amber-600', bgColor: 'bg-amber-50' },
     haid: { label: 'Haid', color: 'text-pink-600', bgColor: 'bg-pink-50' },
     istihadhoh: { label: 'Istihadhoh', color: 'text-violet-600', bgColor: 'bg-violet-50' },
+    masbuq: { label: 'Masbuq', color: 'text-yellow-600', bgColor: 'bg-yellow-50' },
   };
 
   if (loading) {
@@ -232,6 +235,24 @@ const Settings = () => {
             </div>
           ))}
 
+          <div className="p-4 rounded-lg border bg-gray-50">
+            <Label htmlFor="coalesce_seconds" className="font-medium text-gray-700">
+              Jeda penggabungan notifikasi (detik)
+            </Label>
+            <Input
+              id="coalesce_seconds"
+              type="number"
+              min={0}
+              max={3600}
+              value={templates.coalesce_seconds}
+              onChange={(e) => handleChange('coalesce_seconds', Number(e.target.value))}
+              className="mt-2 bg-white w-40"
+            />
+            <p className="text-xs text-gray-500 mt-1">
+              Perubahan status untuk wali yang sama dalam jeda ini dikirim sebagai satu notifikasi. Isi 0 untuk kirim langsung.
+            </p>
+          </div>
+
           <div className="flex justify-end pt-4">
             <Button onClick={handleSave} disabled={saving}>
               {saving ? 'Menyimpan...' : 'Simpan Pengaturan'}
@@ -0,0 +1,103 @@
+"""
+Micro-benchmark: pengiriman FCM per wali vs batch terkumpul
+
+Memakai FakeFcmTransport dari tests/fake_fcm.py (latensi per panggilan SDK
+disimulasikan, tanpa jaringan/Firebase) lalu membandingkan:
+- per-wali : messaging.send_each per wali di event loop (perilaku lama)
+- batched  : send_fcm_pushes() - pesan semua wali digabung ke batch 500
+             dan dijalankan di thread pool FCM
+
+Jalankan dari root repo:
+    python -m tests.bench_fcm_sender --wali 600 --tokens 2 --latency 80
+
+Tidak butuh MongoDB; hanya sender FCM dari backend/main.py yang dipakai.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import main  # noqa: E402
+from firebase_admin import messaging  # noqa: E402
+
+from tests.fake_fcm import FakeFcmTransport  # noqa: E402
+
+
+SCAN_INTERVAL = 0.005  # 5 ms antar "scan"
+
+
+def make_pushes(wali: int, tokens: int):
+    return [
+        ([f"tok-{w}-{t}" for t in range(tokens)], "Absensi Sholat Maghrib", f"Santri {w} hadir pada waktu sholat maghrib")
+        for w in range(wali)
+    ]
+
+
+async def scanner(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(SCAN_INTERVAL)
+        lags.append((time.perf_counter() - start - SCAN_INTERVAL) * 1000)
+
+
+async def send_per_wali(pushes):
+    transport = main.get_fcm_transport()
+    for tokens, title, body in pushes:
+        messages = [messaging.Message(notification=messaging.Notification(title=title, body=body), token=t) for t in tokens]
+        transport.send_each(messages)
+        await asyncio.sleep(0)
+
+
+async def send_batched(pushes):
+    await main.send_fcm_pushes(pushes)
+
+
+async def run_case(name: str, send, pushes, scanners: int):
+    transport = main.get_fcm_transport()
+    calls_before = transport.calls
+    stop = asyncio.Event()
+    lags: list = []
+    tasks = [asyncio.create_task(scanner(stop, lags)) for _ in range(scanners)]
+
+    started = time.perf_counter()
+    await send(pushes)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    lags.sort()
+    p50 = statistics.median(lags) if lags else 0.0
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    messages = sum(len(t) for t, _, _ in pushes)
+    print(
+        f"{name:>8} | {messages} pesan: {elapsed:6.2f}s ({messages / elapsed:8.1f}/s) | "
+        f"SDK calls {transport.calls - calls_before:4d} | lag p50 {p50:7.2f} ms | p99 {p99:8.2f} ms"
+    )
+
+
+async def main_async(args):
+    main._fcm_transport = FakeFcmTransport(latency_ms=args.latency, failure_rate=0.0)
+    print(f"FCM sender workers: {main.FCM_SENDER_WORKERS}, wali: {args.wali}, token/wali: {args.tokens}")
+    pushes = make_pushes(args.wali, args.tokens)
+    await run_case("per-wali", send_per_wali, pushes, args.scanners)
+    await run_case("batched", send_batched, pushes, args.scanners)
+    print(f"FCM sender: {main.fcm_sender_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pengiriman FCM per wali vs batch")
+    parser.add_argument("--wali", type=int, default=600, help="jumlah wali yang dikirimi")
+    parser.add_argument("--tokens", type=int, default=2, help="jumlah token per wali")
+    parser.add_argument("--latency", type=float, default=80.0, help="latensi simulasi per panggilan SDK (ms)")
+    parser.add_argument("--scanners", type=int, default=50, help="jumlah scan bersamaan")
+    asyncio.run(main_async(parser.parse_args()))
+    if main._fcm_thread_pool is not None:
+        main._fcm_thread_pool.shutdown()
@@ -0,0 +1,95 @@
+"""
+Micro-benchmark: event-loop latency saat render QR berjalan
+
+Mensimulasikan scan absensi bersamaan (coroutine kecil yang seharusnya selesai
+dalam hitungan milidetik) sementara import massal sedang merender QR, lalu
+membandingkan:
+- inline : generate_qr_code() langsung di event loop (perilaku lama)
+- pool   : render_qr_codes_bulk() di process pool (import) + generate_qr_code_async()
+
+Jalankan dari root repo:
+    python -m tests.bench_qr_event_loop --qr 300 --scanners 50
+
+Tidak butuh MongoDB; hanya fungsi QR dari backend/main.py yang dipakai.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import main  # noqa: E402
+
+
+SCAN_INTERVAL = 0.005  # 5 ms antar "scan"
+
+
+def make_payloads(n: int):
+    return [{"santri_id": str(uuid.uuid4()), "nama": f"Santri {i}", "nis": f"{i:05d}"} for i in range(n)]
+
+
+async def scanner(stop: asyncio.Event, lags: list):
+    """Satu pengabsen: tidur SCAN_INTERVAL lalu catat keterlambatan bangun."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(SCAN_INTERVAL)
+        lags.append((time.perf_counter() - start - SCAN_INTERVAL) * 1000)
+
+
+async def render_inline(payloads):
+    for p in payloads:
+        main.generate_qr_code(p)
+        await asyncio.sleep(0)
+
+
+async def render_pool(payloads):
+    await main.render_qr_codes_bulk(payloads)
+
+
+async def run_case(name: str, render, payloads, scanners: int):
+    stop = asyncio.Event()
+    lags: list = []
+    tasks = [asyncio.create_task(scanner(stop, lags)) for _ in range(scanners)]
+
+    started = time.perf_counter()
+    await render(payloads)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    lags.sort()
+    p50 = statistics.median(lags) if lags else 0.0
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(
+        f"{name:>7} | render {len(payloads)} QR: {elapsed:6.2f}s | "
+        f"scan samples {len(lags):6d} | lag p50 {p50:7.2f} ms | p99 {p99:8.2f} ms | max {max(lags or [0]):8.2f} ms"
+    )
+
+
+async def main_async(args):
+    print(f"QR process workers: {main.QR_PROCESS_WORKERS}, scanners: {args.scanners}")
+    await run_case("inline", render_inline, make_payloads(args.qr), args.scanners)
+    await run_case("pool", render_pool, make_payloads(args.qr), args.scanners)
+
+    # Payload yang sama kedua kalinya dilayani dari cache
+    cached = make_payloads(args.qr)
+    await main.render_qr_codes_bulk(cached)
+    await run_case("cached", render_pool, cached, args.scanners)
+    print(f"QR cache: {main.QR_CACHE_STATS}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark event-loop latency saat render QR")
+    parser.add_argument("--qr", type=int, default=300, help="jumlah QR yang dirender")
+    parser.add_argument("--scanners", type=int, default=50, help="jumlah scan bersamaan")
+    asyncio.run(main_async(parser.parse_args()))
+    if main._qr_process_pool is not None:
+        main._qr_process_pool.shutdown()
@@ -0,0 +1,264 @@
+"""
+Fixture bersama untuk test unit backend (tanpa server/MongoDB)
+
+- backend/ dimasukkan ke sys.path agar `import main` berjalan dari root repo
+- FakeDb: koleksi in-memory dengan subset query Mongo yang dipakai main.py
+  (kesetaraan, $in/$nin/$lt/$lte/$gt/$gte/$ne/$exists, $or/$and, field array,
+  upsert & unique key)
+"""
+
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import main  # noqa: E402
+
+_MISSING = object()
+
+
+def _matches_condition(value, condition) -> bool:
+    if not isinstance(condition, dict) or not any(str(k).startswith("$") for k in condition):
+        return value is not _MISSING and value == condition
+    for op, operand in condition.items():
+        if op == "$exists":
+            if (value is not _MISSING) != bool(operand):
+                return False
+        elif op == "$in":
+            if value is _MISSING or value not in operand:
+                return False
+        elif op == "$nin":
+            if value is not _MISSING and value in operand:
+                return False
+        elif op == "$ne":
+            if value is not _MISSING and value == operand:
+                return False
+        elif op in ("$lt", "$lte", "$gt", "$gte"):
+            if value is _MISSING or value is None:
+                return False
+            if op == "$lt" and not value < operand:
+                return False
+            if op == "$lte" and not value <= operand:
+                return False
+            if op == "$gt" and not value > operand:
+                return False
+            if op == "$gte" and not value >= operand:
+                return False
+        else:
+            raise NotImplementedError(f"Operator {op} belum didukung FakeCollection")
+    return True
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif not _matches_condition(doc.get(field, _MISSING), condition) and not _matches_element(doc.get(field), condition):
+            return False
+    return True
+
+
+def _matches_element(value, condition) -> bool:
+    # Seperti Mongo: kondisi positif pada field array cocok jika salah satu elemennya cocok
+    if not isinstance(value, list) or (isinstance(condition, dict) and ({"$nin", "$ne"} & set(condition))):
+        return False
+    return any(_matches_condition(element, condition) for element in value)
+
+
+def project(doc: dict, projection) -> dict:
+    if not projection:
+        return dict(doc)
+    included = [k for k, v in projection.items() if v and k != "_id"]
+    if included:
+        return {k: doc[k] for k in included if k in doc}
+    return {k: v for k, v in doc.items() if k not in projection}
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda d: d.get(field) or "", reverse=order < 0)
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        async def iterate():
+            for doc in self.docs:
+                yield doc
+        return iterate()
+
+
+class FakeCollection:
+    """Koleksi in-memory; `unique` meniru unique index pada natural key."""
+
+    def __init__(self, docs=None, unique=None):
+        self.docs = [dict(d) for d in docs or []]
+        self.unique = tuple(unique or ())
+        self.finds = []
+
+    def find(self, query=None, projection=None):
+        self.finds.append((query, projection))
+        return FakeCursor(project(d, projection) for d in self.docs if matches(d, query or {}))
+
+    async def find_one(self, query=None, projection=None):
+        for doc in self.docs:
+            if matches(doc, query or {}):
+                return project(doc, projection)
+        return None
+
+    async def distinct(self, field, query=None):
+        return sorted({d[field] for d in self.docs if field in d and matches(d, query or {})})
+
+    async def count_documents(self, query):
+        return sum(1 for d in self.docs if matches(d, query))
+
+    def _check_unique(self, doc):
+        if self.unique and any(all(d.get(f) == doc.get(f) for f in self.unique) for d in self.docs):
+            raise DuplicateKeyError("E11000 duplicate key", 11000)
+
+    async def insert_one(self, doc):
+        self._check_unique(doc)
+        self.docs.append(dict(doc))
+        return SimpleNamespace(inserted_id=None)
+
+    async def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            await self.insert_one(doc)
+        return SimpleNamespace(inserted_ids=[None] * len(docs))
+
+    async def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if matches(doc, query):
+                doc.update(update.get("$set", {}))
+                for field in update.get("$unset", {}):
+                    doc.pop(field, None)
+                for field, amount in update.get("$inc", {}).items():
+                    doc[field] = doc.get(field, 0) + amount
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if not upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+        # Seperti Mongo: field kesetaraan top-level dari filter ikut ter-insert
+        doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        doc.update(update.get("$setOnInsert", {}))
+        doc.update(update.get("$set", {}))
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        await self.insert_one(doc)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=len(self.docs))
+
+    async def update_many(self, query, update):
+        matched = [doc for doc in self.docs if matches(doc, query)]
+        for doc in matched:
+            doc.update(update.get("$set", {}))
+            for field in update.get("$unset", {}):
+                doc.pop(field, None)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched))
+
+    async def find_one_and_update(self, query, update, sort=None, return_document=None):
+        for doc in FakeCursor(self.docs).sort(sort or []).docs:
+            if matches(doc, query):
+                doc.update(update.get("$set", {}))
+                return dict(doc)
+        return None
+
+    async def replace_one(self, query, replacement, upsert=False):
+        for position, doc in enumerate(self.docs):
+            if matches(doc, query):
+                self.docs[position] = dict(replacement)
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if not upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+        await self.insert_one(replacement)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=len(self.docs))
+
+    async def delete_one(self, query):
+        for doc in self.docs:
+            if matches(doc, query):
+                self.docs.remove(doc)
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    async def delete_many(self, query):
+        kept = [doc for doc in self.docs if not matches(doc, query)]
+        deleted, self.docs = len(self.docs) - len(kept), kept
+        return SimpleNamespace(deleted_count=deleted)
+
+    async def bulk_write(self, ops, ordered=True):
+        errors, matched, upserted = [], 0, {}
+        for index, op in enumerate(ops):
+            try:
+                if isinstance(op, ReplaceOne):
+                    result = await self.replace_one(op._filter, op._doc, upsert=op._upsert)
+                else:
+                    result = await self.update_one(op._filter, op._doc, upsert=op._upsert)
+            except DuplicateKeyError:
+                errors.append({"index": index, "code": 11000})
+                if ordered:
+                    break
+                continue
+            matched += result.matched_count
+            if result.upserted_id is not None:
+                upserted[index] = result.upserted_id
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors, "nMatched": matched,
+                "upserted": [{"index": i, "_id": _id} for i, _id in upserted.items()],
+            })
+        return SimpleNamespace(matched_count=matched, upserted_ids=upserted, bulk_api_result={})
+
+
+class FakeDb:
+    """`db.<koleksi>` dibuat saat pertama diakses; absensi & rollup punya unique key seperti INDEX_PLAN."""
+
+    def __init__(self, **collections):
+        for name, docs in collections.items():
+            setattr(self, name, self._collection(name, docs))
+
+    UNIQUE_KEYS = {
+        **main.ABSENSI_NATURAL_KEYS,
+        "absensi_rollup_harian": ["tanggal", "asrama_id", "waktu_sholat"],
+        "absensi_rollup_status": ["tanggal"],
+    }
+
+    @classmethod
+    def _collection(cls, name, docs=None):
+        return FakeCollection(docs, unique=cls.UNIQUE_KEYS.get(name))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        collection = self._collection(name)
+        setattr(self, name, collection)
+        return collection
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDb()
+    monkeypatch.setattr(main, "db", database)
+    return database
@@ -0,0 +1,60 @@
+"""
+Transport FCM palsu untuk benchmark/tes offline
+
+Meniru `firebase_admin.messaging.send_each` & `send_each_for_multicast`
+(latensi per panggilan dan kegagalan token) tanpa jaringan/Firebase.
+Dipasang dengan mengganti transport backend:
+    main._fcm_transport = FakeFcmTransport(latency_ms=80)
+"""
+
+import random
+import time
+import uuid
+from typing import List, Optional
+
+from firebase_admin import exceptions as firebase_exceptions
+from firebase_admin import messaging
+
+
+class FakeSendResponse:
+    def __init__(self, success: bool, exception: Optional[Exception] = None):
+        self.success = success
+        self.exception = exception
+        self.message_id = f"fake-{uuid.uuid4().hex[:12]}" if success else None
+
+
+class FakeBatchResponse:
+    def __init__(self, responses: List[FakeSendResponse]):
+        self.responses = responses
+        self.success_count = sum(1 for r in responses if r.success)
+        self.failure_count = len(responses) - self.success_count
+
+
+class FakeFcmTransport:
+    """Transport FCM lokal: meniru latensi per panggilan dan kegagalan token.
+
+    Token berawalan `dead-` dianggap tidak terdaftar, berawalan `flaky-` gagal
+    sementara dengan peluang failure_rate.
+    """
+
+    def __init__(self, latency_ms: float = 80.0, failure_rate: float = 0.5):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    def _response(self, token: str) -> FakeSendResponse:
+        if token.startswith("dead-"):
+            return FakeSendResponse(False, messaging.UnregisteredError("Requested entity was not found."))
+        if token.startswith("flaky-") and random.random() < self.failure_rate:
+            return FakeSendResponse(False, firebase_exceptions.UnavailableError("Service unavailable"))
+        return FakeSendResponse(True)
+
+    def send_each(self, messages, dry_run: bool = False, app=None):
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        return FakeBatchResponse([self._response(m.token) for m in messages])
+
+    def send_each_for_multicast(self, multicast_message, dry_run: bool = False, app=None):
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        return FakeBatchResponse([self._response(t) for t in multicast_message.tokens])
@@ -0,0 +1,76 @@
+"""
+Stub server Aladhan untuk tes offline
+
+Meniru endpoint yang dipakai backend:
+- GET /v1/calendarByAddress/{year}           (data dikelompokkan per bulan)
+- GET /v1/calendarByAddress/{year}/{month}
+Jadwal dihitung dengan compute_prayer_times() dari backend/main.py, jadi
+hasilnya realistis tanpa jaringan. Dengan --fail semua request dibalas 503
+untuk menguji fallback perkiraan lokal.
+
+Jalankan dari root repo:
+    python -m tests.stub_aladhan --port 8089
+lalu set di backend/.env:
+    ALADHAN_API_URL=http://localhost:8089/v1
+"""
+
+import argparse
+import calendar
+import os
+import sys
+from pathlib import Path
+
+from aiohttp import web
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import main  # noqa: E402
+
+TIMING_KEYS = {"Fajr": "subuh", "Dhuhr": "dzuhur", "Asr": "ashar", "Maghrib": "maghrib", "Isha": "isya"}
+
+
+def day_entry(year: int, month: int, day: int, suffix: str = " (WIB)") -> dict:
+    times = main.compute_prayer_times(f"{year}-{month:02d}-{day:02d}")
+    return {
+        "timings": {src: times[key] + suffix for src, key in TIMING_KEYS.items()},
+        "date": {"gregorian": {"date": f"{day:02d}-{month:02d}-{year}"}},
+    }
+
+
+def month_entries(year: int, month: int) -> list:
+    return [day_entry(year, month, d) for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+
+
+def create_app(fail: bool = False) -> web.Application:
+    app = web.Application()
+    app["requests"] = []
+
+    @web.middleware
+    async def record(request, handler):
+        app["requests"].append(request.path_qs)
+        if fail:
+            return web.json_response({"code": 503, "status": "Service Unavailable"}, status=503)
+        return await handler(request)
+
+    async def calendar_year(request):
+        year = int(request.match_info["year"])
+        data = {str(m): month_entries(year, m) for m in range(1, 13)}
+        return web.json_response({"code": 200, "status": "OK", "data": data})
+
+    async def calendar_month(request):
+        year, month = int(request.match_info["year"]), int(request.match_info["month"])
+        return web.json_response({"code": 200, "status": "OK", "data": month_entries(year, month)})
+
+    app.middlewares.append(record)
+    app.router.add_get("/v1/calendarByAddress/{year}", calendar_year)
+    app.router.add_get("/v1/calendarByAddress/{year}/{month}", calendar_month)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub server Aladhan")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--fail", action="store_true", help="balas semua request dengan 503")
+    args = parser.parse_args()
+    web.run_app(create_app(fail=args.fail), port=args.port)
@@ -0,0 +1,140 @@
+"""
+Test: endpoint batch absensi sholat pengabsen
+
+Tanpa server/MongoDB: roster santri (FakeDb), bulk_upsert_absensi, rollup dan outbox
+notifikasi diganti fixture, lalu batch_absensi_pengabsen() diuji untuk:
+- hasil per item (created / updated / unchanged) dari satu bulk upsert
+- penolakan per item (404, 403, duplikat, di luar jendela) tanpa menggagalkan batch
+- rollup & notifikasi wali hanya untuk status yang berubah
+- batas jumlah item per request
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+import main
+
+SANTRI = [
+    {"id": "s1", "nama": "Ahmad", "asrama_id": "A"},
+    {"id": "s2", "nama": "Budi", "asrama_id": "A"},
+    {"id": "s3", "nama": "Chandra", "asrama_id": "A"},
+    {"id": "s9", "nama": "Zaki", "asrama_id": "B"},
+]
+PENGABSEN = {"id": "p1", "asrama_ids": ["A"]}
+
+
+@pytest.fixture
+def calls(monkeypatch, fake_db):
+    recorded = {"upserts": [], "rollup": [], "notifications": []}
+    existing = {("s1", "subuh", "2026-10-17"): {"status": "alfa"}, ("s2", "subuh", "2026-10-17"): {"status": "hadir"}}
+
+    async def fake_resolve(waktu_sholat=None, now=None, enforce=None):
+        if waktu_sholat == "isya":
+            raise HTTPException(status_code=400, detail="Di luar jendela waktu sholat isya")
+        return waktu_sholat or "subuh", "2026-10-17"
+
+    async def fake_bulk_upsert(collection_name, items):
+        recorded["upserts"].append((collection_name, items))
+        keys = [main.absensi_key_tuple(collection_name, key) for key, _, _ in items]
+        return {k: existing.get(k) for k in keys}
+
+    async def fake_rollup(changes):
+        recorded["rollup"].extend(changes)
+
+    async def fake_enqueue(events):
+        recorded["notifications"].extend(events)
+
+    fake_db.santri.docs.extend(SANTRI)
+    recorded["db"] = fake_db
+    monkeypatch.setattr(main, "resolve_sholat_scan", fake_resolve)
+    monkeypatch.setattr(main, "bulk_upsert_absensi", fake_bulk_upsert)
+    monkeypatch.setattr(main, "apply_absensi_rollup_bulk", fake_rollup)
+    monkeypatch.setattr(main, "enqueue_absensi_notifications", fake_enqueue)
+    return recorded
+
+
+def run_batch(items):
+    payload = main.AbsensiBatchRequest(items=items)
+    return asyncio.run(main.batch_absensi_pengabsen(payload, PENGABSEN))
+
+
+class TestAbsensiBatch:
+    """Batch absensi sholat: satu roster, satu bulk write, hasil per item"""
+
+    def test_results_per_item(self, calls):
+        response = run_batch([{"santri_id": "s1"}, {"santri_id": "s2"}, {"santri_id": "s3", "status": "izin"}])
+        assert (response["total"], response["saved"], response["failed"]) == (3, 3, 0)
+        assert [r["result"] for r in response["results"]] == ["updated", "unchanged", "created"]
+        assert len(calls["upserts"]) == 1 and len(calls["upserts"][0][1]) == 3
+        assert len(calls["db"].santri.finds) == 1
+        assert calls["db"].santri.finds[0][1] == main.ROSTER_PROJECTIONS["santri_lean"]
+        print("✓ Tiga santri disimpan dengan satu find roster dan satu bulk upsert")
+
+    def test_rejections_do_not_fail_batch(self, calls):
+        response = run_batch([
+            {"santri_id": "s1"},
+            {"santri_id": "tidak-ada"},
+            {"santri_id": "s9"},
+            {"santri_id": "s1"},
+            {"santri_id": "s3", "waktu_sholat": "isya"},
+        ])
+        codes = {r["index"]: r.get("status_code") for r in response["results"] if not r["ok"]}
+        assert codes == {1: 404, 2: 403, 3: 409, 4: 400}
+        assert response["saved"] == 1 and response["failed"] == 4
+        assert [r["index"] for r in response["results"]] == [0, 1, 2, 3, 4]
+        print("✓ Item yang ditolak dilaporkan per item, item valid tetap tersimpan")
+
+    def test_rollup_and_notifications_only_for_changes(self, calls):
+        run_batch([{"santri_id": "s1"}, {"santri_id": "s2"}, {"santri_id": "s3"}])
+        assert [(old, new) for _, _, _, old, new in calls["rollup"]] == [("alfa", "hadir"), ("hadir", "hadir"), (None, "hadir")]
+        assert [santri["id"] for santri, _, _, _ in calls["notifications"]] == ["s1", "s3"]
+        print("✓ Notifikasi wali hanya untuk absensi baru atau status berubah")
+
+    def test_item_limit(self):
+        with pytest.raises(ValidationError):
+            main.AbsensiBatchRequest(items=[{"santri_id": f"s{i}"} for i in range(main.ABSENSI_BATCH_MAX_ITEMS + 1)])
+        with pytest.raises(ValidationError):
+            main.AbsensiBatchRequest(items=[])
+        print(f"✓ Batch dibatasi 1..{main.ABSENSI_BATCH_MAX_ITEMS} item")
+
+
+class TestBulkUpsertAbsensi:
+    """bulk_upsert_absensi: dokumen lama akurat, tulis bersamaan menandai rollup"""
+
+    KEY = {"santri_id": "s1", "waktu_sholat": "subuh", "tanggal": "2026-10-17"}
+
+    def items(self, status="hadir"):
+        return [
+            (self.KEY, {"status": status, "pengabsen_id": "p1"}, None),
+            ({**self.KEY, "santri_id": "s2"}, {"status": status, "pengabsen_id": "p1"}, None),
+        ]
+
+    def test_previous_docs_without_concurrency(self, fake_db):
+        fake_db.absensi.docs.append({**self.KEY, "status": "alfa"})
+        fake_db.absensi_rollup_status.docs.append({"tanggal": "2026-10-17"})
+        previous = asyncio.run(main.bulk_upsert_absensi("absensi", self.items()))
+        assert previous[("s1", "subuh", "2026-10-17")]["status"] == "alfa"
+        assert previous[("s2", "subuh", "2026-10-17")] is None
+        assert sorted(d["status"] for d in fake_db.absensi.docs) == ["hadir", "hadir"]
+        assert fake_db.absensi_rollup_status.docs, "Tanpa tulis bersamaan rollup tetap dipercaya"
+        print("✓ Status lama dari find sama dengan yang ditimpa bulk_write")
+
+    def test_concurrent_write_marks_rollup_stale(self, fake_db, monkeypatch):
+        fake_db.absensi.docs.append({**self.KEY, "status": "alfa"})
+        fake_db.absensi_rollup_status.docs.append({"tanggal": "2026-10-17"})
+        original_bulk_write = fake_db.absensi.bulk_write
+
+        async def racing_bulk_write(ops, ordered=True):
+            # Scan tunggal mengubah status setelah find, sebelum bulk_write
+            fake_db.absensi.docs[0]["status"] = "izin"
+            monkeypatch.setattr(fake_db.absensi, "bulk_write", original_bulk_write)
+            return await original_bulk_write(ops, ordered)
+
+        monkeypatch.setattr(fake_db.absensi, "bulk_write", racing_bulk_write)
+        asyncio.run(main.bulk_upsert_absensi("absensi", self.items()))
+        assert sorted(d["status"] for d in fake_db.absensi.docs) == ["hadir", "hadir"], "Scan batch tetap tersimpan"
+        assert fake_db.absensi_rollup_status.docs == [], "Tanggal ditandai untuk rebuild rollup"
+        print("✓ Tulis bersamaan: item diterapkan ulang dan rollup tanggalnya dibangun ulang")
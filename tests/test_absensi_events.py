@@ -0,0 +1,181 @@
+"""
+Test: kanal push perubahan absensi (SSE)
+
+Tanpa server/MongoDB: pub/sub in-process dan generator SSE diuji langsung untuk:
+- bentuk event per koleksi (scope asrama / kelas / kelas aliyah / kelompok)
+- event hanya sampai ke subscriber dengan scope yang cocok
+- burst event digabung dalam satu pesan; klien lambat menerima resync
+- hook jalur tulis tidak mem-publish saat change stream yang menjadi sumber
+- opsi pre-image hanya untuk MongoDB 6+, gagal membuka change stream -> lokal
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+ROLLUP = {"tanggal": "2026-10-18", "asrama_id": "A", "waktu_sholat": "subuh"}
+
+
+class FakeRequest:
+    def __init__(self):
+        self.closed = False
+
+    async def is_disconnected(self):
+        return self.closed
+
+
+class FakeChangeStream:
+    def __init__(self, server, kwargs):
+        self.server = server
+        self.kwargs = kwargs
+        self.resume_token = None
+
+    async def __aenter__(self):
+        self.server.watches.append(self.kwargs)
+        if self.server.watch_error:
+            raise self.server.watch_error
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(3600)
+
+
+class FakeReplicaSet:
+    """db palsu untuk start_absensi_event_source: hello, buildInfo, collMod, watch()."""
+
+    def __init__(self, version, watch_error=None):
+        self.version = version
+        self.watch_error = watch_error
+        self.watches = []
+        self.coll_mods = []
+
+    async def command(self, name, *args, **kwargs):
+        if name == "hello":
+            return {"setName": "rs0"}
+        if name == "buildInfo":
+            return {"versionArray": [self.version, 0, 0, 0]}
+        self.coll_mods.append(args[0])
+        return {"ok": 1}
+
+    def __getitem__(self, name):
+        return SimpleNamespace(watch=lambda pipeline, **kwargs: FakeChangeStream(self, kwargs))
+
+
+def start_source(monkeypatch, server):
+    monkeypatch.setattr(main, "db", server)
+    monkeypatch.setattr(main, "ABSENSI_EVENTS_SOURCE", "auto")
+
+    async def scenario():
+        source = await main.start_absensi_event_source()
+        await asyncio.sleep(0)
+        await main.stop_absensi_event_source()
+        return source
+
+    return asyncio.run(scenario())
+
+
+@pytest.fixture(autouse=True)
+def fresh_bus(monkeypatch):
+    monkeypatch.setattr(main, "_absensi_subscribers", {})
+    monkeypatch.setattr(main, "ABSENSI_EVENT_STATS", {"source": "local", "seq": 0, "published": 0, "delivered": 0, "dropped": 0})
+    monkeypatch.setattr(main, "ABSENSI_EVENT_COALESCE_SECONDS", 0.05)
+    monkeypatch.setattr(main, "ABSENSI_EVENT_HEARTBEAT_SECONDS", 0.2)
+
+
+def sse_data(message):
+    data = [line[len("data: "):] for line in message.splitlines() if line.startswith("data: ")]
+    return json.loads(data[0])
+
+
+async def open_stream(scopes):
+    stream = main.absensi_event_stream(FakeRequest(), scopes)
+    assert (await stream.__anext__()).startswith("retry:")
+    assert "event: ready" in await stream.__anext__()
+    return stream
+
+
+class TestAbsensiEvents:
+    """Event perubahan absensi: scope, coalesce dan backpressure"""
+
+    def test_event_shape(self):
+        sholat = main.absensi_event("absensi_rollup_harian", ROLLUP)
+        assert sholat == {"kind": "sholat", "scope": "asrama", "scope_id": "A", "tanggal": "2026-10-18", "slot": "subuh", "op": "update"}
+
+        aliyah = main.absensi_event(
+            "absensi_aliyah", {"siswa_id": "a1", "kelas_id": "K", "tanggal": "2026-10-18", "jenis": "pagi", "status": "izin"}, "delete"
+        )
+        assert (aliyah["scope"], aliyah["slot"], aliyah["siswa_id"], aliyah["status"]) == ("kelas_aliyah", "pagi", "a1", None)
+        assert main.absensi_event("absensi_pmq", {"siswa_id": "q1", "tanggal": "2026-10-18", "sesi": "pagi"}) is None
+        print("✓ Event membawa scope, tanggal dan waktu; tanpa scope tidak dikirim")
+
+    def test_scope_filter_and_coalesce(self):
+        async def scenario():
+            stream_a = await open_stream({"asrama": {"A"}})
+            stream_b = await open_stream({"asrama": {"B"}})
+            main.publish_absensi_events([main.absensi_event("absensi_rollup_harian", ROLLUP)] * 3)
+            message = await stream_a.__anext__()
+            other = await stream_b.__anext__()
+            await stream_a.aclose()
+            await stream_b.aclose()
+            return message, other
+
+        message, other = asyncio.run(scenario())
+        assert "event: absensi" in message and len(sse_data(message)["changes"]) == 1
+        assert other == ": ping\n\n", "Subscriber asrama lain hanya menerima heartbeat"
+        assert main._absensi_subscribers == {}
+        print("✓ Event hanya ke scope yang cocok, burst digabung, subscriber dilepas saat tutup")
+
+    def test_slow_client_gets_resync(self, monkeypatch):
+        monkeypatch.setattr(main, "ABSENSI_EVENT_QUEUE_SIZE", 2)
+
+        async def scenario():
+            stream = await open_stream({"asrama": {"A"}})
+            for _ in range(5):
+                main.publish_absensi_events([main.absensi_event("absensi_rollup_harian", ROLLUP)])
+            message = await stream.__anext__()
+            await stream.aclose()
+            return message
+
+        assert "event: resync" in asyncio.run(scenario())
+        assert main.ABSENSI_EVENT_STATS["dropped"] == 3
+        print("✓ Antrean penuh: event dibuang dan klien diminta resync")
+
+    def test_write_hook_skipped_for_change_stream(self):
+        async def scenario():
+            stream = await open_stream({"asrama": {"A"}})
+            main.ABSENSI_EVENT_STATS["source"] = "change_stream"
+            main.emit_absensi_changes("absensi_rollup_harian", [ROLLUP])
+            published_cs = main.ABSENSI_EVENT_STATS["published"]
+            main.ABSENSI_EVENT_STATS["source"] = "local"
+            main.emit_absensi_changes("absensi_rollup_harian", [ROLLUP])
+            await stream.aclose()
+            return published_cs
+
+        assert asyncio.run(scenario()) == 0
+        assert main.ABSENSI_EVENT_STATS["published"] == 1
+        print("✓ Jalur tulis hanya mem-publish saat sumber event lokal")
+
+    @pytest.mark.parametrize("version,pre_image", [(5, False), (6, True)])
+    def test_change_stream_options_follow_server_version(self, monkeypatch, version, pre_image):
+        server = FakeReplicaSet(version)
+        assert start_source(monkeypatch, server) == "change_stream"
+        assert all(("full_document_before_change" in w) == pre_image for w in server.watches)
+        assert bool(server.coll_mods) == pre_image
+        print(f"✓ MongoDB {version}: pre-image {'dipakai' if pre_image else 'tidak diminta'}")
+
+    def test_failed_watch_falls_back_to_local(self, monkeypatch):
+        server = FakeReplicaSet(6, watch_error=RuntimeError("$changeStream tidak didukung"))
+        assert start_source(monkeypatch, server) == "local"
+        assert main.ABSENSI_EVENT_STATS["source"] == "local" and len(server.watches) == 1
+        assert main._absensi_event_tasks == []
+        print("✓ watch() pertama gagal: sumber event kembali ke pub/sub lokal")
@@ -0,0 +1,98 @@
+"""
+Test: backfill & rebuild rollup harian
+
+Tanpa server/MongoDB: absensi, santri & rollup memakai FakeDb, agregasi Mongo
+diganti hitungan Python yang setara, lalu diuji:
+- tanggal tanpa penanda tercakup dibangun dari baris mentah walau sudah ada
+  dokumen rollup hasil $inc hook (scan pertama setelah deploy)
+- tanggal bertanda tidak dibangun ulang; penanda dicabut -> dibangun ulang
+- rebuild tidak menimpa counter yang di-$inc hook setelah rebuild dimulai,
+  dan menghapus key yang tidak lagi punya baris absensi
+"""
+
+import asyncio
+
+import pytest
+
+import main
+
+ASRAMA = {"s1": "A", "s2": "A", "s3": "A", "s4": "A"}
+
+
+@pytest.fixture
+def rollup_db(monkeypatch, fake_db):
+    calls = []
+
+    async def python_aggregate(tanggal_start, tanggal_end, now_iso):
+        calls.append((tanggal_start, tanggal_end))
+        rollups = {}
+        for row in fake_db.absensi.docs:
+            if not tanggal_start <= row["tanggal"] <= tanggal_end:
+                continue
+            key = (row["tanggal"], ASRAMA.get(row["santri_id"]), row["waktu_sholat"])
+            doc = rollups.setdefault(key, {
+                "tanggal": key[0], "asrama_id": key[1], "waktu_sholat": key[2],
+                "total": 0, **{st: 0 for st in main.ROLLUP_STATUS_LIST}, "updated_at": now_iso,
+            })
+            doc[row["status"]] += 1
+            doc["total"] += 1
+        return rollups
+
+    monkeypatch.setattr(main, "_aggregate_absensi_rollup", python_aggregate)
+    # Tiga baris sebelum rollup ada + satu scan setelah deploy yang di-$inc hook
+    fake_db.absensi.docs.extend(
+        {"santri_id": sid, "waktu_sholat": "subuh", "tanggal": "2026-10-01", "status": "hadir"} for sid in ASRAMA
+    )
+    asyncio.run(main.apply_absensi_rollup("2026-10-01", "A", "subuh", None, "hadir"))
+    return calls
+
+
+def rollup_doc(fake_db, tanggal, asrama_id="A", waktu="subuh"):
+    return next(
+        (d for d in fake_db.absensi_rollup_harian.docs
+         if (d["tanggal"], d["asrama_id"], d["waktu_sholat"]) == (tanggal, asrama_id, waktu)),
+        None,
+    )
+
+
+class TestAbsensiRollupBackfill:
+    """Statistik dari rollup tetap benar untuk tanggal sebelum rollup ada"""
+
+    def test_hook_doc_does_not_mark_date_covered(self, rollup_db, fake_db):
+        assert rollup_doc(fake_db, "2026-10-01")["total"] == 1
+        docs = asyncio.run(main.get_absensi_rollup("2026-10-01", "2026-10-01", ["A"]))
+        assert [d["total"] for d in docs] == [4], "Baris sebelum deploy ikut terhitung"
+        assert fake_db.absensi_rollup_status.docs[0]["tanggal"] == "2026-10-01"
+        print("✓ Dokumen rollup hasil hook tidak dianggap tercakup; tanggal dibangun dari baris mentah")
+
+    def test_marked_dates_trusted_until_marked_stale(self, rollup_db, fake_db):
+        asyncio.run(main.get_absensi_rollup("2026-10-01", "2026-10-02"))
+        assert asyncio.run(main.ensure_absensi_rollup("2026-10-01", "2026-10-02")) == []
+        assert rollup_db == [("2026-10-01", "2026-10-02")]
+
+        asyncio.run(main.mark_absensi_rollup_stale(["2026-10-02"]))
+        assert asyncio.run(main.ensure_absensi_rollup("2026-10-01", "2026-10-02")) == ["2026-10-02"]
+        assert rollup_db[-1] == ("2026-10-02", "2026-10-02")
+        print("✓ Tanggal bertanda dipercaya; penanda dicabut -> dibangun ulang")
+
+
+class TestAbsensiRollupRebuild:
+    """Rebuild aman dijalankan bersamaan dengan hook scan"""
+
+    def test_rebuild_keeps_counter_touched_after_start(self, rollup_db, fake_db):
+        rollup_doc(fake_db, "2026-10-01")["updated_at"] = "2999-01-01T00:00:00+00:00"
+        result = asyncio.run(main.rebuild_absensi_rollup("2026-10-01"))
+        assert result["contended"] == ["2026-10-01"]
+        assert rollup_doc(fake_db, "2026-10-01")["total"] == 1, "Counter yang baru di-$inc tidak ditimpa"
+        assert fake_db.absensi_rollup_status.docs == [], "Tanggal yang tersentuh tidak ditandai tercakup"
+        print("✓ Key yang di-$inc di tengah rebuild tidak ditimpa dan tanggalnya diulang nanti")
+
+    def test_rebuild_replaces_and_removes_keys(self, rollup_db, fake_db):
+        asyncio.run(main.apply_absensi_rollup("2026-10-01", "B", "isya", None, "alfa"))
+        for doc in fake_db.absensi_rollup_harian.docs:
+            doc["updated_at"] = "2000-01-01T00:00:00+00:00"
+        result = asyncio.run(main.rebuild_absensi_rollup("2026-10-01"))
+        assert (result["rollup_docs"], result["removed_docs"], result["contended"]) == (1, 1, [])
+        assert rollup_doc(fake_db, "2026-10-01")["total"] == 4
+        assert rollup_doc(fake_db, "2026-10-01", "B", "isya") is None
+        print("✓ Rebuild mengganti counter per key dan menghapus key tanpa baris absensi")
@@ -0,0 +1,178 @@
+"""
+Test: protokol sync offline PWA pengabsen
+
+Tanpa server/MongoDB: penyimpanan idempotency key, penerapan scan dan delta
+diganti fixture, lalu sync_absensi_pengabsen() diuji untuk:
+- replay idempotency key mengembalikan hasil tersimpan tanpa menulis ulang
+- key ganda dalam satu upload, client_time rusak / di masa depan
+- sync token bolak-balik dan token rusak ditolak
+- waktu versi LWW (terbaru dari client_time & waktu_absen server)
+- _apply_sync_scans() terhadap koleksi absensi in-memory: stale vs koreksi online
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+PENGABSEN = {"id": "p1", "asrama_ids": ["A"]}
+
+
+@pytest.fixture
+def applied(monkeypatch, fake_db):
+    calls = []
+
+    async def fake_apply(scans, current_pengabsen):
+        calls.append([index for index, _, _ in scans])
+        return {
+            index: {"index": index, "idempotency_key": scan.idempotency_key, "ok": True, "result": "created"}
+            for index, scan, _ in scans
+        }
+
+    async def fake_delta(current_pengabsen, since):
+        return {"changes": [], "deleted": [], "sync_token": main.encode_sync_token("t"), "has_more": False}
+
+    monkeypatch.setattr(main, "_apply_sync_scans", fake_apply)
+    monkeypatch.setattr(main, "absensi_sync_delta", fake_delta)
+    return calls
+
+
+def sync(scans, since=None):
+    payload = main.AbsensiSyncRequest(scans=scans, since=since)
+    return asyncio.run(main.sync_absensi_pengabsen(payload, PENGABSEN))
+
+
+def scan(key, minutes_ago=5, **extra):
+    client_time = (datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)).isoformat()
+    return {"idempotency_key": key, "santri_id": "s1", "client_time": client_time, **extra}
+
+
+class TestAbsensiSync:
+    """Upload antrean scan offline: idempotent dan aman diulang"""
+
+    def test_replay_returns_stored_result(self, applied):
+        first = sync([scan("k1"), scan("k2")])
+        assert first["applied"] == 2 and applied == [[0, 1]]
+
+        replay = sync([scan("k2"), scan("k1"), scan("k3")])
+        assert applied == [[0, 1], [2]], "Hanya key baru yang diterapkan ulang"
+        assert [r.get("replayed", False) for r in replay["results"]] == [True, True, False]
+        assert [r["index"] for r in replay["results"]] == [0, 1, 2]
+        print("✓ Upload ulang antrean yang sama tidak menulis dua kali")
+
+    def test_duplicate_and_invalid_client_time(self, applied):
+        response = sync([
+            scan("k1"),
+            scan("k1"),
+            scan("k2", minutes_ago=-60),
+            {"idempotency_key": "k3", "santri_id": "s1", "client_time": "kemarin"},
+        ])
+        results = response["results"]
+        assert results[1]["result"] == "duplicate" and results[1]["duplicate_of"] == 0
+        assert results[2]["status_code"] == 400 and "masa depan" in results[2]["detail"]
+        assert results[3]["status_code"] == 400
+        assert applied == [[0]]
+        assert response["failed"] == 2
+        print("✓ Key ganda, client_time rusak & masa depan ditolak per scan")
+
+    def test_sync_token_roundtrip(self, applied):
+        token = main.encode_sync_token("2026-10-17T04:30:00+00:00", "abc")
+        assert main.decode_sync_token(token) == ("2026-10-17T04:30:00+00:00", "abc")
+        with pytest.raises(HTTPException) as exc:
+            sync([], since="bukan-token")
+        assert exc.value.status_code == 400
+        print("✓ Sync token bolak-balik, token rusak ditolak 400")
+
+    def test_client_time_and_lww_version(self):
+        utc = main._parse_client_time("2026-10-17T04:30:00Z")
+        assert utc == datetime(2026, 10, 17, 4, 30, tzinfo=timezone.utc)
+        naive = main._parse_client_time("2026-10-17T04:30:00")
+        assert naive == datetime(2026, 10, 16, 21, 30, tzinfo=timezone.utc), "Waktu tanpa zona dianggap WIB"
+
+        assert main._absensi_effective_time({"client_time": "b", "waktu_absen": "a"}) == "b"
+        assert main._absensi_effective_time({"client_time": "b", "waktu_absen": "c"}) == "c"
+        assert main._absensi_effective_time({"waktu_absen": "c"}) == "c"
+        assert main._absensi_effective_time(None) == ""
+        print("✓ client_time dinormalisasi ke UTC; versi LWW = terbaru dari client_time & waktu_absen")
+
+
+@pytest.fixture
+def sync_db(monkeypatch, fake_db):
+    recorded = {"rollup": [], "notifications": []}
+
+    async def fake_resolve(waktu_sholat=None, now=None, enforce=None):
+        return waktu_sholat or "subuh", "2026-10-17"
+
+    async def fake_rollup(changes):
+        recorded["rollup"].extend(changes)
+
+    async def fake_enqueue(events):
+        recorded["notifications"].extend(events)
+
+    fake_db.santri.docs.extend([{"id": "s1", "nama": "Ahmad", "asrama_id": "A"}, {"id": "s2", "nama": "Budi", "asrama_id": "A"}])
+    monkeypatch.setattr(main, "resolve_sholat_scan", fake_resolve)
+    monkeypatch.setattr(main, "apply_absensi_rollup_bulk", fake_rollup)
+    monkeypatch.setattr(main, "enqueue_absensi_notifications", fake_enqueue)
+    recorded["db"] = fake_db
+    return recorded
+
+
+def apply_scans(scans):
+    parsed = [
+        (index, scan, main._parse_client_time(scan.client_time))
+        for index, scan in enumerate(main.AbsensiSyncScan(**s) for s in scans)
+    ]
+    return asyncio.run(main._apply_sync_scans(parsed, PENGABSEN))
+
+
+def absensi_row(db, santri_id):
+    return next(d for d in db.absensi.docs if d["santri_id"] == santri_id)
+
+
+class TestApplySyncScans:
+    """Penerapan scan offline ke koleksi absensi dengan last-writer-wins"""
+
+    def online_row(self, santri_id, status, waktu):
+        return {
+            "santri_id": santri_id, "waktu_sholat": "subuh", "tanggal": "2026-10-17",
+            "status": status, "waktu_absen": waktu, "client_time": waktu,
+        }
+
+    def test_offline_scan_older_than_online_write_is_stale(self, sync_db):
+        sync_db["db"].absensi.docs.append(self.online_row("s1", "izin", "2026-10-17T00:10:00+00:00"))
+        results = apply_scans([
+            {"idempotency_key": "k1", "santri_id": "s1", "client_time": "2026-10-17T00:05:00+00:00", "status": "hadir"},
+        ])
+        assert results[0]["result"] == "stale" and results[0]["status"] == "izin"
+        assert absensi_row(sync_db["db"], "s1")["status"] == "izin"
+        assert sync_db["rollup"] == [] and sync_db["notifications"] == []
+        print("✓ Scan offline yang lebih lama dari koreksi online tidak menimpa")
+
+    def test_guard_uses_waktu_absen_when_client_time_is_older(self, sync_db):
+        # Baris ditulis online oleh versi lama: client_time basi, waktu_absen terbaru
+        row = {**self.online_row("s1", "izin", "2026-10-17T00:10:00+00:00"), "client_time": "2026-10-17T00:01:00+00:00"}
+        sync_db["db"].absensi.docs.append(row)
+        results = apply_scans([
+            {"idempotency_key": "k1", "santri_id": "s1", "client_time": "2026-10-17T00:05:00+00:00", "status": "hadir"},
+        ])
+        assert results[0]["result"] == "stale"
+        assert absensi_row(sync_db["db"], "s1")["status"] == "izin"
+        print("✓ LWW membandingkan waktu terbaru dari client_time dan waktu_absen")
+
+    def test_newer_scan_updates_and_newest_wins_in_upload(self, sync_db):
+        sync_db["db"].absensi.docs.append(self.online_row("s1", "alfa", "2026-10-17T00:01:00+00:00"))
+        results = apply_scans([
+            {"idempotency_key": "k1", "santri_id": "s1", "client_time": "2026-10-17T00:05:00+00:00", "status": "hadir"},
+            {"idempotency_key": "k2", "santri_id": "s2", "client_time": "2026-10-17T00:07:00+00:00", "status": "hadir"},
+            {"idempotency_key": "k3", "santri_id": "s2", "client_time": "2026-10-17T00:06:00+00:00", "status": "izin"},
+        ])
+        assert [results[i]["result"] for i in range(3)] == ["updated", "created", "superseded"]
+        s1 = absensi_row(sync_db["db"], "s1")
+        assert (s1["status"], s1["client_time"]) == ("hadir", "2026-10-17T00:05:00+00:00")
+        assert absensi_row(sync_db["db"], "s2")["status"] == "hadir"
+        assert len(sync_db["db"].absensi.docs) == 2
+        assert [(old, new) for _, _, _, old, new in sync_db["rollup"]] == [("alfa", "hadir"), (None, "hadir")]
+        print("✓ Scan lebih baru menimpa; dalam satu upload scan terbaru per key yang menang")
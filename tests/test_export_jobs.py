@@ -0,0 +1,63 @@
+"""
+Test: job export background
+
+Tanpa server/MongoDB: koleksi export_jobs memakai FakeDb, lalu diuji untuk:
+- job 'pending'/'running' tanpa heartbeat (proses mati) ditandai failed
+- job yang masih di-heartbeat atau task-nya hidup di worker ini tidak disentuh
+- export CSV ke file (ditulis lewat thread) berisi BOM, header dan semua baris
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+
+
+def ago(seconds):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).isoformat()
+
+
+@pytest.fixture
+def export_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "EXPORT_DIR", tmp_path)
+    monkeypatch.setattr(main, "_export_tasks", {})
+    return tmp_path
+
+
+class TestExportJobs:
+    """Job export yang ditinggal proses mati tidak menggantung di 'running'"""
+
+    def test_orphaned_jobs_marked_failed(self, export_dir, fake_db):
+        stale = ago(main.EXPORT_JOB_STALE_SECONDS + 30)
+        (export_dir / "mati.csv").write_bytes(b"parsial")
+        fake_db.export_jobs.docs.extend([
+            {"id": "mati", "format": "csv", "status": "running", "heartbeat_at": stale},
+            {"id": "lama", "format": "xlsx", "status": "pending"},
+            {"id": "hidup", "format": "csv", "status": "running", "heartbeat_at": ago(5)},
+            {"id": "lokal", "format": "csv", "status": "running", "heartbeat_at": stale},
+            {"id": "selesai", "format": "csv", "status": "completed", "heartbeat_at": stale},
+        ])
+        main._export_tasks["lokal"] = object()
+
+        assert asyncio.run(main.fail_orphaned_export_jobs()) == 2
+        status = {job["id"]: job["status"] for job in fake_db.export_jobs.docs}
+        assert status == {"mati": "failed", "lama": "failed", "hidup": "running", "lokal": "running", "selesai": "completed"}
+        assert not (export_dir / "mati.csv").exists(), "File parsial dibuang"
+        print("✓ Job export yatim ditandai failed, job hidup tidak disentuh")
+
+    def test_csv_export_file(self, export_dir, monkeypatch):
+        async def batches(jenis, params):
+            yield [["s1", "Ahmad"]]
+            yield [["s2", "Budi"], ["s3", "Citra"]]
+
+        monkeypatch.setattr(main, "iter_export_batches", batches)
+        path = export_dir / "santri.csv"
+        rows = asyncio.run(main.write_export_file("santri", "csv", {}, path))
+
+        assert rows == 3
+        content = path.read_bytes()
+        assert content.startswith(b"\xef\xbb\xbf")
+        assert content.decode("utf-8-sig").splitlines()[1:] == ["s1,Ahmad", "s2,Budi", "s3,Citra"]
+        print("✓ Export CSV ditulis lengkap lewat thread")
@@ -0,0 +1,120 @@
+"""
+Test: pembukuan dispatcher notification_outbox
+
+Tanpa server/MongoDB/FCM: outbox memakai FakeDb dan send_fcm_pushes diganti
+pencatat, lalu dispatch_notification_batch diuji untuk:
+- kegagalan sebelum push terkirim: attempts naik, retry dengan backoff, failed di batas percobaan
+- kegagalan setelah push terkirim: entri ditandai sent, tidak dikirim dua kali
+- template admin yang rusak: event wali itu ditandai skipped, wali lain tetap terkirim
+- endpoint settings menolak placeholder selain {nama} dan {waktu}
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def ago(seconds):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).isoformat()
+
+
+def event(event_id, santri_id, attempts=0, status_absen="alfa"):
+    return {
+        "id": event_id, "kind": "absensi_sholat", "santri_id": santri_id, "santri_nama": santri_id.upper(),
+        "tanggal": "2026-10-17", "waktu_sholat": "subuh", "status_absen": status_absen,
+        "status": "pending", "attempts": attempts, "next_attempt_at": ago(120), "created_at": ago(120),
+    }
+
+
+@pytest.fixture
+def pushes(monkeypatch, fake_db):
+    sent = []
+
+    async def fake_send(batch):
+        sent.extend(batch)
+        return [[{"token": t, "success": True, "error": None} for t in tokens] for tokens, _, _ in batch]
+
+    monkeypatch.setattr(main, "send_fcm_pushes", fake_send)
+    monkeypatch.setattr(main, "fcm_is_configured", lambda: True)
+    fake_db.settings.docs.append({"id": "wali_notifikasi", "coalesce_seconds": 0})
+    fake_db.wali_santri.docs.extend([
+        {"id": "w1", "anak_ids": ["s1"], "fcm_tokens": ["token-w1"]},
+        {"id": "w2", "anak_ids": ["s2"], "fcm_tokens": ["token-w2"]},
+    ])
+    return sent
+
+
+def outbox(fake_db):
+    return {doc["id"]: doc for doc in fake_db.notification_outbox.docs}
+
+
+class TestDispatchFailure:
+    """Entri yang diklaim tidak boleh tertinggal 'sending' ketika dispatch gagal"""
+
+    def test_failure_before_push_schedules_retry(self, pushes, fake_db, monkeypatch):
+        async def broken_send(batch):
+            raise RuntimeError("FCM down")
+
+        monkeypatch.setattr(main, "send_fcm_pushes", broken_send)
+        fake_db.notification_outbox.docs.extend([event("e1", "s1"), event("e2", "s2", attempts=main.NOTIFICATION_MAX_ATTEMPTS - 1)])
+        asyncio.run(main.dispatch_notification_batch())
+
+        entries = outbox(fake_db)
+        assert entries["e1"]["status"] == "retry"
+        assert entries["e1"]["attempts"] == 1
+        assert entries["e1"]["next_attempt_at"] > datetime.now(timezone.utc).isoformat()
+        assert "locked_at" not in entries["e1"]
+        assert entries["e2"]["status"] == "failed", "Batas percobaan tercapai"
+        assert "FCM down" in entries["e2"]["last_error"]
+        print("✓ Gagal sebelum push: retry dengan backoff, failed di NOTIFICATION_MAX_ATTEMPTS")
+
+    def test_failure_after_push_does_not_resend(self, pushes, fake_db, monkeypatch):
+        fake_db.notification_outbox.docs.append(event("e1", "s1"))
+        original_update_one = fake_db.notification_outbox.update_one
+
+        async def failing_update_one(query, update, upsert=False):
+            if update.get("$set", {}).get("status") == "sent":
+                raise RuntimeError("Mongo timeout")
+            return await original_update_one(query, update, upsert)
+
+        monkeypatch.setattr(fake_db.notification_outbox, "update_one", failing_update_one)
+        asyncio.run(main.dispatch_notification_batch())
+        monkeypatch.setattr(fake_db.notification_outbox, "update_one", original_update_one)
+        asyncio.run(main.dispatch_notification_batch())
+
+        assert outbox(fake_db)["e1"]["status"] == "sent"
+        assert len(pushes) == 1, "Push yang sudah terkirim tidak diulang"
+        print("✓ Gagal setelah push: entri ditandai sent, tidak ada push ganda")
+
+
+class TestWaliTemplate:
+    """Template notifikasi wali dari admin hanya boleh memakai {nama} dan {waktu}"""
+
+    def test_broken_template_skips_events(self, pushes, fake_db):
+        fake_db.settings.docs[0]["alfa"] = "{nama} alfa di kelas {kelas}"
+        fake_db.notification_outbox.docs.extend([event("e1", "s1"), event("e2", "s2", status_absen="hadir")])
+        asyncio.run(main.dispatch_notification_batch())
+
+        entries = outbox(fake_db)
+        assert entries["e1"]["status"] == "skipped"
+        assert "Template notifikasi tidak valid" in entries["e1"]["last_error"]
+        assert entries["e2"]["status"] == "sent"
+        assert [tokens for tokens, _, _ in pushes] == [["token-w2"]]
+        print("✓ Template rusak: event wali itu skipped, wali lain tetap terkirim")
+
+    def test_settings_endpoint_rejects_unknown_placeholder(self, fake_db):
+        for template in ("{nama} alfa di kelas {kelas}", "{nama} alfa {", "{0} alfa"):
+            with pytest.raises(HTTPException) as exc:
+                asyncio.run(main.update_wali_notifikasi_settings(main.WaliNotifikasiSettings(alfa=template), {}))
+            assert exc.value.status_code == 400
+        assert fake_db.settings.docs == []
+
+        asyncio.run(main.update_wali_notifikasi_settings(
+            main.WaliNotifikasiSettings(alfa="{{Info}} {nama} alfa sholat {waktu}"), {}
+        ))
+        assert fake_db.settings.docs[0]["alfa"] == "{{Info}} {nama} alfa sholat {waktu}"
+        print("✓ Endpoint settings menolak placeholder selain {nama} dan {waktu}")
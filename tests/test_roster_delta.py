@@ -0,0 +1,137 @@
+"""
+Test: ETag & delta untuk endpoint roster "absensi hari ini"
+
+Tanpa server/MongoDB: helper ETag/versi diuji langsung untuk:
+- If-None-Match (daftar tag, pembanding lemah W/, wildcard)
+- ETag berubah bila data/roster berubah, stabil bila tidak
+- versi delta bolak-balik, versi rusak ditolak 400
+- versi dari scope/roster lain memaksa respons penuh
+- only_ids dari FakeDb: baris diubah/dihapus (tombstone) sejak versi, hapus tanpa
+  tombstone dan selisih jumlah baris aliyah/PMQ memaksa respons penuh
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+
+STATE = {
+    "scope": "abc123",
+    "roster": [120, 5974250],
+    "data": [["A", "subuh", 87, "2026-10-17T22:00:00+00:00"]],
+    "count": None,
+    "at": "2026-10-17T22:00:10+00:00",
+}
+
+
+def request_with(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+class TestRosterDelta:
+    """Poll roster hari ini: 304 bila tidak berubah, delta bila sedikit berubah"""
+
+    def test_etag_matches(self):
+        etag = main.roster_etag(STATE)
+        assert etag.startswith('W/"')
+        assert main.etag_matches(request_with(etag), etag)
+        assert main.etag_matches(request_with(etag.removeprefix("W/")), etag)
+        assert main.etag_matches(request_with(f'"lain", {etag}'), etag)
+        assert main.etag_matches(request_with("*"), etag)
+        assert not main.etag_matches(request_with('"lain"'), etag)
+        assert not main.etag_matches(request_with(), etag)
+        print("✓ If-None-Match dicocokkan dengan pembanding lemah")
+
+    def test_etag_follows_state(self):
+        etag = main.roster_etag(STATE)
+        assert main.roster_etag(dict(STATE)) == etag
+        assert main.roster_etag({**STATE, "data": [["A", "subuh", 88, "2026-10-17T22:00:05+00:00"]]}) != etag
+        assert main.roster_etag({**STATE, "roster": [121, 5974250]}) != etag
+        assert main.roster_etag({**STATE, "roster": [120, 5974251]}) != etag, "Epoch baru memaksa refresh roster"
+        print("✓ ETag berubah mengikuti data absensi, jumlah roster dan epoch")
+
+    def test_version_roundtrip(self):
+        version = main.decode_roster_version(main.encode_roster_version(STATE))
+        assert version["k"] == STATE["scope"] and version["r"] == STATE["roster"]
+        assert version["c"] == STATE["at"]
+        assert version["t"] < STATE["at"], "Cutoff delta dimundurkan untuk tulisan yang masih berjalan"
+        with pytest.raises(HTTPException) as exc:
+            main.decode_roster_version("bukan-versi")
+        assert exc.value.status_code == 400
+        print("✓ Versi delta bolak-balik, versi rusak ditolak 400")
+
+    def test_foreign_version_forces_full_response(self):
+        other_scope = main.encode_roster_version({**STATE, "scope": "lain"})
+        other_roster = main.encode_roster_version({**STATE, "roster": [119, 5974250]})
+        for since in (other_scope, other_roster):
+            changed = asyncio.run(
+                main.absensi_roster_changed_ids("sholat", STATE, since, ["A"], "2026-10-18", "subuh")
+            )
+            assert changed is None
+        print("✓ Versi dari scope/roster lain menghasilkan respons penuh")
+
+
+VERSION_AT = "2026-10-17T22:00:10+00:00"
+BEFORE = "2026-10-17T21:00:00+00:00"
+AFTER = "2026-10-17T22:05:00+00:00"
+
+
+def roster_state(count):
+    return {**STATE, "count": count, "at": VERSION_AT}
+
+
+def changed_ids(kind, since, count, scope_ids, slot):
+    return asyncio.run(
+        main.absensi_roster_changed_ids(kind, roster_state(count), since, scope_ids, "2026-10-18", slot)
+    )
+
+
+class TestRosterChangedIds:
+    """absensi_roster_changed_ids terhadap FakeDb"""
+
+    @pytest.fixture
+    def sholat(self, fake_db):
+        fake_db.santri.docs.extend({"id": sid, "asrama_id": "A"} for sid in ("s1", "s2", "s3"))
+        fake_db.santri.docs.append({"id": "x1", "asrama_id": "B"})
+        fake_db.absensi.docs.extend([
+            {"santri_id": "s1", "tanggal": "2026-10-18", "waktu_sholat": "subuh", "created_at": BEFORE, "updated_at": AFTER},
+            {"santri_id": "s3", "tanggal": "2026-10-18", "waktu_sholat": "subuh", "created_at": BEFORE, "updated_at": BEFORE},
+            # Asrama lain: ikut terbaca tapi tidak dihitung untuk scope A
+            {"santri_id": "x1", "tanggal": "2026-10-18", "waktu_sholat": "subuh", "created_at": AFTER, "updated_at": AFTER},
+        ])
+        # Versi diambil saat s1, s2, s3 sudah diabsen (total rollup 3)
+        return main.encode_roster_version(roster_state(3))
+
+    def test_sholat_update_and_tombstoned_delete(self, sholat, fake_db):
+        fake_db.absensi_tombstones.docs.append(
+            {"santri_id": "s2", "tanggal": "2026-10-18", "waktu_sholat": "subuh", "deleted_at": AFTER}
+        )
+        assert changed_ids("sholat", sholat, 2, ["A"], "subuh") == ["s1", "s2", "x1"]
+        print("✓ Sholat: baris diubah dan dihapus (tombstone) sejak versi masuk only_ids")
+
+    def test_sholat_delete_without_tombstone_forces_full(self, sholat):
+        # s2 terhapus tetapi tombstone gagal dicatat: total rollup turun ke 2
+        assert changed_ids("sholat", sholat, 2, ["A"], "subuh") is None
+        print("✓ Sholat: hapus tanpa tombstone memaksa respons penuh")
+
+    @pytest.mark.parametrize("kind, collection, slot_field, scope_field, slot", [
+        ("aliyah", "absensi_aliyah", "jenis", "kelas_id", "pagi"),
+        ("pmq", "absensi_pmq", "sesi", "kelompok_id", "pagi"),
+    ])
+    def test_row_count_fallback(self, fake_db, kind, collection, slot_field, scope_field, slot):
+        since = main.encode_roster_version(roster_state(2))
+        row = {"tanggal": "2026-10-18", slot_field: slot, scope_field: "K1"}
+        fake_db[collection].docs.extend([
+            {**row, "siswa_id": "a1", "created_at": BEFORE, "updated_at": AFTER},
+            {**row, "siswa_id": "a2", "created_at": BEFORE, "updated_at": BEFORE},
+            {**row, "siswa_id": "a3", "created_at": AFTER, "updated_at": AFTER},
+        ])
+        assert changed_ids(kind, since, 3, ["K1"], slot) == ["a1", "a3"], "Satu diubah, satu baru"
+
+        fake_db[collection].docs.pop(1)
+        assert changed_ids(kind, since, 2, ["K1"], slot) is None, "Baris terhapus tanpa tombstone"
+        print(f"✓ {kind}: delta dari jumlah baris, hapus memaksa respons penuh")
@@ -0,0 +1,128 @@
+"""
+Static check: query roster memakai proyeksi bernama
+
+Memeriksa backend/main.py (tanpa server/MongoDB) bahwa:
+- setiap db.<santri|siswa_*>.find(...) mengirim proyeksi
+- handler laporan (riwayat, hari-ini, rekap, statistik, grid, monitoring, report)
+  hanya memakai ROSTER_PROJECTIONS varian lean / with_wali, bukan dokumen penuh
+- setiap nama proyeksi yang dipakai memang terdaftar di ROSTER_PROJECTIONS
+"""
+
+import ast
+import re
+from pathlib import Path
+
+import pytest
+
+MAIN_PY = Path(__file__).resolve().parent.parent / "backend" / "main.py"
+
+ROSTER_COLLECTIONS = {"santri", "siswa_madrasah", "siswa_aliyah", "siswa_pmq"}
+REPORT_HANDLER_PATTERN = re.compile(r"riwayat|hari_ini|rekap|statistik|stats|grid|monitoring|report")
+REPORT_PROJECTIONS = {"santri_lean", "santri_with_wali", "siswa_madrasah_lean", "siswa_aliyah_lean", "siswa_pmq_lean"}
+
+
+@pytest.fixture(scope="module")
+def tree():
+    return ast.parse(MAIN_PY.read_text(encoding="utf-8"))
+
+
+@pytest.fixture(scope="module")
+def registered_projections(tree):
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(t, ast.Name) and t.id == "ROSTER_PROJECTIONS" for t in node.targets
+        ):
+            return {k.value for k in node.value.keys}
+    pytest.fail("ROSTER_PROJECTIONS tidak ditemukan di backend/main.py")
+
+
+def roster_find_calls(tree):
+    """(nama fungsi, koleksi, node proyeksi atau None, lineno) untuk setiap find roster."""
+    for func in tree.body:
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for node in ast.walk(func):
+            if (
+                isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Attribute)
+                and node.func.attr == "find"
+                and isinstance(node.func.value, ast.Attribute)
+                and node.func.value.attr in ROSTER_COLLECTIONS
+                and isinstance(node.func.value.value, ast.Name)
+                and node.func.value.value.id == "db"
+            ):
+                projection = node.args[1] if len(node.args) > 1 else None
+                for kw in node.keywords:
+                    if kw.arg == "projection":
+                        projection = kw.value
+                yield func.name, node.func.value.attr, projection, node.lineno
+
+
+def projection_name(projection):
+    """Nama proyeksi bila bentuknya ROSTER_PROJECTIONS["..."], selain itu None."""
+    if (
+        isinstance(projection, ast.Subscript)
+        and isinstance(projection.value, ast.Name)
+        and projection.value.id == "ROSTER_PROJECTIONS"
+        and isinstance(projection.slice, ast.Constant)
+    ):
+        return projection.slice.value
+    return None
+
+
+def is_inclusion_literal(projection):
+    """Dict literal yang hanya menyertakan field tertentu, mis. {"_id": 0, "id": 1}."""
+    if not isinstance(projection, ast.Dict):
+        return False
+    included = [
+        k.value for k, v in zip(projection.keys, projection.values)
+        if isinstance(k, ast.Constant) and isinstance(v, ast.Constant) and v.value == 1
+    ]
+    return bool(included)
+
+
+class TestRosterProjections:
+    """Query roster tidak boleh mengambil dokumen penuh"""
+
+    def test_every_roster_find_has_projection(self, tree):
+        missing = [
+            f"{func}:{lineno} db.{coll}.find"
+            for func, coll, projection, lineno in roster_find_calls(tree)
+            if projection is None
+        ]
+        assert not missing, f"find roster tanpa proyeksi: {missing}"
+        print("✓ Semua find roster mengirim proyeksi")
+
+    def test_report_handlers_use_lean_projections(self, tree):
+        offenders = []
+        checked = 0
+        for func, coll, projection, lineno in roster_find_calls(tree):
+            if not REPORT_HANDLER_PATTERN.search(func):
+                continue
+            checked += 1
+            name = projection_name(projection)
+            if name in REPORT_PROJECTIONS or is_inclusion_literal(projection):
+                continue
+            offenders.append(f"{func}:{lineno} db.{coll}.find -> {ast.unparse(projection) if projection else None}")
+        assert checked > 0, "Tidak ada handler laporan yang terdeteksi"
+        assert not offenders, f"Handler laporan mengambil dokumen roster tanpa proyeksi lean: {offenders}"
+        print(f"✓ {checked} query roster di handler laporan memakai proyeksi lean")
+
+    def test_projection_matches_collection(self, tree):
+        mismatched = []
+        for func, coll, projection, lineno in roster_find_calls(tree):
+            name = projection_name(projection)
+            if name and not name.startswith(coll + "_"):
+                mismatched.append(f"{func}:{lineno} db.{coll}.find -> {name}")
+        assert not mismatched, f"Proyeksi tidak sesuai koleksi: {mismatched}"
+        print("✓ Nama proyeksi sesuai koleksinya")
+
+    def test_used_projections_are_registered(self, tree, registered_projections):
+        unknown = {
+            name
+            for _, _, projection, _ in roster_find_calls(tree)
+            if (name := projection_name(projection)) and name not in registered_projections
+        }
+        assert not unknown, f"Proyeksi tidak terdaftar: {unknown}"
+        assert REPORT_PROJECTIONS <= registered_projections
+        print(f"✓ {len(registered_projections)} proyeksi roster terdaftar")
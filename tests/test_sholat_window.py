@@ -0,0 +1,95 @@
+"""
+Test: jendela waktu sholat menentukan waktu_sholat & tanggal scan
+
+Tanpa server/MongoDB: jadwal waktu_sholat dan pengaturan jendela diganti
+fixture, lalu resolve_sholat_scan() diuji untuk:
+- inferensi waktu sholat yang sedang berlangsung
+- isya lewat tengah malam tetap bertanggal kemarin
+- penolakan scan di luar jendela (enforce) dan toleransi keterlambatan
+"""
+
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+JADWAL = {"subuh": "04:30", "dzuhur": "11:45", "ashar": "15:00", "maghrib": "17:50", "isya": "19:00"}
+
+
+@pytest.fixture(autouse=True)
+def fixed_schedule(monkeypatch):
+    settings = {"enforce": True, "buka_sebelum_menit": 30, "toleransi_menit": 60}
+
+    async def fake_doc(tanggal):
+        return {"tanggal": tanggal, **JADWAL}
+
+    async def fake_settings():
+        return settings
+
+    monkeypatch.setattr(main, "get_waktu_sholat_doc", fake_doc)
+    monkeypatch.setattr(main, "get_sholat_window_settings", fake_settings)
+    main.invalidate_sholat_windows()
+    yield settings
+    main.invalidate_sholat_windows()
+
+
+def resolve(day: int, jam: str, waktu=None, **kwargs):
+    hh, mm = (int(p) for p in jam.split(":"))
+    now = datetime(2026, 10, day, hh, mm, tzinfo=main.LOCAL_TZ)
+    return asyncio.run(main.resolve_sholat_scan(waktu, now, **kwargs))
+
+
+class TestSholatWindow:
+    """Jendela absensi sholat"""
+
+    @pytest.mark.parametrize("jam,expected", [
+        ("04:00", "subuh"),
+        ("11:14", "subuh"),
+        ("11:15", "dzuhur"),
+        ("15:10", "ashar"),
+        ("17:30", "maghrib"),
+        ("23:59", "isya"),
+    ])
+    def test_infers_current_waktu(self, jam, expected):
+        assert resolve(17, jam) == (expected, "2026-10-17")
+
+    def test_isya_after_midnight_belongs_to_yesterday(self):
+        assert resolve(18, "01:30") == ("isya", "2026-10-17")
+        assert resolve(18, "01:30", "isya") == ("isya", "2026-10-17")
+        print("✓ Isya lewat tengah malam bertanggal kemarin")
+
+    def test_subuh_is_dated_today(self):
+        assert resolve(18, "04:05", "subuh") == ("subuh", "2026-10-18")
+
+    def test_late_entry_within_tolerance(self):
+        # Jendela dzuhur tutup 14:30, toleransi 60 menit
+        assert resolve(17, "15:29", "dzuhur") == ("dzuhur", "2026-10-17")
+
+    def test_outside_window_rejected_when_enforced(self):
+        with pytest.raises(HTTPException) as exc:
+            resolve(17, "03:00", "subuh")
+        assert exc.value.status_code == 400
+        assert "04:00" in exc.value.detail
+        print("✓ Scan subuh sebelum jendela dibuka ditolak")
+
+    def test_outside_window_allowed_when_not_enforced(self, fixed_schedule):
+        fixed_schedule["enforce"] = False
+        assert resolve(17, "12:00", "isya") == ("isya", "2026-10-17")
+        assert resolve(17, "12:00", "isya", enforce=False) == ("isya", "2026-10-17")
+
+    def test_enforce_off_by_default(self):
+        assert main.AbsensiSholatWindowSettings().enforce is False
+        print("✓ Penolakan di luar jendela harus diaktifkan admin")
+
+    def test_waktu_aktif_without_schedule(self, monkeypatch):
+        async def missing_doc(tanggal):
+            raise HTTPException(status_code=500, detail="Gagal mengambil data waktu sholat")
+
+        monkeypatch.setattr(main, "get_waktu_sholat_doc", missing_doc)
+        main.invalidate_sholat_windows()
+        response = asyncio.run(main.get_waktu_sholat_aktif({}))
+        assert response["waktu_sholat"] is None and response["jendela"] == {}
+        print("✓ Jadwal tidak tersedia: waktu-sholat-aktif tetap 200 dengan jendela kosong")
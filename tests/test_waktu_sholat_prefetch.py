@@ -0,0 +1,91 @@
+"""
+Test: prefetch waktu sholat via endpoint calendar Aladhan + fallback perkiraan
+
+Memakai stub server Aladhan (tests/stub_aladhan.py) di port lokal acak, tanpa
+MongoDB maupun akses internet:
+- kalender bulanan & tahunan di-parse jadi {YYYY-MM-DD: {subuh..isya}}
+- suffix zona waktu "(WIB)" dari endpoint calendar dibuang
+- saat API gagal, fungsi fetch mengembalikan None (pemanggil pakai perkiraan lokal)
+- perkiraan astronomis menghasilkan urutan waktu yang masuk akal
+- jadwal perkiraan hanya mengisi tanggal kosong, tidak menimpa jadwal Aladhan
+"""
+
+import asyncio
+import re
+
+import pytest
+from aiohttp import web
+
+import main
+from tests.stub_aladhan import create_app
+
+TIME_PATTERN = re.compile(r"^\d{2}:\d{2}$")
+
+
+async def with_stub(coro_factory, fail: bool = False):
+    app = create_app(fail=fail)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    original_url, original_backoff = main.ALADHAN_API_URL, main.HTTP_CLIENT_RETRY_BACKOFF_SECONDS
+    main.ALADHAN_API_URL = f"http://127.0.0.1:{port}/v1"
+    main.HTTP_CLIENT_RETRY_BACKOFF_SECONDS = 0.01
+    try:
+        return await coro_factory(), app["requests"]
+    finally:
+        main.ALADHAN_API_URL, main.HTTP_CLIENT_RETRY_BACKOFF_SECONDS = original_url, original_backoff
+        await main.close_http_session()
+        await runner.cleanup()
+
+
+class TestWaktuSholatPrefetch:
+    """Prefetch kalender Aladhan & fallback lokal"""
+
+    def test_month_calendar_single_request(self):
+        times, requests = asyncio.run(with_stub(lambda: main.fetch_prayer_calendar(2026, 2)))
+        assert len(times) == 28
+        assert len(requests) == 1
+        assert sorted(times)[0] == "2026-02-01" and sorted(times)[-1] == "2026-02-28"
+        for day in times.values():
+            assert set(day) == {"subuh", "dzuhur", "ashar", "maghrib", "isya"}
+            assert all(TIME_PATTERN.match(v) for v in day.values()), day
+        print("✓ Kalender 1 bulan diambil dengan 1 request")
+
+    def test_year_calendar_single_request(self):
+        times, requests = asyncio.run(with_stub(lambda: main.fetch_prayer_calendar(2028)))
+        assert len(times) == 366
+        assert len(requests) == 1
+        print("✓ Kalender 1 tahun diambil dengan 1 request")
+
+    def test_api_failure_returns_none(self):
+        calendar_times, requests = asyncio.run(with_stub(lambda: main.fetch_prayer_calendar(2026, 3), fail=True))
+        assert calendar_times is None
+        # 503 dicoba ulang oleh HTTP client bersama sebelum menyerah
+        assert len(requests) == main.HTTP_CLIENT_MAX_RETRIES + 1
+        print("✓ API gagal -> None (pemanggil memakai perkiraan lokal)")
+
+    @pytest.mark.parametrize("tanggal", ["2026-01-01", "2026-06-21", "2026-10-17", "2028-02-29"])
+    def test_local_approximation_is_ordered(self, tanggal):
+        times = main.compute_prayer_times(tanggal)
+        order = [times[k] for k in ("subuh", "dzuhur", "ashar", "maghrib", "isya")]
+        assert order == sorted(order), times
+        assert "04:00" <= times["subuh"] <= "05:30"
+        assert "11:30" <= times["dzuhur"] <= "12:15"
+        assert "17:30" <= times["maghrib"] <= "18:30"
+        print(f"✓ Perkiraan {tanggal}: {times}")
+
+    def test_fallback_does_not_overwrite_aladhan(self, fake_db):
+        aladhan = {"subuh": "04:21", "dzuhur": "11:52", "ashar": "15:02", "maghrib": "17:58", "isya": "19:07"}
+        fake_db.waktu_sholat.docs.append({"id": "w1", "tanggal": "2026-10-17", "sumber": "aladhan", **aladhan})
+        estimates = {t: main.compute_prayer_times(t) for t in ("2026-10-17", "2026-10-18")}
+
+        assert asyncio.run(main.upsert_waktu_sholat(estimates, "perkiraan")) == 2
+        docs = {d["tanggal"]: d for d in fake_db.waktu_sholat.docs}
+        assert docs["2026-10-17"] == {"id": "w1", "tanggal": "2026-10-17", "sumber": "aladhan", **aladhan}
+        assert docs["2026-10-18"]["sumber"] == "perkiraan" and docs["2026-10-18"]["subuh"] == estimates["2026-10-18"]["subuh"]
+
+        asyncio.run(main.upsert_waktu_sholat({"2026-10-18": aladhan}, "aladhan"))
+        assert docs["2026-10-18"]["sumber"] == "aladhan" and docs["2026-10-18"]["subuh"] == "04:21"
+        print("✓ Perkiraan hanya mengisi tanggal kosong; Aladhan menggantikan perkiraan")
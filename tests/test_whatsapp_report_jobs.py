@@ -0,0 +1,60 @@
+"""
+Test: pemulihan job rekap WhatsApp harian
+
+Tanpa server/MongoDB/bot: koleksi whatsapp_report_jobs memakai FakeDb dan
+runner job diganti fixture, lalu sweep di dispatcher diuji untuk:
+- job 'running' tanpa heartbeat (proses mati) diklaim ulang dan dijalankan
+- job yang task-nya hidup di worker ini di-heartbeat, tidak diklaim ulang
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+
+
+def ago(seconds):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).isoformat()
+
+
+@pytest.fixture
+def jobs(monkeypatch, fake_db):
+    started = []
+
+    monkeypatch.setattr(main, "WHATSAPP_BOT_URL", "http://bot.invalid/report")
+    monkeypatch.setattr(main, "_whatsapp_report_tasks", {})
+    monkeypatch.setattr(main, "_start_whatsapp_report_job", started.append)
+    fake_db.whatsapp_report_jobs.docs.extend([
+        {"id": "mati", "tanggal": "2026-10-16", "status": "running", "heartbeat_at": ago(main.WHATSAPP_REPORT_STALE_SECONDS + 30)},
+        {"id": "hidup", "tanggal": "2026-10-17", "status": "running", "heartbeat_at": ago(main.WHATSAPP_REPORT_STALE_SECONDS + 30)},
+        {"id": "selesai", "tanggal": "2026-10-15", "status": "completed", "heartbeat_at": ago(86400)},
+    ])
+    return started
+
+
+class TestWhatsappReportJobs:
+    """Job rekap WA yang ditinggal proses mati dilanjutkan oleh sweep berkala"""
+
+    def test_sweep_reclaims_orphans_only(self, jobs, fake_db):
+        main._whatsapp_report_tasks["hidup"] = object()
+
+        async def sweep():
+            await main.heartbeat_whatsapp_report_jobs()
+            return await main.resume_stale_whatsapp_report_jobs()
+
+        assert asyncio.run(sweep()) == 1
+        assert jobs == ["mati"]
+        docs = {d["id"]: d for d in fake_db.whatsapp_report_jobs.docs}
+        assert docs["hidup"]["heartbeat_at"] > ago(5), "Job milik worker ini tetap hidup lewat heartbeat"
+        assert docs["mati"]["heartbeat_at"] > ago(5) and docs["mati"]["status"] == "running"
+        assert docs["selesai"]["status"] == "completed"
+        print("✓ Sweep mengklaim ulang job yatim, job yang hidup hanya di-heartbeat")
+
+    def test_recent_heartbeat_not_reclaimed(self, jobs, fake_db):
+        for job in fake_db.whatsapp_report_jobs.docs:
+            job["heartbeat_at"] = ago(10)
+        assert asyncio.run(main.resume_stale_whatsapp_report_jobs()) == 0
+        assert jobs == []
+        print("✓ Job dengan heartbeat baru tidak diklaim worker lain")
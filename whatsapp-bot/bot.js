@@ -3,6 +3,9 @@
 // Bot ini menerima payload rekap harian dari backend FastAPI dan mengirim
 // 1 pesan per wali berisi ringkasan absensi 5 waktu sholat.
 
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
 const express = require('express');
 const cors = require('cors');
 const qrcode = require('qrcode-terminal');
@@ -12,6 +15,18 @@ require('dotenv').config();
 
 const PORT = process.env.WHATSAPP_BOT_PORT || 4000;
 
+// Antrian kirim (persisten di disk, JSONL)
+const QUEUE_FILE = process.env.WA_QUEUE_FILE || path.join(__dirname, 'data', 'queue.jsonl');
+// Token bucket: rata-rata pesan per menit + burst maksimum
+const RATE_PER_MINUTE = Number(process.env.WA_RATE_PER_MINUTE || 20);
+const RATE_BURST = Number(process.env.WA_RATE_BURST || 5);
+const MAX_ATTEMPTS = Number(process.env.WA_MAX_ATTEMPTS || 5);
+const RETRY_BASE_MS = 15 * 1000;
+const RETRY_MAX_MS = 15 * 60 * 1000;
+// Pesan sent/failed disimpan sekian jam agar statusnya masih bisa dicek backend
+const QUEUE_RETENTION_HOURS = Number(process.env.WA_QUEUE_RETENTION_HOURS || 48);
+const WORKER_IDLE_MS = 1000;
+
 let sock = null;
 let isConnected = false;
 
@@ -94,25 +109,186 @@ function normalizePhoneToJid(phone) {
   return `${cleaned}@s.whatsapp.net`;
 }
 
-async function sendReportBatch(batch) {
-  if (!sock || !isConnected) {
-    throw new Error('WhatsApp belum terhubung. Jalankan bot dan scan QR terlebih dahulu.');
+// ---------------------- Send queue ----------------------
+//
+// Setiap pesan adalah satu record { id, job_id, wali_nomor, jid, text, status,
+// attempts, next_attempt_at, last_error, ... } dengan status
+// pending -> sending -> sent | failed. Perubahan status ditulis append-only ke
+// QUEUE_FILE; saat start file di-replay (record terakhir per id yang berlaku),
+// jadi pesan yang belum terkirim tidak hilang kalau bot/Baileys mati di tengah batch.
+
+const queue = new Map();
+let queueLogLines = 0;
+
+function persistMessage(msg) {
+  fs.appendFileSync(QUEUE_FILE, JSON.stringify(msg) + '\n');
+  queueLogLines += 1;
+}
+
+function updateMessage(msg, changes) {
+  Object.assign(msg, changes, { updated_at: new Date().toISOString() });
+  persistMessage(msg);
+}
+
+function loadQueue() {
+  fs.mkdirSync(path.dirname(QUEUE_FILE), { recursive: true });
+  if (!fs.existsSync(QUEUE_FILE)) return;
+
+  const lines = fs.readFileSync(QUEUE_FILE, 'utf8').split('\n');
+  for (const line of lines) {
+    if (!line.trim()) continue;
+    try {
+      const msg = JSON.parse(line);
+      queue.set(msg.id, msg);
+    } catch (err) {
+      // Baris terakhir bisa terpotong kalau proses mati saat menulis
+      console.warn('Baris antrian rusak dilewati');
+    }
   }
 
-  const reports = batch.reports || [];
-  for (const rep of reports) {
+  // Pesan yang sedang dikirim saat proses mati dikirim ulang
+  for (const msg of queue.values()) {
+    if (msg.status === 'sending') msg.status = 'pending';
+  }
+  compactQueue();
+  console.log(`Antrian dimuat: ${queue.size} pesan (${countByStatus().pending} pending)`);
+}
+
+// Tulis ulang file hanya berisi state terakhir, buang pesan lama yang sudah selesai
+function compactQueue() {
+  const cutoff = Date.now() - QUEUE_RETENTION_HOURS * 3600 * 1000;
+  for (const [id, msg] of queue) {
+    if ((msg.status === 'sent' || msg.status === 'failed') && Date.parse(msg.updated_at) < cutoff) {
+      queue.delete(id);
+    }
+  }
+  const tmp = `${QUEUE_FILE}.tmp`;
+  fs.writeFileSync(tmp, [...queue.values()].map((m) => JSON.stringify(m) + '\n').join(''));
+  fs.renameSync(tmp, QUEUE_FILE);
+  queueLogLines = queue.size;
+}
+
+function maybeCompactQueue() {
+  if (queueLogLines > 1000 && queueLogLines > queue.size * 4) compactQueue();
+}
+
+function countByStatus(items = queue.values()) {
+  const counts = { pending: 0, sending: 0, sent: 0, failed: 0 };
+  for (const msg of items) counts[msg.status] = (counts[msg.status] || 0) + 1;
+  return counts;
+}
+
+/**
+ * Masukkan satu chunk rekap ke antrian. Ack ke backend berisi status per wali:
+ * { queued, failed, results: [ { wali_nomor, ok, status, error? }, ... ] }
+ * Pesan dengan job_id:wali_nomor yang sama tidak dimasukkan dua kali, sehingga
+ * chunk yang dikirim ulang backend tidak membuat wali menerima pesan ganda.
+ */
+function enqueueReportBatch(batch) {
+  const results = [];
+  for (const rep of batch.reports || []) {
+    const id = batch.job_id ? `${batch.job_id}:${rep.wali_nomor}` : crypto.randomUUID();
+    const existing = queue.get(id);
+    if (existing) {
+      results.push({ wali_nomor: rep.wali_nomor, ok: existing.status !== 'failed', status: existing.status, duplicate: true });
+      continue;
+    }
+
     const jid = normalizePhoneToJid(rep.wali_nomor);
     if (!jid) {
       console.warn('Nomor wali tidak valid, dilewati:', rep.wali_nomor);
+      results.push({ wali_nomor: rep.wali_nomor, ok: false, status: 'failed', error: 'Nomor wali tidak valid' });
       continue;
     }
 
-    const text = buildMessage(rep);
-    console.log('Mengirim pesan ke', jid);
-    await sock.sendMessage(jid, { text });
+    const now = new Date().toISOString();
+    const msg = {
+      id,
+      job_id: batch.job_id || null,
+      tanggal: batch.tanggal,
+      wali_nomor: rep.wali_nomor,
+      jid,
+      text: buildMessage(rep),
+      status: 'pending',
+      attempts: 0,
+      next_attempt_at: Date.now(),
+      last_error: null,
+      created_at: now,
+      updated_at: now,
+    };
+    queue.set(id, msg);
+    persistMessage(msg);
+    results.push({ wali_nomor: rep.wali_nomor, ok: true, status: 'pending' });
+  }
+
+  const queued = results.filter((r) => r.ok).length;
+  return { queued, failed: results.length - queued, results };
+}
+
+// Token bucket: kapasitas RATE_BURST, diisi RATE_PER_MINUTE token per menit
+const bucket = { tokens: RATE_BURST, refilledAt: Date.now() };
+
+function refillBucket() {
+  const now = Date.now();
+  bucket.tokens = Math.min(RATE_BURST, bucket.tokens + ((now - bucket.refilledAt) / 60000) * RATE_PER_MINUTE);
+  bucket.refilledAt = now;
+}
+
+async function takeToken() {
+  refillBucket();
+  while (bucket.tokens < 1) {
+    await sleep(((1 - bucket.tokens) * 60000) / RATE_PER_MINUTE);
+    refillBucket();
   }
+  bucket.tokens -= 1;
+}
+
+// Backoff eksponensial dengan jitter penuh supaya retry tidak datang serentak
+function retryDelayMs(attempts) {
+  const ceiling = Math.min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** (attempts - 1));
+  return Math.round(ceiling / 2 + Math.random() * (ceiling / 2));
+}
 
-  return { sent: reports.length };
+function nextDueMessage() {
+  const now = Date.now();
+  for (const msg of queue.values()) {
+    if (msg.status === 'pending' && msg.next_attempt_at <= now) return msg;
+  }
+  return null;
+}
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+async function sendQueueWorker() {
+  for (;;) {
+    const msg = isConnected ? nextDueMessage() : null;
+    if (!msg) {
+      await sleep(WORKER_IDLE_MS);
+      continue;
+    }
+
+    await takeToken();
+    if (!isConnected) continue;
+
+    updateMessage(msg, { status: 'sending', attempts: msg.attempts + 1 });
+    try {
+      console.log('Mengirim pesan ke', msg.jid);
+      await sock.sendMessage(msg.jid, { text: msg.text });
+      updateMessage(msg, { status: 'sent', last_error: null, sent_at: new Date().toISOString() });
+    } catch (err) {
+      console.error('Gagal kirim ke', msg.jid, err.message);
+      if (msg.attempts >= MAX_ATTEMPTS) {
+        updateMessage(msg, { status: 'failed', last_error: err.message });
+      } else {
+        updateMessage(msg, {
+          status: 'pending',
+          last_error: err.message,
+          next_attempt_at: Date.now() + retryDelayMs(msg.attempts),
+        });
+      }
+    }
+    maybeCompactQueue();
+  }
 }
 
 // ---------------------- Express HTTP API ----------------------
@@ -126,26 +302,49 @@ app.get('/status', (req, res) => {
   res.json({
     connected: isConnected,
     user: sock?.user || null,
+    queue: countByStatus(),
   });
 });
 
 // Endpoint yang dipanggil backend FastAPI
-// Payload mengikuti DailyWaliReportBatch dari backend
-app.post('/api/send-daily-report', async (req, res) => {
+// Payload mengikuti DailyWaliReportBatch dari backend. Pesan hanya dimasukkan ke
+// antrian (langsung di-ack), pengiriman sebenarnya berjalan di worker.
+app.post('/api/send-daily-report', (req, res) => {
   try {
     const batch = req.body;
     if (!batch || !Array.isArray(batch.reports)) {
       return res.status(400).json({ ok: false, error: 'Payload tidak valid' });
     }
 
-    const result = await sendReportBatch(batch);
-    res.json({ ok: true, ...result });
+    const result = enqueueReportBatch(batch);
+    res.json({ ok: true, job_id: batch.job_id || null, chunk_index: batch.chunk_index ?? null, ...result });
   } catch (err) {
-    console.error('Gagal mengirim batch WA:', err);
+    console.error('Gagal memasukkan batch WA ke antrian:', err);
     res.status(500).json({ ok: false, error: err.message });
   }
 });
 
+// Status antrian, bisa difilter per job_id dan/atau status
+app.get('/queue', (req, res) => {
+  const { job_id: jobId, status } = req.query;
+  const limit = Math.min(Number(req.query.limit) || 100, 1000);
+
+  let items = [...queue.values()];
+  if (jobId) items = items.filter((m) => m.job_id === jobId);
+  const counts = countByStatus(items);
+  if (status) items = items.filter((m) => m.status === status);
+
+  res.json({
+    connected: isConnected,
+    rate_per_minute: RATE_PER_MINUTE,
+    counts,
+    items: items.slice(0, limit).map(({ text, ...rest }) => rest),
+  });
+});
+
+loadQueue();
+sendQueueWorker();
+
 app.listen(PORT, () => {
   console.log(`WhatsApp Daily Report Bot listening on port ${PORT}`);
   startWhatsApp().catch((err) => console.error('Gagal start WhatsApp:', err));